@@ -150,6 +150,10 @@ PERSONID_CNP_FLAG_MINUS1 = 0.5
 # minimum flag
 PERSONID_UPFA_PPLMF = -1
 
+# find_personIDs_by_name_string: age in hours after which the in-memory
+# index of the gathered names is rebuilt from the database
+PERSONID_NAME_INDEX_MAX_AGE = 2
+
 
 #Tables Utils debug output
 TABLES_UTILS_DEBUG = False
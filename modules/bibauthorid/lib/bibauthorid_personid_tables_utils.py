@@ -27,7 +27,8 @@ import datetime
 import bibauthorid_config as bconfig
 
 from bibauthorid_utils import split_name_parts, create_normalized_name, create_canonical_name
-from bibauthorid_utils import clean_name_string, get_field_values_on_condition
+from bibauthorid_utils import get_field_values_on_condition
+from bibauthorid_utils import PersonNameIndex
 from bibauthorid_authorname_utils import soft_compare_names
 from bibauthorid_tables_utils import get_bibrefs_from_name_string
 
@@ -47,6 +48,7 @@ except ImportError:
 #    from invenio.webuser import collect_user_info
 
 DATA_CACHERS = []
+NAME_INDEX_CACHERS = []
 
 
 class PersonIDStatusDataCacher(DataCacher):
@@ -74,6 +76,40 @@ class PersonIDStatusDataCacher(DataCacher):
         DataCacher.__init__(self, cache_filler, timestamp_verifier)
 
 
+class PersonNameIndexDataCacher(DataCacher):
+    '''
+    Data Cacher holding the index of the names gathered for each person
+    '''
+    def __init__(self):
+        def cache_filler():
+            return PersonNameIndex(run_sql("select personid, data, flag "
+                                           "from aidPERSONID "
+                                           "where tag='gathered_name'"))
+
+        def timestamp_verifier():
+            dt = datetime.datetime.now()
+            td = dt - datetime.timedelta(
+                            hours=bconfig.PERSONID_NAME_INDEX_MAX_AGE)
+            return td.strftime("%Y-%m-%d %H:%M:%S")
+
+        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+
+
+def get_person_name_index():
+    '''
+    Returns the index of the names gathered for each person, rebuilding it
+    if it is too old
+
+    @return: the name index
+    @rtype: PersonNameIndex
+    '''
+    if not NAME_INDEX_CACHERS:
+        NAME_INDEX_CACHERS.append(PersonNameIndexDataCacher())
+
+    NAME_INDEX_CACHERS[0].recreate_cache_if_needed()
+    return NAME_INDEX_CACHERS[0].cache
+
+
 def create_new_person(uid, uid_is_owner=False):
         #creates a new person
         pid = run_sql("select max(personid) from aidPERSONID")[0][0]
@@ -872,79 +908,32 @@ def find_personIDs_by_name_string(namestring, strict=False):
     An ordered list (per compatibility) of pids and found names is returned.
     '''
     canonical = []
-    use_index = True
 
     try:
         canonical = run_sql("select personid,data from aidPERSONID use index (`tdf-b`) where data like %s and tag=%s", (namestring+'%','canonical_name'))
     except (ProgrammingError, OperationalError):
         canonical = run_sql("select personid,data from aidPERSONID where data like %s and tag=%s", (namestring+'%','canonical_name'))
-        use_index = False
 
     namestring_parts = split_name_parts(namestring)
-
-#   The following lines create the regexp used in the query.
-    surname = clean_name_string(namestring_parts[0],
-#                                replacement=".{0,3}",
-                                replacement="%",
-                                keep_whitespace=False,
-                                trim_whitespaces=True)
-    surname = surname + ',%'
-    matching_pids_names_tuple = []
-
-    if use_index:
-        matching_pids_names_tuple = run_sql("select o.personid, o.data, o.flag from aidPERSONID o use index (`ptf-b`), "
-                                            "(select distinct i.personid as ipid from aidPERSONID i use index (`tdf-b`) where i.tag='gathered_name' and i.data like %s)"
-                                            " as dummy where  o.tag='gathered_name' and o.personid = dummy.ipid",(surname,))
-#        matching_pids_names_tuple = run_sql("select personid, data, flag from aidPERSONID use index (`ptf-b`) "
-#                                            "where  tag=\'gathered_name\' and personid in "
-#                                            "(select distinct personid from aidPERSONID use index (`tdf-b`) "
-#                                            "where tag=\'gathered_name\' and data like %s)", (surname,))
-    else:
-        matching_pids_names_tuple = run_sql("select o.personid, o.data, o.flag from aidPERSONID o, "
-                                            "(select distinct i.personid as ipid from aidPERSONID i where i.tag='gathered_name' and i.data like %s)"
-                                            " as dummy where  o.tag='gathered_name' and o.personid = dummy.ipid",(surname,))
-#    print matching_pids_names_tuple
-    if len(matching_pids_names_tuple) == 0 and len(surname) >= 2:
-        surname = surname[0:len(surname) - 2] + '%,%'
-
-        if use_index:
-            matching_pids_names_tuple = run_sql("select o.personid, o.data, o.flag from aidPERSONID o use index (`ptf-b`), "
-                                            "(select distinct i.personid as ipid from aidPERSONID i use index (`tdf-b`) where i.tag='gathered_name' and i.data like %s)"
-                                            " as dummy where  o.tag='gathered_name' and o.personid = dummy.ipid",(surname,))
-        else:
-            matching_pids_names_tuple = run_sql("select o.personid, o.data, o.flag from aidPERSONID o, "
-                                            "(select distinct i.personid as ipid from aidPERSONID i where i.tag='gathered_name' and i.data like %s)"
-                                            " as dummy where  o.tag='gathered_name' and o.personid = dummy.ipid",(surname,))
-
-    if len(matching_pids_names_tuple) == 0 and len(surname) >= 2:
-        surname = '%' + surname[0:len(surname) - 2] + '%,%'
-
-        if use_index:
-            matching_pids_names_tuple = run_sql("select o.personid, o.data, o.flag from aidPERSONID o use index (`ptf-b`), "
-                                            "(select distinct i.personid as ipid from aidPERSONID i use index (`tdf-b`) where i.tag='gathered_name' and i.data like %s)"
-                                            " as dummy where  o.tag='gathered_name' and o.personid = dummy.ipid",(surname,))
-        else:
-            matching_pids_names_tuple = run_sql("select o.personid, o.data, o.flag from aidPERSONID o, "
-                                            "(select distinct i.personid as ipid from aidPERSONID i where i.tag='gathered_name' and i.data like %s)"
-                                            " as dummy where  o.tag='gathered_name' and o.personid = dummy.ipid",(surname,))
+    name_index = get_person_name_index()
 
     matching_pids = []
-#    print matching_pids_names_tuple
-    for name in matching_pids_names_tuple:
-        comparison = soft_compare_names(namestring, name[1])
-        matching_pids.append([name[0], name[1], name[2], comparison])
-#   matching_pids = sorted(matching_pids, key=lambda k: k[3], reverse=True)
-#    print matching_pids
-    persons = {}
+    for pid in name_index.find_persons(namestring_parts[0]):
+        for name, flag in name_index.get_person_names(pid):
+            comparison = soft_compare_names(namestring, name)
+            matching_pids.append([pid, name, flag, comparison])
+
     if len(canonical) > 0:
         for n in canonical:
             matching_pids.append([n[0],n[1], 1, 1])
+
+    persons = {}
     for n in matching_pids:
         if n[3] >= 0.4:
-            if n[0] not in persons:
-                persons[n[0]] = sorted([[p[1], p[2], p[3]] for p in  matching_pids if p[0] == n[0]],
-                                key=lambda k: k[2], reverse=True)
-#    print persons
+            persons.setdefault(n[0], []).append([n[1], n[2], n[3]])
+    for pnames in persons.itervalues():
+        pnames.sort(key=lambda k: k[2], reverse=True)
+
     porderedlist = []
     for i in persons.iteritems():
         porderedlist.append([i[0], i[1]])
@@ -967,6 +956,7 @@ def update_personID_names_string_set(PIDlist=[]):
     person.
     The gathering of names is an expensive operation for the database (many joins), so the operation
     is threaded so to have as many parallell queries as possible.
+    The name index of find_personIDs_by_name_string, if already built, is updated as well.
     '''
     if len(PIDlist) == 0:
         PIDlist = run_sql('SELECT DISTINCT `personid` FROM `aidPERSONID`')
@@ -1031,6 +1021,11 @@ def update_personID_names_string_set(PIDlist=[]):
                             + str(self.pid[0]) + ',\'gathered_name\',\"' + str(name)
                             + '\",\"' + str(self.namesdict[name]) + '\")')
 
+                # keep the name index of this process up to date
+                if NAME_INDEX_CACHERS:
+                    NAME_INDEX_CACHERS[0].cache.set_person_names(
+                                    int(self.pid[0]), self.namesdict)
+
             close_connection()
 #                else:
 #                    sys.stdout.write(str(self.pid) + ' not updating!')
@@ -126,12 +126,55 @@ class TestCompareNames(unittest.TestCase):
         self.assertEqual(0.0,
             bau.compare_names('', ''))
 
+class TestPersonNameIndex(unittest.TestCase):
+    """Test for the functionality of the index of person names"""
+
+    def setUp(self):
+        """Index the names of a few persons"""
+        self.index = baidu.PersonNameIndex([(1, 'Ellis, John', 3),
+                                            (1, 'Ellis, J.', 1),
+                                            (2, 'Ellison, Mark', 2),
+                                            (3, "t'Hooft, Gerard", 5),
+                                            (4, 'Van Ellis, Anna', 1),
+                                            (5, 'Nocomma Name', 1)])
+
+    def test_find_persons(self):
+        """bibauthorid - test name index lookups"""
+
+        self.assertEqual([1], self.index.find_persons('Ellis'))
+
+        self.assertEqual([2], self.index.find_persons('ellison'))
+
+        self.assertEqual([3], self.index.find_persons('T Hooft'))
+
+        self.assertEqual([1, 2], sorted(self.index.find_persons('Ell')))
+
+        self.assertEqual([4], self.index.find_persons('anellis'))
+
+        self.assertEqual([], self.index.find_persons('Nocomma'))
+
+        self.assertEqual([('Ellis, J.', 1), ('Ellis, John', 3)],
+            sorted(self.index.get_person_names(1)))
+
+    def test_set_person_names(self):
+        """bibauthorid - test name index updates"""
+
+        self.index.set_person_names(1, {'Smith, John': 3})
+        self.assertEqual([1], self.index.find_persons('Smith'))
+        self.assertEqual([2], self.index.find_persons('Ellis'))
+
+        self.index.set_person_names(2, {})
+        self.assertEqual([4], self.index.find_persons('Ellis'))
+        self.assertEqual([], self.index.get_person_names(2))
+        self.failIf('e' in self.index.trie)
+
 
 TEST_SUITE = make_test_suite(TestSplitNameParts,
                              TestCreateUnifiedNames,
                              TestCreateNormalizedName,
                              TestCleanNameString,
-                             TestCompareNames,)
+                             TestCompareNames,
+                             TestPersonNameIndex,)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE)
@@ -23,6 +23,7 @@ bibauthorid_utils
 
 import sys
 import re
+import threading
 
 import bibauthorid_config as bconfig
 import bibauthorid_structs as dat
@@ -485,3 +486,196 @@ def clean_name_string(namestring, replacement=" ", keep_whitespace=True,
 #    print namestring, "->", whitespace_removal.sub(" ", tmp).strip()
 
     return whitespace_removal.sub(" ", tmp).strip()
+
+
+def get_surname_key(surname):
+    '''
+    Normalizes a surname for the lookups in the PersonNameIndex: it is
+    lowercased and stripped of everything that is not a letter, a digit
+    or a dot. E.g. "t'Hooft" and "T Hooft" both give "thooft".
+
+    @param surname: the surname to normalize
+    @type surname: string
+
+    @return: the normalized surname
+    @rtype: string
+    '''
+    return clean_name_string(surname, replacement="",
+                             keep_whitespace=False).lower()
+
+
+class PersonNameIndex(object):
+    '''
+    In-memory index of the names gathered for each person (the
+    gathered_name rows of aidPERSONID), to find the persons by surname
+    without scanning the table.
+
+    The normalized surnames (see get_surname_key) are stored in a trie, for
+    exact and prefix lookups, and in trigram postings, for the lookups of
+    surnames containing a given string. The index is thread safe and can
+    be updated one person at a time with set_person_names.
+    '''
+
+    def __init__(self, rows=()):
+        '''
+        @param rows: the (personid, name, flag) rows to index
+        @type rows: iterable of tuples
+        '''
+        self.lock = threading.Lock()
+        self.names = {}             # pid -> {name: flag}
+        self.surname_pids = {}      # surname key -> {pid: number of names}
+        self.trie = {}              # char -> subtrie; '' -> surname key
+        self.trigrams = {}          # trigram -> set of surname keys
+        persons = {}
+        for pid, name, flag in rows:
+            persons.setdefault(pid, {})[name] = flag
+        for pid, names in persons.iteritems():
+            self._set_person_names(pid, names)
+
+    def set_person_names(self, pid, names):
+        '''
+        Replaces the indexed names of a person.
+
+        @param pid: the person id
+        @type pid: int
+        @param names: the names of the person, with their flags (occurrences)
+        @type names: dict {name: flag}
+        '''
+        self.lock.acquire()
+        try:
+            self._set_person_names(pid, names)
+        finally:
+            self.lock.release()
+
+    def get_person_names(self, pid):
+        '''
+        @param pid: the person id
+        @type pid: int
+
+        @return: the indexed names of the person, with their flags
+        @rtype: list of tuples [(name, flag)]
+        '''
+        self.lock.acquire()
+        try:
+            return self.names.get(pid, {}).items()
+        finally:
+            self.lock.release()
+
+    def find_persons(self, surname):
+        '''
+        Finds the persons having gathered a name with the given surname.
+        If there are none, the persons with a surname starting with it are
+        returned, and if there are still none, the persons with a surname
+        containing it.
+
+        @param surname: the surname to look for
+        @type surname: string
+
+        @return: the matching person ids
+        @rtype: list of int
+        '''
+        key = get_surname_key(surname)
+        self.lock.acquire()
+        try:
+            keys = []
+            if key in self.surname_pids:
+                keys = [key]
+            if not keys:
+                keys = self._find_prefixed(key)
+            if not keys:
+                keys = self._find_containing(key)
+            pids = {}
+            for k in keys:
+                pids.update(self.surname_pids[k])
+            return pids.keys()
+        finally:
+            self.lock.release()
+
+    def _set_person_names(self, pid, names):
+        for name in self.names.get(pid, {}):
+            key = self._get_name_surname_key(name)
+            if key is None:
+                continue
+            key_pids = self.surname_pids[key]
+            key_pids[pid] -= 1
+            if not key_pids[pid]:
+                del key_pids[pid]
+            if not key_pids:
+                del self.surname_pids[key]
+                self._remove_key(key)
+        if names:
+            self.names[pid] = dict(names)
+        elif pid in self.names:
+            del self.names[pid]
+        for name in names:
+            key = self._get_name_surname_key(name)
+            if key is None:
+                continue
+            if key not in self.surname_pids:
+                self.surname_pids[key] = {}
+                self._add_key(key)
+            key_pids = self.surname_pids[key]
+            key_pids[pid] = key_pids.get(pid, 0) + 1
+
+    def _get_name_surname_key(self, name):
+        # only names with an explicit surname, 'surname, names', are found
+        # by surname, as they were by the LIKE 'surname,%' queries
+        if ',' not in name:
+            return None
+        return get_surname_key(string_partition(name, ',')[0])
+
+    def _add_key(self, key):
+        node = self.trie
+        for char in key:
+            node = node.setdefault(char, {})
+        node[''] = key
+        for trigram in self._get_trigrams(key):
+            self.trigrams.setdefault(trigram, set()).add(key)
+
+    def _remove_key(self, key):
+        path = [self.trie]
+        for char in key:
+            path.append(path[-1][char])
+        del path[-1]['']
+        # prune the branches left empty
+        for i in range(len(key) - 1, -1, -1):
+            if path[i + 1]:
+                break
+            del path[i][key[i]]
+        for trigram in self._get_trigrams(key):
+            keys = self.trigrams[trigram]
+            keys.discard(key)
+            if not keys:
+                del self.trigrams[trigram]
+
+    def _get_trigrams(self, key):
+        return set([key[i:i + 3] for i in range(len(key) - 2)])
+
+    def _find_prefixed(self, prefix):
+        node = self.trie
+        for char in prefix:
+            if char not in node:
+                return []
+            node = node[char]
+        keys = []
+        nodes = [node]
+        while nodes:
+            node = nodes.pop()
+            for char, child in node.iteritems():
+                if char:
+                    nodes.append(child)
+                else:
+                    keys.append(child)
+        return keys
+
+    def _find_containing(self, substring):
+        if len(substring) < 3:
+            candidates = self.surname_pids.keys()
+        else:
+            postings = [self.trigrams.get(trigram, set())
+                        for trigram in self._get_trigrams(substring)]
+            postings.sort(key=len)
+            candidates = postings[0]
+            for keys in postings[1:]:
+                candidates = candidates & keys
+        return [key for key in candidates if substring in key]
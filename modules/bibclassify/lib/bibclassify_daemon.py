@@ -28,12 +28,14 @@ This is not clean and should be fixed.
 import sys
 import time
 import os
+from itertools import imap
 
 from invenio.dbquery import run_sql
 from invenio.bibtask import task_init, write_message, task_update_progress, \
     task_set_option, task_get_option, task_sleep_now_if_required, \
     task_get_task_param
-from invenio.bibclassify_engine import output_keywords_for_local_file
+from invenio.bibclassify_engine import output_keywords_for_local_file, \
+    load_taxonomy
 from invenio.config import CFG_BINDIR, CFG_TMPDIR
 from invenio.intbitset import intbitset
 from invenio.search_engine import get_collection_reclist
@@ -41,6 +43,12 @@ from invenio.bibdocfile import BibRecDocs
 from invenio.bibclassify_text_extractor import is_pdf
 from invenio.config import CFG_VERSION
 
+try:
+    import multiprocessing
+    MP_ENABLED = True
+except ImportError:
+    MP_ENABLED = False
+
 # Global variables allowing to retain the progress of the task.
 _INDEX = 0
 _RECIDS_NUMBER = 0
@@ -56,18 +64,22 @@ def bibclassify_daemon():
             "task.\nExamples:\n"
             "    $ bibclassify\n"
             "    $ bibclassify -i 79 -k HEP\n"
-            "    $ bibclassify -c 'Articles' -k HEP\n",
+            "    $ bibclassify -c 'Articles' -k HEP\n"
+            "    $ bibclassify -c 'Articles' -k HEP --parallel=4\n",
         help_specific_usage="  -i, --recid\t\tkeywords are extracted from "
         "this record\n"
         "  -c, --collection\t\tkeywords are extracted from this collection\n"
-        "  -k, --taxonomy\t\tkeywords are based on that reference",
+        "  -k, --taxonomy\t\tkeywords are based on that reference\n"
+        "  --parallel=N\t\tanalyze the records in N processes in parallel "
+        "(default 1)",
         version="Invenio v%s" % CFG_VERSION,
         specific_params=("i:c:k:f",
             [
              "recid=",
              "collection=",
              "taxonomy=",
-             "force"
+             "force",
+             "parallel="
             ]),
         task_submit_elaborate_specific_parameter_fnc=
             _task_submit_elaborate_specific_parameter,
@@ -218,6 +230,16 @@ def _task_submit_elaborate_specific_parameter(key, value, opts, args):
         task_set_option("taxonomy", value)
     elif key in ("-f", "--force"):
         task_set_option("force", True)
+    elif key in ("--parallel",):
+        try:
+            parallel = int(value)
+        except ValueError:
+            parallel = 0
+        if parallel < 1:
+            write_message("ERROR: --parallel expects a positive number of "
+                "processes, not '%s'." % value, stream=sys.stderr, verbose=0)
+            return False
+        task_set_option("parallel", parallel)
     else:
         return False
 
@@ -324,33 +346,64 @@ def _analyze_documents(records, ontology, collection):
             collection, stream=sys.stderr, verbose=2)
         return False
 
+    # Load the taxonomy before forking, so that the worker processes
+    # share it instead of reading it again.
+    load_taxonomy(ontology)
+
+    pool = None
+    parallel = task_get_option('parallel', 1)
+    if parallel > 1 and len(records) > 1 and MP_ENABLED:
+        # each worker process opens its own database connection
+        write_message("INFO: Analyzing records in %s processes." % parallel,
+            stream=sys.stderr, verbose=3)
+        pool = multiprocessing.Pool(parallel)
+        results = pool.imap(_analyze_record_worker,
+            [(record, ontology) for record in records])
+    else:
+        results = imap(_analyze_record_worker,
+            [(record, ontology) for record in records])
+
     # Process records:
     output = []
-    for record in records:
-        bibdocfiles = BibRecDocs(record).list_latest_files()
-        output.append('<record>')
-        output.append('<controlfield tag="001">%s</controlfield>' % record)
-        for doc in bibdocfiles:
-            # Get the keywords for each PDF document contained in the record.
-            if is_pdf(doc.get_full_path()):
-                write_message('INFO: Generating keywords for record %d.' %
-                    record, stream=sys.stderr, verbose=3)
-                fulltext = doc.get_full_path()
-
-                output.append(output_keywords_for_local_file(fulltext,
-                    taxonomy=ontology, output_mode="marcxml", output_limit=3,
-                    match_mode="partial", with_author_keywords=True,
-                    verbose=task_get_option('verbose')))
-
+    for record_output in results:
+        output.append(record_output)
         _INDEX += 1
 
-        output.append('</record>')
-
         task_update_progress('Done %d out of %d.' % (_INDEX, _RECIDS_NUMBER))
         task_sleep_now_if_required(can_stop_too=False)
 
+    if pool:
+        pool.close()
+        pool.join()
+
     return '\n'.join(output)
 
+def _analyze_record(record, ontology):
+    """Returns the MARCXML of the keywords of the documents attached to
+    the record."""
+    bibdocfiles = BibRecDocs(record).list_latest_files()
+    output = []
+    output.append('<record>')
+    output.append('<controlfield tag="001">%s</controlfield>' % record)
+    for doc in bibdocfiles:
+        # Get the keywords for each PDF document contained in the record.
+        if is_pdf(doc.get_full_path()):
+            write_message('INFO: Generating keywords for record %d.' %
+                record, stream=sys.stderr, verbose=3)
+            fulltext = doc.get_full_path()
+
+            output.append(output_keywords_for_local_file(fulltext,
+                taxonomy=ontology, output_mode="marcxml", output_limit=3,
+                match_mode="partial", with_author_keywords=True,
+                verbose=task_get_option('verbose')))
+    output.append('</record>')
+
+    return '\n'.join(output)
+
+def _analyze_record_worker(args):
+    """Call _analyze_record() with ARGS in a worker process."""
+    return _analyze_record(*args)
+
 def _task_submit_check_options():
     """Required by bibtask. Checks the options."""
     recids = task_get_option('recids')
@@ -66,10 +66,7 @@ def output_keywords_for_sources(input_sources, taxonomy, rebuild_cache=False,
         set_verbose_level(verbose)
 
     # Initialize cache
-    global _SKWS
-    global _CKWS
-    _SKWS, _CKWS = get_regular_expressions(taxonomy, rebuild=rebuild_cache,
-        no_cache=no_cache)
+    load_taxonomy(taxonomy, rebuild_cache=rebuild_cache, no_cache=no_cache)
 
     # Get the fulltext for each source.
     for entry in input_sources:
@@ -123,6 +120,14 @@ def output_keywords_for_sources(input_sources, taxonomy, rebuild_cache=False,
             else:
                 print keywords
 
+def load_taxonomy(taxonomy, rebuild_cache=False, no_cache=False):
+    """Loads the keywords of the taxonomy used by the next keyword
+    extractions. Processes forked afterwards share the loaded keywords."""
+    global _SKWS
+    global _CKWS
+    _SKWS, _CKWS = get_regular_expressions(taxonomy, rebuild=rebuild_cache,
+        no_cache=no_cache)
+
 def output_keywords_for_local_file(local_file, taxonomy, rebuild_cache=False,
     output_mode="text", output_limit=CFG_BIBCLASSIFY_DEFAULT_OUTPUT_NUMBER,
     match_mode="full", no_cache=False, with_author_keywords=False,
@@ -31,6 +31,7 @@ import time
 
 try:
     from bibclassify_config import CFG_BIBCLASSIFY_VALID_SEPARATORS, \
+        CFG_BIBCLASSIFY_WORD_WRAP, \
         CFG_BIBCLASSIFY_AUTHOR_KW_START, \
         CFG_BIBCLASSIFY_AUTHOR_KW_END, \
         CFG_BIBCLASSIFY_AUTHOR_KW_SEPARATION
@@ -49,41 +50,98 @@ except ImportError:
 _MAXIMUM_SEPARATOR_LENGTH = max([len(_separator)
     for _separator in CFG_BIBCLASSIFY_VALID_SEPARATORS])
 
+# Every single keyword regular expression is wrapped by
+# CFG_BIBCLASSIFY_WORD_WRAP: the part before the label is used to find
+# the positions where a keyword may start.
+_WORD_WRAP_START = CFG_BIBCLASSIFY_WORD_WRAP.split("%s")[0]
+_word_start = re.compile(_WORD_WRAP_START)
+_case_insensitive_letter = re.compile(r"\[(\w)(\w)\]")
+
+# Length of the anchor prefix used as key in the keyword index. Regular
+# expressions whose literal prefix is shorter are run on the whole text.
+_ANCHOR_KEY_LENGTH = 3
+
+# Keyword indexes already built, by id of the list of single keywords.
+_single_keyword_indexes = {}
+
+def build_single_keyword_index(skw_db):
+    """Returns the index of the single keywords used by
+    get_single_keywords.
+
+    The index is a tuple (anchors, fallback). Each regular expression of
+    the single keywords is stored in anchors under the first letters of
+    the literal text any of its matches starts with, as a list of
+    (anchor, keyword position in skw_db, regex). Regular expressions
+    without such a literal prefix are stored in fallback as
+    (keyword position in skw_db, regex)."""
+    anchors = {}
+    fallback = []
+    for skw_position, single_keyword in enumerate(skw_db):
+        for regex in single_keyword.regex:
+            anchor = _get_anchor(regex.pattern)
+            if len(anchor) >= _ANCHOR_KEY_LENGTH:
+                anchors.setdefault(anchor[:_ANCHOR_KEY_LENGTH],
+                    []).append((anchor, skw_position, regex))
+            else:
+                fallback.append((skw_position, regex))
+    return (anchors, fallback)
+
+def set_single_keyword_index(skw_db, index):
+    """Stores the index of the single keywords skw_db, e.g. as read from
+    the ontology cache."""
+    _single_keyword_indexes[id(skw_db)] = (skw_db, index)
+
+def get_single_keyword_index(skw_db):
+    """Returns the index of the single keywords skw_db, building it if
+    it was not stored yet."""
+    try:
+        return _single_keyword_indexes[id(skw_db)][1]
+    except KeyError:
+        index = build_single_keyword_index(skw_db)
+        set_single_keyword_index(skw_db, index)
+        return index
+
 def get_single_keywords(skw_db, fulltext, verbose=True):
     """Returns a dictionary of single keywords bound with the positions
     of the matches in the fulltext.
     Format of the output dictionary is (single keyword: positions)."""
     timer_start = time.clock()
 
-    # Matched span -> single keyword
-    records = []
-
-    for single_keyword in skw_db:
-        for regex in single_keyword.regex:
-            for match in regex.finditer(fulltext):
-                # Modify the right index to put it on the last letter
-                # of the word.
-                span = (match.span()[0], match.span()[1] - 1)
-
-                # Remove the previous records contained by this span
-                records = [record for record in records
-                                  if not _contains_span(span, record[0])]
-
-                add = True
-                for previous_record in records:
-                    if ((span, single_keyword) == previous_record or
-                        _contains_span(previous_record[0], span)):
-                        # Match is contained by a previous match.
-                        add = False
-                        break
-
-                if add:
-                    records.append((span, single_keyword))
+    anchors, fallback = get_single_keyword_index(skw_db)
+
+    # Matched (start, end, keyword position in skw_db)
+    matches = {}
+
+    for skw_position, regex in fallback:
+        for match in regex.finditer(fulltext):
+            # Modify the right index to put it on the last letter
+            # of the word.
+            matches[(match.start(), match.end() - 1, skw_position)] = None
+
+    # Run the other regular expressions only where the text starts with
+    # their anchor. The matches of each regex are kept non-overlapping,
+    # as finditer does.
+    lowered = fulltext.lower()
+    last_ends = {}
+    for word_start in _word_start.finditer(fulltext):
+        start, position = word_start.span()
+        candidates = anchors.get(lowered[position:position +
+            _ANCHOR_KEY_LENGTH])
+        if not candidates:
+            continue
+        for anchor, skw_position, regex in candidates:
+            if (start >= last_ends.get(regex, 0) and
+                lowered.startswith(anchor, position)):
+                match = regex.match(fulltext, start)
+                if match is not None:
+                    last_ends[regex] = match.end()
+                    matches[(start, match.end() - 1, skw_position)] = None
 
     # List of single_keywords: {spans: single keyword}
     single_keywords = {}
-    for span, single_keyword in records:
-        single_keywords.setdefault(single_keyword, []).append(span)
+    for start, end, skw_position in _remove_contained_spans(matches.keys()):
+        single_keywords.setdefault(skw_db[skw_position],
+            []).append((start, end))
 
     if verbose:
         write_message("INFO: Matching single keywords... %d keywords found "
@@ -257,10 +315,89 @@ def _get_ckw_span(fulltext, spans):
     # There is no inclusion.
     return None
 
-def _contains_span(span0, span1):
-    """Return true if span0 contains span1, False otherwise."""
-    if (span0 == span1 or
-        span0[0] > span1[0] or
-        span0[1] < span1[1]):
-        return False
-    return True
+def _get_anchor(pattern):
+    """Returns the lowercased literal text every match of the single
+    keyword regex pattern starts with, right after the word wrapping
+    character. Returns an empty string if there is none."""
+    if not pattern.startswith(_WORD_WRAP_START):
+        return ""
+    label = pattern[len(_WORD_WRAP_START):]
+
+    # An alternative at the top level makes any prefix optional.
+    depth = 0
+    in_class = False
+    index = 0
+    while index < len(label):
+        char = label[index]
+        if char == "\\":
+            index += 1
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return ""
+        index += 1
+
+    anchor = []
+    index = 0
+    while index < len(label):
+        char = label[index]
+        if char == "[":
+            # Only a letter accepting both cases, as produced by
+            # _capitalize_first_letter.
+            match = _case_insensitive_letter.match(label, index)
+            if (match is None or match.group(1) == match.group(2) or
+                match.group(1).lower() != match.group(2).lower()):
+                break
+            literal = match.group(1).lower()
+            next_index = match.end()
+        elif char == "\\":
+            if index + 1 == len(label) or label[index + 1].isalnum():
+                break
+            literal = label[index + 1]
+            next_index = index + 2
+        elif char in ".^$*+?{}()|]":
+            break
+        else:
+            literal = char.lower()
+            next_index = index + 1
+
+        if next_index < len(label) and label[next_index] in "?*{":
+            # The literal is optional.
+            break
+        anchor.append(literal)
+        if next_index < len(label) and label[next_index] == "+":
+            break
+        index = next_index
+
+    return "".join(anchor)
+
+def _remove_contained_spans(matches):
+    """Returns the matches (start, end, keyword) whose span is not
+    strictly contained by the span of another match."""
+    matches = list(matches)
+    # Sort by start, longest span first: a span is contained by another
+    # span iff one of the previous spans ends after it.
+    matches.sort(key=lambda match: (match[0], -match[1], match[2]))
+
+    out = []
+    max_end = -1
+    index = 0
+    while index < len(matches):
+        start, end = matches[index][0], matches[index][1]
+        next_index = index + 1
+        while (next_index < len(matches) and
+               matches[next_index][0] == start and
+               matches[next_index][1] == end):
+            next_index += 1
+        if end > max_end:
+            out.extend(matches[index:next_index])
+            max_end = end
+        index = next_index
+
+    return out
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2007, 2008, 2009, 2010, 2011 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""BibClassify keyword analyzer unit tests."""
+
+import unittest
+
+from invenio.bibclassify_ontology_reader import SingleKeyword
+from invenio.bibclassify_keyword_analyzer import get_single_keywords, \
+    build_single_keyword_index, _get_anchor
+from invenio.testutils import make_test_suite, run_test_suite
+
+class BibClassifySingleKeywordsTest(unittest.TestCase):
+    """Test the matching of single keywords."""
+
+    def setUp(self):
+        """Create a few single keywords."""
+        self.skw_db = [SingleKeyword(label) for label in
+                       ("quark", "quark gluon plasma", "gluon", "CERN",
+                        "W", "x-ray")]
+
+    def test_get_anchor(self):
+        """bibclassify - literal anchor of keyword regular expressions"""
+        self.assertEqual("quark", _get_anchor("[^\\w-][qQ]uarks?[^\\w-]"))
+        self.assertEqual("higgs", _get_anchor("[^\\w-]Higgs('?s)?[^\\w-]"))
+        self.assertEqual("e+", _get_anchor("[^\\w-]e\\+\\s?[aA]nnihilations?[^\\w-]"))
+        self.assertEqual("", _get_anchor("[^\\w-]colou?r|flavou?r[^\\w-]"))
+        self.assertEqual("", _get_anchor("[^\\w-](?i)lattice[^\\w-]"))
+
+    def test_build_single_keyword_index(self):
+        """bibclassify - single keyword index"""
+        anchors, fallback = build_single_keyword_index(self.skw_db)
+        self.assertEqual(["cer", "glu", "qua"], sorted(anchors.keys()))
+        self.assertEqual(2, len(anchors["qua"]))
+        self.assertEqual([4, 5], sorted([position for position, regex in
+                                         fallback]))
+
+    def test_get_single_keywords(self):
+        """bibclassify - matching of single keywords"""
+        text = " quarks and gluons at CERN: a quark-gluon plasma, W and x-rays "
+        single_keywords = get_single_keywords(self.skw_db, text, verbose=False)
+        found = dict([(skw.concept, spans) for skw, spans in
+                      single_keywords.items()])
+        # Spans contained by the composite label match are discarded.
+        self.assertEqual({"quark": [(0, 7)],
+                          "gluon": [(11, 18)],
+                          "CERN": [(21, 26)],
+                          "quark gluon plasma": [(29, 48)],
+                          "W": [(49, 51)],
+                          "x-ray": [(55, 62)]}, found)
+
+TEST_SUITE = make_test_suite(BibClassifySingleKeywordsTest)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
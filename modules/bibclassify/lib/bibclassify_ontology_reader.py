@@ -55,6 +55,8 @@ try:
         CFG_BIBCLASSIFY_GENERAL_REGULAR_EXPRESSIONS, \
         CFG_BIBCLASSIFY_SEPARATORS, CFG_BIBCLASSIFY_SYMBOLS
     from bibclassify_utils import write_message
+    from bibclassify_keyword_analyzer import build_single_keyword_index, \
+        set_single_keyword_index
 except ImportError, err:
     print >> sys.stderr, "Import error: %s" % err
     sys.exit(0)
@@ -371,8 +373,13 @@ def _build_cache(source_file, no_cache=False):
 
         store.close()
 
+    # Index the single keywords for the keyword analyzer.
+    single_index = build_single_keyword_index(single_keywords)
+    set_single_keyword_index(single_keywords, single_index)
+
     cached_data = {}
     cached_data["single"] = single_keywords
+    cached_data["single_index"] = single_index
     cached_data["composite"] = composite_keywords
     cached_data["creation_time"] = time.gmtime()
 
@@ -482,6 +489,8 @@ def _get_cache(source_file):
 
     single_keywords = cached_data["single"]
     composite_keywords = cached_data["composite"]
+    if "single_index" in cached_data:
+        set_single_keyword_index(single_keywords, cached_data["single_index"])
 
     write_message("INFO: Found ontology cache created on %s." %
         time.asctime(cached_data["creation_time"]), stream=sys.stderr,
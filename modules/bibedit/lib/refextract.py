@@ -25,8 +25,17 @@ __revision__ = "$Id$"
 
 import sys, re
 import os, getopt
+import marshal
+import tempfile
+from itertools import imap
 from time import mktime, localtime, ctime
 
+try:
+    import multiprocessing
+    MP_ENABLED = True
+except ImportError:
+    MP_ENABLED = False
+
 # make refextract runnable without having to have done the full Invenio installation:
 try:
     from invenio.refextract_config \
@@ -108,6 +117,12 @@ except ImportError:
     CFG_PATH_GFILE='/usr/bin/file'
     CFG_PATH_PDFTOTEXT='/usr/bin/pdftotext'
 
+# make refextract runnable without having to have done the full Invenio installation:
+try:
+    from invenio.config import CFG_CACHEDIR
+except ImportError:
+    CFG_CACHEDIR = tempfile.gettempdir()
+
 # make refextract runnable without having to have done the full Invenio installation:
 try:
     from invenio.textutils import encode_for_xml
@@ -119,7 +134,19 @@ except ImportError:
         s = string.replace(s, '<', '&lt;')
         return s
 
-cli_opts = {}
+## Options of the extraction job. They are set from the command line by
+## get_cli_options; these defaults apply when refextract is used as a library:
+CFG_REFEXTRACT_DEFAULT_OPTIONS = { 'treat_as_reference_section' : 0,
+                                   'output_raw'                 : 0,
+                                   'verbosity'                  : 0,
+                                   'xmlfile'                    : 0,
+                                   'dictfile'                   : 0,
+                                   'inspire'                    : 0,
+                                   'kb-journal'                 : 0,
+                                   'kb-report-number'           : 0,
+                                   'parallel'                   : 1,
+                                 }
+cli_opts = CFG_REFEXTRACT_DEFAULT_OPTIONS.copy()
 
 ## The minimum length of a reference's misc text to be deemed insignificant.
 ## Values higher than this value reflect meaningful misc text.
@@ -817,6 +844,17 @@ re_title_followed_by_implied_series = \
 
 re_punctuation = re.compile(r'[\.\,\;\'\(\)\-]', re.UNICODE)
 
+## Characters making a report number category from the KB a regexp,
+## rather than a literal string:
+re_regexp_syntax_chars = re.compile(r'[\\\.\^\$\*\+\?\{\}\[\]\(\)\|]', re.UNICODE)
+
+## The start of a word (where a periodical title pattern may match):
+re_word_start = re.compile(r'(?<!\w)\w', re.UNICODE)
+
+## Length of the literal prefixes used to index the knowledge base
+## patterns (see KnowledgeBasePatterns):
+KB_INDEX_PREFIX_LENGTH = 3
+
 ## The following pattern is used to recognise "citation items" that have been
 ## identified in the line, when building a MARC XML representation of the line:
 re_tagged_citation = re.compile(r"""
@@ -1639,11 +1677,10 @@ def build_reportnum_knowledge_base(fpath):
                 search_pattern_str = r'[^a-zA-Z0-9\/\.\-]((?P<categ>' \
                                      + classification[0] + u')' \
                                      + numeration_regexp + r')'
-                re_search_pattern = re.compile(search_pattern_str, \
-                                                 re.UNICODE)
+                ## the pattern is compiled when it is first used:
                 preprint_reference_search_regexp_patterns[(kb_line_num, \
                                                           classification[0])] =\
-                                                          re_search_pattern
+                                                          search_pattern_str
                 standardised_preprint_reference_categories[(kb_line_num, \
                                                           classification[0])] =\
                                                           classification[1]
@@ -1664,6 +1701,13 @@ def build_reportnum_knowledge_base(fpath):
                                                      ## numeration patterns, as
                                                      ## read from the KB
 
+    cached_kb = load_kb_cache(fpath, 'reportnum')
+    if cached_kb is not None:
+        (preprint_reference_search_regexp_patterns, \
+         standardised_preprint_reference_categories) = cached_kb
+        return (make_reportnum_search_kb(preprint_reference_search_regexp_patterns), \
+                standardised_preprint_reference_categories)
+
     ## pattern to recognise an institute name line in the KB
     re_institute_name = re.compile(r'^\#{5}\s*(.+)\s*\#{5}$', re.UNICODE)
 
@@ -1750,11 +1794,32 @@ def build_reportnum_knowledge_base(fpath):
         sys.stderr.flush()
         sys.exit(1)
 
+    write_kb_cache(fpath, 'reportnum', \
+                   (preprint_reference_search_regexp_patterns, \
+                    standardised_preprint_reference_categories))
+
     ## return the preprint reference patterns and the replacement strings
     ## for non-standard categ-strings:
-    return (preprint_reference_search_regexp_patterns, \
+    return (make_reportnum_search_kb(preprint_reference_search_regexp_patterns), \
             standardised_preprint_reference_categories)
 
+def make_reportnum_search_kb(patterns):
+    """Make the KnowledgeBasePatterns of the preprint report number
+       patterns built by build_reportnum_knowledge_base.
+       The category string of a pattern is used as its literal, unless it
+       contains regexp syntax.
+       @param patterns: (dictionary) of regexp strings, keyed by
+        (KB line number, category search string).
+       @return: (KnowledgeBasePatterns) the search patterns.
+    """
+    literals = {}
+    for key in patterns.keys():
+        if re_regexp_syntax_chars.search(key[1]) is None:
+            literals[key] = key[1]
+        else:
+            literals[key] = None
+    return KnowledgeBasePatterns(patterns, literals)
+
 def build_titles_knowledge_base(fpath):
     """Given the path to a knowledge base file, read in the contents
        of that file into a dictionary of search->replace word phrases.
@@ -1810,6 +1875,11 @@ def build_titles_knowledge_base(fpath):
     ## by the KB:
     repl_terms = {}
 
+    cached_kb = load_kb_cache(fpath, 'titles')
+    if cached_kb is not None:
+        (kb, standardised_titles, seek_phrases) = cached_kb
+        return (make_titles_search_kb(kb), standardised_titles, seek_phrases)
+
     ## Pattern to recognise a correct knowledge base line:
     p_kb_line = re.compile('^\s*(?P<seek>[^\s].*?)\s*---\s*(?P<repl>[^\s].*?)\s*$', \
                             re.UNICODE)
@@ -1845,10 +1915,10 @@ def build_titles_knowledge_base(fpath):
                 if len(seek_phrase) > 1:
                     ## add the phrase from the KB if the 'seek' phrase is longer
                     ## than 1 character:
-                    ## compile the seek phrase into a pattern:
-                    seek_ptn = re.compile(r'(?<!\/)\b(' + \
-                                           re.escape(seek_phrase) + \
-                                           r')[^A-Z0-9]', re.UNICODE)
+                    ## make a pattern of the seek phrase (compiled when
+                    ## first used):
+                    seek_ptn = r'(?<!\/)\b(' + re.escape(seek_phrase) + \
+                               r')[^A-Z0-9]'
                     if not kb.has_key(seek_phrase):
                         kb[seek_phrase] = seek_ptn
                         standardised_titles[seek_phrase] = \
@@ -1876,9 +1946,8 @@ def build_titles_knowledge_base(fpath):
             if not kb.has_key(raw_repl_phrase):
                 ## The replace-phrase was not in the KB as a seek phrase
                 ## It should be added.
-                seek_ptn = re.compile(r'(?<!\/)\b(' + \
-                                       re.escape(raw_repl_phrase) + \
-                                       r')[^A-Z0-9]', re.UNICODE)
+                seek_ptn = r'(?<!\/)\b(' + re.escape(raw_repl_phrase) + \
+                           r')[^A-Z0-9]'
                 kb[raw_repl_phrase] = seek_ptn
                 standardised_titles[raw_repl_phrase] = \
                                                  repl_term
@@ -1895,8 +1964,167 @@ def build_titles_knowledge_base(fpath):
         sys.stderr.flush()
         sys.exit(1)
 
+    write_kb_cache(fpath, 'titles', (kb, standardised_titles, seek_phrases))
+
     ## return the raw knowledge base:
-    return (kb, standardised_titles, seek_phrases)
+    return (make_titles_search_kb(kb), standardised_titles, seek_phrases)
+
+def make_titles_search_kb(patterns):
+    """Make the KnowledgeBasePatterns of the periodical title patterns
+       built by build_titles_knowledge_base.
+       The literal of a pattern is the title itself.
+       @param patterns: (dictionary) of regexp strings, keyed by title.
+       @return: (KnowledgeBasePatterns) the search patterns.
+    """
+    literals = {}
+    for title in patterns.keys():
+        literals[title] = title
+    return KnowledgeBasePatterns(patterns, literals)
+
+class KnowledgeBasePatterns(dict):
+    """The search patterns of a knowledge base (periodical titles or
+       preprint report numbers), as a dictionary of compiled regexps.
+
+       The patterns are stored as regexp strings and are compiled the
+       first time they are used, so that a job only compiles the patterns
+       of the citations it meets.
+
+       Each pattern may also have a literal: a string that is part of
+       every text it matches. The literals are used to select the few
+       patterns worth trying on a line, instead of running all of them.
+       Since the working line is only ever masked with underscores, a
+       pattern whose literal (without underscore) is not in the original
+       line cannot match the masked line either.
+    """
+    def __init__(self, patterns, literals):
+        """@param patterns: (dictionary) regexp strings or compiled
+            regexps, keyed like the knowledge base.
+           @param literals: (dictionary) of literal strings (or None if
+            a pattern has no literal), keyed like patterns.
+        """
+        dict.__init__(self, patterns)
+        self.literals = {}
+        self.always_tried = []
+        for key, literal in literals.items():
+            if literal and literal.find(u"_") == -1:
+                self.literals[key] = literal
+            else:
+                self.always_tried.append(key)
+        self.word_start_index = None
+
+    def __getitem__(self, key):
+        pattern = dict.__getitem__(self, key)
+        if isinstance(pattern, basestring):
+            pattern = re.compile(pattern, re.UNICODE)
+            self[key] = pattern
+        return pattern
+
+    def get_candidates(self, line):
+        """Return the keys of the patterns that may match the line: those
+           whose literal is found in the line.
+           @param line: (string) the working reference line.
+           @return: (dictionary) of candidate keys.
+        """
+        candidates = {}
+        for key in self.always_tried:
+            candidates[key] = None
+        for key, literal in self.literals.iteritems():
+            if line.find(literal) != -1:
+                candidates[key] = None
+        return candidates
+
+    def get_candidates_at_word_starts(self, line):
+        """Return the keys of the patterns that may match the line, for
+           patterns that start with their literal at a word boundary
+           (like the periodical title patterns): those whose literal is
+           found at the start of a word of the line.
+           The literals are indexed by their first characters, so that
+           only a few of them have to be compared at each word start.
+           @param line: (string) the working reference line.
+           @return: (dictionary) of candidate keys.
+        """
+        if self.word_start_index is None:
+            self._build_word_start_index()
+        candidates = {}
+        for key in self.always_tried:
+            candidates[key] = None
+        for word_start in re_word_start.finditer(line):
+            position = word_start.start()
+            for prefix_len in (KB_INDEX_PREFIX_LENGTH, KB_INDEX_PREFIX_LENGTH - 1):
+                for key, literal in self.word_start_index.get( \
+                      line[position:position + prefix_len], ()):
+                    if line.startswith(literal, position):
+                        candidates[key] = None
+        return candidates
+
+    def _build_word_start_index(self):
+        """Index the literals by their KB_INDEX_PREFIX_LENGTH first
+           characters (or by the whole literal, if it is shorter) for
+           get_candidates_at_word_starts.  Literals that do not start
+           with a word character are always tried.
+        """
+        self.word_start_index = {}
+        for key, literal in self.literals.items():
+            if len(literal) < KB_INDEX_PREFIX_LENGTH - 1 or \
+                   re_word_start.match(literal) is None:
+                del self.literals[key]
+                self.always_tried.append(key)
+            else:
+                self.word_start_index.setdefault( \
+                    literal[:KB_INDEX_PREFIX_LENGTH], []).append((key, literal))
+
+def get_kb_cache_path(fpath, kind):
+    """Return the path of the file caching the knowledge base FPATH.
+       @param fpath: (string) the path to the knowledge base file.
+       @param kind: (string) the kind of knowledge base: 'titles' or
+        'reportnum'.
+       @return: (string) the path to the cache file.
+    """
+    return os.path.join(CFG_CACHEDIR, 'refextract', '%s.%s.cache' % \
+                        (os.path.basename(fpath), kind))
+
+def load_kb_cache(fpath, kind):
+    """Read the knowledge base FPATH from its cache file, if the cache was
+       written from the current version of the KB file.
+       @param fpath: (string) the path to the knowledge base file.
+       @param kind: (string) the kind of knowledge base: 'titles' or
+        'reportnum'.
+       @return: the cached knowledge base, or None.
+    """
+    try:
+        kb_mtime = os.path.getmtime(fpath)
+        fh = open(get_kb_cache_path(fpath, kind), "rb")
+        try:
+            (cached_fpath, cached_mtime, cached_kb) = marshal.load(fh)
+        finally:
+            fh.close()
+    except (IOError, OSError, EOFError, ValueError, TypeError):
+        return None
+    if cached_fpath != os.path.abspath(fpath) or cached_mtime != kb_mtime:
+        return None
+    return cached_kb
+
+def write_kb_cache(fpath, kind, kb):
+    """Write the knowledge base FPATH, as built from the KB file, into its
+       cache file.  Failing to write the cache is not an error.
+       @param fpath: (string) the path to the knowledge base file.
+       @param kind: (string) the kind of knowledge base: 'titles' or
+        'reportnum'.
+       @param kb: the knowledge base: marshallable, e.g. with its regexps
+        as strings.
+    """
+    cache_path = get_kb_cache_path(fpath, kind)
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(cache_path))
+        fh = os.fdopen(fd, "wb")
+        marshal.dump((os.path.abspath(fpath), os.path.getmtime(fpath), kb), fh)
+        fh.close()
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError):
+        pass
 
 def standardize_and_markup_numeration_of_citations_in_line(line):
     """Given a reference line, attempt to locate instances of citation
@@ -1986,6 +2214,12 @@ def identify_preprint_report_numbers(line,
     preprint_repnum_categs = preprint_repnum_standardised_categs.keys()
     preprint_repnum_categs.sort(_by_len)
 
+    ## only try the patterns that can match this line:
+    if isinstance(preprint_repnum_search_kb, KnowledgeBasePatterns):
+        candidates = preprint_repnum_search_kb.get_candidates(line)
+        preprint_repnum_categs = [categ for categ in preprint_repnum_categs \
+                                  if candidates.has_key(categ)]
+
     ## try to match preprint report numbers in the line:
     for categ in preprint_repnum_categs:
         ## search for all instances of the current report
@@ -2388,6 +2622,15 @@ def identify_periodical_titles(line,
     titles_count = {}             ## sum totals of each 'bad title found in
                                   ## line.
 
+    ## only try the titles that can be found in this line, keeping
+    ## the order of the search keys (longest titles first):
+    if isinstance(periodical_title_search_kb, KnowledgeBasePatterns):
+        candidates = \
+            periodical_title_search_kb.get_candidates_at_word_starts(line)
+        periodical_title_search_keys = [title for title in \
+                                        periodical_title_search_keys \
+                                        if candidates.has_key(title)]
+
     ## Begin searching:
     for title in periodical_title_search_keys:
         ## search for all instances of the current periodical title
@@ -5665,8 +5908,12 @@ def usage(wmsg="", err_code=0):
    -n, --kb-report-number
                   manually specify the location of a report number knowledge-
                   base file.
+   -p, --parallel
+                  number of processes to extract the references of the given
+                  documents with (default 1).
 
   Example: refextract -x /home/chayward/refs.xml 499:/home/chayward/thesis.pdf
+           refextract -p 4 -x refs.xml 499:thesis.pdf 500:paper.pdf 501:notes.pdf
 """
     sys.stderr.write(wmsg + msg)
     sys.exit(err_code)
@@ -5680,18 +5927,10 @@ def get_cli_options():
     """
     global cli_opts
     ## dictionary of important flags and values relating to cli call of program:
-    cli_opts = { 'treat_as_reference_section' : 0,
-                 'output_raw'                 : 0,
-                 'verbosity'                  : 0,
-                 'xmlfile'                    : 0,
-                 'dictfile'                   : 0,
-                 'inspire'                    : 0,
-                 'kb-journal'                 : 0,
-                 'kb-report-number'           : 0,
-               }
+    cli_opts = CFG_REFEXTRACT_DEFAULT_OPTIONS.copy()
 
     try:
-        myoptions, myargs = getopt.getopt(sys.argv[1:], "hVv:zrx:d:sj:n:", \
+        myoptions, myargs = getopt.getopt(sys.argv[1:], "hVv:zrx:d:sj:n:p:", \
                                           ["help",
                                            "version",
                                            "verbose=",
@@ -5701,7 +5940,8 @@ def get_cli_options():
                                            "dictfile=",
                                            "inspire",
                                            "kb-journal=",
-                                           "kb-report-number="])
+                                           "kb-report-number=",
+                                           "parallel="])
     except getopt.GetoptError, err:
         ## Invalid option provided - usage message
         usage(wmsg="Error: %(msg)s." % { 'msg' : str(err) })
@@ -5747,6 +5987,14 @@ def get_cli_options():
             ## The location of the report number kb requested to override
             ## a 'configuration file'-specified kb
             cli_opts['kb-report-number'] = o[1]
+        elif o[0] in ("-p", "--parallel"):
+            ## The number of processes to extract the references with
+            try:
+                cli_opts['parallel'] = int(o[1])
+            except ValueError:
+                cli_opts['parallel'] = 0
+            if cli_opts['parallel'] < 1:
+                usage(wmsg="Error: --parallel takes a positive number of processes.")
 
     # What journal title format are we using?
     if cli_opts['verbosity'] > 0 and cli_opts['inspire']:
@@ -5861,211 +6109,266 @@ def sum_2_dictionaries(dicta, dictb):
             dict_out[key] = dictb[key]
     return dict_out
 
-def main():
-    """Main function.
+def get_knowledge_bases(kb_journal=None, kb_report_number=None):
+    """Read the journal titles and report numbers knowledge bases, creating
+       the search patterns and replace terms used to standardise citations.
+       The compiled knowledge bases are built once and shared by every
+       document of an extraction job.
+       @param kb_journal: (string) - path to a journal titles kb overriding
+        the configured one.
+       @param kb_report_number: (string) - path to a report numbers kb
+        overriding the configured one.
+       @return: (tuple) - (title_search_kb, title_search_standardised_titles,
+        title_search_keys, preprint_reportnum_sre,
+        standardised_preprint_reportnum_categs)
     """
-    global cli_opts
-    (cli_opts, cli_args) =  get_cli_options()
+    if not kb_journal:
+        kb_journal = CFG_REFEXTRACT_KB_JOURNAL_TITLES
+    if not kb_report_number:
+        kb_report_number = CFG_REFEXTRACT_KB_REPORT_NUMBERS
+    (title_search_kb, \
+     title_search_standardised_titles, \
+     title_search_keys) = build_titles_knowledge_base(kb_journal)
+    (preprint_reportnum_sre, \
+     standardised_preprint_reportnum_categs) = \
+               build_reportnum_knowledge_base(kb_report_number)
+    return (title_search_kb, title_search_standardised_titles,
+            title_search_keys, preprint_reportnum_sre,
+            standardised_preprint_reportnum_categs)
+
+def extract_references_from_file_xml(recid, fpath, kbs):
+    """Run the whole reference extraction pipeline on one document: convert
+       it to plaintext, locate its reference section, standardise the
+       reference lines and mark them up as a MARC XML record.
+       @param recid: (string) - the record-id of the document.
+       @param fpath: (string) - path to the full-text of the document.
+       @param kbs: (tuple) - the knowledge bases, as returned by
+        get_knowledge_bases.
+       @return: (tuple) - (out, extract_error, record_titles_count), where
+        out is the MARC XML record (unicode; empty if the file could not be
+        read, in which case extract_error is 1) and record_titles_count is
+        the count of each 'bad title' found in the document.
+    """
+    (title_search_kb, title_search_standardised_titles, title_search_keys,
+     preprint_reportnum_sre, standardised_preprint_reportnum_categs) = kbs
+    how_found_start = -1  ## flag to indicate how the reference start section was found (or not)
+    ## reset the stats counters:
+    count_misc = count_title = count_reportnum = count_url = count_doi = count_auth_group = 0
+    record_titles_count = {}
+    if cli_opts['verbosity'] >= 1:
+        sys.stdout.write("--- processing RecID: %s pdffile: %s; %s\n" \
+                         % (str(recid), fpath, ctime()))
+
+    ## 1. Get this document body as plaintext:
+    (docbody, extract_error) = get_plaintext_document_body(fpath)
+    if extract_error == 1:
+        ## Non-existent or unreadable pdf/text directory.
+        return (u"", extract_error, record_titles_count)
+    if extract_error == 0 and len(docbody) == 0:
+        extract_error = 3
+    if cli_opts['verbosity'] >= 1:
+        sys.stdout.write("-----get_plaintext_document_body gave: " \
+                         "%s lines, overall error: %s\n" \
+                         % (str(len(docbody)), str(extract_error)))
+
+    if len(docbody) > 0:
+        ## the document body is not empty:
+        ## 2. If necessary, locate the reference section:
+        if cli_opts['treat_as_reference_section']:
+            ## don't search for citations in the document body:
+            ## treat it as a reference section:
+            reflines = docbody
+        else:
+            ## launch search for the reference section in the document body:
+            (reflines, extract_error, how_found_start) = \
+                       extract_references_from_fulltext(docbody)
+            if len(reflines) == 0 and extract_error == 0:
+                extract_error = 6
+            if cli_opts['verbosity'] >= 1:
+                sys.stdout.write("-----extract_references_from_fulltext " \
+                                 "gave len(reflines): %s overall error: " \
+                                 "%s\n" \
+                                 % (str(len(reflines)), str(extract_error)))
+
+        ## 3. Standardise the reference lines:
+        (processed_references, count_misc, \
+         count_title, count_reportnum, \
+         count_url, count_doi, count_auth_group, \
+         record_titles_count) = \
+          create_marc_xml_reference_section(reflines,
+                                            preprint_repnum_search_kb=\
+                                              preprint_reportnum_sre,
+                                            preprint_repnum_standardised_categs=\
+                                              standardised_preprint_reportnum_categs,
+                                            periodical_title_search_kb=\
+                                              title_search_kb,
+                                            standardised_periodical_titles=\
+                                              title_search_standardised_titles,
+                                            periodical_title_search_keys=\
+                                              title_search_keys)
+    else:
+        ## document body is empty, therefore the reference section is empty:
+        reflines = []
+        processed_references = []
+
+    ## 4. Display the extracted references, status codes, etc:
+    if cli_opts['output_raw']:
+        ## now write the raw references to the stream:
+        raw_file = str(recid) + '.rawrefs'
+        try:
+            rawfilehdl = open(raw_file, 'w')
+            write_raw_references_to_stream(recid, reflines, rawfilehdl)
+            rawfilehdl.close()
+        except:
+            raise IOError("Cannot open raw ref file: %s to write" \
+                          % raw_file)
+    ## If found ref section by a weaker method and only found misc/urls then junk it
+    ## studies show that such cases are ~ 100% rubbish. Also allowing only
+    ## urls found greatly increases the level of rubbish accepted..
+    if count_reportnum + count_title == 0 and how_found_start > 2:
+        count_misc = count_url = count_doi = count_auth_group = 0
+        processed_references = []
+        if cli_opts['verbosity'] >= 1:
+            sys.stdout.write("-----Found ONLY miscellaneous/Urls so removed it how_found_start=  %d\n" % (how_found_start))
+    elif  count_reportnum + count_title  > 0 and how_found_start > 2:
+        if cli_opts['verbosity'] >= 1:
+            sys.stdout.write("-----Found journals/reports with how_found_start=  %d\n" % (how_found_start))
+
+    ## Display the processed reference lines:
+    out = display_xml_record(extract_error, \
+                             count_reportnum, \
+                             count_title, \
+                             count_url, \
+                             count_doi, \
+                             count_misc, \
+                             count_auth_group, \
+                             recid, \
+                             processed_references)
+
+    ## Filter the processed reference lines to remove junk
+    out = filter_processed_references(out)  ## Be sure to call this BEFORE compress_subfields
+                                            ## since filter_processed_references expects the
+                                            ## original xml format.
+    ## Compress mulitple 'm' subfields in a datafield
+    out = compress_subfields(out,CFG_REFEXTRACT_SUBFIELD_MISC)
+    ## Compress multiple 'h' subfields in a datafield
+    out = compress_subfields(out,CFG_REFEXTRACT_SUBFIELD_AUTH)
+
+    if cli_opts['verbosity'] >= 1:
+        lines = out.split('\n')
+        sys.stdout.write("-----display_xml_record gave: %s significant " \
+                         "lines of xml, overall error: %s\n" \
+                         % (str(len(lines) - 7), extract_error))
+    return (out, extract_error, record_titles_count)
+
+## The knowledge bases of the running batch, inherited by the worker
+## processes so that they are not rebuilt for every document:
+_batch_kbs = None
+
+def _extract_references_worker(job):
+    """Process pool entry point: extract the references of one
+       (recid, filepath) job using the knowledge bases of the batch.
+    """
+    (recid, fpath) = job
+    return (recid, fpath) + \
+           extract_references_from_file_xml(recid, fpath, _batch_kbs)
+
+def extract_references_batch(extract_jobs, xmlfile=None, kbs=None,
+                             parallel=1):
+    """Extract the references of a batch of documents, streaming the
+       resulting MARC XML records to a single collection, ready for
+       bibupload.  Text extraction and reference parsing run in a pool of
+       `parallel' processes, which share the knowledge bases compiled
+       beforehand by the parent.  Records are written in the order of
+       extract_jobs as soon as they are ready.
+       @param extract_jobs: (list) of (recid, filepath) tuples.
+       @param xmlfile: (string) - path of the file to write the collection
+        to; the standard output stream is used if not given.
+       @param kbs: (tuple) - the knowledge bases, as returned by
+        get_knowledge_bases; the configured ones are read if not given.
+       @param parallel: (integer) - number of worker processes.
+       @return: (tuple) - (failed_jobs, all_found_titles_count), where
+        failed_jobs is the list of (recid, filepath) whose full-text could
+        not be read (no record is output for them) and
+        all_found_titles_count the counts of all 'bad titles' found.
+    """
+    global _batch_kbs
+    if kbs is None:
+        kbs = get_knowledge_bases()
+    _batch_kbs = kbs
 
     ## A dictionary to contain the counts of all 'bad titles' found during
     ## this reference extraction job:
     all_found_titles_count = {}
+    failed_jobs = []
 
-    extract_jobs = get_recids_and_filepaths(cli_args)
-    if len(extract_jobs) == 0:
-        ## no files provided for reference extraction - error message
-        usage()
-
-    ## Read the journal titles knowledge base, creating the search
-    ## patterns and replace terms. Check for user-specified journal kb.
-    if cli_opts['kb-journal'] != 0:
-        (title_search_kb, \
-         title_search_standardised_titles, \
-         title_search_keys) = \
-                   build_titles_knowledge_base(cli_opts['kb-journal'])
+    ## Output opening XML collection tags, either to an xml file or stdout:
+    if xmlfile:
+        try:
+            ofilehdl = open(xmlfile, 'w')
+        except IOError:
+            sys.stdout.write("***%s\n\n" % xmlfile)
+            raise IOError("Cannot open %s to write!" % xmlfile)
     else:
-        (title_search_kb, \
-         title_search_standardised_titles, \
-         title_search_keys) = \
-                   build_titles_knowledge_base(CFG_REFEXTRACT_KB_JOURNAL_TITLES)
-
-    ## Read the report numbers knowledge base, creating the search
-    ## patterns and replace terms. Check for user-specified rep-no kb.
-    if cli_opts['kb-report-number'] != 0:
-        (preprint_reportnum_sre, \
-         standardised_preprint_reportnum_categs) = \
-                   build_reportnum_knowledge_base(cli_opts['kb-report-number'])
+        ofilehdl = sys.stdout
+    ofilehdl.write("%s\n" % CFG_REFEXTRACT_XML_VERSION.encode("utf-8"))
+    ofilehdl.write("%s\n" % CFG_REFEXTRACT_XML_COLLECTION_OPEN.encode("utf-8"))
+    ofilehdl.flush()
+
+    pool = None
+    if parallel > 1 and len(extract_jobs) > 1 and MP_ENABLED:
+        pool = multiprocessing.Pool(parallel)
+        results = pool.imap(_extract_references_worker, extract_jobs)
     else:
-        (preprint_reportnum_sre, \
-         standardised_preprint_reportnum_categs) = \
-                   build_reportnum_knowledge_base(CFG_REFEXTRACT_KB_REPORT_NUMBERS)
-
-    done_coltags = 0 ## flag to signal that the starting XML collection
-                     ## tags have been output to either an xml file or stdout
-
-    for curitem in extract_jobs:
-        how_found_start = -1  ## flag to indicate how the reference start section was found (or not)
-        extract_error = 0  ## extraction was OK unless determined otherwise
-        ## reset the stats counters:
-        count_misc = count_title = count_reportnum = count_url = count_doi = count_auth_group = 0
-        recid = curitem[0]
-        if cli_opts['verbosity'] >= 1:
-            sys.stdout.write("--- processing RecID: %s pdffile: %s; %s\n" \
-                             % (str(curitem[0]), curitem[1], ctime()))
-
-        ## 1. Get this document body as plaintext:
-        (docbody, extract_error) = get_plaintext_document_body(curitem[1])
-        if extract_error == 1:
-            ## Non-existent or unreadable pdf/text directory.
-            sys.stderr.write("Error: could not open %s for extraction.\n" \
-                             % curitem[1])
-            sys.exit(1)
-        if extract_error == 0 and len(docbody) == 0:
-            extract_error = 3
-        if cli_opts['verbosity'] >= 1:
-            sys.stdout.write("-----get_plaintext_document_body gave: " \
-                             "%s lines, overall error: %s\n" \
-                             % (str(len(docbody)), str(extract_error)))
-
-        if not done_coltags:
-            ## Output opening XML collection tags:
-            ## Initialise ouput xml file if the relevant cli flag/arg exists
-            if cli_opts['xmlfile']:
-                try:
-                    ofilehdl = open(cli_opts['xmlfile'], 'w')
-                    ofilehdl.write("%s\n" \
-                          % CFG_REFEXTRACT_XML_VERSION.encode("utf-8"))
-                    ofilehdl.write("%s\n" \
-                          % CFG_REFEXTRACT_XML_COLLECTION_OPEN.encode("utf-8"))
-                    ofilehdl.flush()
-                except:
-                    sys.stdout.write("***%s\n\n" % cli_opts['xmlfile'])
-                    raise IOError("Cannot open %s to write!" \
-                                  % cli_opts['xmlfile'])
-            ## else, write the xml lines to the stdout
-            else:
-                sys.stdout.write("%s\n" \
-                          % CFG_REFEXTRACT_XML_VERSION.encode("utf-8"))
-                sys.stdout.write("%s\n" \
-                          % CFG_REFEXTRACT_XML_COLLECTION_OPEN.encode("utf-8"))
-            done_coltags = 1
-
-        if len(docbody) > 0:
-            ## the document body is not empty:
-            ## 2. If necessary, locate the reference section:
-            if cli_opts['treat_as_reference_section']:
-                ## don't search for citations in the document body:
-                ## treat it as a reference section:
-                reflines = docbody
-            else:
-                ## launch search for the reference section in the document body:
-                (reflines, extract_error, how_found_start) = \
-                           extract_references_from_fulltext(docbody)
-                if len(reflines) == 0 and extract_error == 0:
-                    extract_error = 6
-                if cli_opts['verbosity'] >= 1:
-                    sys.stdout.write("-----extract_references_from_fulltext " \
-                                     "gave len(reflines): %s overall error: " \
-                                     "%s\n" \
-                                     % (str(len(reflines)), str(extract_error)))
-
-            ## 3. Standardise the reference lines:
-            #reflines = test_get_reference_lines()
-            (processed_references, count_misc, \
-             count_title, count_reportnum, \
-             count_url, count_doi, count_auth_group, \
-             record_titles_count) = \
-              create_marc_xml_reference_section(reflines,
-                                                preprint_repnum_search_kb=\
-                                                  preprint_reportnum_sre,
-                                                preprint_repnum_standardised_categs=\
-                                                  standardised_preprint_reportnum_categs,
-                                                periodical_title_search_kb=\
-                                                  title_search_kb,
-                                                standardised_periodical_titles=\
-                                                  title_search_standardised_titles,
-                                                periodical_title_search_keys=\
-                                                  title_search_keys)
-
-            ## Add the count of 'bad titles' found in this line to the total
-            ## for the reference section:
+        results = imap(_extract_references_worker, extract_jobs)
+    try:
+        for (recid, fpath, out, extract_error, record_titles_count) in results:
+            if extract_error == 1:
+                failed_jobs.append((recid, fpath))
+                continue
+            ## Add the count of 'bad titles' found in this document to the
+            ## total for the extraction job:
             all_found_titles_count = \
                                    sum_2_dictionaries(all_found_titles_count, \
                                                       record_titles_count)
+            ofilehdl.write("%s" % (out.encode("utf-8"),))
+            ofilehdl.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    ## Display closing tag of the XML collection:
+    ofilehdl.write("%s\n" % CFG_REFEXTRACT_XML_COLLECTION_CLOSE.encode("utf-8"))
+    if xmlfile:
+        ofilehdl.close()
+        ## limit m tag data to something less than infinity
+        limit_m_tags(xmlfile, 2024)
+    else:
+        ofilehdl.flush()
+    return (failed_jobs, all_found_titles_count)
 
+def main():
+    """Main function.
+    """
+    global cli_opts
+    (cli_opts, cli_args) =  get_cli_options()
 
-        else:
-            ## document body is empty, therefore the reference section is empty:
-            reflines = []
-            processed_references = []
-
-        ## 4. Display the extracted references, status codes, etc:
-        if cli_opts['output_raw']:
-            ## now write the raw references to the stream:
-            raw_file = str(recid) + '.rawrefs'
-            try:
-                rawfilehdl = open(raw_file, 'w')
-                write_raw_references_to_stream(recid, reflines, rawfilehdl)
-                rawfilehdl.close()
-            except:
-                raise IOError("Cannot open raw ref file: %s to write" \
-                              % raw_file)
-        ## If found ref section by a weaker method and only found misc/urls then junk it
-        ## studies show that such cases are ~ 100% rubbish. Also allowing only
-        ## urls found greatly increases the level of rubbish accepted..
-        if count_reportnum + count_title == 0 and how_found_start > 2:
-            count_misc = count_url = count_doi = count_auth_group = 0
-            processed_references = []
-            if cli_opts['verbosity'] >= 1:
-                sys.stdout.write("-----Found ONLY miscellaneous/Urls so removed it how_found_start=  %d\n" % (how_found_start))
-        elif  count_reportnum + count_title  > 0 and how_found_start > 2:
-            if cli_opts['verbosity'] >= 1:
-                sys.stdout.write("-----Found journals/reports with how_found_start=  %d\n" % (how_found_start))
-
-        ## Display the processed reference lines:
-        out = display_xml_record(extract_error, \
-                                 count_reportnum, \
-                                 count_title, \
-                                 count_url, \
-                                 count_doi, \
-                                 count_misc, \
-                                 count_auth_group, \
-                                 recid, \
-                                 processed_references)
-
-        ## Filter the processed reference lines to remove junk
-        out = filter_processed_references(out)  ## Be sure to call this BEFORE compress_subfields
-                                                ## since filter_processed_references expects the
-                                                ## original xml format.
-        ## Compress mulitple 'm' subfields in a datafield
-        out = compress_subfields(out,CFG_REFEXTRACT_SUBFIELD_MISC)
-        ## Compress multiple 'h' subfields in a datafield
-        out = compress_subfields(out,CFG_REFEXTRACT_SUBFIELD_AUTH)
+    extract_jobs = get_recids_and_filepaths(cli_args)
+    if len(extract_jobs) == 0:
+        ## no files provided for reference extraction - error message
+        usage()
 
-        if cli_opts['verbosity'] >= 1:
-            lines = out.split('\n')
-            sys.stdout.write("-----display_xml_record gave: %s significant " \
-                             "lines of xml, overall error: %s\n" \
-                             % (str(len(lines) - 7), extract_error))
-        if cli_opts['xmlfile']:
-            ofilehdl.write("%s" % (out.encode("utf-8"),))
-            ofilehdl.flush()
-        else:
-            ## Write the record to the standard output stream:
-            sys.stdout.write("%s" % out.encode("utf-8"))
-            sys.stdout.flush()
+    ## Read the journal titles and report numbers knowledge bases, creating
+    ## the search patterns and replace terms. Check for user-specified kbs.
+    kbs = get_knowledge_bases(cli_opts['kb-journal'],
+                              cli_opts['kb-report-number'])
 
-    ## If an XML collection was opened, display closing tag
-    if done_coltags:
-        if (cli_opts['xmlfile']):
-            ofilehdl.write("%s\n" \
-                          % CFG_REFEXTRACT_XML_COLLECTION_CLOSE.encode("utf-8"))
-            ofilehdl.close()
-            ## limit m tag data to something less than infinity
-            limit_m_tags(cli_opts['xmlfile'], 2024)
-        else:
-            sys.stdout.write("%s\n" \
-                          % CFG_REFEXTRACT_XML_COLLECTION_CLOSE.encode("utf-8"))
+    (failed_jobs, all_found_titles_count) = \
+                  extract_references_batch(extract_jobs,
+                                           xmlfile=cli_opts['xmlfile'],
+                                           kbs=kbs,
+                                           parallel=cli_opts['parallel'])
 
     ## If the option to write the statistics about all periodical titles matched
     ## during the extraction-job was selected, do so using the specified file.
@@ -6089,6 +6392,13 @@ def main():
                              % (cli_opts['dictfile'], errno, err_string))
             sys.exit(1)
 
+    if failed_jobs:
+        ## Non-existent or unreadable pdf/text directory.
+        for (dummy, fpath) in failed_jobs:
+            sys.stderr.write("Error: could not open %s for extraction.\n" \
+                             % fpath)
+        sys.exit(1)
+
 
 def test_get_reference_lines():
     """Returns some test reference lines.
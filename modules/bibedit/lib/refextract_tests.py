@@ -21,6 +21,10 @@
 The Refextract test suite.
 """
 
+import os
+import re
+import shutil
+import tempfile
 import unittest
 from invenio.testutils import make_test_suite, run_test_suite
 ## Import the minimal necessary methods and variables needed to run Refextract
@@ -32,6 +36,10 @@ from invenio.refextract import CFG_REFEXTRACT_KB_JOURNAL_TITLES, \
                                display_xml_record, \
                                compress_subfields, \
                                restrict_m_subfields, \
+                               identify_periodical_titles, \
+                               KnowledgeBasePatterns, \
+                               get_knowledge_bases, \
+                               extract_references_batch, \
                                cli_opts
 
 # Initially, build the titles knowledge base
@@ -575,7 +583,93 @@ class RefextractTest(unittest.TestCase):
         #Compare the recieved output with the expected references
         self.assertEqual(out, references_expected)
 
-TEST_SUITE = make_test_suite(RefextractTest)
+class RefextractKnowledgeBaseTest(unittest.TestCase):
+    """ refextract - testing the knowledge base pattern matching """
+
+    def test_titles_candidates(self):
+        """ refextract - title candidates are found at word starts """
+        candidates = title_search_kb.get_candidates_at_word_starts(u"[1] PHYS REV D 12 (1999) 34")
+        self.assert_(candidates.has_key(u"PHYS REV D"))
+        self.assert_(candidates.has_key(u"PHYS REV"))
+        self.failIf(candidates.has_key(u"NUCL PHYS"))
+        candidates = title_search_kb.get_candidates_at_word_starts(u"[1] APHYS REV D 12")
+        self.failIf(candidates.has_key(u"PHYS REV D"))
+
+    def test_titles_longest_first(self):
+        """ refextract - longest titles are matched first, and masked """
+        (matchlen, matchtext, line, count) = \
+            identify_periodical_titles(u"[1] PHYS REV D 12 (1999) 34 ",
+                                       title_search_kb,
+                                       title_search_keys)
+        self.assertEqual({4: u"PHYS REV D"}, matchtext)
+        self.assertEqual(u"[1] __________ 12 (1999) 34 ", line)
+
+    def test_lazy_compilation(self):
+        """ refextract - knowledge base patterns are compiled when used """
+        kb = KnowledgeBasePatterns({u"ABC": r"\bABC\b"}, {u"ABC": u"ABC"})
+        self.assert_(isinstance(dict.__getitem__(kb, u"ABC"), basestring))
+        self.assertNotEqual(None, kb[u"ABC"].search(u"x ABC y"))
+        self.failIf(isinstance(dict.__getitem__(kb, u"ABC"), basestring))
+
+class RefextractBatchTest(unittest.TestCase):
+    """ refextract - testing the batch extraction of references """
+
+    def setUp(self):
+        """Write two reference sections to extract from"""
+        cli_opts['inspire'] = 0
+        cli_opts['treat_as_reference_section'] = 1
+        self.tmpdir = tempfile.mkdtemp()
+        self.jobs = []
+        for (recid, journal) in (("10", "Phys. Rev. D"), ("20", "Nucl. Phys. B")):
+            fpath = os.path.join(self.tmpdir, "%s.txt" % recid)
+            fdesc = open(fpath, "w")
+            for i in range(1, 6):
+                fdesc.write("[%d] A. Author, %s %d (1999) %d\n" \
+                            % (i, journal, i * 10, i * 100))
+            fdesc.close()
+            self.jobs.append((recid, fpath))
+        self.kbs = get_knowledge_bases()
+
+    def tearDown(self):
+        """Remove the documents and the batch outputs"""
+        cli_opts['treat_as_reference_section'] = 0
+        shutil.rmtree(self.tmpdir)
+
+    def _extract(self, jobs, parallel):
+        """Run a batch and return its failed jobs and its output, without
+        the extraction timestamps"""
+        xmlfile = os.path.join(self.tmpdir, "refs-%d.xml" % parallel)
+        failed_jobs = extract_references_batch(jobs, xmlfile=xmlfile,
+                                               kbs=self.kbs,
+                                               parallel=parallel)[0]
+        out = open(xmlfile).read()
+        return (failed_jobs, re.sub(r"-\d+-(\d+-)", r"-\1", out))
+
+    def test_batch_output(self):
+        """ refextract - batch output is one collection, in job order """
+        (failed_jobs, out) = self._extract(self.jobs, 1)
+        self.assertEqual([], failed_jobs)
+        self.assertEqual(1, out.count("<collection"))
+        self.assertEqual(2, out.count("<record>"))
+        self.assert_(out.index('<controlfield tag="001">10</controlfield>') <
+                     out.index('<controlfield tag="001">20</controlfield>'))
+        self.assertEqual(10, out.count('<subfield code="s">'))
+
+    def test_batch_parallel(self):
+        """ refextract - parallel batch output equals the sequential one """
+        self.assertEqual(self._extract(self.jobs, 1),
+                         self._extract(self.jobs, 2))
+
+    def test_batch_unreadable_file(self):
+        """ refextract - unreadable files are reported and skipped """
+        missing = ("30", os.path.join(self.tmpdir, "missing.txt"))
+        (failed_jobs, out) = self._extract(self.jobs + [missing], 2)
+        self.assertEqual([missing], failed_jobs)
+        self.assertEqual(2, out.count("<record>"))
+
+TEST_SUITE = make_test_suite(RefextractTest,
+                             RefextractKnowledgeBaseTest,
+                             RefextractBatchTest)
 
 if __name__ == '__main__':
     run_test_suite(TEST_SUITE)
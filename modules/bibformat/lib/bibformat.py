@@ -318,7 +318,14 @@ def format_records(recIDs, of, ln=CFG_SITE_LANG, verbose=0, search_pattern=None,
     if req is not None:
         req.write(prologue)
 
-    formatted_records = ''
+    formatted_records = []
+    def output(string):
+        """Collect STRING and stream it to req, if any."""
+        formatted_records.append(string)
+        if req is not None:
+            ## Do not flush for every record: the request object
+            ## sends the output in bigger chunks.
+            req.write(string, 0)
 
     #Fill one of the lists with Nones
     if xml_records is not None:
@@ -335,51 +342,33 @@ def format_records(recIDs, of, ln=CFG_SITE_LANG, verbose=0, search_pattern=None,
         #Print prefix
         if record_prefix is not None:
             if isinstance(record_prefix, str):
-                formatted_records += record_prefix
-                if req is not None:
-                    req.write(record_prefix)
+                output(record_prefix)
             else:
-                string_prefix = record_prefix(i)
-                formatted_records += string_prefix
-                if req is not None:
-                    req.write(string_prefix)
+                output(record_prefix(i))
 
         #Print formatted record
-        formatted_record = format_record(recIDs[i], of, ln, verbose, \
-                                         search_pattern, xml_records[i],\
-                                         user_info, on_the_fly)
-        formatted_records += formatted_record
-        if req is not None:
-            req.write(formatted_record)
+        output(format_record(recIDs[i], of, ln, verbose, \
+                             search_pattern, xml_records[i],\
+                             user_info, on_the_fly))
 
         #Print suffix
         if record_suffix is not None:
             if isinstance(record_suffix, str):
-                formatted_records += record_suffix
-                if req is not None:
-                    req.write(record_suffix)
+                output(record_suffix)
             else:
-                string_suffix = record_suffix(i)
-                formatted_records += string_suffix
-                if req is not None:
-                    req.write(string_suffix)
+                output(record_suffix(i))
 
         #Print separator if needed
         if record_separator is not None and not last_iteration:
             if isinstance(record_separator, str):
-                formatted_records += record_separator
-                if req is not None:
-                    req.write(record_separator)
+                output(record_separator)
             else:
-                string_separator = record_separator(i)
-                formatted_records += string_separator
-                if req is not None:
-                    req.write(string_separator)
+                output(record_separator(i))
 
     if req is not None:
         req.write(epilogue)
 
-    return prologue + formatted_records + epilogue
+    return prologue + ''.join(formatted_records) + epilogue
 
 def create_excel(recIDs, req=None, ln=CFG_SITE_LANG, ot=None, ot_sep="; "):
     """
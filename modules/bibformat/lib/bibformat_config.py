@@ -44,6 +44,16 @@ CFG_BIBFORMAT_USE_OLD_BIBFORMAT = False
 #performance of your server to have on-the-fly formatting enabled.
 CFG_BIBFORMAT_ENABLE_I18N_BRIEF_FORMAT = True
 
+#Number of records that bibreformat formats before writing them into
+#bibfmt with one multi-row query.  In --parallel mode, this is also the
+#number of records given at once to each worker process.
+CFG_BIBFORMAT_REFORMAT_BATCH_SIZE = 100
+
+#Maximum number of bytes of formatted records that bibreformat writes
+#with one query.  Keep it well below the max_allowed_packet of the
+#database server, since the values are escaped in the query.
+CFG_BIBFORMAT_REFORMAT_MAX_QUERY_SIZE = 400000
+
 #Paths to main formats directories
 CFG_BIBFORMAT_TEMPLATES_PATH = "%s%sbibformat%sformat_templates" % (CFG_ETCDIR, os.sep, os.sep)
 CFG_BIBFORMAT_ELEMENTS_IMPORT_PATH = "invenio.bibformat_elements"
@@ -78,6 +78,7 @@ if CFG_PATH_PHP: #Remove when call_old_bibformat is removed
 
 # Cache for data we have already read and parsed
 format_templates_cache = {}
+compiled_format_templates_cache = {}
 format_elements_cache = {}
 format_outputs_cache = {}
 
@@ -427,34 +428,28 @@ def format_with_format_template(format_template_filename, bfo,
                                                        9: errors and warnings, stop if error (debug mode ))
     @return: tuple (formatted text, errors)
     """
-    _ = gettext_set_language(bfo.lang)
-
-    def translate(match):
-        """
-        Translate matching values
-        """
-        word = match.group("word")
-        translated_word = _(word)
-        return translated_word
-
     errors_ = []
-    if format_template_code is not None:
-        format_content = str(format_template_code)
-    else:
-        format_content = get_format_template(format_template_filename)['code']
-
     if format_template_filename is None or \
            format_template_filename.endswith("."+CFG_BIBFORMAT_FORMAT_TEMPLATE_EXTENSION):
         # .bft
-        filtered_format = filter_languages(format_content, bfo.lang)
-        localized_format = translation_pattern.sub(translate, filtered_format)
+        if format_template_code is not None:
+            compiled_format = compile_format_template(str(format_template_code),
+                                                      bfo.lang)
+        else:
+            compiled_format = get_compiled_format_template(format_template_filename,
+                                                           bfo.lang)
 
-        (evaluated_format, errors) = eval_format_template_elements(localized_format,
+        (evaluated_format, errors) = eval_compiled_format_template(compiled_format,
                                                                    bfo,
                                                                    verbose)
         errors_ = errors
     else:
         #.xsl
+        if format_template_code is not None:
+            format_content = str(format_template_code)
+        else:
+            format_content = get_format_template(format_template_filename)['code']
+
         if bfo.xml_record:
             # bfo was initialized with a custom MARCXML
             xml_record = '<?xml version="1.0" encoding="UTF-8"?>\n' + \
@@ -487,58 +482,135 @@ def eval_format_template_elements(format_template, bfo, verbose=0):
                                                        9: errors and warnings, stop if error (debug mode ))
     @return: tuple (result, errors)
     """
-    errors_ = []
+    return eval_compiled_format_template(parse_format_template(format_template),
+                                         bfo, verbose)
 
-    # First define insert_element_code(match), used in re.sub() function
-    def insert_element_code(match):
-        """
-        Analyses 'match', interpret the corresponding code, and return the result of the evaluation.
+def parse_format_template(format_template):
+    """
+    Splits the given format template code into a list of literal text
+    chunks (strings) and of format element calls (tuples
+    (function_name, parameters) where parameters is a dictionary).
 
-        Called by substitution in 'eval_format_template_elements(...)'
+    @param format_template: the format template code
+    @return: list of chunks
+    """
+    chunks = []
+    position = 0
+    for match in pattern_tag.finditer(format_template):
+        if match.start() > position:
+            chunks.append(format_template[position:match.start()])
+        params = {}
+        # Look for function parameters given in format template code
+        all_params = match.group('params')
+        if all_params is not None:
+            function_params_iterator = pattern_function_params.finditer(all_params)
+            for param_match in function_params_iterator:
+                name = param_match.group('param')
+                value = param_match.group('value')
+                params[name] = value
+        chunks.append((match.group("function_name"), params))
+        position = match.end()
+    if position < len(format_template):
+        chunks.append(format_template[position:])
+    return chunks
+
+def compile_format_template(format_template, ln=CFG_SITE_LANG):
+    """
+    Compiles the given format template code for language LN: keeps
+    only the parts in language LN, translates the _(...)_ strings and
+    parses the format element calls.
 
-        @param match: a match object corresponding to the special tag that must be interpreted
+    @param format_template: the format template code
+    @param ln: the language of the compiled template
+    @return: list of chunks, as returned by parse_format_template(..)
+    """
+    _ = gettext_set_language(ln)
+
+    def translate(match):
         """
+        Translate matching values
+        """
+        word = match.group("word")
+        translated_word = _(word)
+        return translated_word
+
+    filtered_format = filter_languages(format_template, ln)
+    localized_format = translation_pattern.sub(translate, filtered_format)
+    return parse_format_template(localized_format)
+
+def get_compiled_format_template(filename, ln=CFG_SITE_LANG):
+    """
+    Returns the compiled version of the given format template in
+    language LN, as returned by compile_format_template(..).  Compiled
+    templates are cached until their file is modified.
+
+    @param filename: the filename of a format template
+    @param ln: the language of the compiled template
+    @return: list of chunks
+    """
+    try:
+        mtime = os.path.getmtime("%s%s%s" % (CFG_BIBFORMAT_TEMPLATES_PATH,
+                                             os.sep, filename))
+    except OSError:
+        mtime = None
+    key = (filename, ln)
+    if compiled_format_templates_cache.has_key(key) and \
+           compiled_format_templates_cache[key][0] == mtime:
+        return compiled_format_templates_cache[key][1]
+
+    compiled_format = compile_format_template(get_format_template(filename)['code'],
+                                              ln)
+    compiled_format_templates_cache[key] = (mtime, compiled_format)
+    return compiled_format
+
+def eval_compiled_format_template(compiled_format, bfo, verbose=0):
+    """
+    Evaluates the format elements of the given compiled format template
+    and returns the concatenation of their values and of the literal
+    chunks.  Also returns errors.
+
+    @param compiled_format: a list of chunks, as returned by compile_format_template(..)
+    @param bfo: the object containing parameters for the current formatting
+    @param verbose: the level of verbosity from 0 to 9 (O: silent,
+                                                       5: errors,
+                                                       7: errors and warnings,
+                                                       9: errors and warnings, stop if error (debug mode ))
+    @return: tuple (result, errors)
+    """
+    errors_ = []
+    out = []
+    for chunk in compiled_format:
+        if type(chunk) is not tuple:
+            out.append(chunk)
+            continue
 
-        function_name = match.group("function_name")
+        (function_name, params) = chunk
         try:
             format_element = get_format_element(function_name, verbose)
         except Exception, e:
             if verbose >= 5:
-                return '<b><span style="color: rgb(255, 0, 0);">' + \
-                       cgi.escape(str(e)).replace('\n', '<br/>') + \
-                       '</span>'
+                out.append('<b><span style="color: rgb(255, 0, 0);">' + \
+                           cgi.escape(str(e)).replace('\n', '<br/>') + \
+                           '</span>')
+            continue
         if format_element is None:
             error = get_msgs_for_code_list([("ERR_BIBFORMAT_CANNOT_RESOLVE_ELEMENT_NAME", function_name)],
                                            stream='error', ln=CFG_SITE_LANG)
             errors_.append(error)
             if verbose >= 5:
-                return '<b><span style="color: rgb(255, 0, 0);">' + \
-                       error[0][1]+'</span></b>'
+                out.append('<b><span style="color: rgb(255, 0, 0);">' + \
+                           error[0][1]+'</span></b>')
         else:
-            params = {}
-            # Look for function parameters given in format template code
-            all_params = match.group('params')
-            if all_params is not None:
-                function_params_iterator = pattern_function_params.finditer(all_params)
-                for param_match in function_params_iterator:
-                    name = param_match.group('param')
-                    value = param_match.group('value')
-                    params[name] = value
-
             # Evaluate element with params and return (Do not return errors)
             (result, errors) = eval_format_element(format_element,
                                                    bfo,
                                                    params,
                                                    verbose)
             errors_.append(errors)
-            return result
-
-
-    # Substitute special tags in the format by our own text.
-    # Special tags have the form <BNE_format_element_name [param="value"]* />
-    format = pattern_tag.sub(insert_element_code, format_template)
+            if result is not None:
+                out.append(result)
 
-    return (format, errors_)
+    return (''.join(out), errors_)
 
 
 def eval_format_element(format_element, bfo, parameters=None, verbose=0):
@@ -1685,8 +1757,10 @@ def clear_caches():
     Clear the caches (Output Format, Format Templates and Format Elements)
 
     """
-    global format_templates_cache, format_elements_cache, format_outputs_cache
+    global format_templates_cache, format_elements_cache, format_outputs_cache, \
+           compiled_format_templates_cache
     format_templates_cache = {}
+    compiled_format_templates_cache = {}
     format_elements_cache = {}
     format_outputs_cache = {}
 
@@ -71,6 +71,26 @@ class FormatTemplateTest(unittest.TestCase):
         self.assertEqual(unknown_template,  None)
 
 
+    def test_parse_format_template(self):
+        """bibformat - format template parsing into chunks"""
+        chunks = bibformat_engine.parse_format_template('a <BFE_TITLE prefix="<b>" suffix=\'</b>\'/> b <bfe_authors limit="3" >')
+        self.assertEqual(chunks, ['a ',
+                                  ('TITLE', {'prefix': '<b>', 'suffix': '</b>'}),
+                                  ' b ',
+                                  ('authors', {'limit': '3'})])
+
+    def test_compile_format_template(self):
+        """bibformat - format template compilation for a language"""
+        chunks = bibformat_engine.compile_format_template('<lang><en>Title</en><fr>Titre</fr></lang>: <BFE_TITLE />', 'fr')
+        self.assertEqual(chunks, ['Titre: ', ('TITLE', {})])
+
+    def test_get_compiled_format_template(self):
+        """bibformat - compiled format template cache"""
+        bibformat_engine.CFG_BIBFORMAT_TEMPLATES_PATH = CFG_BIBFORMAT_TEMPLATES_PATH
+        chunks = bibformat_engine.get_compiled_format_template("Test_2.bft", 'en')
+        self.assertEqual(chunks, ['test'])
+        self.assert_(bibformat_engine.get_compiled_format_template("Test_2.bft", 'en') is chunks)
+
     def test_get_format_templates(self):
         """ bibformat - loading multiple format templates"""
         bibformat_engine.CFG_BIBFORMAT_TEMPLATES_PATH = CFG_BIBFORMAT_TEMPLATES_PATH
@@ -35,18 +35,26 @@ try:
     from invenio.search_engine import perform_request_search, search_pattern
     from invenio.search_engine import print_record
     from invenio.bibformat import format_record
-    from invenio.bibformat_config import CFG_BIBFORMAT_USE_OLD_BIBFORMAT
+    from invenio.bibformat_config import CFG_BIBFORMAT_USE_OLD_BIBFORMAT, \
+         CFG_BIBFORMAT_REFORMAT_BATCH_SIZE, \
+         CFG_BIBFORMAT_REFORMAT_MAX_QUERY_SIZE
     from invenio.bibtask import task_init, write_message, task_set_option, \
             task_get_option, task_update_progress, task_has_option, \
-            task_low_level_submission, task_sleep_now_if_required, \
-            task_get_task_param
+            task_low_level_submission, task_sleep_now_if_required
     import os
     import time
     import zlib
+    from itertools import imap
 except ImportError, e:
     print "Error: %s" % e
     sys.exit(1)
 
+try:
+    import multiprocessing
+    MP_ENABLED = True
+except ImportError:
+    MP_ENABLED = False
+
 ### run the bibreformat task bibsched scheduled
 ###
 
@@ -182,34 +190,83 @@ def without_fmt(sql):
 ### Bibreformat all selected records (using new python bibformat)
 ### (see iterate_over_old further down)
 
+def write_formatted_records(formatted_records, fmt):
+    """Write FORMATTED_RECORDS, a list of (recID, last_updated,
+    compressed value) tuples, into bibfmt for format FMT.  Existing
+    bibfmt rows are updated in place thanks to their primary key, new
+    ones are created, with multi-row queries holding at most
+    CFG_BIBFORMAT_REFORMAT_MAX_QUERY_SIZE bytes of values each."""
+    if not formatted_records:
+        return
+    recIDs = [formatted_record[0] for formatted_record in formatted_records]
+    bibfmt_ids = dict(run_sql("SELECT id_bibrec, id FROM bibfmt WHERE format=%%s AND id_bibrec IN (%s)" % \
+                              ','.join(['%s'] * len(recIDs)), tuple([fmt] + recIDs)))
+    chunks = [[]]
+    chunk_size = 0
+    for formatted_record in formatted_records:
+        value_size = len(formatted_record[2])
+        if chunks[-1] and chunk_size + value_size > CFG_BIBFORMAT_REFORMAT_MAX_QUERY_SIZE:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append(formatted_record)
+        chunk_size += value_size
+    for chunk in chunks:
+        values = []
+        params = []
+        for recID, last_updated, value in chunk:
+            values.append('(%s, %s, %s, %s, %s)')
+            params.extend((bibfmt_ids.get(recID), recID, fmt, last_updated, value))
+        run_sql("INSERT INTO bibfmt(id, id_bibrec, format, last_updated, value) VALUES %s "
+                "ON DUPLICATE KEY UPDATE last_updated=VALUES(last_updated), value=VALUES(value)" % \
+                ', '.join(values), tuple(params))
+
+def format_records(recIDs, fmt):
+    """Format the records RECIDS in FMT and save them into bibfmt.
+    Return the number of formatted records and the time spent."""
+    t1 = os.times()[4]
+    formatted_records = []
+    for recID in recIDs:
+        start_date = time.strftime('%Y-%m-%d %H:%M:%S')
+        formatted_record = zlib.compress(format_record(recID, fmt, on_the_fly=True))
+        formatted_records.append((recID, start_date, formatted_record))
+    write_formatted_records(formatted_records, fmt)
+    t2 = os.times()[4]
+    return (len(recIDs), t2 - t1)
+
+def format_records_worker(args):
+    """Call format_records() with ARGS in a worker process."""
+    return format_records(*args)
+
 def iterate_over_new(list, fmt):
     "Iterate over list of IDs"
     global total_rec
 
-    formatted_records = ''      # (string-)List of formatted record of an iteration
     tbibformat  = 0     # time taken up by external call
     tbibupload  = 0     # time taken up by external call
-    start_date = task_get_task_param('task_starting_time') # Time at which the record was formatted
 
-    tot = len(list)
+    recIDs = [recID for recID in list]
+    tot = len(recIDs)
     count = 0
-    for recID in list:
-        t1 = os.times()[4]
-        start_date = time.strftime('%Y-%m-%d %H:%M:%S')
-        formatted_record = zlib.compress(format_record(recID, fmt, on_the_fly=True))
-        if run_sql('SELECT id FROM bibfmt WHERE id_bibrec=%s AND format=%s', (recID, fmt)):
-            run_sql('UPDATE bibfmt SET last_updated=%s, value=%s WHERE id_bibrec=%s AND format=%s', (start_date, formatted_record, recID, fmt))
-        else:
-            run_sql('INSERT INTO bibfmt(id_bibrec, format, last_updated, value) VALUES(%s, %s, %s, %s)', (recID, fmt, start_date, formatted_record))
-        t2 = os.times()[4]
-        tbibformat += (t2 - t1)
-        count += 1
-        if (count % 100) == 0:
-            write_message("   ... formatted %s records out of %s" % (count, tot))
-            task_update_progress('Formatted %s out of %s' % (count, tot))
-            task_sleep_now_if_required(can_stop_too=True)
-    if (tot % 100) != 0:
+    batches = [(recIDs[i:i+CFG_BIBFORMAT_REFORMAT_BATCH_SIZE], fmt) \
+               for i in range(0, tot, CFG_BIBFORMAT_REFORMAT_BATCH_SIZE)]
+    pool = None
+    parallel = task_get_option('parallel', 1)
+    if parallel > 1 and len(batches) > 1 and MP_ENABLED:
+        # each worker process opens its own database connection
+        write_message("Formatting records in %s processes" % parallel, verbose=2)
+        pool = multiprocessing.Pool(parallel)
+        results = pool.imap_unordered(format_records_worker, batches)
+    else:
+        results = imap(format_records_worker, batches)
+    for (nb_formatted, tbatch) in results:
+        tbibformat += tbatch
+        count += nb_formatted
         write_message("   ... formatted %s records out of %s" % (count, tot))
+        task_update_progress('Formatted %s out of %s' % (count, tot))
+        task_sleep_now_if_required(can_stop_too=True)
+    if pool:
+        pool.close()
+        pool.join()
     return (tot, tbibformat, tbibupload)
 
 def iterate_over_old(list, fmt):
@@ -431,6 +488,8 @@ Examples:
   bibreformat -n                 Show how many records are to be (re)formatted.
   bibreformat -n -c 'Articles'   Show how many records are to be (re)formatted in 'Articles' collection.
 
+  bibreformat -a --parallel=4    Force reformatting all records (in HB) in 4 processes.
+
   bibreformat -oHB -s1h          Format all new and modified records every hour, in HB.
 """, help_specific_usage="""  -o,  --format         \t Specify output format (default HB)
   -n,  --noprocess      \t Count records to be formatted (no processing done)
@@ -440,6 +499,8 @@ Reformatting options:
   -f,  --field          \t Force reformatting records by field
   -p,  --pattern        \t Force reformatting records by pattern
   -i,  --id             \t Force reformatting records by record id(s)
+Processing options:
+       --parallel=N     \t Format records in N processes in parallel (default 1)
 Pattern options:
   -m,  --matching       \t Specify if pattern is exact (e), regular expression (r),
                         \t partial (p), any of the words (o) or all of the words (a)
@@ -453,7 +514,8 @@ Pattern options:
                  "pattern=",
                  "format=",
                  "noprocess",
-                 "id="]),
+                 "id=",
+                 "parallel="]),
             task_submit_check_options_fnc=task_submit_check_options,
             task_submit_elaborate_specific_parameter_fnc=task_submit_elaborate_specific_parameter,
             task_run_fnc=task_run_core)
@@ -486,6 +548,15 @@ def task_submit_elaborate_specific_parameter(key, value, opts, args):
         task_set_option("format", value)
     elif key in ("-i","--id"):
         task_set_option("recids", value)
+    elif key in ("--parallel",):
+        try:
+            parallel = int(value)
+        except ValueError:
+            parallel = 0
+        if parallel < 1:
+            print >> sys.stderr, "ERROR: --parallel expects a positive number of processes, not '%s'." % value
+            return False
+        task_set_option("parallel", parallel)
     else:
         return False
     return True
@@ -62,7 +62,7 @@ from invenio.shellutils import run_shell_command
 ## precompile some often-used regexp for speed reasons:
 REGEXP_OAI_ID = re.compile("<identifier.*?>(.*?)<\/identifier>", re.DOTALL)
 REGEXP_RECORD = re.compile("<record.*?>(.*?)</record>", re.DOTALL)
-REGEXP_REFS = re.compile("<record.*?>.*?<controlfield .*?>.*?</controlfield>(.*?)</record>", re.DOTALL)
+REGEXP_REFS_RECORD = re.compile("<record.*?>.*?<controlfield .*?>(.*?)</controlfield>(.*?)</record>", re.DOTALL)
 
 def get_nb_records_in_file(filename):
     """
@@ -658,7 +658,8 @@ def call_refextract(active_file, extracted_file, harvested_identifier_list,
     """ 
     Function that calls refextractor to extract references and attach them to
     harvested records. It will download the fulltext-pdf for each identifier
-    if necessary.
+    if necessary. The references of all the records of active_file are
+    extracted in one batch, using --parallel processes.
 
     @param active_file: path to the currently processed file
     @param extracted_file: path to the file where the final results will be saved
@@ -669,28 +670,23 @@ def call_refextract(active_file, extracted_file, harvested_identifier_list,
     """
     all_err_msg = []
     exitcode = 0
-    flag = ""
+    kb_journal = None
     if CFG_INSPIRE_SITE == 1:
-        flag = "--inspire --kb-journal '%s/bibedit/refextract-journal-titles-INSPIRE.kb'" \
-                % (CFG_ETCDIR,)
+        kb_journal = "%s/bibedit/refextract-journal-titles-INSPIRE.kb" \
+                     % (CFG_ETCDIR,)
     # Read in active file
     recs_fd = open(active_file, 'r')
     records = recs_fd.read()
     recs_fd.close()
 
-    # Find all record
+    # Find all record and download their fulltext
     record_xmls = REGEXP_RECORD.findall(records)
-    updated_xml = ['<?xml version="1.0" encoding="UTF-8"?>']
-    updated_xml.append('<collection>')
+    extract_jobs = []
     i = 0
     for record_xml in record_xmls:
-        current_exitcode = 0
         identifier = harvested_identifier_list[i]
-        i += 1
         if identifier not in downloaded_files:
             downloaded_files[identifier] = {}
-        updated_xml.append("<record>")
-        updated_xml.append(record_xml)
         if "pdf" not in downloaded_files[identifier]:
             current_exitcode, err_msg, dummy, pdf = \
                         plotextractor_harvest(identifier, active_file, selection=["pdf"])
@@ -699,21 +695,67 @@ def call_refextract(active_file, extracted_file, harvested_identifier_list,
                 all_err_msg.append(err_msg)
             else:
                 downloaded_files[identifier]["pdf"] = pdf
-        if current_exitcode == 0:
-            current_exitcode, cmd_stdout, err_msg = run_shell_command(cmd="%s/refextract %s 1:'%s'" % \
-                                                (CFG_BINDIR, flag, downloaded_files[identifier]["pdf"]))
-            if err_msg != "" or current_exitcode != 0:
-                exitcode = current_exitcode
-                all_err_msg.append("Error extracting references from id: %s\nError:%s" % \
-                         (identifier, err_msg))
-            else:
-                references_xml = REGEXP_REFS.search(cmd_stdout)
-                if references_xml:
-                    updated_xml.append(references_xml.group(1))
-                else:
-                    all_err_msg.append("No references found for id: %s %s\n" % \
-                             (identifier, pdf))
+        if "pdf" in downloaded_files[identifier]:
+            # the record position is used as recid of the extraction job
+            extract_jobs.append((str(i), downloaded_files[identifier]["pdf"]))
+        i += 1
+
+    # Extract the references of the whole file in one batch
+    references = {}
+    if extract_jobs:
+        references_file = "%s.references" % (extracted_file,)
+        try:
+            # refextract is heavy to import (it compiles its regexps and
+            # reads its knowledge bases), so only do it when needed:
+            from invenio import refextract
+            previous_inspire_opt = refextract.cli_opts['inspire']
+            if CFG_INSPIRE_SITE == 1:
+                refextract.cli_opts['inspire'] = 1
+            try:
+                failed_jobs = refextract.extract_references_batch(extract_jobs,
+                                  xmlfile=references_file,
+                                  kbs=refextract.get_knowledge_bases(kb_journal),
+                                  parallel=task_get_option("parallel", 1))[0]
+            finally:
+                refextract.cli_opts['inspire'] = previous_inspire_opt
+            batch_failed = False
+        except (Exception, SystemExit), err:
+            # refextract may even exit, which must not stop the harvest:
+            exitcode = 1
+            all_err_msg.append("Error extracting references from %s:\n%s" % \
+                               (active_file, err))
+            for (position, fpath) in extract_jobs:
+                references[int(position)] = ""
+            failed_jobs = []
+            batch_failed = True
+        for (position, fpath) in failed_jobs:
+            exitcode = 1
+            references[int(position)] = ""
+            all_err_msg.append("Error extracting references from id: %s\nError:could not open %s for extraction." % \
+                     (harvested_identifier_list[int(position)], fpath))
+        if not batch_failed:
+            refs_fd = open(references_file, 'r')
+            for (position, references_xml) in \
+                    REGEXP_REFS_RECORD.findall(refs_fd.read()):
+                references[int(position)] = references_xml
+            refs_fd.close()
+        if os.path.exists(references_file):
+            os.remove(references_file)
+
+    updated_xml = ['<?xml version="1.0" encoding="UTF-8"?>']
+    updated_xml.append('<collection>')
+    i = 0
+    for record_xml in record_xmls:
+        updated_xml.append("<record>")
+        updated_xml.append(record_xml)
+        if i in references:
+            updated_xml.append(references[i])
+        elif "pdf" in downloaded_files[harvested_identifier_list[i]]:
+            all_err_msg.append("No references found for id: %s %s\n" % \
+                     (harvested_identifier_list[i],
+                      downloaded_files[harvested_identifier_list[i]]["pdf"]))
         updated_xml.append("</record>")
+        i += 1
     updated_xml.append('</collection>')
     # Write to file
     file_fd = open(extracted_file, 'w')
@@ -1200,9 +1242,10 @@ Automatic (periodical) harvesting mode:
               '  -w, --password       password (in case of password-protected harvesting)\n'
               'Automatic periodical harvesting mode:\n'
               '  -r, --repository="repo A"[,"repo B"] \t which repositories to harvest (default=all)\n'
-              '  -d, --dates=yyyy-mm-dd:yyyy-mm-dd \t reharvest given dates only\n',
+              '  -d, --dates=yyyy-mm-dd:yyyy-mm-dd \t reharvest given dates only\n'
+              '  --parallel=N \t\t\t\t number of processes extracting references (default=1)\n',
             version=__revision__,
-            specific_params=("r:d:", ["repository=", "dates=", ]),
+            specific_params=("r:d:", ["repository=", "dates=", "parallel=", ]),
             task_submit_elaborate_specific_parameter_fnc=
                 task_submit_elaborate_specific_parameter,
             task_run_fnc=task_run_core)
@@ -1215,6 +1258,15 @@ def task_submit_elaborate_specific_parameter(key, value, opts, args):
         task_set_option('dates', get_dates(value))
         if value is not None and task_get_option("dates") is None:
             raise StandardError, "Date format not valid."
+    elif key in ("--parallel",):
+        try:
+            parallel = int(value)
+        except ValueError:
+            parallel = 0
+        if parallel < 1:
+            print >> sys.stderr, "ERROR: --parallel expects a positive number of processes, not '%s'." % value
+            return False
+        task_set_option('parallel', parallel)
     else:
         return False
     return True
@@ -19,17 +19,12 @@
 
 __revision__ = "$Id$"
 
-import cPickle
-import os
 import re
 import cgi
 import urllib
 import time
-import sys
-if sys.hexversion < 0x2060000:
-    from md5 import md5
-else:
-    from hashlib import md5
+import base64
+import bisect
 
 from invenio.config import \
      CFG_OAI_DELETED_POLICY, \
@@ -38,7 +33,6 @@ from invenio.config import \
      CFG_OAI_ID_FIELD, \
      CFG_OAI_LOAD, \
      CFG_OAI_SET_FIELD, \
-     CFG_CACHEDIR, \
      CFG_SITE_NAME, \
      CFG_SITE_SUPPORT_EMAIL, \
      CFG_SITE_URL
@@ -473,62 +467,14 @@ def oailistmetadataformats(args):
 def oailistrecords(args):
     "Generates response to oailistrecords verb."
 
-    arg = parse_args(args)
-
-    out = ""
-    resumptionToken_printed = False
+    return ''.join(oailistrecords_iter(args))
 
-    sysnos = []
-    sysno  = []
-    # check if the resumptionToken did not expire
-    if arg['resumptionToken']:
-        filename = os.path.join(CFG_CACHEDIR, 'RTdata', arg['resumptionToken'])
-        if os.path.exists(filename) == 0:
-            out = oai_error("badResumptionToken", "ResumptionToken expired")
-            out = oai_error_header(args, "ListRecords") + out + oai_error_footer("ListRecords")
-            return out
-
-    if arg['resumptionToken'] != "":
-        sysnos = oaicacheout(arg['resumptionToken'])
-        arg['metadataPrefix'] = sysnos.pop()
-    else:
-        sysnos = oaigetsysnolist(arg['set'], arg['from'], arg['until'])
+def oailistrecords_iter(args):
+    """Generates response to oailistrecords verb, chunk by chunk, so
+    that the records can be sent to the harvester as soon as they are
+    formatted."""
 
-    if len(sysnos) == 0: # noRecordsMatch error
-
-        out = out + oai_error("noRecordsMatch", "no records correspond to the request")
-        out = oai_error_header(args, "ListRecords") + out + oai_error_footer("ListRecords")
-        return out
-
-    i = 0
-    for sysno_ in sysnos:
-        if sysno_:
-            if i >= CFG_OAI_LOAD:          # cache or write?
-                if not resumptionToken_printed: # resumptionToken?
-                    arg['resumptionToken'] = oaigenresumptionToken()
-                    extdate = oaigetresponsedate(CFG_OAI_EXPIRE)
-                    if extdate:
-                        out = "%s <resumptionToken expirationDate=\"%s\">%s</resumptionToken>\n" % (out, extdate, arg['resumptionToken'])
-                    else:
-                        out = "%s <resumptionToken>%s</resumptionToken>\n" % (out, arg['resumptionToken'])
-                    resumptionToken_printed = True
-                sysno.append(sysno_)
-            else:
-                _record_exists = record_exists(sysno_)
-                if not (_record_exists == -1 and CFG_OAI_DELETED_POLICY == "no"):
-                    #Produce output only if record exists and had to be printed
-                    i = i + 1 # Increment limit only if record is returned
-                    res = print_record(sysno_, arg['metadataPrefix'], _record_exists)
-                    if res:
-                        out += res
-
-    if resumptionToken_printed:
-        oaicacheclean()
-        sysno.append(arg['metadataPrefix'])
-        oaicachein(arg['resumptionToken'], sysno)
-
-    out = oai_header(args, "ListRecords") + out + oai_footer("ListRecords")
-    return out
+    return oailist_iter(args, "ListRecords")
 
 def oailistsets(args):
     "Lists available sets for OAI metadata harvesting."
@@ -582,75 +528,107 @@ def oaigetrecord(args):
 def oailistidentifiers(args):
     "Prints OAI response to the ListIdentifiers verb."
 
-    arg = parse_args(args)
+    return ''.join(oailistidentifiers_iter(args))
+
+def oailistidentifiers_iter(args):
+    """Prints OAI response to the ListIdentifiers verb, chunk by chunk,
+    so that the headers can be sent to the harvester as they come."""
+
+    return oailist_iter(args, "ListIdentifiers")
+
+def print_record_header(sysno, record_exists_result):
+    """Prints the OAI header of record 'sysno' for the ListIdentifiers
+    verb.  Deleted records are printed only if CFG_OAI_DELETED_POLICY
+    allows it."""
 
     out = ""
-    resumptionToken_printed = False
+    for ident in get_field(sysno, CFG_OAI_ID_FIELD):
+        if ident != '':
+            if record_exists_result == -1: #Deleted?
+                if CFG_OAI_DELETED_POLICY == "persistent" \
+                       or CFG_OAI_DELETED_POLICY == "transient":
+                    out = out + "    <header status=\"deleted\">\n"
+                else:
+                    # In that case, print nothing (do not go further)
+                    break
+            else:
+                out = out + "    <header>\n"
+            out = "%s      <identifier>%s</identifier>\n" % (out, escape_space(ident))
+            out = "%s      <datestamp>%s</datestamp>\n" % (out, get_modification_date(sysno))
+            for set in get_field(sysno, CFG_OAI_SET_FIELD):
+                if set:
+                    # Print only if field not empty
+                    out = "%s      <setSpec>%s</setSpec>\n" % (out, set)
+            out = out + "    </header>\n"
+    return out
 
-    sysno  = []
-    sysnos = []
+def oailist_iter(args, verb):
+    """Generates the response to the ListRecords or ListIdentifiers
+    'verb', chunk by chunk.
 
-    if arg['resumptionToken']:
-        filename = os.path.join(CFG_CACHEDIR, 'RTdata', arg['resumptionToken'])
-        if os.path.exists(filename) == 0:
-            out = out + oai_error("badResumptionToken", "ResumptionToken expired")
-            out = oai_error_header(args, "ListIdentifiers") + out + oai_error_footer("ListIdentifiers")
-            return out
+    At most CFG_OAI_LOAD records are printed per response.  The
+    resumptionToken given for the next records carries the whole state
+    of the harvest (see oaigenresumptionToken()), so that nothing needs
+    to be stored on the server side: the record list is simply searched
+    again and continued after the last record already served.
+    """
+
+    arg = parse_args(args)
 
     if arg['resumptionToken']:
-        sysnos = oaicacheout(arg['resumptionToken'])
+        state = oaiparseresumptionToken(arg['resumptionToken'])
+        if state is None:
+            yield oai_error_header(args, verb) + \
+                  oai_error("badResumptionToken", "ResumptionToken expired") + \
+                  oai_error_footer(verb)
+            return
+        metadataprefix, set, fromdate, untildate, last_sysno = state
     else:
-        sysnos = oaigetsysnolist(arg['set'], arg['from'], arg['until'])
+        metadataprefix = arg['metadataPrefix']
+        set = arg['set']
+        fromdate = arg['from'] and normalize_date(arg['from'], "T00:00:00Z")
+        # freeze the upper bound of the harvest, so that the following
+        # pages see the same list of records:
+        untildate = (arg['until'] and normalize_date(arg['until'], "T23:59:59Z")) \
+                    or get_latest_datestamp()
+        last_sysno = 0
+
+    sysnos = oaigetsysnolist(set, fromdate, untildate)
+    sysnos = sysnos[bisect.bisect_right(sysnos, last_sysno):]
 
     if len(sysnos) == 0: # noRecordsMatch error
-        out = out + oai_error("noRecordsMatch", "no records correspond to the request")
-        out = oai_error_header(args, "ListIdentifiers") + out + oai_error_footer("ListIdentifiers")
-        return out
+        yield oai_error_header(args, verb) + \
+              oai_error("noRecordsMatch", "no records correspond to the request") + \
+              oai_error_footer(verb)
+        return
+
+    yield oai_header(args, verb)
 
     i = 0
-    for sysno_ in sysnos:
-        if sysno_:
-            if i >= CFG_OAI_LOAD:           # cache or write?
-                if not resumptionToken_printed: # resumptionToken?
-                    arg['resumptionToken'] = oaigenresumptionToken()
-                    extdate = oaigetresponsedate(CFG_OAI_EXPIRE)
-                    if extdate:
-                        out = "%s  <resumptionToken expirationDate=\"%s\">%s</resumptionToken>\n" % (out, extdate, arg['resumptionToken'])
-                    else:
-                        out = "%s  <resumptionToken>%s</resumptionToken>\n" % (out, arg['resumptionToken'])
-                    resumptionToken_printed = True
-                sysno.append(sysno_)
+    for sysno in sysnos:
+        if i >= CFG_OAI_LOAD:
+            resumptionToken = oaigenresumptionToken(metadataprefix, set,
+                                                    fromdate, untildate,
+                                                    last_sysno)
+            extdate = oaigetresponsedate(CFG_OAI_EXPIRE)
+            if extdate:
+                yield "  <resumptionToken expirationDate=\"%s\">%s</resumptionToken>\n" % (extdate, resumptionToken)
             else:
-                _record_exists = record_exists(sysno_)
-                if (not _record_exists == -1 and CFG_OAI_DELETED_POLICY == "no"):
-                    i = i + 1 # Increment limit only if record is returned
-                for ident in get_field(sysno_, CFG_OAI_ID_FIELD):
-                    if ident != '':
-                        if _record_exists == -1: #Deleted?
-                            if CFG_OAI_DELETED_POLICY == "persistent" \
-                                   or CFG_OAI_DELETED_POLICY == "transient":
-                                out = out + "    <header status=\"deleted\">\n"
-                            else:
-                                # In that case, print nothing (do not go further)
-                                break
-                        else:
-                            out = out + "    <header>\n"
-                        out = "%s      <identifier>%s</identifier>\n" % (out, escape_space(ident))
-                        out = "%s      <datestamp>%s</datestamp>\n" % (out, get_modification_date(oaigetsysno(ident)))
-                        for set in get_field(sysno_, CFG_OAI_SET_FIELD):
-                            if set:
-                                # Print only if field not empty
-                                out = "%s      <setSpec>%s</setSpec>\n" % (out, set)
-                        out = out + "    </header>\n"
-
-    if resumptionToken_printed:
-        oaicacheclean() # clean cache from expired resumptionTokens
-        oaicachein(arg['resumptionToken'], sysno)
-
-    out = oai_header(args, "ListIdentifiers") + out + oai_footer("ListIdentifiers")
-
-    return out
+                yield "  <resumptionToken>%s</resumptionToken>\n" % resumptionToken
+            break
+        last_sysno = sysno
+        _record_exists = record_exists(sysno)
+        if not (_record_exists == -1 and CFG_OAI_DELETED_POLICY == "no"):
+            # Produce output only if record exists and had to be printed
+            i = i + 1 # Increment limit only if record is returned
+            if verb == "ListRecords":
+                res = print_record(sysno, metadataprefix, _record_exists)
+            else:
+                res = print_record_header(sysno, _record_exists)
+            if res:
+                yield res
 
+    yield oai_footer(verb)
 
 def oaiidentify(args, script_url):
     """Generates a response to oaiidentify verb.
@@ -740,70 +718,40 @@ def oaigetsysnolist(set="", fromdate="", untildate=""):
                                     ap=0)
     return recids
 
-def oaigenresumptionToken():
-    "Generates unique ID for resumption token management."
-
-    return md5(str(time.time())).hexdigest()
-
-
-def oaicachein(resumptionToken, sysnos):
-    "Stores or adds sysnos in cache.  Input is a string of sysnos separated by commas."
+def oaigenresumptionToken(metadataprefix, set, fromdate, untildate, last_sysno):
+    """Generates the resumptionToken of the harvest of 'set' in format
+    'metadataprefix', between 'fromdate' and 'untildate', that has
+    been served up to record 'last_sysno'.
 
-    filename = os.path.join(CFG_CACHEDIR, 'RTdata', resumptionToken)
+    The token is the URL-safe base64 encoding of these values and of
+    its issue time, so that it can be checked and decoded by
+    oaiparseresumptionToken() without any server-side storage."""
 
-    fil = open(filename, "w")
-    cPickle.dump(sysnos, fil)
-    fil.close()
-    return 1
+    token = "\t".join([metadataprefix, set, fromdate, untildate,
+                       str(last_sysno), str(int(time.time()))])
+    return base64.urlsafe_b64encode(token).rstrip('=')
 
 
-def oaicacheout(resumptionToken):
-    "Restores string of comma-separated system numbers from cache."
+def oaiparseresumptionToken(resumptionToken):
+    """Returns the harvest state (metadataprefix, set, fromdate,
+    untildate, last_sysno) stored in 'resumptionToken', or None if the
+    token is invalid or expired."""
 
-    sysnos = []
+    try:
+        token = base64.urlsafe_b64decode(resumptionToken + \
+                                         '=' * (-len(resumptionToken) % 4))
+        metadataprefix, set, fromdate, untildate, last_sysno, issued = \
+                        token.split("\t")
+        last_sysno = int(last_sysno)
+        issued = int(issued)
+    except (TypeError, ValueError):
+        return None
 
-    filename = os.path.join(CFG_CACHEDIR, 'RTdata', resumptionToken)
+    if metadataprefix not in params['metadataPrefix'] or \
+           time.time() - issued > CFG_OAI_EXPIRE:
+        return None
 
-    if oaicachestatus(resumptionToken):
-        fil = open(filename, "r")
-        sysnos = cPickle.load(fil)
-        fil.close()
-    else:
-        return 0
-    return sysnos
-
-
-def oaicacheclean():
-    "Removes cached resumptionTokens older than specified"
-
-    directory = os.path.join(CFG_CACHEDIR, 'RTdata')
-
-    files = os.listdir(directory)
-
-    for file_ in files:
-        filename = os.path.join(directory, file_)
-        # cache entry expires when not modified during a specified period of time
-        if ((time.time() - os.path.getmtime(filename)) > CFG_OAI_EXPIRE):
-            try:
-                os.remove(filename)
-            except OSError, e:
-                # Most probably the cache was already deleted
-                pass
-    return 1
-
-
-def oaicachestatus(resumptionToken):
-    "Checks cache status.  Returns 0 for empty, 1 for full."
-
-    filename = os.path.join(CFG_CACHEDIR, 'RTdata', resumptionToken)
-
-    if os.path.exists(filename):
-        if os.path.getsize(filename) > 0:
-            return 1
-        else:
-            return 0
-    else:
-        return 0
+    return metadataprefix, set, fromdate, untildate, last_sysno
 
 
 def get_sets():
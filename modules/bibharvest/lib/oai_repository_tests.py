@@ -24,6 +24,8 @@ __revision__ = "$Id$"
 
 import unittest
 import re
+import time
+import base64
 
 from invenio import oai_repository_server
 from invenio.testutils import make_test_suite, run_test_suite
@@ -84,9 +86,34 @@ class TestEncodings(unittest.TestCase):
 
 
 
+class TestResumptionToken(unittest.TestCase):
+    """Test for OAI resumptionToken management."""
+
+    def test_resumption_token_roundtrip(self):
+        """oairepository - testing resumptionToken encoding"""
+        token = oai_repository_server.oaigenresumptionToken("marcxml", "cern:theory",
+                                                            "2001-01-01T00:00:00Z",
+                                                            "2002-01-01T23:59:59Z", 42)
+        self.assertEqual(None, re.search("[^A-Za-z0-9_-]", token))
+        self.assertEqual(("marcxml", "cern:theory", "2001-01-01T00:00:00Z",
+                          "2002-01-01T23:59:59Z", 42),
+                         oai_repository_server.oaiparseresumptionToken(token))
+
+    def test_resumption_token_invalid(self):
+        """oairepository - testing invalid and expired resumptionTokens"""
+        self.assertEqual(None, oai_repository_server.oaiparseresumptionToken("foo"))
+        self.assertEqual(None, oai_repository_server.oaiparseresumptionToken(""))
+        expired = "\t".join(["marcxml", "", "", "", "42",
+                             str(int(time.time() - oai_repository_server.CFG_OAI_EXPIRE - 10))])
+        self.assertEqual(None, oai_repository_server.oaiparseresumptionToken(
+            base64.urlsafe_b64encode(expired).rstrip('=')))
+        self.assertNotEqual(None, re.search("badResumptionToken",
+                                            oai_repository_server.oailistrecords("resumptionToken=foo")))
+
 TEST_SUITE = make_test_suite(TestVerbs,
                              TestErrorCodes,
-                             TestEncodings,)
+                             TestEncodings,
+                             TestResumptionToken,)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE)
@@ -114,13 +114,15 @@ class WebInterfaceOAIProviderPages(WebInterfaceDirectory):
             ## OAI ListIdentifiers
 
             elif argd['verb'] == "ListIdentifiers":
-                req.write(oai_repository_server.oailistidentifiers(args))
+                for chunk in oai_repository_server.oailistidentifiers_iter(args):
+                    req.write(chunk)
 
 
             ## OAI ListRecords
 
             elif argd['verb'] == "ListRecords":
-                req.write(oai_repository_server.oailistrecords(args))
+                for chunk in oai_repository_server.oailistrecords_iter(args):
+                    req.write(chunk)
 
 
             ## OAI GetRecord
@@ -29,6 +29,8 @@ import sys
 import time
 import urllib2
 import logging
+import zlib
+from array import array
 
 from invenio.config import \
      CFG_BIBINDEX_CHARS_ALPHANUMERIC_SEPARATORS, \
@@ -41,21 +43,24 @@ from invenio.config import \
      CFG_CERN_SITE, CFG_INSPIRE_SITE, \
      CFG_BIBINDEX_PERFORM_OCR_ON_DOCNAMES, \
      CFG_BIBINDEX_SPLASH_PAGES, \
+     CFG_BIBINDEX_TRIGRAM_TABLES, \
      CFG_SOLR_URL
 from invenio.websubmit_config import CFG_WEBSUBMIT_BEST_FORMATS_TO_EXTRACT_TEXT_FROM
 from invenio.bibindex_engine_config import CFG_MAX_MYSQL_THREADS, \
     CFG_MYSQL_THREAD_TIMEOUT, \
     CFG_CHECK_MYSQL_THREADS
 from invenio.bibindex_engine_tokenizer import BibIndexFuzzyNameTokenizer, \
-     BibIndexExactNameTokenizer
+     BibIndexExactNameTokenizer, BibIndexTrigramTokenizer
 from invenio.bibdocfile import bibdocfile_url_p, \
      bibdocfile_url_to_bibdoc, normalize_format, \
      download_url, guess_format_from_url, BibRecDocs
 from invenio.websubmit_file_converter import convert_file, get_file_converter_logger
 from invenio.search_engine import perform_request_search, strip_accents, \
-     wash_index_term, lower_index_term, get_index_stemming_language
-from invenio.dbquery import run_sql, DatabaseError, serialize_via_marshal, \
-     deserialize_via_marshal
+     wash_index_term, lower_index_term, get_index_stemming_language, \
+     normalize_sort_tag_values, get_sort_value
+from invenio.search_engine_config import CFG_WEBSEARCH_SORT_RANK_TYPECODE
+from invenio.dbquery import run_sql, run_sql_many, DatabaseError, \
+     serialize_via_marshal, deserialize_via_marshal, get_table_update_time
 from invenio.bibindex_engine_stopwords import is_stopword
 from invenio.bibindex_engine_stemmer import stem
 from invenio.bibtask import task_init, write_message, get_datetime, \
@@ -94,6 +99,7 @@ re_arxiv = re.compile(r'^arxiv:\d\d\d\d\.\d\d\d\d')
 nb_char_in_line = 50  # for verbose pretty printing
 chunksize = 1000 # default size of chunks that the records will be treated by
 base_process_size = 4500 # process base size
+trigram_chunksize = 50000 # number of bibxxx values indexed between trigram table flushes
 _last_word_table = None
 
 def list_union(list1, list2):
@@ -755,6 +761,147 @@ def update_index_last_updated(index_id, starting_time=None):
     return run_sql("UPDATE idxINDEX SET last_updated=%s WHERE id=%s",
                     (starting_time, index_id,))
 
+def get_sort_fields():
+    """Returns the list of (field_id, field_code, field_tags) tuples of
+       the fields proposed as sort options in some collection.  These
+       are the fields for which BibIndex maintains the sort index."""
+    out = []
+    res = run_sql("""SELECT DISTINCT f.id, f.code FROM field AS f,
+                     collection_field_fieldvalue AS cff
+                     WHERE cff.type='soo' AND cff.id_field=f.id""")
+    for field_id, field_code in res:
+        tags = get_field_tags(field_code)
+        if tags:
+            out.append((field_id, field_code, tags))
+    return out
+
+def update_sort_index(sort_fields, recID1, recID2):
+    """Update the sort values (idxSORT table) of the SORT_FIELDS for
+       records from RECID1 to RECID2.  The sort value of a record is
+       the normalized value that search_engine.sort_records() sorts
+       it by in absence of sort pattern."""
+    for field_id, field_code, tags in sort_fields:
+        vals = {}
+        for tag in tags:
+            bibXXx = "bib" + tag[0] + tag[1] + "x"
+            bibrec_bibXXx = "bibrec_" + bibXXx
+            query = """SELECT bb.id_bibrec, b.value FROM %s AS b, %s AS bb
+                    WHERE bb.id_bibrec BETWEEN %%s AND %%s
+                    AND bb.id_bibxxx=b.id AND tag LIKE %%s
+                    ORDER BY bb.id_bibrec, bb.field_number, b.tag""" % (bibXXx, bibrec_bibXXx)
+            tag_vals = {}
+            for recID, value in run_sql(query, (recID1, recID2, tag)):
+                tag_vals.setdefault(recID, []).append(value)
+            for recID, values in tag_vals.iteritems():
+                vals.setdefault(recID, []).extend(normalize_sort_tag_values(tag, values))
+        run_sql("DELETE FROM idxSORT WHERE id_field=%s AND id_bibrec BETWEEN %s AND %s",
+                (field_id, recID1, recID2))
+        params = [(field_id, recID, wash_for_utf8(get_sort_value(values)[:255]))
+                  for recID, values in vals.iteritems()]
+        if params:
+            run_sql_many("INSERT INTO idxSORT (id_field,id_bibrec,value) VALUES (%s,%s,%s)",
+                         params)
+
+def delete_from_sort_index(recID1, recID2):
+    """Delete the sort values of records from RECID1 to RECID2."""
+    run_sql("DELETE FROM idxSORT WHERE id_bibrec BETWEEN %s AND %s",
+            (recID1, recID2))
+
+def update_sort_ranks(sort_fields):
+    """Recompute the record ranks (idxSORTRANK table) of the
+       SORT_FIELDS out of their sort values, so that WebSearch can sort
+       hitsets of any size by simple rank lookups.  The rank of records
+       without values is 0, other records are ranked from 1 according
+       to their sort value, equal values having equal ranks.  Ranks
+       are recomputed only if the sort values changed since the last
+       computation."""
+    starting_time = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    sort_index_update_time = get_table_update_time('idxSORT')
+    last_updated = {}
+    for field_id, field_last_updated in run_sql("SELECT id_field, last_updated FROM idxSORTRANK"):
+        last_updated[field_id] = field_last_updated and str(field_last_updated) or ''
+    res = run_sql("SELECT MAX(id) FROM bibrec")
+    max_recID = res and res[0][0] or 0
+    for field_id, field_code, tags in sort_fields:
+        if last_updated.get(field_id, '') >= sort_index_update_time:
+            write_message("sort ranks of field %s are up to date" % field_code, verbose=2)
+            continue
+        write_message("updating sort ranks of field %s..." % field_code, verbose=2)
+        task_update_progress("Updating sort ranks of field %s" % field_code)
+        res = run_sql("SELECT id_bibrec, value FROM idxSORT WHERE id_field=%s",
+                      (field_id,))
+        values = dict.fromkeys([row[1] for row in res if row[1]]).keys()
+        values.sort()
+        value_ranks = {}
+        for i in xrange(len(values)):
+            value_ranks[values[i]] = i + 1
+        ranks = array(CFG_WEBSEARCH_SORT_RANK_TYPECODE, [0]) * (max_recID + 1)
+        for recID, value in res:
+            if recID <= max_recID:
+                ranks[recID] = value_ranks.get(value, 0)
+        run_sql("REPLACE INTO idxSORTRANK (id_field,ranks,last_updated) VALUES (%s,%s,%s)",
+                (field_id, zlib.compress(ranks.tostring()), starting_time))
+        task_sleep_now_if_required()
+    # forget about fields that are no longer sort options:
+    field_ids = [field_id for field_id, field_code, tags in sort_fields]
+    for field_id in last_updated.keys():
+        if field_id not in field_ids:
+            run_sql("DELETE FROM idxSORTRANK WHERE id_field=%s", (field_id,))
+            run_sql("DELETE FROM idxSORT WHERE id_field=%s", (field_id,))
+
+def update_trigram_index(bibxxx, rebuild=False):
+    """Index by trigrams the values of the BIBXXX table (e.g. 'bib10x')
+       that were not indexed yet, or all of them if REBUILD is True.
+       The idxTRIGRAM table maps each trigram of the washed values to
+       the hitlist of bibxxx value ids containing it.  Since bibxxx
+       values are never modified, only the values added since the
+       last run are indexed, and the index stays consistent at each
+       flush.  WebSearch uses it to narrow down regexp and substring
+       searches."""
+    if not re.match(r'^bib\d\dx$', bibxxx):
+        write_message("ignoring invalid trigram table %s" % bibxxx, stream=sys.stderr)
+        return
+    res = run_sql("SELECT last_id FROM idxTRIGRAMSTATUS WHERE bibxxx=%s", (bibxxx,))
+    if rebuild or not res:
+        run_sql("DELETE FROM idxTRIGRAMSTATUS WHERE bibxxx=%s", (bibxxx,))
+        run_sql("DELETE FROM idxTRIGRAM WHERE bibxxx=%s", (bibxxx,))
+        last_id = 0
+    else:
+        last_id = res[0][0]
+    res = run_sql("SELECT MAX(id) FROM %s" % bibxxx)
+    max_id = res and res[0][0] or 0
+    if last_id >= max_id:
+        write_message("trigram index of %s is up to date" % bibxxx, verbose=2)
+        return
+    write_message("updating trigram index of %s for values %d-%d..." % \
+                  (bibxxx, last_id + 1, max_id), verbose=2)
+    tokenizer = BibIndexTrigramTokenizer()
+    while last_id < max_id:
+        upper_id = min(last_id + trigram_chunksize, max_id)
+        task_update_progress("Updating trigram index of %s: %d/%d values" % \
+                             (bibxxx, last_id, max_id))
+        postings = {}
+        for value_id, value in run_sql("SELECT id, value FROM %s WHERE id>%%s AND id<=%%s" % bibxxx,
+                                       (last_id, upper_id)):
+            for trigram in tokenizer.tokenize(value):
+                postings.setdefault(trigram, []).append(value_id)
+        for trigram, value_ids in postings.iteritems():
+            res = run_sql("SELECT hitlist FROM idxTRIGRAM WHERE bibxxx=%s AND term=%s",
+                          (bibxxx, trigram))
+            if res:
+                hitlist = intbitset(res[0][0])
+                hitlist |= intbitset(value_ids)
+                run_sql("UPDATE idxTRIGRAM SET hitlist=%s WHERE bibxxx=%s AND term=%s",
+                        (hitlist.fastdump(), bibxxx, trigram))
+            else:
+                run_sql("INSERT INTO idxTRIGRAM (bibxxx, term, hitlist) VALUES (%s, %s, %s)",
+                        (bibxxx, trigram, intbitset(value_ids).fastdump()))
+        run_sql("REPLACE INTO idxTRIGRAMSTATUS (bibxxx, last_id, last_updated) VALUES (%s, %s, NOW())",
+                (bibxxx, upper_id))
+        last_id = upper_id
+        task_sleep_now_if_required(can_stop_too=True)
+    write_message("trigram index of %s updated" % bibxxx, verbose=2)
+
 #def update_text_extraction_date(first_recid, last_recid):
     #"""for all the bibdoc connected to the specified recid, set
     #the text_extraction_date to the task_starting_time."""
@@ -763,7 +910,7 @@ def update_index_last_updated(index_id, starting_time=None):
 class WordTable:
     "A class to hold the words table."
 
-    def __init__(self, index_name, index_id, fields_to_index, table_name_pattern, default_get_words_fnc, tag_to_words_fnc_map, wash_index_terms=50, is_fulltext_index=False):
+    def __init__(self, index_name, index_id, fields_to_index, table_name_pattern, default_get_words_fnc, tag_to_words_fnc_map, wash_index_terms=50, is_fulltext_index=False, sort_fields=None):
         """Creates words table instance.
         @param index_name: the index name
         @param index_id: the index integer identificator
@@ -775,6 +922,9 @@ class WordTable:
         @param wash_index_terms: do we wash index terms, and if yes (when >0),
             how many characters do we keep in the index terms; see
             max_char_length parameter of wash_index_term()
+        @param sort_fields: list of (field_id, field_code, field_tags) of
+            the sort fields whose sort index should be updated together
+            with this words table (see get_sort_fields())
         """
         self.index_name = index_name
         self.index_id = index_id
@@ -785,6 +935,7 @@ class WordTable:
         self.stemming_language = get_index_stemming_language(index_id)
         self.is_fulltext_index = is_fulltext_index
         self.wash_index_terms = wash_index_terms
+        self.sort_fields = sort_fields or []
 
         # tagToFunctions mapping. It offers an indirection level necessary for
         # indexing fulltext. The default is get_words_from_phrase
@@ -1064,6 +1215,8 @@ class WordTable:
         """Add records from RECID1 to RECID2."""
         wlist = {}
         self.recIDs_in_mem.append([recID1,recID2])
+        if self.sort_fields:
+            update_sort_index(self.sort_fields, recID1, recID2)
         # special case of author indexes where we also add author
         # canonical IDs:
         if self.index_name in ('author', 'firstauthor', 'exactauthor'):
@@ -1175,6 +1328,8 @@ class WordTable:
         count = 0
         for arange in recIDs:
             self.del_recID_range(arange[0],arange[1])
+            if self.sort_fields:
+                delete_from_sort_index(arange[0],arange[1])
             count = count + arange[1] - arange[0]
         self.put_into_db()
 
@@ -1549,6 +1704,11 @@ def task_run_core():
 
     # Let's work on single words!
     wordTables = get_word_tables(task_get_option("windex"))
+    # the sort index is updated together with the first words table:
+    sort_fields = []
+    if task_get_option("cmd") in ("add", "del"):
+        sort_fields = get_sort_fields()
+    sort_fields_to_update = sort_fields
     for index_id, index_name, index_tags in wordTables:
         is_fulltext_index = index_name == 'fulltext'
         reindex_prefix = ""
@@ -1569,7 +1729,9 @@ def task_run_core():
                               default_get_words_fnc=fnc_get_words_from_phrase,
                               tag_to_words_fnc_map={'8564_u': get_words_from_fulltext},
                               is_fulltext_index=is_fulltext_index,
-                              wash_index_terms=50)
+                              wash_index_terms=50,
+                              sort_fields=sort_fields_to_update)
+        sort_fields_to_update = []
         _last_word_table = wordTable
         wordTable.report_on_table_consistency()
         try:
@@ -1770,6 +1932,17 @@ def task_run_core():
         task_sleep_now_if_required(can_stop_too=True)
 
     _last_word_table = None
+
+    # Let's update the trigram index of bibxxx values now
+    if task_get_option("cmd") == "add" and not task_get_option("windex"):
+        for bibxxx in CFG_BIBINDEX_TRIGRAM_TABLES:
+            update_trigram_index(bibxxx, rebuild=task_get_option("reindex"))
+
+    # Let's recompute sort ranks now
+    if sort_fields and wordTables:
+        update_sort_ranks(sort_fields)
+        task_sleep_now_if_required(can_stop_too=True)
+
     return True
 
 
@@ -24,6 +24,7 @@ on the input string as tokens suitable for word or phrase indexing.
 """
 
 import re
+import unicodedata
 
 re_pattern_fuzzy_author_dots = re.compile(r'[\.\-]+')
 re_pattern_fuzzy_author_spaces = re.compile(r'\s+')
@@ -54,6 +55,18 @@ def author_name_requires_phrase_search(p):
         return True
     return False
 
+def wash_trigram_phrase(p):
+    """
+    Wash phrase p (UTF-8 string or Unicode) before computing its
+    trigrams: lowercase it and strip accents, character by character,
+    so that a substring of p always washes into a substring of the
+    washed p.  Return a Unicode string.
+    """
+    if not isinstance(p, unicode):
+        p = unicode(p, 'utf-8', 'replace')
+    return u''.join([c for c in unicodedata.normalize('NFKD', p.lower())
+                     if not unicodedata.combining(c)])
+
 class BibIndexTokenizer(object):
     """Base class for the tokenizers
 
@@ -374,6 +387,24 @@ class BibIndexFuzzyNameTokenizer(BibIndexTokenizer):
         return self.parse_scanned(self.scan(s))
 
 
+class BibIndexTrigramTokenizer(BibIndexTokenizer):
+    """
+    Trigram tokenizer, used to index bibxxx values for substring and
+    regular expression searches.
+    """
+
+    def tokenize(self, s):
+        """
+        Return the list of distinct trigrams (sequences of three
+        consecutive characters) of the washed s, as UTF-8 strings.
+        """
+        phrase = wash_trigram_phrase(s)
+        trigrams = {}
+        for i in range(len(phrase) - 2):
+            trigrams[phrase[i:i+3]] = 1
+        return [trigram.encode('utf-8') for trigram in trigrams.keys()]
+
+
 if __name__ == "__main__":
     """Trivial manual test framework"""
     import sys
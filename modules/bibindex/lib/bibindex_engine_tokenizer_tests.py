@@ -305,9 +305,34 @@ class TestExactNameTokenizer(unittest.TestCase):
                          ['Doe, Jean Pierre'])
 
 
+class TestTrigramTokenizer(unittest.TestCase):
+    """Test trigram tokenizer."""
+
+    def setUp(self):
+        self.tokenizer = tokenizer_lib.BibIndexTrigramTokenizer()
+
+    def test_trigram_tokenizer_short(self):
+        """BibIndexTrigramTokenizer - phrase shorter than a trigram"""
+        self.assertEqual(self.tokenizer.tokenize('ab'), [])
+
+    def test_trigram_tokenizer_distinct(self):
+        """BibIndexTrigramTokenizer - distinct lowercased trigrams"""
+        trigrams = self.tokenizer.tokenize('Ellis ellis')
+        trigrams.sort()
+        self.assertEqual(trigrams, [' el', 'ell', 'is ', 'lis', 'lli',
+                                    's e'])
+
+    def test_trigram_tokenizer_accents(self):
+        """BibIndexTrigramTokenizer - accents are stripped"""
+        trigrams = self.tokenizer.tokenize('M\xc3\xbcller')
+        trigrams.sort()
+        self.assertEqual(trigrams, ['ler', 'lle', 'mul', 'ull'])
+
+
 TEST_SUITE = make_test_suite(TestFuzzyNameTokenizerScanning,
                              TestFuzzyNameTokenizerTokens,
-                             TestExactNameTokenizer,)
+                             TestExactNameTokenizer,
+                             TestTrigramTokenizer,)
 
 
 if __name__ == '__main__':
@@ -30,7 +30,7 @@ if sys.hexversion < 0x2040000:
     from sets import Set as set
     # pylint: enable=W0622
 
-from invenio.dbquery import run_sql, serialize_via_marshal, \
+from invenio.dbquery import run_sql, run_sql_many, serialize_via_marshal, \
                             deserialize_via_marshal
 from invenio.search_engine import search_pattern, get_fieldvalues, \
                            search_unit
@@ -40,6 +40,14 @@ from invenio.bibtask import write_message, task_get_option, \
                      task_get_task_param
 from invenio.errorlib import register_exception
 
+## number of days during which the changes of the citation dictionaries
+## are kept in rnkCITATIONLOG for the citation searchers
+CFG_BIBRANK_CITATION_LOG_EXPIRY = 7
+
+## hashes of the lists of the citation dictionaries as last written
+## into rnkCITATIONDATA, by dictionary name and recid
+_cit_db_hashes = {}
+
 class memoise:
     def __init__(self, function):
         self.memo = {}
@@ -925,6 +933,7 @@ def insert_cit_ref_list_intodb(citation_dic, reference_dic, selfcbdic,
     insert_into_cit_db(citation_dic,"citationdict")
     insert_into_cit_db(selfcbdic,"selfcitedbydict")
     insert_into_cit_db(selfdic,"selfcitdict")
+    purge_cit_db_log()
 
     for a in authorcitdic.keys():
         lserarr = (serialize_via_marshal(authorcitdic[a]))
@@ -944,10 +953,34 @@ def insert_cit_ref_list_intodb(citation_dic, reference_dic, selfcbdic,
         except:
             register_exception(prefix="could not read/write rnkAUTHORDATA aterm="+a+" hitlist="+str(lserarr), alert_admin=True)
 
+def get_cit_dict_changes(dic, name):
+    """Return the list of (recid, list) pairs of citation dictionary
+       DIC that changed since it was last written into the database
+       under NAME, the list being None for removed recids.
+    """
+    if not _cit_db_hashes.has_key(name):
+        hashes = {}
+        for recid, value in get_cit_dict(name).iteritems():
+            hashes[recid] = hash(tuple(value))
+        _cit_db_hashes[name] = hashes
+    hashes = _cit_db_hashes[name]
+    changes = []
+    for recid, value in dic.iteritems():
+        value_hash = hash(tuple(value))
+        if hashes.get(recid) != value_hash:
+            changes.append((recid, value))
+            hashes[recid] = value_hash
+    for recid in hashes.keys():
+        if not dic.has_key(recid):
+            changes.append((recid, None))
+            del hashes[recid]
+    return changes
+
 def insert_into_cit_db(dic, name):
     """an aux thing to avoid repeating code"""
     ndate = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
     try:
+        changes = get_cit_dict_changes(dic, name)
         s = serialize_via_marshal(dic)
         write_message("size of "+name+" "+str(len(s)))
         #check that this column really exists
@@ -962,9 +995,34 @@ def insert_into_cit_db(dic, name):
                      (name,s))
         run_sql("UPDATE rnkCITATIONDATA SET last_updated = %s where object_name = %s",
                (ndate,name))
+        #log the changes only after the dictionary is written, so that
+        #the searchers never miss them
+        if len(changes) > 1000 and len(changes) * 2 > len(dic):
+            #cheaper for the searchers to reload the whole dictionary
+            changes = [(0, None)]
+        write_message("changes of "+name+" "+str(len(changes)), verbose=5)
+        params = []
+        for recid, value in changes:
+            if value is not None:
+                value = serialize_via_marshal(value)
+            params.append((name, recid, value, ndate))
+        if params:
+            run_sql_many("""INSERT INTO rnkCITATIONLOG(object_name, id_bibrec,
+                            object_value, last_updated) VALUES (%s,%s,%s,%s)""",
+                         params)
     except:
         register_exception(prefix="could not write "+name+" into db", alert_admin=True)
 
+def purge_cit_db_log():
+    """Remove the citation dictionary changes older than
+       CFG_BIBRANK_CITATION_LOG_EXPIRY days, except the last one,
+       which tells the searchers where the log stands.
+    """
+    res = run_sql("SELECT MAX(id) FROM rnkCITATIONLOG")
+    if res and res[0][0]:
+        run_sql("""DELETE FROM rnkCITATIONLOG WHERE id < %s AND
+                   last_updated < DATE_SUB(NOW(), INTERVAL %s DAY)""",
+                (res[0][0], CFG_BIBRANK_CITATION_LOG_EXPIRY))
 
 def get_cit_dict(name):
     """get a named citation dict from the db"""
@@ -979,7 +1037,7 @@ def get_cit_dict(name):
             return {}
     except:
         register_exception(prefix="could not read "+name+" from db", alert_admin=True)
-    return dict
+    return {}
 
 def get_initial_author_dict():
     """read author->citedinlist dict from the db"""
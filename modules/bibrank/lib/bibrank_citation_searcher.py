@@ -20,60 +20,210 @@
 __revision__ = "$Id$"
 
 import re
+from array import array
 
-from invenio.dbquery import run_sql, get_table_update_time, OperationalError, \
-        deserialize_via_marshal
+from invenio.dbquery import run_sql, OperationalError, deserialize_via_marshal
 from invenio.intbitset import intbitset
-from invenio.data_cacher import DataCacher
 
-class CitationDictsDataCacher(DataCacher):
+class CitationDict:
     """
-    Cache holding all citation dictionaries (citationdict,
-    reversedict, selfcitdict, selfcitedbydict).
+    Read-only {recid: [recid, ...]} citation dictionary stored in a
+    compact adjacency form: the lists of all the keys are concatenated
+    in the TARGETS integer array, the list of key K starting at
+    OFFSETS[K] and ending at OFFSETS[K+1].  Updates coming from the
+    citation indexer are kept in the small OVERLAY dictionary (None
+    meaning a removed key) until they are merged by compact().
+
+    Supports the dict methods used by the clients of the citation
+    dictionaries: get(), has_key(), [], keys(), len() and iteration.
     """
-    def __init__(self):
-        def cache_filler():
-            alldicts = {}
-            try:
-                res = run_sql("SELECT object_name,object_value FROM rnkCITATIONDATA")
-            except OperationalError:
-                # database problems, return empty cache
-                return {}
-            for row in res:
-                object_name = row[0]
-                object_value = row[1]
-                try:
-                    object_value_dict = deserialize_via_marshal(object_value)
-                except:
-                    object_value_dict = {}
-                alldicts[object_name] = object_value_dict
-                if object_name == 'citationdict':
-                    # for cited:M->N queries, it is interesting to cache also
-                    # some preprocessed citationdict:
-                    alldicts['citationdict_keys'] = object_value_dict.keys()
-                    alldicts['citationdict_keys_intbitset'] = intbitset(object_value_dict.keys())
-            return alldicts
-        def timestamp_verifier():
-            res = run_sql("""SELECT DATE_FORMAT(last_updated, '%Y-%m-%d %H:%i:%s')
-                              FROM rnkMETHOD WHERE name='citation'""")
-            if res:
-                return res[0][0]
+    def __init__(self, dic=None):
+        self.keys_intbitset = intbitset()
+        self.offsets = array('l', [0])
+        self.targets = array('i')
+        self.overlay = {}
+        if dic:
+            self.overlay.update(dic)
+            self.compact()
+
+    def compact(self):
+        """Merge the overlay into the adjacency arrays."""
+        keys = (self.keys_intbitset | intbitset(self.overlay.keys())).tolist()
+        if keys:
+            max_key = keys[-1]
+        else:
+            max_key = -1
+        offsets = array('l', [0]) * (max_key + 2)
+        targets = array('i')
+        keys_intbitset = intbitset()
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                targets.extend(value)
+                keys_intbitset.add(key)
+            offsets[key + 1] = len(targets)
+        # the recids that are not keys get the offset of their predecessor:
+        for key in xrange(1, max_key + 2):
+            if offsets[key] < offsets[key - 1]:
+                offsets[key] = offsets[key - 1]
+        self.keys_intbitset = keys_intbitset
+        self.offsets = offsets
+        self.targets = targets
+        self.overlay = {}
+
+    def update(self, key, value):
+        """Set the list of KEY to VALUE, or remove KEY if VALUE is
+        None.  The adjacency arrays are rebuilt once the overlay
+        reaches a tenth of their size."""
+        self.overlay[key] = value
+        if len(self.overlay) > 1000 and \
+               len(self.overlay) * 10 > len(self.keys_intbitset):
+            self.compact()
+
+    def get(self, key, default=None):
+        """Return a fresh list of the values of KEY, or DEFAULT."""
+        if self.overlay.has_key(key):
+            value = self.overlay[key]
+            if value is None:
+                return default
+            return list(value)
+        if key in self.keys_intbitset:
+            return self.targets[self.offsets[key]:self.offsets[key + 1]].tolist()
+        return default
+
+    def get_count(self, key):
+        """Return the number of values of KEY."""
+        if self.overlay.has_key(key):
+            return len(self.overlay[key] or [])
+        if key in self.keys_intbitset:
+            return self.offsets[key + 1] - self.offsets[key]
+        return 0
+
+    def get_union(self, keys):
+        """Return the intbitset union of the values of all KEYS."""
+        keys = intbitset(keys)
+        values = array('i')
+        for key in keys & self.keys_intbitset:
+            if not self.overlay.has_key(key):
+                values.extend(self.targets[self.offsets[key]:self.offsets[key + 1]])
+        for key, value in self.overlay.iteritems():
+            if value and key in keys:
+                values.extend(value)
+        return intbitset(values.tolist())
+
+    def keys_as_intbitset(self):
+        """Return the intbitset of the keys."""
+        if not self.overlay:
+            return self.keys_intbitset
+        keys = intbitset(self.keys_intbitset)
+        for key, value in self.overlay.iteritems():
+            if value is None:
+                keys.discard(key)
             else:
-                return '0000-00-00 00:00:00'
+                keys.add(key)
+        return keys
+
+    def keys(self):
+        return self.keys_as_intbitset().tolist()
+
+    def has_key(self, key):
+        if self.overlay.has_key(key):
+            return self.overlay[key] is not None
+        return key in self.keys_intbitset
+
+    __contains__ = has_key
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __len__(self):
+        return len(self.keys_as_intbitset())
+
+    def __iter__(self):
+        return iter(self.keys_as_intbitset())
+
+    def iteritems(self):
+        for key in self.keys_as_intbitset():
+            yield (key, self.get(key))
+
+def load_citation_dict(dictname):
+    """Load citation dictionary DICTNAME from rnkCITATIONDATA."""
+    try:
+        res = run_sql("SELECT object_value FROM rnkCITATIONDATA WHERE object_name=%s",
+                      (dictname,))
+    except OperationalError:
+        # database problems, return empty dictionary
+        return CitationDict()
+    try:
+        return CitationDict(deserialize_via_marshal(res[0][0]))
+    except:
+        return CitationDict()
+
+class CitationDictsCache:
+    """
+    Cache holding the citation dictionaries (citationdict,
+    reversedict, selfcitdict, selfcitedbydict).  Each dictionary is
+    loaded on first use; afterwards it is kept up to date by applying
+    the per-record changes that the citation indexer logs into the
+    rnkCITATIONLOG table, instead of reloading it as a whole.
+    """
+    def __init__(self):
+        self.dicts = {}
+        self.last_log_id = 0
+        self.is_ok_p = True
+
+    def refresh(self):
+        """Apply the citation log entries that arrived since the last
+        refresh.  A log entry with recid 0 asks for a full reload of
+        its dictionary.  If log entries we did not see have been
+        purged, all the dictionaries are reloaded."""
+        try:
+            res = run_sql("SELECT MIN(id), MAX(id) FROM rnkCITATIONLOG")
+        except OperationalError:
+            return
+        (min_id, max_id) = res[0]
+        if max_id is None:
+            # empty log, e.g. after a cleaning of the citation data
+            max_id = 0
+        if max_id == self.last_log_id:
+            return
+        if max_id < self.last_log_id or min_id > self.last_log_id + 1:
+            self.dicts = {}
+        else:
+            res = run_sql("""SELECT object_name, id_bibrec, object_value
+                               FROM rnkCITATIONLOG WHERE id>%s AND id<=%s
+                              ORDER BY id""", (self.last_log_id, max_id))
+            for dictname, recid, value in res:
+                if not self.dicts.has_key(dictname):
+                    continue
+                if recid == 0:
+                    del self.dicts[dictname]
+                elif value is None:
+                    self.dicts[dictname].update(recid, None)
+                else:
+                    self.dicts[dictname].update(recid, deserialize_via_marshal(value))
+        self.last_log_id = max_id
 
-        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+    def get(self, dictname):
+        """Return citation dictionary DICTNAME."""
+        self.refresh()
+        if not self.dicts.has_key(dictname):
+            self.dicts[dictname] = load_citation_dict(dictname)
+        return self.dicts[dictname]
 
 try:
     cache_citation_dicts.is_ok_p
 except Exception:
-    cache_citation_dicts = CitationDictsDataCacher()
+    cache_citation_dicts = CitationDictsCache()
 
 def get_citation_dict(dictname):
     """Return cached value of a citation dictionary. DICTNAME can be
        citationdict, reversedict, selfcitdict, selfcitedbydict.
     """
-    cache_citation_dicts.recreate_cache_if_needed()
-    return cache_citation_dicts.cache.get(dictname, {})
+    return cache_citation_dicts.get(dictname)
 
 def get_cited_by(recordid):
     """Return a list of records that cite recordid"""
@@ -86,7 +236,7 @@ def get_cited_by(recordid):
 def get_cited_by_count(recordid):
     """Return how many records cite given RECORDID."""
     cache_cited_by_dictionary = get_citation_dict("citationdict")
-    return len(cache_cited_by_dictionary.get(recordid, []))
+    return cache_cited_by_dictionary.get_count(recordid)
 
 def get_records_with_num_cites(numstr, allrecs = intbitset([])):
     """Return an intbitset of record IDs that are cited X times,
@@ -95,8 +245,7 @@ def get_records_with_num_cites(numstr, allrecs = intbitset([])):
        be 10,0->100 etc
     """
     cache_cited_by_dictionary = get_citation_dict("citationdict")
-    cache_cited_by_dictionary_keys = get_citation_dict("citationdict_keys")
-    cache_cited_by_dictionary_keys_intbitset = get_citation_dict("citationdict_keys_intbitset")
+    cache_cited_by_dictionary_keys_intbitset = cache_cited_by_dictionary.keys_as_intbitset()
     matches = intbitset([])
     #once again, check that the parameter is a string
     if not (type(numstr) == type("thisisastring")):
@@ -112,9 +261,8 @@ def get_records_with_num_cites(numstr, allrecs = intbitset([])):
         if num == 0:
             #we return recids that are not in keys
             return allrecs - cache_cited_by_dictionary_keys_intbitset
-        for k in cache_cited_by_dictionary_keys:
-            li = cache_cited_by_dictionary[k]
-            if len(li) == num:
+        for k in cache_cited_by_dictionary_keys_intbitset:
+            if cache_cited_by_dictionary.get_count(k) == num:
                 matches.add(k)
         return matches
 
@@ -132,19 +280,18 @@ def get_records_with_num_cites(numstr, allrecs = intbitset([])):
             #start with those that have no cites..
             matches = allrecs - cache_cited_by_dictionary_keys_intbitset
         if (first <= sec):
-            for k in cache_cited_by_dictionary_keys:
-                li = cache_cited_by_dictionary[k]
-                if len(li) >= first:
-                    if len(li) <= sec:
+            for k in cache_cited_by_dictionary_keys_intbitset:
+                count = cache_cited_by_dictionary.get_count(k)
+                if count >= first:
+                    if count <= sec:
                         matches.add(k)
             return matches
 
     firstsec = re.findall("(\d+)\+", numstr)
     if firstsec:
-        first = firstsec[0]
-        for k in cache_cited_by_dictionary_keys:
-            li = cache_cited_by_dictionary[k]
-            if len(li) > int(first):
+        first = int(firstsec[0])
+        for k in cache_cited_by_dictionary_keys_intbitset:
+            if cache_cited_by_dictionary.get_count(k) > first:
                 matches.add(k)
     return matches
 
@@ -167,8 +314,7 @@ def get_refersto_hitset(ahitset):
     cache_cited_by_dictionary = get_citation_dict("citationdict")
     out = intbitset()
     if ahitset:
-        for recid in ahitset:
-            out = out | intbitset(cache_cited_by_dictionary.get(recid, []))
+        out = cache_cited_by_dictionary.get_union(ahitset)
     return out
 
 def get_citedby_hitset(ahitset):
@@ -179,8 +325,7 @@ def get_citedby_hitset(ahitset):
     cache_cited_by_dictionary = get_citation_dict("reversedict")
     out = intbitset()
     if ahitset:
-        for recid in ahitset:
-            out = out | intbitset(cache_cited_by_dictionary.get(recid, []))
+        out = cache_cited_by_dictionary.get_union(ahitset)
     return out
 
 def get_cited_by_weight(recordlist):
@@ -190,7 +335,7 @@ def get_cited_by_weight(recordlist):
     cache_cited_by_dictionary = get_citation_dict("citationdict")
     result = []
     for recid in recordlist:
-        result.append([recid, len(cache_cited_by_dictionary.get(recid, []))])
+        result.append([recid, cache_cited_by_dictionary.get_count(recid)])
     return result
 
 def calculate_cited_by_list(record_id, sort_order="d"):
@@ -206,8 +351,7 @@ def calculate_cited_by_list(record_id, sort_order="d"):
         citation_list = cache_cited_by_dictionary.get(record_id, [])
     #add weights i.e. records that cite each of the entries in citation_list
     for c in citation_list:
-        ccited = cache_cited_by_dictionary.get(c, [])
-        result.append([c, len(ccited)])
+        result.append([c, cache_cited_by_dictionary.get_count(c)])
     # sort them:
     if result:
         if sort_order == "d":
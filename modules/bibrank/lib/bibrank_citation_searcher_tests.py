@@ -23,6 +23,7 @@ __revision__ = "$Id$"
 
 import unittest
 
+from invenio.bibrank_citation_searcher import CitationDict
 from invenio.testutils import make_test_suite, run_test_suite
 
 class TestCitationSearcher(unittest.TestCase):
@@ -52,7 +53,39 @@ class TestCitationSearcher(unittest.TestCase):
         """bibrank citation searcher - get co-cited-with data"""
         # FIXME: test postponed
 
-TEST_SUITE = make_test_suite(TestCitationSearcher,)
+class TestCitationDict(unittest.TestCase):
+    """Test the compact citation dictionary."""
+
+    def setUp(self):
+        # pylint: disable=C0103
+        """Initialize stuff"""
+        self.citdict = CitationDict({3: [1, 2], 4: [], 7: [5]})
+
+    def test_lookup(self):
+        """bibrank citation searcher - citation dictionary lookup"""
+        self.assertEqual([1, 2], self.citdict.get(3))
+        self.assertEqual([], self.citdict.get(4))
+        self.assertEqual(None, self.citdict.get(5))
+        self.assertEqual([5], self.citdict[7])
+        self.assertRaises(KeyError, self.citdict.__getitem__, 6)
+        self.assertEqual([3, 4, 7], self.citdict.keys())
+        self.assertEqual(2, self.citdict.get_count(3))
+        self.assertEqual(0, self.citdict.get_count(8))
+        self.assertEqual([1, 2, 5], list(self.citdict.get_union([3, 7, 9])))
+
+    def test_update(self):
+        """bibrank citation searcher - citation dictionary update"""
+        self.citdict.update(7, None)
+        self.citdict.update(9, [1])
+        self.citdict.update(3, [8])
+        for citdict in (self.citdict, CitationDict(dict(self.citdict.iteritems()))):
+            self.assertEqual([3, 4, 9], citdict.keys())
+            self.assertEqual(None, citdict.get(7))
+            self.assertEqual([8], citdict.get(3))
+            self.assertEqual([1, 8], list(citdict.get_union([3, 7, 9])))
+
+TEST_SUITE = make_test_suite(TestCitationSearcher,
+                             TestCitationDict,)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE)
@@ -33,7 +33,8 @@ import time
 import re
 import sys
 try:
-    from numpy import array, ones, zeros, int32, float32, sqrt, dot
+    from numpy import array, ones, zeros, int32, float32, float64, sqrt, \
+        dot, add, bincount, cumsum
     import_numpy = 1
 except ImportError:
     import_numpy = 0
@@ -437,33 +438,67 @@ def statistics_on_sparse(sparse):
     return count_diag
 
 
-def pagerank(conv_threshold, check_point, len_, sparse, \
-            semi_sparse, semi_sparse_coef):
-    """the core function of the PAGERANK method
-    returns an array with the ranks coresponding to each recid"""
-    weights_old = ones((len_), float32) # initial weights
-    weights_new = array((), float32)
+def construct_csr_matrix(sparse, len_):
+    """converts the sparse matrix given as a dictionary (i, j): value
+    into a compressed sparse row representation (the row start
+    positions, the column indices and the values, as arrays), which
+    permits to multiply it with a vector in one vectorized step"""
+    keys = sparse.keys()
+    keys.sort()
+    rows = array([i for (i, j) in keys], int32)
+    indices = array([j for (i, j) in keys], int32)
+    data = array([sparse[key] for key in keys], float64)
+    indptr = zeros(len_ + 1, int32)
+    if len(rows):
+        row_counts = bincount(rows)
+        indptr[1:len(row_counts) + 1] = cumsum(row_counts)
+        indptr[len(row_counts) + 1:] = indptr[len(row_counts)]
+    write_message("Sparse matrix of %s elements compressed" % \
+        str(len(keys)), verbose=5)
+    return indptr, indices, data
+
+
+def csr_dot(matrix, weights):
+    """returns the product of the compressed sparse row MATRIX (see
+    construct_csr_matrix) and the vector WEIGHTS"""
+    indptr, indices, data = matrix
+    result = zeros(len(indptr) - 1, float64)
+    if len(data):
+        products = data * weights[indices]
+        starts = indptr[:-1]
+        non_empty = starts < indptr[1:]
+        result[non_empty] = add.reduceat(products, starts[non_empty])
+    return result
+
+
+def power_iteration(conv_threshold, check_point, len_, matrix, \
+                    constant_term, weights_old=None):
+    """the core engine of all the PAGERANK methods: starting from
+    WEIGHTS_OLD (or from ones), iterates
+        weights_new = MATRIX * weights_old + constant_term(weights_old)
+    until the weights are stable; CONSTANT_TERM returns either a scalar
+    or a vector to be added to the product of the sparse matrix in
+    compressed sparse row form (see construct_csr_matrix) and of the
+    weight vector.
+    returns an array with the ranks coresponding to each index"""
+    if weights_old is None:
+        weights_old = ones((len_), float32) # initial weights
     converged = False
     nr_of_check_points = 0
     difference = len_
     while not converged:
         nr_of_check_points += 1
         for step in (range(check_point)):
-            weights_new = zeros((len_), float32)
-            for (i, j) in sparse.keys():
-                weights_new[i] += sparse[(i, j)]*weights_old[j]
-            semi_total = 0.0
-            for j in semi_sparse:
-                semi_total += weights_old[j]
-            weights_new = weights_new + semi_sparse_coef * semi_total + \
-                            (1.0/len_ - semi_sparse_coef) * sum(weights_old)
+            weights_new = csr_dot(matrix, weights_old) + \
+                          constant_term(weights_old)
+            weights_new = weights_new.astype(float32)
             if step == check_point - 1:
                 diff = weights_new - weights_old
                 difference = sqrt(dot(diff, diff))/len_
                 write_message("Finished step: %s, %s " \
                         %(str(check_point*(nr_of_check_points-1) + step), \
                             str(difference)), verbose=5)
-            weights_old = weights_new.copy()
+            weights_old = weights_new
             converged = (difference < conv_threshold)
     write_message("PageRank calculated for all recids finnished in %s steps. \
 The threshold was %s" % (str(nr_of_check_points), str(difference)),\
@@ -471,78 +506,90 @@ The threshold was %s" % (str(nr_of_check_points), str(difference)),\
     return weights_old
 
 
-def pagerank_ext(conv_threshold, check_point, len_, sparse, semi_sparse):
+def pagerank(conv_threshold, check_point, len_, sparse, \
+            semi_sparse, semi_sparse_coef, weights_old=None):
+    """the core function of the PAGERANK method
+    returns an array with the ranks coresponding to each recid"""
+    matrix = construct_csr_matrix(sparse, len_)
+    semi_sparse = array(semi_sparse, int32)
+    def constant_term(weights):
+        """contribution of the papers citing nobody and of the damping"""
+        return semi_sparse_coef * weights[semi_sparse].sum() + \
+               (1.0/len_ - semi_sparse_coef) * weights.sum()
+    return power_iteration(conv_threshold, check_point, len_, matrix, \
+                           constant_term, weights_old)
+
+
+def pagerank_ext(conv_threshold, check_point, len_, sparse, semi_sparse, \
+                 weights_old=None):
     """the core function of the PAGERANK_EXT method
     returns an array with the ranks coresponding to each recid"""
-    weights_old = array((), float32)
-    weights_old = ones((len_), float32)
-    weights_new = array((), float32)
-    converged = False
-    nr_of_check_points = 0
-    difference = len_
-    while not converged:
-        nr_of_check_points += 1
-        for step in (range(check_point)):
-            weights_new = zeros((len_), float32)
-            for (i, j) in sparse.keys():
-                weights_new[i] += sparse[(i, j)]*weights_old[j]
-            total_sum = 0.0
-            for j in semi_sparse:
-                total_sum += semi_sparse[j]*weights_old[j]
-            weights_new[1:len_] = weights_new[1:len_] + total_sum
-            if step == check_point - 1:
-                diff = weights_new - weights_old
-                difference = sqrt(dot(diff, diff))/len_
-                write_message("Finished step: %s, %s " \
-                    % (str(check_point*(nr_of_check_points-1) + step), \
-                        str(difference)), verbose=5)
-            weights_old = weights_new.copy()
-            converged = (difference < conv_threshold)
-    write_message("PageRank calculated for all recids finnished in %s steps. \
-The threshold was %s" % (str(nr_of_check_points), \
-            str(difference)), verbose=2)
-    #return weights_old[1:len_]/(len_ - weights_old[0])
-    return weights_old[1:len_]
+    matrix = construct_csr_matrix(sparse, len_)
+    semi_sparse_keys = semi_sparse.keys()
+    semi_sparse_ids = array(semi_sparse_keys, int32)
+    semi_sparse_coefs = array([semi_sparse[j] for j in semi_sparse_keys], \
+                              float64)
+    not_external = ones((len_), float64)
+    not_external[0] = 0.0
+    def constant_term(weights):
+        """contribution of the papers citing nobody, except for the
+        external node"""
+        return not_external * dot(semi_sparse_coefs, weights[semi_sparse_ids])
+    weights = power_iteration(conv_threshold, check_point, len_, matrix, \
+                              constant_term, weights_old)
+    #return weights[1:len_]/(len_ - weights[0])
+    return weights[1:len_]
 
 
 def pagerank_time(conv_threshold, check_point, len_, \
-        sparse, semi_sparse, semi_sparse_coeficient, date_coef):
+        sparse, semi_sparse, semi_sparse_coeficient, date_coef, \
+        weights_old=None):
     """the core function of the PAGERANK_TIME method: pageRank + time decay
     returns an array with the ranks coresponding to each recid"""
-    weights_old = array((), float32)
-    weights_old = ones((len_), float32) # initial weights
-    weights_new = array((), float32)
-    converged = False
-    nr_of_check_points = 0
-    difference = len_
-    while not converged:
-        nr_of_check_points += 1
-        for step in (range(check_point)):
-            weights_new = zeros((len_), float32)
-            for (i, j) in sparse.keys():
-                weights_new[i] += sparse[(i, j)]*weights_old[j]
-            semi_total = 0.0
-            for j in semi_sparse:
-                semi_total += weights_old[j]*date_coef[j]
-            zero_total = 0.0
-            for i in range(len_):
-                zero_total += weights_old[i]*date_coef[i]
-            #dates = array(date_coef.keys())
-            #zero_total = dot(weights_old, dates)
-            weights_new = weights_new + semi_sparse_coeficient * semi_total + \
-                    (1.0/len_ - semi_sparse_coeficient) * zero_total
-            if step == check_point - 1:
-                diff = weights_new - weights_old
-                difference = sqrt(dot(diff, diff))/len_
-                write_message("Finished step: %s, %s " \
-                    % (str(check_point*(nr_of_check_points-1) + step), \
-                    str(difference)), verbose=5)
-            weights_old = weights_new.copy()
-            converged = (difference < conv_threshold)
-    write_message("PageRank calculated for all recids finnished in %s steps.\
-The threshold was %s" % (str(nr_of_check_points), \
-        str(difference)), verbose=2)
-    return weights_old
+    matrix = construct_csr_matrix(sparse, len_)
+    semi_sparse = array(semi_sparse, int32)
+    date_coef = array([date_coef[j] for j in range(len_)], float64)
+    semi_date_coef = date_coef[semi_sparse]
+    def constant_term(weights):
+        """time decayed contribution of the papers citing nobody and of
+        the damping"""
+        return semi_sparse_coeficient * \
+                   dot(weights[semi_sparse], semi_date_coef) + \
+               (1.0/len_ - semi_sparse_coeficient) * dot(weights, date_coef)
+    return power_iteration(conv_threshold, check_point, len_, matrix, \
+                           constant_term, weights_old)
+
+
+def get_previous_weights(rank_method_code, dict_of_ids, len_, offset=0):
+    """returns the weights computed by the previous run of the rank
+    method, as stored in the rnkMETHODDATA table, as an initial weight
+    vector of size LEN_ (papers being shifted by OFFSET), scaled so that
+    its sum is LEN_ like the default initial vector; papers new since
+    the previous run get the average weight.  Returns None if there
+    are no previous weights."""
+    res = run_sql("SELECT d.relevance_data FROM rnkMETHODDATA AS d, \
+                   rnkMETHOD AS m WHERE m.name=%s AND d.id_rnkMETHOD=m.id", \
+                   (rank_method_code, ))
+    if not res or not res[0][0]:
+        return None
+    previous_ranks = deserialize_via_marshal(res[0][0])
+    if not previous_ranks:
+        return None
+    known = [previous_ranks[recid] for recid in dict_of_ids \
+             if recid in previous_ranks]
+    if not known:
+        return None
+    average = sum(known)/len(known)
+    weights = ones((len_), float64) * average
+    for recid in dict_of_ids:
+        if recid in previous_ranks:
+            weights[dict_of_ids[recid] + offset] = previous_ranks[recid]
+    if weights.sum() <= 0:
+        return None
+    weights = weights * len_ / weights.sum()
+    write_message("Warm start from the %s weights of the previous run" % \
+        str(len(known)), verbose=2)
+    return weights.astype(float32)
 
 
 def citation_rank_time(cit, dict_of_ids, date_coef, dates, decimals):
@@ -632,32 +679,34 @@ def into_db(dict_of_ranks, rank_method_code):
 
 
 def run_pagerank(cit, dict_of_ids, len_, ref, damping_factor, \
-            conv_threshold, check_point, dates):
+            conv_threshold, check_point, dates, weights_old=None):
     """returns the final form of the ranks when using pagerank method"""
     write_message("Running the PageRank method", verbose=5)
     sparse, semi_sparse, semi_sparse_coeficient = \
         construct_sparse_matrix(cit, ref, dict_of_ids, len_, damping_factor)
     weights = pagerank(conv_threshold, check_point, len_, \
-                    sparse, semi_sparse, semi_sparse_coeficient)
+                    sparse, semi_sparse, semi_sparse_coeficient, weights_old)
     dict_of_ranks = get_ranks(weights, dict_of_ids, 1, dates, 2)
     return dict_of_ranks
 
 
 def run_pagerank_ext(cit, dict_of_ids, ref, ext_links, \
-                        conv_threshold, check_point, alpha, beta, dates):
+                        conv_threshold, check_point, alpha, beta, dates, \
+                        weights_old=None):
     """returns the final form of the ranks when using pagerank_ext method"""
     write_message("Running the PageRank with external links method", verbose=5)
     len_ = len(dict_of_ids)
     sparse, semi_sparse = construct_sparse_matrix_ext(cit, ref, \
         ext_links, dict_of_ids, alpha, beta)
     weights = pagerank_ext(conv_threshold, check_point, \
-        len_ + 1, sparse, semi_sparse)
+        len_ + 1, sparse, semi_sparse, weights_old)
     dict_of_ranks = get_ranks(weights, dict_of_ids, 1, dates, 2)
     return dict_of_ranks
 
 
 def run_pagerank_time(cit, dict_of_ids, len_, ref, damping_factor, \
-                        conv_threshold, check_point, date_coef, dates):
+                        conv_threshold, check_point, date_coef, dates, \
+                        weights_old=None):
     """returns the final form of the ranks when using
     pagerank + time decay method"""
     write_message("Running the PageRank_time method", verbose=5)
@@ -665,7 +714,7 @@ def run_pagerank_time(cit, dict_of_ids, len_, ref, damping_factor, \
         construct_sparse_matrix_time(cit, ref, dict_of_ids, \
             damping_factor, date_coef)
     weights = pagerank_time(conv_threshold, check_point, len_, \
-        sparse, semi_sparse, semi_sparse_coeficient, date_coef)
+        sparse, semi_sparse, semi_sparse_coeficient, date_coef, weights_old)
     dict_of_ranks = get_ranks(weights, dict_of_ids, 100000, dates, 2)
     return dict_of_ranks
 
@@ -808,6 +857,11 @@ str(conv_threshold), str(check_point)), verbose=5)
         except (ConfigParser.NoOptionError, StandardError), err:
             write_message("Exception: %s" % err, sys.stderr)
             raise Exception
+        warm_start = ""
+        try:
+            warm_start = config.get(function, "warm_start")
+        except (ConfigParser.NoOptionError, StandardError), err:
+            write_message("%s" % err, verbose=2)
         if method == "pagerank_classic":
             ref = construct_ref_array(cit, dict_of_ids, len_)
             use_ext_cit = ""
@@ -848,11 +902,25 @@ sys.stderr)
                 except (ConfigParser.NoOptionError, StandardError), err:
                     write_message("Exception: %s" % err, sys.stderr)
                     raise Exception
+                weights_old = None
+                if warm_start == "yes":
+                    weights_old = get_previous_weights(rank_method_code, \
+                        dict_of_ids, len_ + 1, 1)
+                    if weights_old is not None:
+                        # the external node keeps the default weight:
+                        weights_old[0] = 1.0
+                        weights_old = weights_old * (len_ + 1) / weights_old.sum()
                 dict_of_ranks = run_pagerank_ext(cit, dict_of_ids, ref, \
-                ext_links, conv_threshold, check_point, alpha, beta, dates)
+                ext_links, conv_threshold, check_point, alpha, beta, dates, \
+                weights_old)
             else:
+                weights_old = None
+                if warm_start == "yes":
+                    weights_old = get_previous_weights(rank_method_code, \
+                        dict_of_ids, len_)
                 dict_of_ranks = run_pagerank(cit, dict_of_ids, len_, ref, \
-                    damping_factor, conv_threshold, check_point, dates)
+                    damping_factor, conv_threshold, check_point, dates, \
+                    weights_old)
         elif method == "pagerank_time":
             try:
                 time_decay = float(config.get(function, "time_decay"))
@@ -864,8 +932,13 @@ sys.stderr)
             date_coef = calculate_time_weights(len_, time_decay, dates)
             cit = remove_loops(cit, dates, dict_of_ids)
             ref = construct_ref_array(cit, dict_of_ids, len_)
+            weights_old = None
+            if warm_start == "yes":
+                weights_old = get_previous_weights(rank_method_code, \
+                    dict_of_ids, len_)
             dict_of_ranks = run_pagerank_time(cit, dict_of_ids, len_, ref, \
-             damping_factor, conv_threshold, check_point, date_coef, dates)
+             damping_factor, conv_threshold, check_point, date_coef, dates, \
+             weights_old)
         else:
             write_message("Error: Unknown ranking method. \
 Please check the ranking_method parameter in the config. file.", sys.stderr)
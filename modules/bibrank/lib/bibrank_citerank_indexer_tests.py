@@ -51,6 +51,27 @@ class TestCiterankIndexer(unittest.TestCase):
         dict_of_ranks = bibrank_citerank_indexer.run_pagerank(self.cit, self.dict_of_ids, len(self.dict_of_ids), self.ref, self.damping_factor, self.conv_threshold, self.check_point, self.dates)
         self.assertEqual({96: 0.622, 18: 1.1419839999999999, 74: 0.88200100000000003, 77: 1.142002, 78: 1.6020020000000001, 79: 0.86200299999999996, 80: 0.62200199999999994, 81: 2.712002, 82: 0.62200199999999994, 83: 0.62200299999999997, 84: 1.6520029999999999, 85: 0.62200299999999997, 86: 0.62200299999999997, 87: 0.62200299999999997, 88: 0.62200299999999997, 89: 0.62200500000000003, 91: 0.88200699999999999, 92: 0.62200599999999995, 94: 1.1419969999999999, 95: 1.8519990000000002}, dict_of_ranks)
 
+    def test_csr_dot(self):
+        """bibrank citerank indexer - sparse matrix vector product"""
+        sparse = {(0, 1): 0.5, (0, 2): 0.25, (2, 0): 2.0, (3, 3): 1.0}
+        matrix = bibrank_citerank_indexer.construct_csr_matrix(sparse, 5)
+        weights = bibrank_citerank_indexer.ones((5), bibrank_citerank_indexer.float32)
+        weights[3] = 4.0
+        self.assertEqual([0.75, 0.0, 2.0, 4.0, 0.0],
+                         list(bibrank_citerank_indexer.csr_dot(matrix, weights)))
+
+    def test_calculate_ranks_warm_start(self):
+        """bibrank citerank indexer - calculate ranks from previous weights"""
+        len_ = len(self.dict_of_ids)
+        dict_of_ranks = bibrank_citerank_indexer.run_pagerank(self.cit, self.dict_of_ids, len_, self.ref, self.damping_factor, self.conv_threshold, self.check_point, self.dates)
+        weights = bibrank_citerank_indexer.ones((len_), bibrank_citerank_indexer.float32)
+        for recid, index in self.dict_of_ids.items():
+            weights[index] = dict_of_ranks[recid]
+        weights = weights * len_ / weights.sum()
+        warm_dict_of_ranks = bibrank_citerank_indexer.run_pagerank(self.cit, self.dict_of_ids, len_, self.ref, self.damping_factor, self.conv_threshold, self.check_point, self.dates, weights)
+        for recid in dict_of_ranks:
+            self.assertAlmostEqual(dict_of_ranks[recid], warm_dict_of_ranks[recid], 1)
+
 TEST_SUITE = make_test_suite(TestCiterankIndexer,)
 
 if __name__ == "__main__":
@@ -26,10 +26,16 @@ import math
 import re
 import ConfigParser
 import copy
+import heapq
+import marshal
+import os
+import tempfile
+from array import array
 
 from invenio.config import \
      CFG_SITE_LANG, \
-     CFG_ETCDIR
+     CFG_ETCDIR, \
+     CFG_CACHEDIR
 from invenio.dbquery import run_sql, deserialize_via_marshal
 from invenio.errorlib import register_exception
 from invenio.webpage import adderrorbox
@@ -37,6 +43,7 @@ from invenio.bibindex_engine_stemmer import stem
 from invenio.bibindex_engine_stopwords import is_stopword
 from invenio.bibrank_citation_searcher import get_cited_by, get_cited_by_weight
 from invenio.intbitset import intbitset
+from invenio.data_cacher import DataCacher
 
 
 def compare_on_val(first, second):
@@ -167,12 +174,14 @@ def get_bibrank_methods(colID, ln=CFG_SITE_LANG):
                 avail_methods.append((rank_method_code, rank_method_code))
     return avail_methods
 
-def rank_records(rank_method_code, rank_limit_relevance, hitset_global, pattern=[], verbose=0):
+def rank_records(rank_method_code, rank_limit_relevance, hitset_global, pattern=[], verbose=0, limit=0):
     """rank_method_code, e.g. `jif' or `sbr' (word frequency vector model)
        rank_limit_relevance, e.g. `23' for `nbc' (number of citations) or `0.10' for `vec'
        hitset, search engine hits;
        pattern, search engine query or record ID (you check the type)
        verbose, verbose level
+       limit, if set, only the `limit' best records are guaranteed to
+       be sorted (at the end of the list of records)
        output:
        list of records
        list of rank values
@@ -209,7 +218,7 @@ def rank_records(rank_method_code, rank_limit_relevance, hitset_global, pattern=
         elif func_object:
             result = func_object(rank_method_code, pattern, hitset, rank_limit_relevance, verbose)
         else:
-            result = rank_by_method(rank_method_code, pattern, hitset, rank_limit_relevance, verbose)
+            result = rank_by_method(rank_method_code, pattern, hitset, rank_limit_relevance, verbose, limit)
     except Exception, e:
         register_exception()
         result = (None, "", adderrorbox("An error occured when trying to rank the search result "+rank_method_code, ["Unexpected error: %s<br />" % (e,)]), voutput)
@@ -262,7 +271,129 @@ def combine_method(rank_method_code, pattern, hitset, rank_limit_relevance,verbo
     except Exception, e:
         return (None, "Warning: %s method cannot be used for ranking your query." % rank_method_code, "", voutput)
 
-def rank_by_method(rank_method_code, lwords, hitset, rank_limit_relevance,verbose):
+def build_rank_values(rnkdict):
+    """Convert RNKDICT, the {recID: value} dictionary written by the
+    rank indexers, into a columnar structure (ranked, values), where
+    RANKED is an intbitset of the recIDs having a value and VALUES is
+    a dense array indexed by recID.  Integer values are kept as
+    integers so that they are printed the same way as before."""
+    ranked = intbitset(rnkdict.keys())
+    if not rnkdict:
+        return (ranked, array('l'))
+    typecode = 'l'
+    for value in rnkdict.itervalues():
+        if type(value) is not int:
+            typecode = 'd'
+            break
+    values = array(typecode, [0]) * (max(rnkdict) + 1)
+    for recID, value in rnkdict.iteritems():
+        values[recID] = value
+    return (ranked, values)
+
+def get_rank_values_filename(rank_method_code, last_updated):
+    """Return the name of the file holding the columnar rank values of
+    RANK_METHOD_CODE as of LAST_UPDATED."""
+    return os.path.join(CFG_CACHEDIR, 'rnkvalues', rank_method_code,
+                        '%s.dat' % re.sub(r'[^0-9]', '', last_updated))
+
+def load_rank_values(rank_method_code, last_updated):
+    """Return the columnar rank values of RANK_METHOD_CODE.  They are
+    read from the flat file written by the first process that needed
+    them since the method was last updated, or otherwise built from
+    the relevance_data blob of rnkMETHODDATA and dumped to that file.
+    Return None if the method has no ranking data."""
+    filename = get_rank_values_filename(rank_method_code, last_updated)
+    try:
+        (typecode, ranked, values) = marshal.loads(open(filename, 'rb').read())
+        ranked_bitset = intbitset()
+        ranked_bitset.fastload(ranked)
+        values_array = array(typecode)
+        values_array.fromstring(values)
+        return (ranked_bitset, values_array)
+    except (IOError, EOFError, ValueError, TypeError):
+        pass
+    res = run_sql("""SELECT relevance_data FROM rnkMETHODDATA, rnkMETHOD
+                      WHERE rnkMETHOD.id=id_rnkMETHOD AND rnkMETHOD.name=%s""",
+                  (rank_method_code,))
+    if not res:
+        return None
+    (ranked, values) = build_rank_values(deserialize_via_marshal(res[0][0]))
+    try:
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for oldfile in os.listdir(dirname):
+            os.remove(os.path.join(dirname, oldfile))
+        (fd, tmpname) = tempfile.mkstemp(dir=dirname)
+        os.write(fd, marshal.dumps((values.typecode, ranked.fastdump(),
+                                    values.tostring())))
+        os.close(fd)
+        os.rename(tmpname, filename)
+    except (IOError, OSError):
+        # the file is only a shortcut for the other processes, so
+        # ranking can well go on without it
+        register_exception()
+    return (ranked, values)
+
+class RankValuesDataCacher(DataCacher):
+    """
+    Cache holding the columnar rank values of one rank method, as
+    returned by load_rank_values().
+    """
+    def __init__(self, rank_method_code):
+        # last updated time of the rank method the cache was filled from:
+        self.last_updated = None
+        def timestamp_verifier():
+            res = run_sql("""SELECT DATE_FORMAT(last_updated, '%%Y-%%m-%%d %%H:%%i:%%s')
+                              FROM rnkMETHOD WHERE name=%s""", (rank_method_code,))
+            if res and res[0][0]:
+                return res[0][0]
+            else:
+                return '0000-00-00 00:00:00'
+        def cache_filler():
+            self.last_updated = timestamp_verifier()
+            return load_rank_values(rank_method_code, self.last_updated)
+
+        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+
+    def recreate_cache_if_needed(self):
+        """
+        Recreate cache if the rank method was updated since the cache
+        was filled.  The indexer sets last_updated to the start time of
+        its run, which may well be older than the cache build time, so
+        it is compared with the value read when filling the cache.
+        """
+        if self.timestamp_verifier() != self.last_updated:
+            self.create_cache()
+
+rank_values_cache = {}
+
+def get_rank_values(rank_method_code):
+    """Return the columnar rank values (ranked, values) of
+    RANK_METHOD_CODE, or None if the method has no ranking data."""
+    if not rank_values_cache.has_key(rank_method_code):
+        rank_values_cache[rank_method_code] = RankValuesDataCacher(rank_method_code)
+    cacher = rank_values_cache[rank_method_code]
+    cacher.recreate_cache_if_needed()
+    return cacher.cache
+
+def sort_by_rank_values(recIDs, values, limit=0):
+    """Return the list of (recID, value) pairs for RECIDS, sorted by
+    increasing VALUES[recID] and then by recID.  If LIMIT is set, only
+    the LIMIT best records are sorted, the others being put in front of
+    them in arbitrary order; this is all what is needed to print one
+    page of results, since they are printed from the end of the list."""
+    if limit and limit < len(recIDs):
+        top = heapq.nlargest(limit, [(values[recID], recID) for recID in recIDs])
+        top.reverse()
+        rest = recIDs - intbitset([recID for (value, recID) in top])
+        return [(recID, values[recID]) for recID in rest] + \
+               [(recID, value) for (value, recID) in top]
+    reclist = [(recID, values[recID]) for recID in recIDs]
+    reclist.sort(key=lambda x: x[1])
+    return reclist
+
+def rank_by_method(rank_method_code, lwords, hitset, rank_limit_relevance, verbose, limit=0):
     """Ranking of records based on predetermined values.
     input:
     rank_method_code - the code of the method, from the name field in rnkMETHOD, used to get predetermined values from
@@ -271,6 +402,7 @@ def rank_by_method(rank_method_code, lwords, hitset, rank_limit_relevance,verbos
     hitset - a list of hits for the query found by search_engine
     rank_limit_relevance - show only records with a rank value above this
     verbose - verbose value
+    limit - if set, sort only this number of best records
     output:
     reclist - a list of sorted records, with unsorted added to the end: [[23,34], [344,24], [1,01]]
     prefix - what to show before the rank value
@@ -278,9 +410,9 @@ def rank_by_method(rank_method_code, lwords, hitset, rank_limit_relevance,verbos
     voutput - contains extra information, content dependent on verbose value"""
 
     global voutput
-    rnkdict = run_sql("SELECT relevance_data FROM rnkMETHODDATA,rnkMETHOD where rnkMETHOD.id=id_rnkMETHOD and rnkMETHOD.name='%s'" % rank_method_code)
+    rnkvalues = get_rank_values(rank_method_code)
 
-    if not rnkdict:
+    if not rnkvalues:
         return (None, "Warning: Could not load ranking data for method %s." % rank_method_code, "", voutput)
 
     max_recid = 0
@@ -305,37 +437,24 @@ def rank_by_method(rank_method_code, lwords, hitset, rank_limit_relevance,verbos
             else:
                 return (None, "Warning: Given record IDs are out of range.", "", voutput)
 
-    rnkdict = deserialize_via_marshal(rnkdict[0][0])
+    (ranked, values) = rnkvalues
     if verbose > 0:
         voutput += "<br />Running rank method: %s, using rank_by_method function in bibrank_record_sorter<br />" % rank_method_code
-        voutput += "Ranking data loaded, size of structure: %s<br />" % len(rnkdict)
-    lrecIDs = list(hitset)
+        voutput += "Ranking data loaded, size of structure: %s<br />" % len(ranked)
+
+    if lwords_hitset:
+        hitset = hitset & lwords_hitset
 
     if verbose > 0:
-        voutput += "Number of records to rank: %s<br />" % len(lrecIDs)
-    reclist = []
-    reclist_addend = []
+        voutput += "Number of records to rank: %s<br />" % len(hitset)
 
-    if not lwords_hitset: #rank all docs, can this be speed up using something else than for loop?
-        for recID in lrecIDs:
-            if rnkdict.has_key(recID):
-                reclist.append((recID, rnkdict[recID]))
-                del rnkdict[recID]
-            else:
-                reclist_addend.append((recID, 0))
-    else: #rank docs in hitset, can this be speed up using something else than for loop?
-        for recID in lwords_hitset:
-            if rnkdict.has_key(recID) and recID in hitset:
-                reclist.append((recID, rnkdict[recID]))
-                del rnkdict[recID]
-            elif recID in hitset:
-                reclist_addend.append((recID, 0))
+    reclist_addend = [(recID, 0) for recID in hitset - ranked]
+    reclist = sort_by_rank_values(hitset & ranked, values, limit)
 
     if verbose > 0:
         voutput += "Number of records ranked: %s<br />" % len(reclist)
         voutput += "Number of records not ranked: %s<br />" % len(reclist_addend)
 
-    reclist.sort(lambda x, y: cmp(x[1], y[1]))
     return (reclist_addend + reclist, methods[rank_method_code]["prefix"], methods[rank_method_code]["postfix"], voutput)
 
 def find_citations(rank_method_code, recID, hitset, verbose):
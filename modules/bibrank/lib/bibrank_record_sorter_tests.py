@@ -47,7 +47,60 @@ class TestListSetOperations(unittest.TestCase):
         self.assertEqual(({1: 7, 2: 7, 5: 5}, {1: 1, 2: 1, 5: 1}),  bibrank_record_sorter.calculate_record_relevance(("testterm", 2.0),
 {"Gi":(0, 50.0), 1: (3, 4.0), 2: (4, 5.0), 5: (1, 3.5)}, hitset, {}, {}, 0, None))
 
-TEST_SUITE = make_test_suite(TestListSetOperations,)
+class TestRankValues(unittest.TestCase):
+    """Test ranking by predetermined rank values."""
+
+    def test_build_rank_values(self):
+        """bibrank record sorter - building columnar rank values"""
+        (ranked, values) = bibrank_record_sorter.build_rank_values({2: 10, 5: 3})
+        self.assertEqual([2, 5], list(ranked))
+        self.assertEqual([0, 0, 10, 0, 0, 3], list(values))
+        self.assertEqual('l', values.typecode)
+        (ranked, values) = bibrank_record_sorter.build_rank_values({1: 0.5, 3: 2})
+        self.assertEqual('d', values.typecode)
+        self.assertEqual([0.0, 0.5, 0.0, 2.0], list(values))
+
+    def test_sort_by_rank_values(self):
+        """bibrank record sorter - sorting by rank values"""
+        (ranked, values) = bibrank_record_sorter.build_rank_values({1: 5, 2: 1, 3: 5, 4: 7, 6: 2})
+        hitset = HitSet([1, 2, 3, 4, 6])
+        self.assertEqual([(2, 1), (6, 2), (1, 5), (3, 5), (4, 7)],
+                         bibrank_record_sorter.sort_by_rank_values(hitset, values))
+        self.assertEqual([(2, 1), (6, 2), (1, 5), (3, 5), (4, 7)],
+                         bibrank_record_sorter.sort_by_rank_values(hitset, values, 10))
+
+    def test_sort_by_rank_values_with_limit(self):
+        """bibrank record sorter - sorting only the best rank values"""
+        (ranked, values) = bibrank_record_sorter.build_rank_values({1: 5, 2: 1, 3: 5, 4: 7, 6: 2})
+        hitset = HitSet([1, 2, 3, 4, 6])
+        reclist = bibrank_record_sorter.sort_by_rank_values(hitset, values, 2)
+        self.assertEqual(5, len(reclist))
+        self.assertEqual([(3, 5), (4, 7)], reclist[-2:])
+        self.assertEqual([1, 2, 6], sorted([recID for (recID, value) in reclist[:-2]]))
+
+    def test_rank_values_cache_reload(self):
+        """bibrank record sorter - reloading rank values of updated methods"""
+        last_updated = ['2010-01-01 10:00:00']
+        def run_sql(query, params=None):
+            return ((last_updated[0],),)
+        def load_rank_values(rank_method_code, timestamp):
+            return (rank_method_code, timestamp)
+        saved = (bibrank_record_sorter.run_sql, bibrank_record_sorter.load_rank_values)
+        bibrank_record_sorter.run_sql = run_sql
+        bibrank_record_sorter.load_rank_values = load_rank_values
+        try:
+            cacher = bibrank_record_sorter.RankValuesDataCacher('test')
+            cacher.recreate_cache_if_needed()
+            self.assertEqual(('test', '2010-01-01 10:00:00'), cacher.cache)
+            # an indexer run started before the cache was built:
+            last_updated[0] = '2010-01-01 11:00:00'
+            cacher.recreate_cache_if_needed()
+            self.assertEqual(('test', '2010-01-01 11:00:00'), cacher.cache)
+        finally:
+            (bibrank_record_sorter.run_sql, bibrank_record_sorter.load_rank_values) = saved
+
+TEST_SUITE = make_test_suite(TestListSetOperations,
+                             TestRankValues,)
 
 if __name__ == "__main__":
     run_test_suite(TEST_SUITE)
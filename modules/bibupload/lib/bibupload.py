@@ -81,8 +81,12 @@ from invenio.config import CFG_OAI_ID_FIELD, \
      CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE
 
 from invenio.bibupload_config import CFG_BIBUPLOAD_CONTROLFIELD_TAGS, \
-    CFG_BIBUPLOAD_SPECIAL_TAGS
-from invenio.dbquery import run_sql, \
+    CFG_BIBUPLOAD_SPECIAL_TAGS, \
+    CFG_BIBUPLOAD_BULK_BATCH_SIZE, \
+    CFG_BIBUPLOAD_BIBXXX_ID_CACHE_SIZE, \
+    CFG_BIBUPLOAD_BIBXXX_QUERY_CHUNK_SIZE, \
+    CFG_BIBUPLOAD_BIBXXX_QUERY_MAX_SIZE
+from invenio.dbquery import run_sql, run_sql_many, \
                             Error
 from invenio.bibrecord import create_records, \
                               record_add_field, \
@@ -124,6 +128,13 @@ stat['exectime'] = time.localtime()
 
 _WRITING_RIGHTS = None
 
+## ids of already seen (tag, value) combinations of bibxxx tables;
+## they are only trusted within one batch of records prefetched by
+## prefetch_records_bibxxx() or within one call to bibupload(), since
+## unused bibxxx rows may be deleted in between (e.g. by inveniogc):
+_BIBXXX_ID_CACHE = {}
+_BIBXXX_ID_CACHE_BATCH_P = False
+
 ## Let's set a reasonable timeout for URL request (e.g. FFT)
 socket.setdefaulttimeout(40)
 
@@ -170,6 +181,9 @@ def bibupload(record, opt_tag=None, opt_mode=None,
     assert(opt_mode in ('insert', 'replace', 'replace_or_insert', 'reference',
         'correct', 'append', 'format', 'holdingpen', 'delete'))
     error = None
+    if not _BIBXXX_ID_CACHE_BATCH_P:
+        # not uploading a prefetched batch, so do not trust older ids:
+        _BIBXXX_ID_CACHE.clear()
     # If there are special tags to proceed check if it exists in the record
     if opt_tag is not None and not(record.has_key(opt_tag)):
         write_message("    Failed: Tag not found, enter a valid tag to update.",
@@ -884,6 +898,180 @@ def insert_record_bibrec_bibxxx(table_name, id_bibxxx,
             " function 2nd query : %s " % error, verbose=1, stream=sys.stderr)
     return res
 
+def get_bibxxx_rows_from_record(record):
+    """Return the list of (full_tag, value, field_number) tuples of the
+    metadata of RECORD that go into the bibxxx tables, in the order in
+    which they should be stored."""
+    rows = []
+    for tag in record.keys():
+        # check if tag is not a special one:
+        if tag in CFG_BIBUPLOAD_SPECIAL_TAGS:
+            # nothing to do for special tags (FFT, FMT)
+            continue
+        # for each tag there is a list of tuples representing datafields
+        for single_tuple in record[tag]:
+            # these are the contents of a single tuple
+            subfield_list = single_tuple[0]
+            ind1 = single_tuple[1]
+            ind2 = single_tuple[2]
+            if ind1 == '' or ind1 == ' ':
+                ind1 = '_'
+            if ind2 == '' or ind2 == ' ':
+                ind2 = '_'
+            datafield_number = single_tuple[4]
+            if tag in CFG_BIBUPLOAD_CONTROLFIELD_TAGS:
+                if tag != "001":
+                    rows.append((tag + ind1 + ind2, single_tuple[3], datafield_number))
+            else:
+                # get the tag and value from the content of each subfield
+                for subtag, value in subfield_list:
+                    rows.append((tag + ind1 + ind2 + subtag, value, datafield_number))
+    return rows
+
+def get_bibxxx_query_chunks(items, get_size,
+                            max_items=CFG_BIBUPLOAD_BIBXXX_QUERY_CHUNK_SIZE,
+                            max_size=CFG_BIBUPLOAD_BIBXXX_QUERY_MAX_SIZE):
+    """Split the ITEMS list into chunks to be put in one bibxxx query
+    each, holding at most MAX_ITEMS items and at most MAX_SIZE bytes as
+    measured by the GET_SIZE function (but at least one item)."""
+    chunks = []
+    chunk = []
+    chunk_size = 0
+    for item in items:
+        item_size = get_size(item)
+        if chunk and (len(chunk) >= max_items or chunk_size + item_size > max_size):
+            chunks.append(chunk)
+            chunk = []
+            chunk_size = 0
+        chunk.append(item)
+        chunk_size += item_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+def find_records_bibxxx(tag_values):
+    """Look up the ids of the (tag, value) combinations of the
+    TAG_VALUES list in the bibxxx tables, using one query per table and
+    chunk of values.  Return a dictionary {(tag, value): (table_name,
+    id)} of the found combinations.  Found ids are remembered for the
+    rest of the batch of records (see _BIBXXX_ID_CACHE)."""
+    out = {}
+    values_by_table = {}
+    for tag, value in tag_values:
+        if (tag, value) in _BIBXXX_ID_CACHE:
+            out[(tag, value)] = _BIBXXX_ID_CACHE[(tag, value)]
+        else:
+            values_by_table.setdefault('bib' + tag[0:2] + 'x', {})[(tag, value)] = None
+    if len(_BIBXXX_ID_CACHE) > CFG_BIBUPLOAD_BIBXXX_ID_CACHE_SIZE:
+        _BIBXXX_ID_CACHE.clear()
+    for table_name, table_tag_values in values_by_table.iteritems():
+        tags = dict([(tag, None) for tag, value in table_tag_values]).keys()
+        values = dict([(value, None) for tag, value in table_tag_values]).keys()
+        for chunk in get_bibxxx_query_chunks(values, len):
+            query = """SELECT id,tag,value FROM %s WHERE tag IN (%s) AND value IN (%s)
+                       ORDER BY id""" % \
+                    (table_name, ','.join(['%s'] * len(tags)), ','.join(['%s'] * len(chunk)))
+            try:
+                res = run_sql(query, tuple(tags) + tuple(chunk))
+            except Error, error:
+                write_message("   Error during the find_records_bibxxx function : %s "
+                    % error, verbose=1, stream=sys.stderr)
+                continue
+            # Note: compare the found values one by one and look for
+            # string binary equality, as insert_record_bibxxx() does.
+            for row_id, row_tag, row_value in res:
+                if (row_tag, row_value) in table_tag_values and \
+                       (row_tag, row_value) not in out:
+                    out[(row_tag, row_value)] = (table_name, row_id)
+                    _BIBXXX_ID_CACHE[(row_tag, row_value)] = (table_name, row_id)
+    return out
+
+def insert_records_bibxxx(tag_values, pretend=False):
+    """Bulk version of insert_record_bibxxx(): return a dictionary
+    {(tag, value): (table_name, id)} for all the (tag, value)
+    combinations of the TAG_VALUES list, inserting into the bibxxx
+    tables those that do not exist yet."""
+    out = find_records_bibxxx(tag_values)
+    missing_by_table = {}
+    for tag, value in tag_values:
+        if (tag, value) not in out:
+            missing_by_table.setdefault('bib' + tag[0:2] + 'x', {})[(tag, value)] = None
+    if pretend:
+        for table_name, table_tag_values in missing_by_table.iteritems():
+            for tag_value in table_tag_values:
+                out[tag_value] = (table_name, 1)
+        return out
+    # insert the new combinations with one query per table and chunk:
+    for table_name, table_tag_values in missing_by_table.iteritems():
+        table_tag_values = table_tag_values.keys()
+        for chunk in get_bibxxx_query_chunks(table_tag_values,
+                                             lambda tag_value: len(tag_value[0]) + len(tag_value[1])):
+            query = """INSERT INTO %s (tag, value) VALUES %s""" % \
+                    (table_name, ','.join(['(%s,%s)'] * len(chunk)))
+            params = []
+            for tag, value in chunk:
+                params.extend((tag, value))
+            try:
+                run_sql(query, tuple(params))
+            except Error, error:
+                write_message("   Error during the insert_records_bibxxx function : %s "
+                    % error, verbose=1, stream=sys.stderr)
+    # now look up their ids, inserting one by one those that failed:
+    missing = []
+    for table_tag_values in missing_by_table.itervalues():
+        missing.extend(table_tag_values.keys())
+    out.update(find_records_bibxxx(missing))
+    for tag, value in missing:
+        if (tag, value) not in out:
+            out[(tag, value)] = insert_record_bibxxx(tag, value)
+            if out[(tag, value)][1] is not None:
+                _BIBXXX_ID_CACHE[(tag, value)] = out[(tag, value)]
+    return out
+
+def insert_records_bibrec_bibxxx(rows, pretend=False):
+    """Bulk version of insert_record_bibrec_bibxxx(): insert the ROWS
+    list of (table_name, id_bibxxx, field_number, id_bibrec) into the
+    bibrec_bibxxx tables, using one query per table.  Return the number
+    of inserted rows, or None in case of error."""
+    rows_by_table = {}
+    for table_name, id_bibxxx, field_number, id_bibrec in rows:
+        rows_by_table.setdefault('bibrec_' + table_name, []).append((id_bibrec, id_bibxxx, field_number))
+    if pretend:
+        return len(rows)
+    res = 0
+    for full_table_name, params in rows_by_table.iteritems():
+        query = """INSERT INTO %s """ % full_table_name
+        query += """(id_bibrec,id_bibxxx, field_number) values (%s , %s, %s)"""
+        try:
+            res += run_sql_many(query, params)
+        except Error, error:
+            write_message("   Error during the insert_records_bibrec_bibxxx"
+                " function : %s " % error, verbose=1, stream=sys.stderr)
+            return None
+    return res
+
+def clear_bibxxx_id_cache():
+    """Forget the bibxxx ids remembered so far, and end the current
+    batch of records, if any."""
+    global _BIBXXX_ID_CACHE_BATCH_P
+    _BIBXXX_ID_CACHE.clear()
+    _BIBXXX_ID_CACHE_BATCH_P = False
+
+def prefetch_records_bibxxx(records):
+    """Resolve in bulk the bibxxx ids of the metadata of all the
+    RECORDS, so that their subsequent upload finds them in memory.
+    This starts a new batch of records: the ids are remembered until
+    the next call or until clear_bibxxx_id_cache() is called."""
+    global _BIBXXX_ID_CACHE_BATCH_P
+    _BIBXXX_ID_CACHE.clear()
+    _BIBXXX_ID_CACHE_BATCH_P = True
+    tag_values = {}
+    for record in records:
+        if record:
+            for full_tag, value, field_number in get_bibxxx_rows_from_record(record):
+                tag_values[(full_tag, value)] = None
+    find_records_bibxxx(tag_values.keys())
+
 def synchronize_8564(rec_id, record, record_had_FFT, pretend=False):
     """
     Synchronize 8564_ tags and BibDocFile tables.
@@ -1541,72 +1729,23 @@ def archive_marcxml_for_history(recID, pretend=False):
 
 def update_database_with_metadata(record, rec_id, oai_rec_id = "oai", pretend=False):
     """Update the database tables with the record and the record id given in parameter"""
-    for tag in record.keys():
-        # check if tag is not a special one:
-        if tag not in CFG_BIBUPLOAD_SPECIAL_TAGS:
-            # for each tag there is a list of tuples representing datafields
-            tuple_list = record[tag]
-            # this list should contain the elements of a full tag [tag, ind1, ind2, subfield_code]
-            tag_list = []
-            tag_list.append(tag)
-            for single_tuple in tuple_list:
-                # these are the contents of a single tuple
-                subfield_list = single_tuple[0]
-                ind1 = single_tuple[1]
-                ind2 = single_tuple[2]
-                # append the ind's to the full tag
-                if ind1 == '' or ind1 == ' ':
-                    tag_list.append('_')
-                else:
-                    tag_list.append(ind1)
-                if ind2 == '' or ind2 == ' ':
-                    tag_list.append('_')
-                else:
-                    tag_list.append(ind2)
-                datafield_number = single_tuple[4]
-
-                if tag in CFG_BIBUPLOAD_SPECIAL_TAGS:
-                    # nothing to do for special tags (FFT, FMT)
-                    pass
-                elif tag in CFG_BIBUPLOAD_CONTROLFIELD_TAGS and tag != "001":
-                    value = single_tuple[3]
-                    # get the full tag
-                    full_tag = ''.join(tag_list)
-
-                    # update the tables
-                    write_message("   insertion of the tag "+full_tag+" with the value "+value, verbose=9)
-                    # insert the tag and value into into bibxxx
-                    (table_name, bibxxx_row_id) = insert_record_bibxxx(full_tag, value, pretend=pretend)
-                    #print 'tname, bibrow', table_name, bibxxx_row_id;
-                    if table_name is None or bibxxx_row_id is None:
-                        write_message("   Failed : during insert_record_bibxxx", verbose=1, stream=sys.stderr)
-                    # connect bibxxx and bibrec with the table bibrec_bibxxx
-                    res = insert_record_bibrec_bibxxx(table_name, bibxxx_row_id, datafield_number, rec_id, pretend=pretend)
-                    if res is None:
-                        write_message("   Failed : during insert_record_bibrec_bibxxx", verbose=1, stream=sys.stderr)
-                else:
-                    # get the tag and value from the content of each subfield
-                    for subfield in subfield_list:
-                        subtag = subfield[0]
-                        value = subfield[1]
-                        tag_list.append(subtag)
-                        # get the full tag
-                        full_tag = ''.join(tag_list)
-                        # update the tables
-                        write_message("   insertion of the tag "+full_tag+" with the value "+value, verbose=9)
-                        # insert the tag and value into into bibxxx
-                        (table_name, bibxxx_row_id) = insert_record_bibxxx(full_tag, value, pretend=pretend)
-                        if table_name is None or bibxxx_row_id is None:
-                            write_message("   Failed : during insert_record_bibxxx", verbose=1, stream=sys.stderr)
-                        # connect bibxxx and bibrec with the table bibrec_bibxxx
-                        res = insert_record_bibrec_bibxxx(table_name, bibxxx_row_id, datafield_number, rec_id, pretend=pretend)
-                        if res is None:
-                            write_message("   Failed : during insert_record_bibrec_bibxxx", verbose=1, stream=sys.stderr)
-                        # remove the subtag from the list
-                        tag_list.pop()
-                tag_list.pop()
-                tag_list.pop()
-            tag_list.pop()
+    rows = get_bibxxx_rows_from_record(record)
+    for full_tag, value, datafield_number in rows:
+        write_message("   insertion of the tag "+full_tag+" with the value "+value, verbose=9)
+    # insert the tags and values into bibxxx
+    bibxxx_ids = insert_records_bibxxx([(full_tag, value) for full_tag, value, datafield_number in rows],
+                                       pretend=pretend)
+    # connect bibxxx and bibrec with the tables bibrec_bibxxx
+    links = []
+    for full_tag, value, datafield_number in rows:
+        (table_name, bibxxx_row_id) = bibxxx_ids[(full_tag, value)]
+        if table_name is None or bibxxx_row_id is None:
+            write_message("   Failed : during insert_record_bibxxx", verbose=1, stream=sys.stderr)
+            continue
+        links.append((table_name, bibxxx_row_id, datafield_number, rec_id))
+    res = insert_records_bibrec_bibxxx(links, pretend=pretend)
+    if res is None:
+        write_message("   Failed : during insert_record_bibrec_bibxxx", verbose=1, stream=sys.stderr)
     write_message("   -Update the database with metadata : DONE", verbose=2)
 
     log_record_uploading(oai_rec_id, task_get_task_param('task_id', 0), rec_id, 'P', pretend=pretend)
@@ -1968,7 +2107,12 @@ def task_run_core():
         write_message("Entering records loop", verbose=3)
         if recs is not None:
             # We proceed each record by record
-            for record in recs:
+            for i in xrange(len(recs)):
+                record = recs[i]
+                if i % CFG_BIBUPLOAD_BULK_BATCH_SIZE == 0 and \
+                       task_get_option("mode") != "holdingpen":
+                    # resolve the bibxxx ids of the next batch at once:
+                    prefetch_records_bibxxx(recs[i:i + CFG_BIBUPLOAD_BULK_BATCH_SIZE])
                 record_id = record_extract_oai_id(record)
                 task_sleep_now_if_required(can_stop_too=True)
                 if task_get_option("mode") == "holdingpen":
@@ -2005,6 +2149,7 @@ def task_run_core():
                     (stat['nb_records_inserted'] + \
                     stat['nb_records_updated'],
                     stat['nb_records_to_upload']))
+            clear_bibxxx_id_cache()
         else:
             write_message("   Error bibupload failed: No record found",
                         verbose=1, stream=sys.stderr)
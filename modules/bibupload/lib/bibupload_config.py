@@ -28,4 +28,14 @@ CFG_BIBUPLOAD_CONTROLFIELD_TAGS = ['001', '002', '003', '004',
 
 CFG_BIBUPLOAD_SPECIAL_TAGS = ['FMT', 'FFT']
 
+## how many records to read ahead in order to resolve the ids of their
+## bibxxx values in bulk, and how many resolved ids to keep in memory
+## during an upload:
+CFG_BIBUPLOAD_BULK_BATCH_SIZE = 100
+CFG_BIBUPLOAD_BIBXXX_ID_CACHE_SIZE = 200000
 
+## how many values to look for in one bibxxx query, and how many bytes
+## of values at most (keep it well below the max_allowed_packet of the
+## database server, since the values are escaped in the query):
+CFG_BIBUPLOAD_BIBXXX_QUERY_CHUNK_SIZE = 500
+CFG_BIBUPLOAD_BIBXXX_QUERY_MAX_SIZE = 400000
@@ -3841,6 +3841,72 @@ allow any</subfield>
         self.assertEqual(test_web_page_content(testrec_expected_url, 'jekyll', 'j123ekyll', expected_text=expected_content_version), [])
 
 
+class BibUploadBibxxxBulkTest(GenericBibUploadTest):
+    """Testing bulk lookup and insertion of bibxxx values."""
+
+    def setUp(self):
+        GenericBibUploadTest.setUp(self)
+        self.tag_values = [('100__a', 'BibUpload Bulk Test, A'),
+                           ('100__a', 'bibupload bulk test, a'),
+                           ('245__a', 'BibUpload bulk test title')]
+        bibupload.clear_bibxxx_id_cache()
+
+    def tearDown(self):
+        GenericBibUploadTest.tearDown(self)
+        for tag, value in self.tag_values:
+            run_sql("DELETE FROM bib%sx WHERE tag=%%s AND value=%%s" % tag[0:2],
+                    (tag, value))
+        bibupload.clear_bibxxx_id_cache()
+
+    def test_insert_records_bibxxx(self):
+        """bibupload - bulk insertion of bibxxx values"""
+        ids = bibupload.insert_records_bibxxx(self.tag_values)
+        self.assertEqual(ids[self.tag_values[0]][0], 'bib10x')
+        self.assertEqual(ids[self.tag_values[2]][0], 'bib24x')
+        # values differing by case only are stored apart:
+        self.assertNotEqual(ids[self.tag_values[0]][1], ids[self.tag_values[1]][1])
+        # no duplicates were created, and the ids are found again:
+        bibupload.clear_bibxxx_id_cache()
+        self.assertEqual(bibupload.find_records_bibxxx(self.tag_values), ids)
+        self.assertEqual(bibupload.insert_records_bibxxx(self.tag_values), ids)
+        for tag, value in self.tag_values:
+            self.assertEqual(bibupload.insert_record_bibxxx(tag, value), ids[(tag, value)])
+
+    def test_get_bibxxx_query_chunks(self):
+        """bibupload - splitting bibxxx queries by count and size"""
+        self.assertEqual(bibupload.get_bibxxx_query_chunks(['a', 'bb', 'c', 'dddd', 'e'], len,
+                                                           max_items=2, max_size=3),
+                         [['a', 'bb'], ['c'], ['dddd'], ['e']])
+        self.assertEqual(bibupload.get_bibxxx_query_chunks([], len), [])
+
+    def test_insert_records_bibxxx_pretend(self):
+        """bibupload - bulk insertion of bibxxx values in pretend mode"""
+        ids = bibupload.insert_records_bibxxx(self.tag_values, pretend=True)
+        self.assertEqual(len(ids), len(self.tag_values))
+        self.assertEqual(bibupload.find_records_bibxxx(self.tag_values), {})
+
+    def test_bibxxx_id_cache_scope(self):
+        """bibupload - bibxxx ids are not remembered across uploads"""
+        ids = bibupload.insert_records_bibxxx(self.tag_values)
+        # unused bibxxx rows get deleted, e.g. by inveniogc:
+        for tag, value in self.tag_values:
+            run_sql("DELETE FROM bib%sx WHERE tag=%%s AND value=%%s" % tag[0:2],
+                    (tag, value))
+        # a new batch does not see the deleted ids anymore:
+        bibupload.prefetch_records_bibxxx([])
+        self.assertEqual(bibupload.find_records_bibxxx(self.tag_values), {})
+        # neither does a direct call to bibupload():
+        bibupload.clear_bibxxx_id_cache()
+        bibupload.find_records_bibxxx(self.tag_values)
+        bibupload.insert_records_bibxxx(self.tag_values)
+        self.failUnless(bibupload._BIBXXX_ID_CACHE)
+        for tag, value in self.tag_values:
+            run_sql("DELETE FROM bib%sx WHERE tag=%%s AND value=%%s" % tag[0:2],
+                    (tag, value))
+        bibupload.bibupload({}, opt_tag='999__', opt_mode='insert')
+        self.assertEqual(bibupload.find_records_bibxxx(self.tag_values), {})
+        self.failIf(ids == bibupload.insert_records_bibxxx(self.tag_values))
+
 TEST_SUITE = make_test_suite(BibUploadHoldingPenTest,
                              BibUploadInsertModeTest,
                              BibUploadAppendModeTest,
@@ -3858,6 +3924,7 @@ TEST_SUITE = make_test_suite(BibUploadHoldingPenTest,
                              BibUploadStrongTagsTest,
                              BibUploadFFTModeTest,
                              BibUploadPretendTest,
+                             BibUploadBibxxxBulkTest,
                              )
 
 if __name__ == "__main__":
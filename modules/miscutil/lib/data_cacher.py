@@ -22,9 +22,17 @@ Tool for caching important infos, which are slow to rebuild, but that
 rarely change.
 """
 
-from invenio.dbquery import run_sql, get_table_update_time
+import os
+import tempfile
 import time
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+from invenio.dbquery import run_sql, get_table_update_time
+
 class InvenioDataCacherError(Exception):
     """Error raised by data cacher."""
     pass
@@ -104,3 +112,227 @@ class SQLDataCacher(DataCacher):
 
 
 
+
+class SizeBoundedCache:
+    """
+    SizeBoundedCache is a simple in-process least-recently-used cache
+    whose total size is bounded by a number of bytes rather than by a
+    number of entries.  Useful for caching objects of very different
+    sizes (e.g. hitsets of frequent and rare terms) without letting a
+    few big ones blow up the memory of the process.
+
+    The size of each entry is given by the caller at insertion time.
+    When the bound is exceeded, the least recently used entries are
+    evicted until the cache occupies at most three quarters of its
+    allowed size, so that eviction does not happen on every insert.
+    """
+    def __init__(self, max_size):
+        """ @param max_size: maximum total size of the cached values,
+                   in bytes.  Zero or a negative value means that the
+                   cache is disabled.
+        """
+        self.max_size = max_size
+        self.clear()
+
+    def clear(self):
+        """Empty the cache and reset its statistics."""
+        self.entries = {} # key -> (value, size)
+        self.last_used = {} # key -> access tick
+        self.tick = 0
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def keys(self):
+        """Return the list of keys currently stored in the cache."""
+        return self.entries.keys()
+
+    def get(self, key, default=None):
+        """Return the value stored under KEY, or DEFAULT if it is not
+        cached.  Updates the hit/miss statistics."""
+        try:
+            value = self.entries[key][0]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.tick += 1
+        self.last_used[key] = self.tick
+        return value
+
+    def set(self, key, value, size):
+        """Store VALUE under KEY, accounting for SIZE bytes.  Values
+        bigger than the whole cache are not stored at all."""
+        if size > self.max_size:
+            return
+        self.delete(key)
+        self.tick += 1
+        self.entries[key] = (value, size)
+        self.last_used[key] = self.tick
+        self.size += size
+        if self.size > self.max_size:
+            self.evict(self.max_size * 3 / 4)
+
+    def delete(self, key):
+        """Remove KEY from the cache, if present."""
+        if key in self.entries:
+            self.size -= self.entries[key][1]
+            del self.entries[key]
+            del self.last_used[key]
+
+    def evict(self, target_size):
+        """Evict least recently used entries until the total size of
+        the cache is not greater than TARGET_SIZE."""
+        lru_keys = [(tick, key) for key, tick in self.last_used.iteritems()]
+        lru_keys.sort()
+        for dummy, key in lru_keys:
+            if self.size <= target_size:
+                break
+            self.delete(key)
+
+class FileStoreCache:
+    """
+    FileStoreCache is a node-local cache of string values, stored as
+    one file per key below a given directory.  Since all the Apache
+    or WSGI processes of a node share the same directory (and the
+    same operating system page cache), a value computed by one
+    process is available to all the others.
+
+    Values are written atomically (write to a temporary file, then
+    rename), so readers never see partially written entries.  The
+    modification time of an entry file is its creation time, which
+    permits clients to discard entries older than a given timestamp.
+    The total size of the store is kept under MAX_SIZE bytes by
+    removing the least recently modified entries; this cleanup scans
+    the directory, hence it is only run every CLEANUP_FREQUENCY
+    writes.  If LRU is set, reading an entry refreshes its
+    modification time, so that the least recently used entries are
+    removed first (the modification time is then no longer the
+    creation time).
+    """
+    def __init__(self, dirname, max_size=0, cleanup_frequency=1000,
+                 lru=False):
+        """ @param dirname: the directory holding the entries.
+            @param max_size: maximum total size of the store in bytes;
+                   zero means unbounded.
+            @param cleanup_frequency: run the size bounding cleanup
+                   every this many writes.
+            @param lru: whether reads refresh the entries.
+        """
+        self.dirname = dirname
+        self.max_size = max_size
+        self.cleanup_frequency = cleanup_frequency
+        self.lru = lru
+        self.nb_writes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry_path(self, key):
+        """Return the path of the file holding KEY."""
+        digest = md5(repr(key)).hexdigest()
+        return os.path.join(self.dirname, digest[:2], digest)
+
+    def get(self, key, newer_than=0, default=None):
+        """Return the value stored under KEY, or DEFAULT if it is not
+        cached or if it was stored before NEWER_THAN (seconds since
+        the epoch)."""
+        path = self.get_entry_path(key)
+        try:
+            if os.path.getmtime(path) < newer_than:
+                self.misses += 1
+                return default
+            entry = open(path, 'rb')
+            try:
+                value = entry.read()
+            finally:
+                entry.close()
+        except (IOError, OSError):
+            self.misses += 1
+            return default
+        self.hits += 1
+        if self.lru:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+        return value
+
+    def set(self, key, value):
+        """Store string VALUE under KEY.  Errors (e.g. full disk) are
+        silently ignored, since the store is only a cache."""
+        path = self.get_entry_path(key)
+        try:
+            dirname = os.path.dirname(path)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            fd, tmp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp')
+            try:
+                os.write(fd, value)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            return
+        self.nb_writes += 1
+        if self.max_size > 0 and \
+               self.nb_writes % self.cleanup_frequency == 0:
+            self.cleanup()
+
+    def delete(self, key):
+        """Remove KEY from the store, if present."""
+        try:
+            os.remove(self.get_entry_path(key))
+        except OSError:
+            pass
+
+    def get_entries(self):
+        """Return the list of (mtime, size, path) of all the entries
+        of the store."""
+        entries = []
+        for dirpath, dummy, filenames in os.walk(self.dirname):
+            for filename in filenames:
+                if filename.startswith('.tmp'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get_size(self):
+        """Return the total size of the store in bytes."""
+        return sum([size for dummy, size, dummy in self.get_entries()])
+
+    def cleanup(self, expire_before=0):
+        """Remove the entries older than EXPIRE_BEFORE (seconds since
+        the epoch), then the least recently modified ones until the
+        store occupies at most three quarters of its allowed size."""
+        entries = self.get_entries()
+        entries.sort()
+        total_size = sum([size for dummy, size, dummy in entries])
+        target_size = self.max_size * 3 / 4
+        for mtime, size, path in entries:
+            if mtime >= expire_before and \
+                   (self.max_size <= 0 or total_size <= target_size):
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total_size -= size
+
+    def clear(self):
+        """Remove all the entries of the store."""
+        for dummy, dummy, path in self.get_entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
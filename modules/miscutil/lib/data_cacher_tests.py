@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2011 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for data_cacher library."""
+
+__revision__ = "$Id$"
+
+import os
+import time
+import unittest
+import shutil
+import tempfile
+
+from invenio.data_cacher import SizeBoundedCache, FileStoreCache
+from invenio.testutils import make_test_suite, run_test_suite
+
+class SizeBoundedCacheTest(unittest.TestCase):
+    """Test size bounded in-memory cache."""
+
+    def test_get_set(self):
+        """data cacher - size bounded cache get and set"""
+        cache = SizeBoundedCache(100)
+        cache.set('a', 'foo', 3)
+        self.assertEqual(cache.get('a'), 'foo')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.size, 3)
+
+    def test_lru_eviction(self):
+        """data cacher - size bounded cache evicts least recently used"""
+        cache = SizeBoundedCache(100)
+        cache.set('a', 1, 30)
+        cache.set('b', 2, 30)
+        cache.set('c', 3, 30)
+        cache.get('a')
+        cache.set('d', 4, 30)
+        self.failUnless('a' in cache)
+        self.failIf('b' in cache)
+        self.failUnless('d' in cache)
+        self.failUnless(cache.size <= 100)
+
+    def test_too_big_value(self):
+        """data cacher - size bounded cache ignores too big values"""
+        cache = SizeBoundedCache(10)
+        cache.set('a', 1, 11)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+    def test_replace_value(self):
+        """data cacher - size bounded cache replaces values"""
+        cache = SizeBoundedCache(100)
+        cache.set('a', 1, 10)
+        cache.set('a', 2, 20)
+        self.assertEqual(cache.get('a'), 2)
+        self.assertEqual(cache.size, 20)
+
+class FileStoreCacheTest(unittest.TestCase):
+    """Test node-local file store cache."""
+
+    def setUp(self):
+        """Create a temporary store directory."""
+        self.dirname = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """Remove the temporary store directory."""
+        shutil.rmtree(self.dirname)
+
+    def test_get_set_delete(self):
+        """data cacher - file store cache get, set and delete"""
+        store = FileStoreCache(self.dirname)
+        store.set(('idxWORD01F', 'ellis'), 'foo\0bar')
+        self.assertEqual(store.get(('idxWORD01F', 'ellis')), 'foo\0bar')
+        self.assertEqual(store.get(('idxWORD01F', 'muon')), None)
+        store.delete(('idxWORD01F', 'ellis'))
+        self.assertEqual(store.get(('idxWORD01F', 'ellis')), None)
+
+    def test_shared_between_instances(self):
+        """data cacher - file store cache is shared between instances"""
+        FileStoreCache(self.dirname).set('a', 'foo')
+        self.assertEqual(FileStoreCache(self.dirname).get('a'), 'foo')
+
+    def test_newer_than(self):
+        """data cacher - file store cache discards old entries"""
+        store = FileStoreCache(self.dirname)
+        store.set('a', 'foo')
+        self.assertEqual(store.get('a', newer_than=0), 'foo')
+        self.assertEqual(store.get('a', newer_than=2**31), None)
+
+    def test_cleanup(self):
+        """data cacher - file store cache size bounding"""
+        store = FileStoreCache(self.dirname, max_size=100,
+                               cleanup_frequency=1)
+        for i in range(10):
+            store.set(i, 'x' * 30)
+        self.failUnless(store.get_size() <= 100)
+
+    def test_cleanup_lru(self):
+        """data cacher - file store cache evicts least recently used entries"""
+        store = FileStoreCache(self.dirname, max_size=100, lru=True)
+        store.set('a', 'x' * 30)
+        store.set('b', 'x' * 30)
+        old_time = time.time() - 3600
+        os.utime(store.get_entry_path('a'), (old_time, old_time))
+        os.utime(store.get_entry_path('b'), (old_time + 1, old_time + 1))
+        store.get('a')
+        store.set('c', 'x' * 30)
+        store.cleanup()
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('a'), 'x' * 30)
+
+TEST_SUITE = make_test_suite(SizeBoundedCacheTest,
+                             FileStoreCacheTest)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
@@ -290,8 +290,13 @@ TRUNCATE idxPHRASE12R;
 TRUNCATE idxPHRASE13R;
 TRUNCATE idxPHRASE14R;
 TRUNCATE idxPHRASE15R;
+TRUNCATE idxSORT;
+TRUNCATE idxSORTRANK;
+TRUNCATE idxTRIGRAM;
+TRUNCATE idxTRIGRAMSTATUS;
 TRUNCATE rnkMETHODDATA;
 TRUNCATE rnkCITATIONDATA;
+TRUNCATE rnkCITATIONLOG;
 TRUNCATE rnkDOWNLOADS;
 TRUNCATE rnkPAGEVIEWS;
 TRUNCATE rnkWORD01F;
@@ -2489,6 +2489,36 @@ CREATE TABLE IF NOT EXISTS idxPHRASE16R (
   PRIMARY KEY (id_bibrec,type)
 ) ENGINE=MyISAM;
 
+-- tables for sort index:
+
+CREATE TABLE IF NOT EXISTS idxSORT (
+  id_field mediumint(9) unsigned NOT NULL,
+  id_bibrec mediumint(8) unsigned NOT NULL,
+  value varchar(255) NOT NULL default '',
+  PRIMARY KEY (id_field,id_bibrec)
+) ENGINE=MyISAM;
+
+CREATE TABLE IF NOT EXISTS idxSORTRANK (
+  id_field mediumint(9) unsigned NOT NULL,
+  ranks longblob,
+  last_updated datetime NOT NULL default '0000-00-00 00:00:00',
+  PRIMARY KEY (id_field)
+) ENGINE=MyISAM;
+
+CREATE TABLE IF NOT EXISTS idxTRIGRAM (
+  bibxxx varchar(6) NOT NULL default '',
+  term varbinary(12) NOT NULL default '',
+  hitlist longblob,
+  PRIMARY KEY (bibxxx, term)
+) ENGINE=MyISAM;
+
+CREATE TABLE IF NOT EXISTS idxTRIGRAMSTATUS (
+  bibxxx varchar(6) NOT NULL default '',
+  last_id mediumint(8) unsigned NOT NULL default '0',
+  last_updated datetime NOT NULL default '0000-00-00 00:00:00',
+  PRIMARY KEY (bibxxx)
+) ENGINE=MyISAM;
+
 -- tables for ranking:
 
 CREATE TABLE IF NOT EXISTS rnkMETHOD (
@@ -2574,6 +2604,21 @@ CREATE TABLE IF NOT EXISTS rnkCITATIONDATA (
   UNIQUE KEY object_name (object_name)
 ) ENGINE=MyISAM;
 
+-- a table logging the per-record changes of the citation dictionaries
+-- of rnkCITATIONDATA, so that the citation searchers can update their
+-- copy without reloading whole dictionaries.  object_value is NULL for
+-- removed records; id_bibrec is 0 when the whole dictionary changed.
+
+CREATE TABLE IF NOT EXISTS rnkCITATIONLOG (
+  id int(15) unsigned NOT NULL auto_increment,
+  object_name varchar(255) NOT NULL,
+  id_bibrec int(8) unsigned NOT NULL,
+  object_value longblob,
+  last_updated datetime NOT NULL default '0000-00-00',
+  PRIMARY KEY id (id),
+  KEY last_updated (last_updated)
+) ENGINE=MyISAM;
+
 -- a table for missing citations. This should be scanned by a program
 -- occasionally to check if some publication has been cited more than
 -- 50 times (or such), and alert cataloguers to create record for that
@@ -3490,6 +3535,22 @@ CREATE TABLE IF NOT EXISTS staEVENT (
   UNIQUE KEY number (number)
 ) ENGINE=MyISAM;
 
+CREATE TABLE IF NOT EXISTS staKEYEVENTROLLUP (
+  event varchar(64) NOT NULL default '',
+  collection varchar(255) NOT NULL default '',
+  granularity varchar(5) NOT NULL default '',
+  bucket datetime NOT NULL default '0000-00-00 00:00:00',
+  value int(15) unsigned NOT NULL default '0',
+  PRIMARY KEY  (event, collection, granularity, bucket)
+) ENGINE=MyISAM;
+
+CREATE TABLE IF NOT EXISTS staKEYEVENTROLLUPSTATUS (
+  event varchar(64) NOT NULL default '',
+  collection varchar(255) NOT NULL default '',
+  last_updated datetime NOT NULL default '0000-00-00 00:00:00',
+  PRIMARY KEY  (event, collection)
+) ENGINE=MyISAM;
+
 -- BibClassify tables:
 
 CREATE TABLE IF NOT EXISTS clsMETHOD (
@@ -318,6 +318,10 @@ DROP TABLE IF EXISTS idxPHRASE13R;
 DROP TABLE IF EXISTS idxPHRASE14R;
 DROP TABLE IF EXISTS idxPHRASE15R;
 DROP TABLE IF EXISTS idxPHRASE16R;
+DROP TABLE IF EXISTS idxSORT;
+DROP TABLE IF EXISTS idxSORTRANK;
+DROP TABLE IF EXISTS idxTRIGRAM;
+DROP TABLE IF EXISTS idxTRIGRAMSTATUS;
 DROP TABLE IF EXISTS rnkMETHOD;
 DROP TABLE IF EXISTS rnkMETHODNAME;
 DROP TABLE IF EXISTS rnkMETHODDATA;
@@ -327,6 +331,7 @@ DROP TABLE IF EXISTS rnkPAGEVIEWS;
 DROP TABLE IF EXISTS rnkDOWNLOADS;
 DROP TABLE IF EXISTS rnkCITATIONDATA;
 DROP TABLE IF EXISTS rnkCITATIONDATAEXT;
+DROP TABLE IF EXISTS rnkCITATIONLOG;
 DROP TABLE IF EXISTS rnkAUTHORDATA;
 DROP TABLE IF EXISTS collection_rnkMETHOD;
 DROP TABLE IF EXISTS collection;
@@ -415,6 +420,8 @@ DROP TABLE IF EXISTS collection_externalcollection;
 DROP TABLE IF EXISTS externalcollection;
 DROP TABLE IF EXISTS collectiondetailedrecordpagetabs;
 DROP TABLE IF EXISTS staEVENT;
+DROP TABLE IF EXISTS staKEYEVENTROLLUP;
+DROP TABLE IF EXISTS staKEYEVENTROLLUPSTATUS;
 DROP TABLE IF EXISTS clsMETHOD;
 DROP TABLE IF EXISTS collection_clsMETHOD;
 DROP TABLE IF EXISTS jrnJOURNAL;
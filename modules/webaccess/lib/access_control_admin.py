@@ -24,6 +24,8 @@ __revision__ = "$Id$"
 ## import interesting modules:
 
 import sys
+import time
+import datetime
 
 if sys.hexversion < 0x2040000:
     # pylint: disable=W0622
@@ -34,10 +36,14 @@ from invenio.messages import gettext_set_language
 from invenio.config import CFG_SITE_ADMIN_EMAIL, CFG_SITE_LANG
 from invenio.access_control_config import CFG_ACC_EMPTY_ROLE_DEFINITION_SER, \
     CFG_ACC_EMPTY_ROLE_DEFINITION_SRC, DELEGATEADDUSERROLE, SUPERADMINROLE, \
-    DEF_USERS, DEF_ROLES, DEF_AUTHS, DEF_ACTIONS, CFG_ACC_ACTIVITIES_URLS
-from invenio.dbquery import run_sql, ProgrammingError
+    DEF_USERS, DEF_ROLES, DEF_AUTHS, DEF_ACTIONS, CFG_ACC_ACTIVITIES_URLS, \
+    CFG_ACC_EMPTY_ROLE_DEFINITION_OBJ, \
+    CFG_ACC_AUTHORIZATION_CACHE_CHECK_INTERVAL, \
+    CFG_ACC_AUTHORIZATION_CACHE_MAX_USERS
+from invenio.dbquery import run_sql, ProgrammingError, get_table_update_time
 from invenio.access_control_firerole import compile_role_definition, \
-    acc_firerole_check_user, serialize, deserialize, load_role_definition
+    acc_firerole_check_user, serialize, deserialize, repair_role_definitions
+from invenio.data_cacher import DataCacher
 from invenio.intbitset import intbitset
 
 CFG_SUPERADMINROLE_ID = 0
@@ -48,6 +54,109 @@ try:
 except:
     pass
 
+# AUTHORIZATION CACHE
+
+class AccAuthorizationDataCacher(DataCacher):
+    """
+    Cache of the access control tables needed to authorize actions, so that
+    authorization checks do not run any SQL query:
+
+      action_ids - {name_action: id_action}
+
+      roles_without_arguments - {id_action: intbitset of the roles
+                                 authorized without arguments}
+
+      roles_with_arguments - {id_action: {(id_role, argumentlistid):
+                              {keyword: value}}}
+
+      firerole_definitions - {id_role: compiled FireRole definition}
+
+      user_roles - {id_user: {id_role: expiration}}, filled lazily with the
+                   explicit roles of each user checked
+
+    The update times of the tables are checked at most once every
+    CFG_ACC_AUTHORIZATION_CACHE_CHECK_INTERVAL seconds; changes made
+    through this module expire the cache immediately.
+    """
+    def __init__(self):
+        def cache_filler():
+            cache = {'action_ids': {},
+                     'roles_without_arguments': {},
+                     'roles_with_arguments': {},
+                     'firerole_definitions': {},
+                     'user_roles': {}}
+            for id_action, name_action in run_sql("SELECT id, name FROM accACTION"):
+                cache['action_ids'][name_action] = id_action
+            for id_role, id_action in run_sql("SELECT id_accROLE, id_accACTION FROM accROLE_accACTION_accARGUMENT WHERE argumentlistid <= 0"):
+                cache['roles_without_arguments'].setdefault(id_action, intbitset()).add(id_role)
+            for id_role, id_action, keyword, value, argumentlistid in run_sql("SELECT id_accROLE, id_accACTION, keyword, value, argumentlistid FROM accROLE_accACTION_accARGUMENT JOIN accARGUMENT ON id_accARGUMENT=id WHERE argumentlistid > 0"):
+                cache['roles_with_arguments'].setdefault(id_action, {}).setdefault((id_role, argumentlistid), {})[keyword] = value
+            try:
+                definitions = [(id_role, deserialize(firerole_def_ser)) for id_role, firerole_def_ser in run_sql("SELECT id, firerole_def_ser FROM accROLE")]
+            except Exception:
+                ## Something bad might have happened? (Update of Python?)
+                repair_role_definitions()
+                definitions = [(id_role, deserialize(firerole_def_ser)) for id_role, firerole_def_ser in run_sql("SELECT id, firerole_def_ser FROM accROLE")]
+            cache['firerole_definitions'] = dict(definitions)
+            return cache
+
+        def timestamp_verifier():
+            return max([get_table_update_time(table) for table in
+                ('accACTION', 'accARGUMENT', 'accROLE',
+                 'accROLE_accACTION_accARGUMENT', 'user_accROLE')])
+
+        self.last_check = 0
+        self.expired = False
+        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+
+    def create_cache(self):
+        """Create the cache, and remember when the tables were checked."""
+        DataCacher.create_cache(self)
+        self.last_check = time.time()
+        self.expired = False
+
+    def recreate_cache_if_needed(self):
+        """Recreate the cache if it has been expired, or if the tables have
+        changed since its creation, checking them at most once every
+        CFG_ACC_AUTHORIZATION_CACHE_CHECK_INTERVAL seconds."""
+        if self.expired:
+            self.create_cache()
+        elif time.time() - self.last_check >= CFG_ACC_AUTHORIZATION_CACHE_CHECK_INTERVAL:
+            self.last_check = time.time()
+            DataCacher.recreate_cache_if_needed(self)
+
+ACC_AUTHORIZATION_CACHERS = []
+
+def acc_get_authorization_cache():
+    """Return the up to date cache of the access control tables (see
+    AccAuthorizationDataCacher)."""
+    if not ACC_AUTHORIZATION_CACHERS:
+        ACC_AUTHORIZATION_CACHERS.append(AccAuthorizationDataCacher())
+    else:
+        ACC_AUTHORIZATION_CACHERS[0].recreate_cache_if_needed()
+    return ACC_AUTHORIZATION_CACHERS[0].cache
+
+def acc_expire_authorization_cache():
+    """Expire the authorization cache of this process, so that it is
+    recreated on its next use. To be called when changing the access
+    control tables."""
+    if ACC_AUTHORIZATION_CACHERS:
+        ACC_AUTHORIZATION_CACHERS[0].expired = True
+
+def acc_get_user_explicit_roles(id_user):
+    """Return the explicit roles of the user, as a dictionary
+    {id_role: expiration}, memoized in the authorization cache."""
+    user_roles = acc_get_authorization_cache()['user_roles']
+    try:
+        return user_roles[id_user]
+    except KeyError:
+        if len(user_roles) >= CFG_ACC_AUTHORIZATION_CACHE_MAX_USERS:
+            user_roles.clear()
+        roles = dict(run_sql("""SELECT id_accROLE, expiration
+            FROM user_accROLE WHERE id_user = %s""", (id_user, )))
+        user_roles[id_user] = roles
+        return roles
+
 # ACTIONS
 
 def acc_add_action(name_action='', description='', optional='no',
@@ -80,6 +189,7 @@ def acc_add_action(name_action='', description='', optional='no',
     if not allowedkeywords:
         optional = 'no'
 
+    acc_expire_authorization_cache()
     # insert the new entry
     try:
         res = run_sql("""INSERT INTO accACTION (name, description,
@@ -107,6 +217,7 @@ def acc_delete_action(id_action=0, name_action=0):
     if not id_action:
         return 0
 
+    acc_expire_authorization_cache()
     # delete the action
     if run_sql("""DELETE FROM accACTION WHERE id=%s""", (id_action, )):
         # delete all entries related
@@ -157,6 +268,7 @@ def acc_update_action(id_action=0, name_action='', verbose=0, **update):
     if not id_action:
         return 0
 
+    acc_expire_authorization_cache()
     try:
         if update.has_key('description'):
             # change the description, no other effects
@@ -232,6 +344,7 @@ def acc_add_role(name_role, description,
     """
 
     if not run_sql("""SELECT name FROM accROLE WHERE name = %s""", (name_role, )):
+        acc_expire_authorization_cache()
         res = run_sql("""INSERT INTO accROLE (name, description,
                             firerole_def_ser, firerole_def_src)
                          VALUES (%s, %s, %s, %s)""",
@@ -284,6 +397,7 @@ def acc_delete_role(id_role=0, name_role=0):
     if SUPERADMINROLE == acc_get_role_name(id_role):
         return 0
 
+    acc_expire_authorization_cache()
     # try to delete
     if run_sql("""DELETE FROM accROLE WHERE id = %s  """ % (id_role, )):
         # delete everything related
@@ -342,6 +456,7 @@ def acc_update_role(id_role=0, name_role='', dummy=0, description='', \
     if not id_role:
         return 0
 
+    acc_expire_authorization_cache()
     return run_sql("""UPDATE accROLE SET description = %s,
         firerole_def_ser = %s, firerole_def_src = %s
         WHERE id = %s""", (description, firerole_def_ser,
@@ -371,6 +486,7 @@ def acc_add_user_role(id_user=0, id_role=0, email='', name_role='',
     if not acc_get_user_email(id_user=id_user):
         return 0
 
+    acc_expire_authorization_cache()
     # control if existing entry
     if run_sql("""SELECT id_user FROM user_accROLE WHERE id_user = %s AND
         id_accROLE = %s""", (id_user, id_role)):
@@ -396,6 +512,7 @@ def acc_delete_user_role(id_user, id_role=0, name_role=0):
     # need to find id of the role
     id_role = id_role or acc_get_role_id(name_role=name_role)
 
+    acc_expire_authorization_cache()
     # number of deleted entries will be returned (0 or 1)
     return run_sql("""DELETE FROM user_accROLE WHERE id_user = %s
         AND id_accROLE = %s """, (id_user, id_role))
@@ -490,6 +607,7 @@ def acc_add_authorization(name_role='', name_action='', optional=0, **keyval):
     optional_action = action_details[0][4] == 'yes' and 1 or 0
     optional = int(optional)
 
+    acc_expire_authorization_cache()
     # this action does not take arguments
     if not optional and not keyval:
         # can not add if user is doing a mistake
@@ -622,6 +740,7 @@ def acc_add_role_action_arguments(id_role=0, id_action=0, arglistid=-1,
     except (IndexError, AttributeError):
         return 0
 
+    acc_expire_authorization_cache()
     if verbose:
         print 'ids: is it optional'
     # action with optional arguments
@@ -848,6 +967,7 @@ def acc_delete_role_action_arguments(id_role, id_action, arglistid=1,
         if pa[0] == arglistid and pa[1:] not in auths:
             keepauths.append(pa[1:])
 
+    acc_expire_authorization_cache()
     # delete everything
     run_sql("""DELETE FROM accROLE_accACTION_accARGUMENT
         WHERE id_accROLE = %s AND
@@ -922,6 +1042,7 @@ def acc_delete_role_action_arguments_group(id_role=0, id_action=0, arglistid=0):
     if not id_role or not id_action:
         return []
 
+    acc_expire_authorization_cache()
     return run_sql("""DELETE FROM accROLE_accACTION_accARGUMENT
     WHERE id_accROLE = %s AND
     id_accACTION = %s AND
@@ -977,6 +1098,7 @@ def acc_delete_possible_actions(id_role=0, id_action=0, authids=[]):
 def acc_delete_role_action(id_role=0, id_action=0):
     """delete all connections between a role and an action. """
 
+    acc_expire_authorization_cache()
     count = run_sql("""DELETE FROM accROLE_accACTION_accARGUMENT
         WHERE id_accROLE = %s AND id_accACTION = %s """, (id_role, id_action))
 
@@ -1211,28 +1333,27 @@ def acc_get_user_id(email=''):
 def acc_is_user_in_role(user_info, id_role):
     """Return True if the user belong implicitly or explicitly to the role."""
 
-    if run_sql("""SELECT ur.id_accROLE
-            FROM user_accROLE ur
-            WHERE ur.id_user = %s AND ur.expiration >= NOW() AND
-            ur.id_accROLE = %s LIMIT 1""", (user_info['uid'], id_role), 1):
+    expiration = acc_get_user_explicit_roles(user_info['uid']).get(id_role)
+    if expiration is not None and expiration >= datetime.datetime.now():
         return True
 
-    return acc_firerole_check_user(user_info, load_role_definition(id_role))
+    firerole_definitions = acc_get_authorization_cache()['firerole_definitions']
+    return acc_firerole_check_user(user_info,
+        firerole_definitions.get(id_role, CFG_ACC_EMPTY_ROLE_DEFINITION_OBJ))
 
 def acc_get_user_roles_from_user_info(user_info):
     """get all roles a user is connected to."""
 
-    roles = intbitset(run_sql("""SELECT ur.id_accROLE
-        FROM user_accROLE ur
-        WHERE ur.id_user = %s AND ur.expiration >= NOW()
-        ORDER BY ur.id_accROLE""", (user_info['uid'], )))
-
-    potential_implicit_roles = run_sql("""SELECT id, firerole_def_ser FROM accROLE
-        WHERE firerole_def_ser IS NOT NULL""")
+    now = datetime.datetime.now()
+    roles = intbitset([id_role for id_role, expiration in
+        acc_get_user_explicit_roles(user_info['uid']).iteritems()
+        if expiration >= now])
 
-    for role_id, firerole_def_ser in potential_implicit_roles:
-        if role_id not in roles:
-            if acc_firerole_check_user(user_info, deserialize(firerole_def_ser)):
+    firerole_definitions = acc_get_authorization_cache()['firerole_definitions']
+    for role_id, firerole_def_obj in firerole_definitions.iteritems():
+        if role_id not in roles and \
+               firerole_def_obj is not CFG_ACC_EMPTY_ROLE_DEFINITION_OBJ:
+            if acc_firerole_check_user(user_info, firerole_def_obj):
                 roles.add(role_id)
 
     return roles
@@ -1360,19 +1481,15 @@ def acc_find_possible_roles(name_action, always_add_superadmin=True, **arguments
     """Find all the possible roles that are enabled to action_name with
     given arguments. roles is a list of role_id
     """
-    id_action = acc_get_action_id(name_action)
-    roles = intbitset(run_sql("SELECT id_accROLE FROM accROLE_accACTION_accARGUMENT WHERE id_accACTION=%s AND argumentlistid <= 0", (id_action, )))
+    cache = acc_get_authorization_cache()
+    id_action = cache['action_ids'].get(name_action, 0)
+    roles = intbitset(cache['roles_without_arguments'].get(id_action, []))
     if always_add_superadmin:
         roles.add(CFG_SUPERADMINROLE_ID)
-    other_roles_to_check = run_sql("SELECT id_accROLE, keyword, value, argumentlistid FROM  accROLE_accACTION_accARGUMENT JOIN accARGUMENT ON id_accARGUMENT=id WHERE id_accACTION=%s AND argumentlistid > 0", (id_action, ))
-    other_roles_to_check_dict = {}
-    for id_accROLE, keyword, value, argumentlistid in other_roles_to_check:
-        if id_accROLE not in roles:
-            try:
-                other_roles_to_check_dict[(id_accROLE, argumentlistid)][keyword] = value
-            except KeyError:
-                other_roles_to_check_dict[(id_accROLE, argumentlistid)] = {keyword : value}
+    other_roles_to_check_dict = cache['roles_with_arguments'].get(id_action, {})
     for ((id_accROLE, argumentlistid), stored_arguments) in other_roles_to_check_dict.iteritems():
+        if id_accROLE in roles:
+            continue
         for key, value in stored_arguments.iteritems():
             if (value != arguments.get(key, '*') != '*') and value != '*':
                 break
@@ -1625,6 +1742,7 @@ def acc_merge_argument_groups(id_role=0, id_action=0, arglistids=[]):
     if not res:
         return []
 
+    acc_expire_authorization_cache()
     run_sql(q_del, (id_role, id_action))
 
     # list of entire entries
@@ -1670,6 +1788,7 @@ def acc_delete_all_settings():
     """simply remove all data affiliated with webaccess by truncating
     tables accROLE, accACTION, accARGUMENT and those connected. """
 
+    acc_expire_authorization_cache()
     run_sql("""TRUNCATE accROLE""")
     run_sql("""TRUNCATE accACTION""")
     run_sql("""TRUNCATE accARGUMENT""")
@@ -67,6 +67,14 @@ CFG_ACC_EMPTY_ROLE_DEFINITION_OBJ = (False, ())
 # default role definition, compiled and serialized:
 CFG_ACC_EMPTY_ROLE_DEFINITION_SER = None
 
+# minimum number of seconds between two checks of the update time of the
+# access control tables by the authorization cache of each process:
+CFG_ACC_AUTHORIZATION_CACHE_CHECK_INTERVAL = 10
+
+# maximum number of users whose explicit roles are memoized by the
+# authorization cache of each process:
+CFG_ACC_AUTHORIZATION_CACHE_MAX_USERS = 10000
+
 # List of tags containing (multiple) emails of users who should authorize
 # to access the corresponding record regardless of collection restrictions.
 if CFG_CERN_SITE:
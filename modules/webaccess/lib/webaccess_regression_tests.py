@@ -30,10 +30,11 @@ from urlparse import urlparse, urlunparse
 from urllib import urlopen, urlencode
 
 from invenio.access_control_admin import acc_add_role, acc_delete_role, \
-    acc_get_role_definition
+    acc_get_role_definition, acc_update_role, acc_is_user_in_role
 from invenio.access_control_firerole import compile_role_definition, \
     serialize, deserialize
 from invenio.config import CFG_SITE_URL, CFG_SITE_SECURE_URL, CFG_DEVEL_SITE
+from invenio.webuser import collect_user_info
 from invenio.testutils import make_test_suite, run_test_suite, \
                               test_web_page_content, merge_error_messages
 
@@ -94,6 +95,16 @@ class WebAccessFireRoleTest(unittest.TestCase):
         tmp_def_ser = acc_get_role_definition(self.role_id)
         self.assertEqual(def_ser, deserialize(tmp_def_ser))
 
+    def test_webaccess_firerole_authorization_cache(self):
+        """webaccess - firerole role definition changes are seen at once"""
+        user_info = collect_user_info(1)
+        user_info['email'] = 'test@cern.ch'
+        self.failUnless(acc_is_user_in_role(user_info, self.role_id))
+        acc_update_role(self.role_id, description=self.role_description,
+            firerole_def_ser=serialize(compile_role_definition('deny all')),
+            firerole_def_src='deny all')
+        self.failIf(acc_is_user_in_role(user_info, self.role_id))
+
 class WebAccessUseBasketsTest(unittest.TestCase):
     """
     Check WebAccess behaviour WRT enabling/disabling web modules such
@@ -39,7 +39,8 @@ from invenio.config import \
 from invenio.webbasket_dblayer import get_basket_owner_id, add_to_basket
 from invenio.webbasket import format_external_records
 from invenio.search_engine import perform_request_search, wash_colls, \
-get_coll_sons, is_hosted_collection
+get_coll_sons, is_hosted_collection, wash_dates, search_unit_in_bibrec, \
+set_search_unit_memoization
 from invenio.webinterface_handler import wash_urlargd
 from invenio.dbquery import run_sql
 from invenio.webuser import get_email
@@ -246,18 +247,30 @@ def get_record_ids(argstr, date_from, date_until):
     else:
         external_records = ([],[])
 
-    recids = perform_request_search(of='id', p=p, c=c, cc=cc, f=f, so=so, sp=sp, ot=ot,
-                                  aas=aas, p1=p1, f1=f1, m1=m1, op1=op1, p2=p2, f2=f2,
-                                  m2=m2, op2=op2, p3=p3, f3=f3, m3=m3, sc=sc, d1y=d1y,
-                                  d1m=d1m, d1d=d1d, d2y=d2y, d2m=d2m, d2d=d2d)
+    # The records created within the time window are the same for all
+    # the alerts of a run (and the search units are memoized by
+    # run_alerts()), so the window is only computed once; if no record
+    # was created, no need to search at all.
+    window = search_unit_in_bibrec(*wash_dates(d1y=d1y, d1m=d1m, d1d=d1d,
+                                               d2y=d2y, d2m=d2m, d2d=d2d))
+    if window:
+        recids = perform_request_search(of='id', p=p, c=c, cc=cc, f=f, so=so, sp=sp, ot=ot,
+                                      aas=aas, p1=p1, f1=f1, m1=m1, op1=op1, p2=p2, f2=f2,
+                                      m2=m2, op2=op2, p3=p3, f3=f3, m3=m3, sc=sc, d1y=d1y,
+                                      d1m=d1m, d1d=d1d, d2y=d2y, d2m=d2m, d2d=d2d)
+    else:
+        recids = []
 
     return (recids, external_records)
 
-def run_query(query, frequency, date_until):
+def run_query(query, frequency, date_until, records_memo=None):
     """Return a dictionary containing the information of the performed query.
 
     The information contains the id of the query, the arguments as a
-    string, and the list of found records."""
+    string, and the list of found records.
+
+    If records_memo is a dictionary, it is used to reuse the records
+    found by queries with identical arguments and time frame."""
 
     if frequency == 'day':
         date_from = date_until - datetime.timedelta(days=1)
@@ -278,7 +291,13 @@ def run_query(query, frequency, date_until):
 
         date_from = datetime.date(year=y, month=m, day=d)
 
-    recs = get_record_ids(query[1], date_from, date_until)
+    if records_memo is None:
+        recs = get_record_ids(query[1], date_from, date_until)
+    else:
+        key = (query[1], date_from, date_until)
+        if key not in records_memo:
+            records_memo[key] = get_record_ids(query[1], date_from, date_until)
+        recs = records_memo[key]
 
     n = len(recs[0])
     if n:
@@ -296,7 +315,7 @@ def run_query(query, frequency, date_until):
     return {'id_query': query[0], 'argstr': query[1],
             'records': recs, 'date_from': date_from, 'date_until': date_until}
 
-def process_alert_queries(frequency, date):
+def process_alert_queries(frequency, date, records_memo=None):
     """Run the alerts according to the frequency.
 
     Retrieves the queries for which an alert exists, performs it, and
@@ -305,7 +324,7 @@ def process_alert_queries(frequency, date):
     alert_queries = get_alert_queries(frequency)
 
     for aq in alert_queries:
-        q = run_query(aq, frequency, date)
+        q = run_query(aq, frequency, date, records_memo)
         alerts = get_alerts(q, frequency)
         process_alerts(alerts)
 
@@ -316,11 +335,16 @@ def process_alert_queries_for_user(uid, date):
 
     alert_queries = get_alert_queries_for_user(uid)
 
-    for aq in alert_queries:
-        frequency = aq[2]
-        q = run_query(aq, frequency, date)
-        alerts = get_alerts(q, frequency)
-        process_alerts(alerts)
+    records_memo = {}
+    set_search_unit_memoization(True)
+    try:
+        for aq in alert_queries:
+            frequency = aq[2]
+            q = run_query(aq, frequency, date, records_memo)
+            alerts = get_alerts(q, frequency)
+            process_alerts(alerts)
+    finally:
+        set_search_unit_memoization(False)
 
 def replace_argument(argstr, argname, argval):
     """Replace the given date argument value with the new one.
@@ -404,15 +428,26 @@ def run_alerts(date):
     """Run the alerts.
 
     First decide which alerts to run according to the current local
-    time, and runs them."""
+    time, and runs them.
 
-    if date.day == 1:
-        process_alert_queries('month', date)
+    The work is shared among all the alerts of the run: queries with
+    identical arguments are run only once per time frame, and the
+    basic search units (including the time frame hitsets) are computed
+    only once, so that the run scales with the number of distinct
+    queries and search terms rather than with the number of alerts."""
+
+    records_memo = {}
+    set_search_unit_memoization(True)
+    try:
+        if date.day == 1:
+            process_alert_queries('month', date, records_memo)
 
-    if date.isoweekday() == 1: # first day of the week
-        process_alert_queries('week', date)
+        if date.isoweekday() == 1: # first day of the week
+            process_alert_queries('week', date, records_memo)
 
-    process_alert_queries('day', date)
+        process_alert_queries('day', date, records_memo)
+    finally:
+        set_search_unit_memoization(False)
 
 # External records related functions
 def calculate_external_records(req_args, pattern_list, field, hosted_colls, timeout=CFG_EXTERNAL_COLLECTION_TIMEOUT, limit=CFG_EXTERNAL_COLLECTION_MAXRESULTS_ALERTS):
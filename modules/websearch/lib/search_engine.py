@@ -37,12 +37,19 @@ import urllib
 import urlparse
 import zlib
 import sys
+import threading
+from array import array
 
 if sys.hexversion < 0x2040000:
     # pylint: disable=W0622
     from sets import Set as set
     # pylint: enable=W0622
 
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
 ## import Invenio stuff:
 from invenio.config import \
      CFG_CERN_SITE, \
@@ -53,7 +60,10 @@ from invenio.config import \
      CFG_WEBSEARCH_CREATE_SIMILARLY_NAMED_AUTHORS_LINK_BOX, \
      CFG_WEBSEARCH_FIELDS_CONVERT, \
      CFG_WEBSEARCH_NB_RECORDS_TO_SORT, \
-     CFG_WEBSEARCH_SEARCH_CACHE_SIZE, \
+     CFG_WEBSEARCH_SEARCH_CACHE_BYTES, \
+     CFG_WEBSEARCH_TERM_CACHE_SIZE, \
+     CFG_WEBSEARCH_TERM_CACHE_SHARED, \
+     CFG_WEBSEARCH_FACET_TAGS, \
      CFG_WEBSEARCH_USE_MATHJAX_FOR_FORMATS, \
      CFG_WEBSEARCH_USE_ALEPH_SYSNOS, \
      CFG_WEBSEARCH_DEF_RECORDS_IN_GROUPS, \
@@ -65,21 +75,26 @@ from invenio.config import \
      CFG_SITE_LANG, \
      CFG_SITE_NAME, \
      CFG_LOGDIR, \
+     CFG_CACHEDIR, \
      CFG_BIBFORMAT_HIDDEN_TAGS, \
      CFG_SITE_URL, \
      CFG_ACCESS_CONTROL_LEVEL_ACCOUNTS, \
      CFG_BIBRANK_SHOW_CITATION_LINKS, \
      CFG_SOLR_URL
-from invenio.search_engine_config import InvenioWebSearchUnknownCollectionError, InvenioWebSearchWildcardLimitError
+from invenio.search_engine_config import InvenioWebSearchUnknownCollectionError, InvenioWebSearchWildcardLimitError, \
+     CFG_WEBSEARCH_SORT_RANK_TYPECODE, CFG_WEBSEARCH_SORT_RANK_UNKNOWN, \
+     CFG_WEBSEARCH_TRIGRAM_MAX_CANDIDATES, CFG_WEBSEARCH_RESTRICTED_SEARCH_MAX_RECORDS, \
+     CFG_WEBSEARCH_FACET_COUNTS_CACHE_SIZE, CFG_WEBSEARCH_PREFETCH_CHUNK_SIZE
 from invenio.bibrecord import create_record, record_get_field_instances
 from invenio.bibrank_record_sorter import get_bibrank_methods, rank_records, is_method_valid
 from invenio.bibrank_downloads_similarity import register_page_view_event, calculate_reading_similarity_list
 from invenio.bibindex_engine_stemmer import stem
-from invenio.bibindex_engine_tokenizer import wash_author_name, author_name_requires_phrase_search
+from invenio.bibindex_engine_tokenizer import wash_author_name, author_name_requires_phrase_search, \
+     wash_trigram_phrase, BibIndexTrigramTokenizer
 from invenio.bibformat import format_record, format_records, get_output_format_content_type, create_excel
 from invenio.bibformat_config import CFG_BIBFORMAT_USE_OLD_BIBFORMAT
 from invenio.bibrank_downloads_grapher import create_download_history_graph_and_box
-from invenio.data_cacher import DataCacher
+from invenio.data_cacher import DataCacher, SizeBoundedCache, FileStoreCache
 from invenio.websearch_external_collections import print_external_results_overview, perform_external_collection_search
 from invenio.access_control_admin import acc_get_action_id
 from invenio.access_control_config import VIEWRESTRCOLL, \
@@ -360,6 +375,113 @@ def get_index_stemming_language(index_id, recreate_cache_if_needed=True):
         index_stemming_cache.recreate_cache_if_needed()
     return index_stemming_cache.cache[index_id]
 
+class IndexLastUpdatedDataCacher(DataCacher):
+    """
+    Provides cache for the last update times of word/phrase indexes,
+    as written by BibIndex.  This class is not to be used directly;
+    use function get_index_last_updated() instead.
+    """
+    def __init__(self):
+        def cache_filler():
+            try:
+                res = run_sql("""SELECT id, last_updated FROM idxINDEX""")
+            except DatabaseError:
+                # database problems, return empty cache
+                return {}
+            ret = {}
+            for index_id, last_updated in res:
+                if last_updated:
+                    ret[index_id] = str(last_updated)
+                else:
+                    ret[index_id] = ''
+            return ret
+
+        def timestamp_verifier():
+            return get_table_update_time('idxINDEX')
+
+        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+
+try:
+    index_last_updated_cache.is_ok_p
+except Exception:
+    index_last_updated_cache = IndexLastUpdatedDataCacher()
+
+def get_index_last_updated(index_id, recreate_cache_if_needed=True):
+    """Return last update time of given index as a string, or empty
+    string if the index was never updated or was reset."""
+    if recreate_cache_if_needed:
+        index_last_updated_cache.recreate_cache_if_needed()
+    return index_last_updated_cache.cache.get(index_id, '')
+
+class WordHitlistCache:
+    """
+    Provides cache for decoded hitlists of word index terms, keyed by
+    (index table, term, index last update time), so that entries are
+    implicitly invalidated whenever BibIndex updates the index.  The
+    entries live in a per-process memory cache bounded by
+    CFG_WEBSEARCH_TERM_CACHE_SIZE bytes and, if
+    CFG_WEBSEARCH_TERM_CACHE_SHARED is set, in a node-local file store
+    shared by all the processes.  This class is not to be used
+    directly; use function get_word_hitlist() instead.
+    """
+    def __init__(self):
+        self.is_ok_p = True
+        self.memory = SizeBoundedCache(CFG_WEBSEARCH_TERM_CACHE_SIZE)
+        self.store = None
+        if CFG_WEBSEARCH_TERM_CACHE_SHARED:
+            self.store = FileStoreCache(os.path.join(CFG_CACHEDIR, 'wordhitlists'),
+                                        max_size=10 * CFG_WEBSEARCH_TERM_CACHE_SIZE)
+
+    def clear(self):
+        """Clear both the memory and the shared caches."""
+        self.memory.clear()
+        if self.store:
+            self.store.clear()
+
+try:
+    if not word_hitlist_cache.is_ok_p:
+        raise Exception
+except Exception:
+    word_hitlist_cache = WordHitlistCache()
+
+def get_word_hitlist(bibwordsX, index_id, term):
+    """Return hitset of recIDs for the exact (already washed) TERM
+       inside the word index table BIBWORDSX of index INDEX_ID.  The
+       returned hitset is a private copy that the caller may modify.
+    """
+    last_updated = ''
+    if CFG_WEBSEARCH_TERM_CACHE_SIZE > 0:
+        last_updated = get_index_last_updated(index_id)
+    if not last_updated:
+        # cache disabled, or index being reindexed, so do not cache:
+        res = run_sql("SELECT hitlist FROM %s WHERE term=%%s" % bibwordsX,
+                      (term,))
+        if res:
+            return HitSet(res[0][0])
+        return HitSet()
+    key = (bibwordsX, term, last_updated)
+    hitset = word_hitlist_cache.memory.get(key)
+    if hitset is None:
+        hitlist = None
+        if word_hitlist_cache.store:
+            hitlist = word_hitlist_cache.store.get(key)
+        if hitlist is None:
+            res = run_sql("SELECT hitlist FROM %s WHERE term=%%s" % bibwordsX,
+                          (term,))
+            if res:
+                hitlist = res[0][0]
+            else:
+                hitlist = ''
+            if word_hitlist_cache.store:
+                word_hitlist_cache.store.set(key, hitlist)
+        if hitlist:
+            hitset = HitSet(hitlist)
+        else:
+            hitset = HitSet()
+        word_hitlist_cache.memory.set(key, hitset,
+            hitset.get_allocated() * hitset.get_wordbytsize() + len(term))
+    return HitSet(hitset)
+
 class CollectionRecListDataCacher(DataCacher):
     """
     Provides cache for collection reclist hitsets.  This class is not
@@ -406,26 +528,210 @@ def get_collection_reclist(coll, recreate_cache_if_needed=True):
     # finally, return reclist:
     return collection_reclist_cache.cache[coll]
 
-class SearchResultsCache(DataCacher):
+class SortRankDataCacher(DataCacher):
     """
-    Provides temporary lazy cache for Search Results.
-    Useful when users click on `next page'.
+    Provides cache for the precomputed record ranks of the sort fields
+    maintained by BibIndex in the idxSORTRANK table.  This class is
+    not to be used directly; use function get_sort_ranks() instead.
     """
     def __init__(self):
         def cache_filler():
-            return {}
+            ret = {}
+            try:
+                res = run_sql("""SELECT f.code FROM idxSORTRANK AS r, field AS f
+                                  WHERE r.id_field=f.id""")
+            except Exception:
+                # database problems, return empty cache
+                return {}
+            for row in res:
+                ret[row[0]] = None # this will be filled later during runtime by calling get_sort_ranks(field)
+            return ret
+
         def timestamp_verifier():
-            return '1970-01-01 00:00:00' # lazy cache is always okay;
-                                         # its filling is governed by
-                                         # CFG_WEBSEARCH_SEARCH_CACHE_SIZE
+            return get_table_update_time('idxSORTRANK')
+
         DataCacher.__init__(self, cache_filler, timestamp_verifier)
 
+try:
+    if not sort_rank_cache.is_ok_p:
+        raise Exception
+except Exception:
+    sort_rank_cache = SortRankDataCacher()
+
+def get_sort_ranks(field, recreate_cache_if_needed=True):
+    """Return array of record ranks for sort field code FIELD, indexed
+       by recID, such that sorting recIDs by their ranks gives the same
+       order as sorting them by their normalized field values.  Return
+       None if BibIndex does not maintain sort index for FIELD."""
+    if recreate_cache_if_needed:
+        sort_rank_cache.recreate_cache_if_needed()
+    if not sort_rank_cache.cache.has_key(field):
+        return None
+    if sort_rank_cache.cache[field] is None:
+        # not yet it the cache, so load it and fill the cache:
+        ranks = array(CFG_WEBSEARCH_SORT_RANK_TYPECODE)
+        res = run_sql("""SELECT r.ranks FROM idxSORTRANK AS r, field AS f
+                          WHERE r.id_field=f.id AND f.code=%s""", (field,))
+        if res and res[0][0]:
+            try:
+                ranks.fromstring(zlib.decompress(res[0][0]))
+            except (zlib.error, ValueError):
+                register_exception()
+                return None
+        sort_rank_cache.cache[field] = ranks
+    return sort_rank_cache.cache[field]
+
+class SearchResultsCache:
+    """
+    Provides cache for search results, useful when users click on
+    `next page' or when several users run the same query.  The hitsets
+    live in a node-local file store shared by all the processes and
+    bounded by CFG_WEBSEARCH_SEARCH_CACHE_BYTES bytes, evicting the
+    least recently used queries first.  The entries are keyed by the
+    query and by the last update times of the indexes and of the
+    collection tree, so that they are implicitly invalidated whenever
+    BibIndex or WebColl run.
+    """
+    def __init__(self):
+        self.is_ok_p = True
+        self.store = None
+        if CFG_WEBSEARCH_SEARCH_CACHE_BYTES > 0:
+            self.store = FileStoreCache(os.path.join(CFG_CACHEDIR, 'searchresults'),
+                                        max_size=CFG_WEBSEARCH_SEARCH_CACHE_BYTES,
+                                        cleanup_frequency=100, lru=True)
+
+    def get_key(self, query):
+        """Return the cache key of QUERY, i.e. QUERY together with the
+        current index and collection update times."""
+        index_last_updated_cache.recreate_cache_if_needed()
+        last_updated = max([''] + index_last_updated_cache.cache.values())
+        return (query, last_updated, get_table_update_time('collection'))
+
+    def get(self, query):
+        """Return the cached hitset of QUERY, or None."""
+        if not self.store:
+            return None
+        key = repr(self.get_key(query))
+        value = self.store.get(key)
+        if value is None:
+            return None
+        stored_key, hitlist = value.split('\n', 1)
+        if stored_key != key:
+            # digest collision between two queries
+            self.store.hits -= 1
+            self.store.misses += 1
+            return None
+        return HitSet(hitlist)
+
+    def set(self, query, hitset):
+        """Store HITSET as the results of QUERY."""
+        if not self.store:
+            return
+        key = repr(self.get_key(query))
+        self.store.set(key, key + '\n' + hitset.fastdump())
+
+    def get_entries(self):
+        """Return the list of (last used time, size, cache key) of the
+        cached queries, most recently used first."""
+        entries = []
+        if not self.store:
+            return entries
+        for mtime, size, path in self.store.get_entries():
+            try:
+                entry = open(path, 'rb')
+                try:
+                    key = entry.readline().rstrip('\n')
+                finally:
+                    entry.close()
+            except (IOError, OSError):
+                continue
+            entries.append((mtime, size, key))
+        entries.sort()
+        entries.reverse()
+        return entries
+
+    def clear(self):
+        """Clear the shared cache."""
+        if self.store:
+            self.store.clear()
+
 try:
     if not search_results_cache.is_ok_p:
         raise Exception
 except Exception:
     search_results_cache = SearchResultsCache()
 
+class FacetIndexDataCacher(DataCacher):
+    """
+    Provides cache for the facet index of a tag, i.e. the values of
+    the tag and, for every record, the ids of its values in field
+    order, so that the values of the tag can be counted over many
+    records without querying the bibXXx tables.  This class is not to
+    be used directly; use function get_facet_index() instead.
+    """
+    def __init__(self, tag):
+        bx = "bib%sx" % tag[0:2]
+        bibx = "bibrec_bib%sx" % tag[0:2]
+
+        def cache_filler():
+            try:
+                values = dict(run_sql("SELECT id, value FROM %s WHERE tag LIKE %%s" % bx,
+                                      (tag,)))
+                res = run_sql("""SELECT bibx.id_bibrec, bibx.id_bibxxx FROM %s AS bx, %s AS bibx
+                                  WHERE bx.id=bibx.id_bibxxx AND bx.tag LIKE %%s
+                                  ORDER BY bibx.id_bibrec, bibx.field_number, bx.tag""" % \
+                              (bx, bibx), (tag,))
+            except DatabaseError:
+                # database problems, return empty cache
+                return {'values': {}, 'column': {}, 'recids': HitSet()}
+            column = {}
+            for recid, value_id in res:
+                column.setdefault(recid, []).append(value_id)
+            for recid, value_ids in column.iteritems():
+                column[recid] = tuple(value_ids)
+            return {'values': values,
+                    'column': column,
+                    'recids': HitSet(column.keys())}
+
+        def timestamp_verifier():
+            return max(get_table_update_time(bx), get_table_update_time(bibx))
+
+        DataCacher.__init__(self, cache_filler, timestamp_verifier)
+
+class FacetCache:
+    """
+    Provides cache for counting the most popular field values: the
+    facet indexes of the tags listed in CFG_WEBSEARCH_FACET_TAGS,
+    built lazily, and the counts already computed for a given set of
+    records, bounded by CFG_WEBSEARCH_FACET_COUNTS_CACHE_SIZE bytes.
+    This class is not to be used directly; use function
+    get_most_popular_field_values() instead.
+    """
+    def __init__(self):
+        self.is_ok_p = True
+        self.indexes = {} # tag -> FacetIndexDataCacher
+        self.counts = SizeBoundedCache(CFG_WEBSEARCH_FACET_COUNTS_CACHE_SIZE)
+
+try:
+    if not facet_cache.is_ok_p:
+        raise Exception
+except Exception:
+    facet_cache = FacetCache()
+
+def get_facet_index(tag, recreate_cache_if_needed=True):
+    """Return the facet index of TAG as a dictionary with keys
+       'values' (bibXXx id -> value), 'column' (recID -> tuple of
+       bibXXx ids in field order) and 'recids' (hitset of the records
+       having TAG).  Return None if TAG is not listed in
+       CFG_WEBSEARCH_FACET_TAGS."""
+    if tag not in CFG_WEBSEARCH_FACET_TAGS:
+        return None
+    if not facet_cache.indexes.has_key(tag):
+        facet_cache.indexes[tag] = FacetIndexDataCacher(tag)
+    elif recreate_cache_if_needed:
+        facet_cache.indexes[tag].recreate_cache_if_needed()
+    return facet_cache.indexes[tag].cache
+
 class CollectionI18nNameDataCacher(DataCacher):
     """
     Provides cache for I18N collection names.  This class is not to be
@@ -1763,7 +2069,7 @@ def browse_in_bibwords(req, p, f, ln=CFG_SITE_LANG):
     ))
     return
 
-def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, ln=CFG_SITE_LANG, display_nearest_terms_box=True, wl=0):
+def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, ln=CFG_SITE_LANG, display_nearest_terms_box=True, wl=0, restrict_to=None):
     """Search for complex pattern 'p' within field 'f' according to
        matching type 'm'.  Return hitset of recIDs.
 
@@ -1786,6 +2092,11 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
        The 'verbose' argument controls the level of debugging information
        to be printed (0=least, 9=most).
 
+       If the 'restrict_to' hitset is given, the pattern is evaluated
+       within these recIDs only, i.e. the result is the intersection
+       of the full result with 'restrict_to', but the basic search
+       units may be searched more cheaply.
+
        All the parameters are assumed to have been previously washed.
 
        This function is suitable as a mid-level API.
@@ -1796,6 +2107,8 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
     hitset_empty = HitSet()
     # sanity check:
     if not p:
+        if restrict_to is not None:
+            return HitSet(restrict_to)
         hitset_full = HitSet(trailing_bits=1)
         hitset_full.discard(0)
         # no pattern, so return all universe
@@ -1811,7 +2124,6 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
     # search stage 2: do search for each search unit and verify hit presence:
     if verbose and of.startswith("h"):
         t1 = os.times()[4]
-    basic_search_units_hitsets = []
     #prepare hiddenfield-related..
     myhiddens = CFG_BIBFORMAT_HIDDEN_TAGS
     can_see_hidden = False
@@ -1829,14 +2141,48 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
         elif 'caption' in fields_to_be_searched:
             print_warning(req, _("Warning: figure caption search is only available for a subset of papers mostly from 2008-2011."))
 
-    for idx_unit in xrange(len(basic_search_units)):
+    # plan the evaluation order of the search units; when the query
+    # is a plain conjunction, the intermediate result is computed as
+    # we go, so that empty intermediates stop the search and
+    # expensive units are only searched within the intermediate:
+    plan = plan_basic_search_units(basic_search_units)
+    if plan is None:
+        units_order = range(len(basic_search_units))
+    else:
+        units_order = plan
+        if verbose >= 3 and of.startswith("h"):
+            print_warning(req, "Search stage 2: evaluation plan is: %s" % \
+                          cgi.escape(repr([basic_search_units[idx_unit] for idx_unit in plan])))
+    basic_search_units_hitsets = [None] * len(basic_search_units)
+    restricted_units = [] # units searched within the intermediate result
+    hitset_intermediate = None # None stands for the whole universe
+    for idx_unit in units_order:
         bsu_o, bsu_p, bsu_f, bsu_m = basic_search_units[idx_unit]
+        unit_restriction = None
+        if plan is not None:
+            if hitset_intermediate is not None and not hitset_intermediate:
+                # empty intermediate result, no need to go on:
+                if verbose >= 3 and of.startswith("h"):
+                    print_warning(req, "Search stage 2: empty intermediate result, skipping remaining units.")
+                break
+            if get_search_unit_cost(bsu_p, bsu_f, bsu_m) > 0 and hitset_intermediate is not None:
+                unit_restriction = hitset_intermediate
+                restricted_units.append(idx_unit)
+        if restrict_to is not None and unit_restriction is None:
+            unit_restriction = restrict_to
+            restricted_units.append(idx_unit)
+        if verbose >= 3 and of.startswith("h"):
+            t_unit = os.times()[4]
         try:
-            basic_search_unit_hitset = search_unit(bsu_p, bsu_f, bsu_m, wl)
+            basic_search_unit_hitset = search_unit(bsu_p, bsu_f, bsu_m, wl, restrict_to=unit_restriction)
         except InvenioWebSearchWildcardLimitError, excp:
             basic_search_unit_hitset = excp.res
             if of.startswith("h"):
                 print_warning(req, "Search term too generic, displaying only partial results...")
+        if verbose >= 3 and of.startswith("h"):
+            print_warning(req, "Search stage 2: basic search unit %s took %.2f seconds%s." % \
+                          (cgi.escape(repr(basic_search_units[idx_unit][1:])), os.times()[4] - t_unit,
+                           unit_restriction is not None and " (within %d intermediate hits)" % len(unit_restriction) or ""))
         # FIXME: print warning if we use native full-text indexing
         if bsu_f == 'fulltext' and bsu_m != 'w' and of.startswith('h') and not CFG_SOLR_URL:
             print_warning(req, _("No phrase index available for fulltext yet, looking for word combination..."))
@@ -1856,16 +2202,26 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
                     display_nearest_terms_box=False #..and stop spying, too.
         if verbose >= 9 and of.startswith("h"):
             print_warning(req, "Search stage 1: pattern %s gave hitlist %s" % (cgi.escape(bsu_p), basic_search_unit_hitset))
-        if len(basic_search_unit_hitset) > 0 or \
-           ap==0 or \
-           bsu_o=="|" or \
-           ((idx_unit+1)<len(basic_search_units) and basic_search_units[idx_unit+1][0]=="|"):
+        unit_retained_p = len(basic_search_unit_hitset) > 0 or \
+                          ap==0 or \
+                          bsu_o=="|" or \
+                          ((idx_unit+1)<len(basic_search_units) and basic_search_units[idx_unit+1][0]=="|")
+        if not unit_retained_p and unit_restriction is not None:
+            # the unit has no hits within the restriction; the
+            # approximate pattern treatment applies only if it has
+            # no hits at all:
+            try:
+                unit_retained_p = len(search_unit(bsu_p, bsu_f, bsu_m, wl)) > 0
+            except InvenioWebSearchWildcardLimitError, excp:
+                unit_retained_p = len(excp.res) > 0
+        if unit_retained_p:
             # stage 2-1: this basic search unit is retained, since
             # either the hitset is non-empty, or the approximate
             # pattern treatment is switched off, or the search unit
             # was joined by an OR operator to preceding/following
-            # units so we do not require that it exists
-            basic_search_units_hitsets.append(basic_search_unit_hitset)
+            # units so we do not require that it exists, or it
+            # exists outside of the restriction it was searched in
+            basic_search_units_hitsets[idx_unit] = basic_search_unit_hitset
         else:
             # stage 2-2: no hits found for this search unit, try to replace non-alphanumeric chars inside pattern:
             if re.search(r'[^a-zA-Z0-9\s\:]', bsu_p) and bsu_f != 'refersto' and bsu_f != 'citedby':
@@ -1875,7 +2231,8 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
                     bsu_pn = re.sub(r'[^a-zA-Z0-9\s\:]+', " ", bsu_p)
                 if verbose and of.startswith('h') and req:
                     print_warning(req, "Trying (%s,%s,%s)" % (cgi.escape(bsu_pn), cgi.escape(bsu_f), cgi.escape(bsu_m)))
-                basic_search_unit_hitset = search_pattern(req=None, p=bsu_pn, f=bsu_f, m=bsu_m, of="id", ln=ln, wl=wl)
+                basic_search_unit_hitset = search_pattern(req=None, p=bsu_pn, f=bsu_f, m=bsu_m, of="id", ln=ln, wl=wl,
+                                                          restrict_to=unit_restriction)
                 if len(basic_search_unit_hitset) > 0:
                     # we retain the new unit instead
                     if of.startswith('h'):
@@ -1883,7 +2240,7 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
                                       {'x_query1': "<em>" + cgi.escape(bsu_p) + "</em>",
                                        'x_query2': "<em>" + cgi.escape(bsu_pn) + "</em>"})
                     basic_search_units[idx_unit][1] = bsu_pn
-                    basic_search_units_hitsets.append(basic_search_unit_hitset)
+                    basic_search_units_hitsets[idx_unit] = basic_search_unit_hitset
                 else:
                     # stage 2-3: no hits found either, propose nearest indexed terms:
                     if of.startswith('h') and display_nearest_terms_box:
@@ -1902,39 +2259,67 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
                         else:
                             print_warning(req, create_nearest_terms_box(req.argd, bsu_p, bsu_f, bsu_m, ln=ln))
                 return hitset_empty
+        if plan is not None:
+            if hitset_intermediate is None:
+                hitset_intermediate = HitSet(basic_search_unit_hitset)
+            elif bsu_o == '-':
+                hitset_intermediate.difference_update(basic_search_unit_hitset)
+            else:
+                hitset_intermediate.intersection_update(basic_search_unit_hitset)
     if verbose and of.startswith("h"):
         t2 = os.times()[4]
         for idx_unit in range(0, len(basic_search_units)):
-            print_warning(req, "Search stage 2: basic search unit %s gave %d hits." %
-                          (basic_search_units[idx_unit][1:], len(basic_search_units_hitsets[idx_unit])))
+            if basic_search_units_hitsets[idx_unit] is None:
+                print_warning(req, "Search stage 2: basic search unit %s was skipped." %
+                              (basic_search_units[idx_unit][1:],))
+            else:
+                print_warning(req, "Search stage 2: basic search unit %s gave %d hits." %
+                              (basic_search_units[idx_unit][1:], len(basic_search_units_hitsets[idx_unit])))
         print_warning(req, "Search stage 2: execution took %.2f seconds." % (t2 - t1))
     # search stage 3: apply boolean query for each search unit:
     if verbose and of.startswith("h"):
         t1 = os.times()[4]
-    # let the initial set be the complete universe:
-    hitset_in_any_collection = HitSet(trailing_bits=1)
-    hitset_in_any_collection.discard(0)
-    for idx_unit in xrange(len(basic_search_units)):
-        this_unit_operation = basic_search_units[idx_unit][0]
-        this_unit_hitset = basic_search_units_hitsets[idx_unit]
-        if this_unit_operation == '+':
-            hitset_in_any_collection.intersection_update(this_unit_hitset)
-        elif this_unit_operation == '-':
-            hitset_in_any_collection.difference_update(this_unit_hitset)
-        elif this_unit_operation == '|':
-            hitset_in_any_collection.union_update(this_unit_hitset)
-        else:
-            if of.startswith("h"):
-                print_warning(req, "Invalid set operation %s." % cgi.escape(this_unit_operation), "Error")
+    if plan is not None:
+        # the planned evaluation already computed the result:
+        hitset_in_any_collection = hitset_intermediate
+    elif restrict_to is not None:
+        # let the initial set be the given restriction:
+        hitset_in_any_collection = HitSet(restrict_to)
+    else:
+        # let the initial set be the complete universe:
+        hitset_in_any_collection = HitSet(trailing_bits=1)
+        hitset_in_any_collection.discard(0)
+    if plan is None:
+        for idx_unit in xrange(len(basic_search_units)):
+            this_unit_operation = basic_search_units[idx_unit][0]
+            this_unit_hitset = basic_search_units_hitsets[idx_unit]
+            if this_unit_operation == '+':
+                hitset_in_any_collection.intersection_update(this_unit_hitset)
+            elif this_unit_operation == '-':
+                hitset_in_any_collection.difference_update(this_unit_hitset)
+            elif this_unit_operation == '|':
+                hitset_in_any_collection.union_update(this_unit_hitset)
+            else:
+                if of.startswith("h"):
+                    print_warning(req, "Invalid set operation %s." % cgi.escape(this_unit_operation), "Error")
     if len(hitset_in_any_collection) == 0:
         # no hits found, propose alternative boolean query:
         if of.startswith('h') and display_nearest_terms_box:
             nearestterms = []
             for idx_unit in range(0, len(basic_search_units)):
                 bsu_o, bsu_p, bsu_f, bsu_m = basic_search_units[idx_unit]
+                if basic_search_units_hitsets[idx_unit] is None or \
+                       idx_unit in restricted_units:
+                    # the planner skipped this unit or searched it
+                    # within the intermediate result only:
+                    try:
+                        bsu_nbhits = len(search_unit(bsu_p, bsu_f, bsu_m, wl))
+                    except InvenioWebSearchWildcardLimitError, excp:
+                        bsu_nbhits = len(excp.res)
+                else:
+                    bsu_nbhits = len(basic_search_units_hitsets[idx_unit])
                 if bsu_p.startswith("%") and bsu_p.endswith("%"):
                     bsu_p = "'" + bsu_p[1:-1] + "'"
-                bsu_nbhits = len(basic_search_units_hitsets[idx_unit])
 
                 # create a similar query, but with the basic search unit only
                 argd = {}
@@ -1954,6 +2339,41 @@ def search_pattern(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, l
         print_warning(req, "Search stage 3: execution took %.2f seconds." % (t2 - t1))
     return hitset_in_any_collection
 
+def get_search_unit_cost(p, f, m):
+    """Return a rough cost class of searching for the basic search
+    unit (p, f, m): 0 for units answered by index lookups of given
+    terms, 1 for units scanning ranges of index terms (wildcards,
+    spans), 2 for units scanning bibxxx tables (regexps, phrase
+    wildcards of fields without phrase index), 3 for units needing
+    citation sub-searches."""
+    if f in ('refersto', 'citedby') or p.startswith('cited:'):
+        return 3
+    if m == 'r' and f != 'fulltext' and not get_index_id_from_field(f):
+        return 2
+    if m == 'r' or p.find('*') > -1 or p.find('%') > -1 or p.find('->') > -1:
+        if m == 'a' and f != 'fulltext' and not get_index_id_from_field(f):
+            return 2
+        return 1
+    if f in ('datecreated', 'datemodified') or (f == 'fulltext' and m == 'a'):
+        return 1
+    return 0
+
+def plan_basic_search_units(basic_search_units):
+    """Return the list of indexes of BASIC_SEARCH_UNITS, in the order
+    in which search_pattern() should evaluate them: cheap AND units
+    first, then expensive AND units by increasing cost, then the NOT
+    units.  Return None if the units must be evaluated from left to
+    right, i.e. if the query contains OR operators or no AND unit."""
+    if not basic_search_units:
+        return None
+    operators = [unit[0] for unit in basic_search_units]
+    if '|' in operators or '+' not in operators:
+        return None
+    plan = [(bsu_o == '-', get_search_unit_cost(bsu_p, bsu_f, bsu_m), idx_unit)
+            for idx_unit, (bsu_o, bsu_p, bsu_f, bsu_m) in enumerate(basic_search_units)]
+    plan.sort()
+    return [idx_unit for dummy, dummy, idx_unit in plan]
+
 def search_pattern_parenthesised(req=None, p=None, f=None, m=None, ap=0, of="id", verbose=0, ln=CFG_SITE_LANG, display_nearest_terms_box=True, wl=0):
     """Search for complex pattern 'p' containing parenthesis within field 'f' according to
        matching type 'm'.  Return hitset of recIDs.
@@ -2029,10 +2449,46 @@ def search_pattern_parenthesised(req=None, p=None, f=None, m=None, ap=0, of="id"
 
         return search_pattern(req, p, f, m, ap, of, verbose, ln, display_nearest_terms_box=display_nearest_terms_box, wl=wl)
 
-def search_unit(p, f=None, m=None, wl=0):
+## Memoized search_unit() and search_unit_in_bibrec() results, used by
+## batch processes running many queries against unchanging data (such as
+## the alert engine).  None when memoization is off.
+_SEARCH_UNIT_MEMO = None
+
+def set_search_unit_memoization(enabled=True):
+    """
+    Start (or stop, if ENABLED is False) memoizing the results of the
+    basic search units, so that further queries sharing some of them
+    do not recompute them.  Since the memoized results are never
+    invalidated, this is meant for batch processes only; stopping the
+    memoization frees the memoized results.
+    """
+    global _SEARCH_UNIT_MEMO
+    if enabled:
+        _SEARCH_UNIT_MEMO = {}
+    else:
+        _SEARCH_UNIT_MEMO = None
+
+def _memoize_search_unit(key, search_function, *args):
+    """
+    Return the hitset computed by SEARCH_FUNCTION(*ARGS), taken from
+    the search unit memo under KEY, if memoization is on.  A copy is
+    returned, since callers are free to modify hitsets in place.
+    """
+    memo = _SEARCH_UNIT_MEMO
+    if memo is None:
+        return search_function(*args)
+    if key not in memo:
+        memo[key] = search_function(*args)
+    return HitSet(memo[key])
+
+def search_unit(p, f=None, m=None, wl=0, restrict_to=None):
     """Search for basic search unit defined by pattern 'p' and field
        'f' and matching type 'm'.  Return hitset of recIDs.
 
+       If the 'restrict_to' hitset is given, only the recIDs it
+       contains are returned, which lets table scanning units be
+       searched within these records only.
+
        All the parameters are assumed to have been previously washed.
        'p' is assumed to be already a ``basic search unit'' so that it
        is searched as such and is not broken up in any way.  Only
@@ -2045,6 +2501,17 @@ def search_unit(p, f=None, m=None, wl=0):
 
        This function is suitable as a low-level API.
     """
+    if restrict_to is not None and _SEARCH_UNIT_MEMO is None:
+        set = _search_unit(p, f, m, wl, restrict_to)
+    else:
+        set = _memoize_search_unit(('unit', p, f, m, wl), _search_unit,
+                                   p, f, m, wl)
+    if restrict_to is not None:
+        set.intersection_update(restrict_to)
+    return set
+
+def _search_unit(p, f=None, m=None, wl=0, restrict_to=None):
+    """Search for basic search unit.  See search_unit()."""
 
     ## create empty output results set:
     set = HitSet()
@@ -2072,7 +2539,7 @@ def search_unit(p, f=None, m=None, wl=0):
         if index_id != 0:
             set = search_unit_in_idxphrases(p, f, m, wl)
         else:
-            set = search_unit_in_bibxxx(p, f, m, wl)
+            set = search_unit_in_bibxxx(p, f, m, wl, restrict_to)
     elif p.startswith("cited:"):
         # we are doing search by the citation count
         set = search_unit_by_times_cited(p[6:])
@@ -2087,15 +2554,13 @@ def search_unit_in_bibwords(word, f, m=None, decompress=zlib.decompress, wl=0):
     set_used = 0 # not-yet-used flag, to be able to circumvent set operations
     limit_reached = 0 # flag for knowing if the query limit has been reached
     # deduce into which bibwordsX table we will search:
-    stemming_language = get_index_stemming_language(get_index_id_from_field("anyfield"))
-    bibwordsX = "idxWORD%02dF" % get_index_id_from_field("anyfield")
+    index_id = get_index_id_from_field("anyfield")
     if f:
         index_id = get_index_id_from_field(f)
-        if index_id:
-            bibwordsX = "idxWORD%02dF" % index_id
-            stemming_language = get_index_stemming_language(index_id)
-        else:
+        if not index_id:
             return HitSet() # word index f does not exist
+    bibwordsX = "idxWORD%02dF" % index_id
+    stemming_language = get_index_stemming_language(index_id)
 
     # wash 'word' argument and run query:
     word = string.replace(word, '*', '%') # we now use '*' as the truncation character
@@ -2135,8 +2600,8 @@ def search_unit_in_bibwords(word, f, m=None, decompress=zlib.decompress, wl=0):
                     res = excp.res
                     limit_reached = 1 # set the limit reached flag to true
         else:
-            res = run_sql("SELECT term,hitlist FROM %s WHERE term=%%s" % bibwordsX,
-                          (wash_index_term(word),))
+            # exact term, the most frequent case, so use term cache:
+            return get_word_hitlist(bibwordsX, index_id, wash_index_term(word))
     # fill the result set:
     for word, hitlist in res:
         hitset_bibwrd = HitSet(hitlist)
@@ -2221,9 +2686,226 @@ def search_unit_in_idxphrases(p, f, type, wl=0):
     # okay, return result set:
     return set
 
-def search_unit_in_bibxxx(p, f, type, wl=0):
+def get_regexp_literals(p):
+    """Return the list of literal strings (as Unicode) that any value
+    matching the regular expression P necessarily contains.  The
+    analysis is conservative: groups, bracket expressions and
+    optional characters are skipped, and nothing is returned for
+    patterns with top-level alternatives."""
+    p = unicode(p, 'utf-8', 'replace')
+    literals = []
+    current = u''
+    depth = 0 # nesting level of parenthesised groups
+    i = 0
+    while i < len(p):
+        c = p[i]
+        i += 1
+        atom = None # the literal character matched here, if any
+        if c == '\\':
+            if i < len(p) and not p[i].isalnum():
+                atom = p[i]
+            i += 1
+        elif c == '[':
+            # skip the bracket expression, including [:class:] items
+            if p[i:i+1] == '^':
+                i += 1
+            if p[i:i+1] == ']':
+                i += 1
+            while i < len(p) and p[i] != ']':
+                if p[i:i+2] in ('[:', '[.', '[='):
+                    end = p.find(p[i+1] + ']', i + 2)
+                    if end == -1:
+                        i = len(p)
+                    else:
+                        i = end + 2
+                else:
+                    i += 1
+            i += 1
+        elif c == '{':
+            end = p.find('}', i)
+            if end == -1:
+                atom = c
+            else:
+                i = end + 1
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|':
+            if depth <= 0:
+                return []
+        elif c not in '.^$*+?':
+            atom = c
+        if atom is not None and depth <= 0:
+            quantifier = p[i:i+1]
+            if quantifier == '+':
+                current += atom
+                atom = None
+            elif quantifier in ('*', '?', '{'):
+                atom = None
+        if atom is not None and depth <= 0:
+            current += atom
+        elif current:
+            literals.append(current)
+            current = u''
+    if current:
+        literals.append(current)
+    return literals
+
+def get_like_pattern_literals(p):
+    """Return the list of literal strings that any value matching the
+    SQL LIKE pattern P necessarily contains."""
+    if p.find('\\') > -1:
+        return [] # escaped wildcards, do not bother
+    return [literal for literal in re.split('[%_]', p) if literal]
+
+_POSIX_CHARACTER_CLASSES = {'alnum': 'a-zA-Z0-9',
+                            'alpha': 'a-zA-Z',
+                            'blank': ' \\t',
+                            'cntrl': '\\x00-\\x1f\\x7f',
+                            'digit': '0-9',
+                            'graph': '\\x21-\\x7e',
+                            'lower': 'a-z',
+                            'print': '\\x20-\\x7e',
+                            'punct': re.escape('!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~'),
+                            'space': '\\s',
+                            'upper': 'A-Z',
+                            'xdigit': '0-9a-fA-F'}
+
+def translate_posix_regexp(p):
+    """Translate the MySQL (POSIX) regular expression P into Python
+    syntax, i.e. the word boundaries [[:<:]] and [[:>:]] and the
+    character classes of bracket expressions.  Return None if P uses
+    constructs that cannot be translated, such as collating elements
+    or equivalence classes."""
+    out = ''
+    i = 0
+    while i < len(p):
+        if p.startswith('[[:<:]]', i):
+            out += r'\b(?=\w)'
+            i += 7
+        elif p.startswith('[[:>:]]', i):
+            out += r'\b(?<=\w)'
+            i += 7
+        elif p[i] == '\\':
+            out += p[i:i+2]
+            i += 2
+        elif p[i] == '[':
+            # bracket expression; backslashes are literal in there
+            i += 1
+            bracket = '['
+            if p[i:i+1] == '^':
+                bracket += '^'
+                i += 1
+            if p[i:i+1] == ']':
+                bracket += '\\]'
+                i += 1
+            while i < len(p) and p[i] != ']':
+                if p[i:i+2] in ('[.', '[='):
+                    return None
+                elif p[i:i+2] == '[:':
+                    end = p.find(':]', i + 2)
+                    if end == -1 or \
+                           not _POSIX_CHARACTER_CLASSES.has_key(p[i+2:end]):
+                        return None
+                    bracket += _POSIX_CHARACTER_CLASSES[p[i+2:end]]
+                    i = end + 2
+                elif p[i] in '\\[':
+                    bracket += '\\' + p[i]
+                    i += 1
+                else:
+                    bracket += p[i]
+                    i += 1
+            if i >= len(p):
+                # unterminated bracket expression
+                return None
+            out += bracket + ']'
+            i += 1
+        else:
+            out += p[i]
+            i += 1
+    return out
+
+def get_bibxxx_value_matcher(p, type):
+    """Return a function telling whether a bibxxx value matches the
+    pattern P the way MySQL would, P being a regular expression if
+    TYPE is 'r', an SQL LIKE pattern otherwise.  Return None if P is
+    not supported."""
+    if type == 'r':
+        p = translate_posix_regexp(p)
+        if p is None:
+            return None
+        try:
+            regexp = re.compile(unicode(p, 'utf-8', 'replace'), re.I | re.U)
+        except re.error:
+            return None
+        return lambda value: regexp.search(unicode(value, 'utf-8', 'replace')) is not None
+    # LIKE comparisons are case and accent insensitive:
+    regexp = ''
+    for token in re.split('([%_])', p):
+        if token == '%':
+            regexp += '.*'
+        elif token == '_':
+            regexp += '.'
+        else:
+            regexp += re.escape(wash_trigram_phrase(token))
+    regexp = re.compile(regexp + r'\Z', re.S | re.U)
+    return lambda value: regexp.match(wash_trigram_phrase(value)) is not None
+
+def search_unit_in_bibxxx_by_trigrams(bx, bibx, tag_query, tag_param, literals, matcher):
+    """Search inside bibxxx table BX (restricted by TAG_QUERY and
+    TAG_PARAM) for values containing all the LITERALS and accepted by
+    the MATCHER function, using the trigram index maintained by
+    BibIndex to avoid full table scans.  Return the list of rows of
+    recIDs found, or None if the trigram index cannot be used, in
+    which case the caller has to search the table itself."""
+    res = run_sql("SELECT last_id FROM idxTRIGRAMSTATUS WHERE bibxxx=%s", (bx,))
+    if not res:
+        return None
+    last_id = res[0][0]
+    tokenizer = BibIndexTrigramTokenizer()
+    trigrams = {}
+    for literal in literals:
+        for trigram in tokenizer.tokenize(literal):
+            trigrams[trigram] = 1
+    trigrams = trigrams.keys()
+    if not trigrams:
+        return None
+    # narrow down the values by intersecting trigram hitlists:
+    res = run_sql("SELECT hitlist FROM idxTRIGRAM WHERE bibxxx=%%s AND term IN (%s)" % \
+                  ','.join(['%s'] * len(trigrams)), tuple([bx] + trigrams))
+    if len(res) < len(trigrams):
+        candidates = HitSet()
+    else:
+        candidates = HitSet(res[0][0])
+        for row in res[1:]:
+            candidates.intersection_update(HitSet(row[0]))
+    if len(candidates) > CFG_WEBSEARCH_TRIGRAM_MAX_CANDIDATES:
+        return None
+    # verify the candidates, and the values not indexed yet:
+    value_ids = []
+    candidates = candidates.tolist()
+    for i in range(0, len(candidates), 1000):
+        ids_str = ','.join([str(value_id) for value_id in candidates[i:i+1000]])
+        for value_id, value in run_sql("SELECT bx.id, bx.value FROM %s AS bx WHERE bx.id IN (%s) AND %s" % \
+                                       (bx, ids_str, tag_query), (tag_param,)):
+            if matcher(value):
+                value_ids.append(value_id)
+    for value_id, value in run_sql("SELECT bx.id, bx.value FROM %s AS bx WHERE bx.id>%%s AND %s" % \
+                                   (bx, tag_query), (last_id, tag_param)):
+        if matcher(value):
+            value_ids.append(value_id)
+    res = []
+    for i in range(0, len(value_ids), 1000):
+        ids_str = ','.join([str(value_id) for value_id in value_ids[i:i+1000]])
+        res.extend(run_sql("SELECT id_bibrec FROM %s WHERE id_bibxxx IN (%s)" % (bibx, ids_str)))
+    return res
+
+def search_unit_in_bibxxx(p, f, type, wl=0, restrict_to=None):
     """Searches for pattern 'p' inside bibxxx tables for field 'f' and returns hitset of recIDs found.
-    The search type is defined by 'type' (e.g. equals to 'r' for a regexp search)."""
+    The search type is defined by 'type' (e.g. equals to 'r' for a regexp search).
+    If the 'restrict_to' hitset is small enough, only its recIDs are searched
+    (others may still be returned)."""
 
     # FIXME: quick hack for the journal index
     if f == 'journal':
@@ -2233,12 +2915,17 @@ def search_unit_in_bibxxx(p, f, type, wl=0):
     use_query_limit = False  # flag for knowing if to limit the query results or not
     query_addons = "" # will hold additional SQL code for the query
     query_params = () # will hold parameters for the query (their number may vary depending on TYPE argument)
+    trigram_literals = [] # literal strings searched values must contain
+    trigram_matcher = None # function verifying values found via the trigram index
     # wash arguments:
     f = string.replace(f, '*', '%') # replace truncation char '*' in field definition
     if type == 'r':
         query_addons = "REGEXP %s"
         query_params = (p,)
         use_query_limit = True
+        trigram_literals = get_regexp_literals(p)
+        if trigram_literals:
+            trigram_matcher = get_bibxxx_value_matcher(p, type)
     else:
         p = string.replace(p, '*', '%') # we now use '*' as the truncation character
         ps = string.split(p, "->", 1) # check for span query:
@@ -2251,6 +2938,9 @@ def search_unit_in_bibxxx(p, f, type, wl=0):
                 query_addons = "LIKE %s"
                 query_params = (p,)
                 use_query_limit = True
+                trigram_literals = get_like_pattern_literals(p)
+                if trigram_literals:
+                    trigram_matcher = get_bibxxx_value_matcher(p, type)
             else:
                 query_addons = "= %s"
                 query_params = (p,)
@@ -2290,25 +2980,39 @@ def search_unit_in_bibxxx(p, f, type, wl=0):
                 res = run_sql("SELECT id FROM bibrec WHERE id %s" % query_addons,
                               query_params)
         else:
-            query = "SELECT bibx.id_bibrec FROM %s AS bx LEFT JOIN %s AS bibx ON bx.id=bibx.id_bibxxx WHERE bx.value %s" % \
-                    (bx, bibx, query_addons)
             if len(t) != 6 or t[-1:]=='%':
                 # wildcard query, or only the beginning of field 't'
                 # is defined, so add wildcard character:
-                query += " AND bx.tag LIKE %s"
-                query_params = query_params + (t + '%',)
+                tag_query = "bx.tag LIKE %s"
+                tag_param = t + '%'
             else:
                 # exact query for 't':
-                query += " AND bx.tag=%s"
-                query_params = query_params + (t,)
-            if use_query_limit:
-                try:
-                    res = run_sql_with_limit(query, query_params, wildcard_limit=wl)
-                except InvenioDbQueryWildcardLimitError, excp:
-                    res = excp.res
+                tag_query = "bx.tag=%s"
+                tag_param = t
+            res = None
+            if trigram_matcher:
+                # regexp or substring query, try to avoid the table scan:
+                res = search_unit_in_bibxxx_by_trigrams(bx, bibx, tag_query, tag_param,
+                                                        trigram_literals, trigram_matcher)
+                if res is not None and wl > 0 and len(res) >= wl:
+                    res = res[:wl]
                     limit_reached = 1 # set the limit reached flag to true
-            else:
-                res = run_sql(query, query_params)
+            if res is None:
+                query = "SELECT bibx.id_bibrec FROM %s AS bx LEFT JOIN %s AS bibx ON bx.id=bibx.id_bibxxx WHERE bx.value %s AND %s" % \
+                        (bx, bibx, query_addons, tag_query)
+                if restrict_to is not None and use_query_limit and \
+                       len(restrict_to) <= CFG_WEBSEARCH_RESTRICTED_SEARCH_MAX_RECORDS:
+                    # scan the values of the given records only:
+                    query += " AND bibx.id_bibrec IN (%s)" % \
+                             ','.join([str(recid) for recid in restrict_to] or ['0'])
+                if use_query_limit:
+                    try:
+                        res = run_sql_with_limit(query, query_params + (tag_param,), wildcard_limit=wl)
+                    except InvenioDbQueryWildcardLimitError, excp:
+                        res = excp.res
+                        limit_reached = 1 # set the limit reached flag to true
+                else:
+                    res = run_sql(query, query_params + (tag_param,))
         # fill the result set:
         for id_bibrec in res:
             if id_bibrec[0]:
@@ -2341,6 +3045,18 @@ def search_unit_in_bibrec(datetext1, datetext2, type='c'):
     Does not pay attention to pattern, collection, anything.  Useful
     to intersect later on with the 'real' query.
     """
+    # normalise the type, so that e.g. '' and 'c' share their memo key:
+    if type.startswith("m"):
+        type = "m"
+    else:
+        type = "c"
+    return _memoize_search_unit(('bibrec', datetext1, datetext2, type),
+                                _search_unit_in_bibrec,
+                                datetext1, datetext2, type)
+
+def _search_unit_in_bibrec(datetext1, datetext2, type='c'):
+    """Search for recIDs by creation/modification date.  See
+    search_unit_in_bibrec()."""
     set = HitSet()
     if type.startswith("m"):
         type = "modification_date"
@@ -2802,18 +3518,14 @@ def get_nbhits_in_bibwords(word, f):
     """Return number of hits for word 'word' inside words index for field 'f'."""
     out = 0
     # deduce into which bibwordsX table we will search:
-    bibwordsX = "idxWORD%02dF" % get_index_id_from_field("anyfield")
+    index_id = get_index_id_from_field("anyfield")
     if f:
         index_id = get_index_id_from_field(f)
-        if index_id:
-            bibwordsX = "idxWORD%02dF" % index_id
-        else:
+        if not index_id:
             return 0
+    bibwordsX = "idxWORD%02dF" % index_id
     if word:
-        res = run_sql("SELECT hitlist FROM %s WHERE term=%%s" % bibwordsX,
-                      (word,))
-        for hitlist in res:
-            out += len(HitSet(hitlist[0]))
+        out = len(get_word_hitlist(bibwordsX, index_id, word))
     return out
 
 def get_nbhits_in_idxphrases(word, f):
@@ -3048,6 +3760,41 @@ def get_fieldvalues(recIDs, tag, repetitive_values=True):
             out.append(row[0])
     return out
 
+def get_fieldvalues_per_record(recIDs, tag):
+    """
+    Return dictionary mapping every record ID of RECIDS (an iterable
+    of integers) having field TAG to the list of its values, in field
+    order.  All the records are looked up at once, which is much
+    faster than calling get_fieldvalues() record by record.
+    """
+    out = {}
+    recIDs = list(recIDs)
+    if len(recIDs) == 0:
+        return out
+    if tag == "001___":
+        # we have asked for tag 001 (=recID) that is not stored in bibXXx tables
+        for recID in recIDs:
+            out[recID] = [str(recID)]
+        return out
+    digits = tag[0:2]
+    try:
+        intdigits = int(digits)
+        if intdigits < 0 or intdigits > 99:
+            raise ValueError
+    except ValueError:
+        # invalid tag value asked for
+        return out
+    bx = "bib%sx" % digits
+    bibx = "bibrec_bib%sx" % digits
+    query = "SELECT bibx.id_bibrec, bx.value FROM %s AS bx, %s AS bibx WHERE bibx.id_bibrec IN (%s) " \
+            " AND bx.id=bibx.id_bibxxx AND bx.tag LIKE %%s " \
+            " ORDER BY bibx.field_number, bx.tag ASC" % \
+            (bx, bibx, ("%s,"*len(recIDs))[:-1])
+    res = run_sql(query, tuple(recIDs) + (tag,))
+    for recID, value in res:
+        out.setdefault(recID, []).append(value)
+    return out
+
 def get_fieldvalues_alephseq_like(recID, tags_in, can_see_hidden=False):
     """Return buffer of ALEPH sequential-like textual format with fields found
        in the list TAGS_IN for record RECID.
@@ -3375,6 +4122,15 @@ def sort_records(req, recIDs, sort_field='', sort_order='d', sort_pattern='', ve
     ## check arguments:
     if not sort_field:
         return recIDs
+
+    ## can we use the sort index precomputed by BibIndex?
+    if not sort_pattern and sort_field.find(",") == -1:
+        ranks = get_sort_ranks(sort_field)
+        if ranks is not None:
+            if verbose >= 3:
+                print_warning(req, "Sorting by precomputed ranks of field %s." % cgi.escape(sort_field))
+            return sort_records_by_ranks(recIDs, ranks, sort_order)
+
     if len(recIDs) > CFG_WEBSEARCH_NB_RECORDS_TO_SORT:
         if of.startswith('h'):
             print_warning(req, _("Sorry, sorting is allowed on sets of up to %d records only. Using default sort order.") % CFG_WEBSEARCH_NB_RECORDS_TO_SORT, "Warning")
@@ -3413,14 +4169,7 @@ def sort_records(req, recIDs, sort_field='', sort_order='d', sort_pattern='', ve
         # fetch the necessary field values:
         for recID in recIDs:
             val = "" # will hold value for recID according to which sort
-            vals = [] # will hold all values found in sorting tag for recID
-            for tag in tags:
-                if CFG_CERN_SITE and tag == '773__c':
-                    # CERN hack: journal sorting
-                    # 773__c contains page numbers, e.g. 3-13, and we want to sort by 3, and numerically:
-                    vals.extend(["%050s" % x.split("-",1)[0] for x in get_fieldvalues(recID, tag)])
-                else:
-                    vals.extend(get_fieldvalues(recID, tag))
+            vals = get_record_sort_values(recID, tags) # will hold all values found in sorting tag for recID
             if sort_pattern:
                 # try to pick that tag value that corresponds to sort pattern
                 bingo = 0
@@ -3455,6 +4204,56 @@ def sort_records(req, recIDs, sort_field='', sort_order='d', sort_pattern='', ve
         # good, no sort needed
         return recIDs
 
+def get_record_sort_values(recID, tags):
+    """Return list of values of record RECID found in sorting TAGS."""
+    vals = []
+    for tag in tags:
+        vals.extend(normalize_sort_tag_values(tag, get_fieldvalues(recID, tag)))
+    return vals
+
+def normalize_sort_tag_values(tag, vals):
+    """Return list of values VALS of sorting TAG transformed so that
+       they sort properly as strings."""
+    if CFG_CERN_SITE and tag == '773__c':
+        # CERN hack: journal sorting
+        # 773__c contains page numbers, e.g. 3-13, and we want to sort by 3, and numerically:
+        return ["%050s" % x.split("-",1)[0] for x in vals]
+    return vals
+
+def get_sort_value(vals):
+    """Return the value according to which a record having values
+       VALS in sorting tags is sorted in absence of sort pattern,
+       i.e. values joined together regardless of accents and case."""
+    return strip_accents(string.join(vals).lower())
+
+def sort_records_by_ranks(recIDs, ranks, sort_order='d'):
+    """Sort records in 'recIDs' list according to their precomputed
+       RANKS array (see get_sort_ranks()) in order 'sort_order'.  The
+       result is the same as the one of sort_records() in absence of
+       sort pattern, except that records not yet seen by BibIndex are
+       put after all the others."""
+    recIDs = list(recIDs)
+    nb_ranks = len(ranks)
+    def get_rank(recID):
+        """Return the rank of RECID, which may have been created after
+        the last BibIndex run.  (RANKS is shared, so it is not
+        extended.)"""
+        if recID < nb_ranks:
+            return ranks[recID]
+        return CFG_WEBSEARCH_SORT_RANK_UNKNOWN
+    recIDs.sort(key=get_rank)
+    # ascending or descending?
+    if sort_order == 'a':
+        # reverse the records seen by BibIndex only, keeping the
+        # others after them:
+        nb_known = len(recIDs)
+        while nb_known and get_rank(recIDs[nb_known - 1]) == CFG_WEBSEARCH_SORT_RANK_UNKNOWN:
+            nb_known -= 1
+        known = recIDs[:nb_known]
+        known.reverse()
+        recIDs = known + recIDs[nb_known:]
+    return recIDs
+
 def print_records(req, recIDs, jrec=1, rg=10, format='hb', ot='', ln=CFG_SITE_LANG, relevances=[], relevances_prologue="(", relevances_epilogue="%%)", decompress=zlib.decompress, search_pattern='', print_records_prologue_p=True, print_records_epilogue_p=True, verbose=0, tab='', sf='', so='d', sp='', rm=''):
 
     """
@@ -3514,312 +4313,317 @@ def print_records(req, recIDs, jrec=1, rg=10, format='hb', ot='', ln=CFG_SITE_LA
 
         #req.write("%s:%d-%d" % (recIDs, irec_min, irec_max))
 
-        if format.startswith('x'):
-
-            # print header if needed
-            if print_records_prologue_p:
-                print_records_prologue(req, format)
-
-            # print records
-            recIDs_to_print = [recIDs[x] for x in range(irec_max, irec_min, -1)]
-
-            format_records(recIDs_to_print,
-                           format,
-                           ln=ln,
-                           search_pattern=search_pattern,
-                           record_separator="\n",
-                           user_info=user_info,
-                           req=req)
-            # print footer if needed
-            if print_records_epilogue_p:
-                print_records_epilogue(req, format)
-
-        elif format.startswith('t') or str(format[0:3]).isdigit():
-            # we are doing plain text output:
-            for irec in range(irec_max, irec_min, -1):
-                x = print_record(recIDs[irec], format, ot, ln, search_pattern=search_pattern,
-                                 user_info=user_info, verbose=verbose, sf=sf, so=so, sp=sp, rm=rm)
-                req.write(x)
-                if x:
-                    req.write('\n')
-        elif format == 'excel':
-            recIDs_to_print = [recIDs[x] for x in range(irec_max, irec_min, -1)]
-            create_excel(recIDs=recIDs_to_print, req=req, ln=ln, ot=ot)
-        else:
-            # we are doing HTML output:
-            if format == 'hp' or format.startswith("hb_") or format.startswith("hd_"):
-                # portfolio and on-the-fly formats:
-                for irec in range(irec_max, irec_min, -1):
-                    req.write(print_record(recIDs[irec], format, ot, ln, search_pattern=search_pattern,
-                                           user_info=user_info, verbose=verbose, sf=sf, so=so, sp=sp, rm=rm))
-            elif format.startswith("hb"):
-                # HTML brief format:
-
-                display_add_to_basket = True
-                if user_info:
-                    if user_info['email'] == 'guest':
-                        if CFG_ACCESS_CONTROL_LEVEL_ACCOUNTS > 4:
-                            display_add_to_basket = False
-                    else:
-                        if not user_info['precached_usebaskets']:
-                            display_add_to_basket = False
-                req.write(websearch_templates.tmpl_record_format_htmlbrief_header(
-                    ln = ln))
+        # records to be formatted on the fly will be loaded by chunks:
+        prefetch_records([recIDs[x] for x in range(irec_max, irec_min, -1)])
+        try:
+            if format.startswith('x'):
+
+                # print header if needed
+                if print_records_prologue_p:
+                    print_records_prologue(req, format)
+
+                # print records
+                recIDs_to_print = [recIDs[x] for x in range(irec_max, irec_min, -1)]
+
+                format_records(recIDs_to_print,
+                               format,
+                               ln=ln,
+                               search_pattern=search_pattern,
+                               record_separator="\n",
+                               user_info=user_info,
+                               req=req)
+                # print footer if needed
+                if print_records_epilogue_p:
+                    print_records_epilogue(req, format)
+
+            elif format.startswith('t') or str(format[0:3]).isdigit():
+                # we are doing plain text output:
                 for irec in range(irec_max, irec_min, -1):
-                    row_number = jrec+irec_max-irec
-                    recid = recIDs[irec]
-                    if relevances and relevances[irec]:
-                        relevance = relevances[irec]
-                    else:
-                        relevance = ''
-                    record = print_record(recIDs[irec], format, ot, ln, search_pattern=search_pattern,
-                                                  user_info=user_info, verbose=verbose, sf=sf, so=so, sp=sp, rm=rm)
+                    x = print_record(recIDs[irec], format, ot, ln, search_pattern=search_pattern,
+                                     user_info=user_info, verbose=verbose, sf=sf, so=so, sp=sp, rm=rm)
+                    req.write(x)
+                    if x:
+                        req.write('\n')
+            elif format == 'excel':
+                recIDs_to_print = [recIDs[x] for x in range(irec_max, irec_min, -1)]
+                create_excel(recIDs=recIDs_to_print, req=req, ln=ln, ot=ot)
+            else:
+                # we are doing HTML output:
+                if format == 'hp' or format.startswith("hb_") or format.startswith("hd_"):
+                    # portfolio and on-the-fly formats:
+                    for irec in range(irec_max, irec_min, -1):
+                        req.write(print_record(recIDs[irec], format, ot, ln, search_pattern=search_pattern,
+                                               user_info=user_info, verbose=verbose, sf=sf, so=so, sp=sp, rm=rm))
+                elif format.startswith("hb"):
+                    # HTML brief format:
+
+                    display_add_to_basket = True
+                    if user_info:
+                        if user_info['email'] == 'guest':
+                            if CFG_ACCESS_CONTROL_LEVEL_ACCOUNTS > 4:
+                                display_add_to_basket = False
+                        else:
+                            if not user_info['precached_usebaskets']:
+                                display_add_to_basket = False
+                    req.write(websearch_templates.tmpl_record_format_htmlbrief_header(
+                        ln = ln))
+                    for irec in range(irec_max, irec_min, -1):
+                        row_number = jrec+irec_max-irec
+                        recid = recIDs[irec]
+                        if relevances and relevances[irec]:
+                            relevance = relevances[irec]
+                        else:
+                            relevance = ''
+                        record = print_record(recIDs[irec], format, ot, ln, search_pattern=search_pattern,
+                                                      user_info=user_info, verbose=verbose, sf=sf, so=so, sp=sp, rm=rm)
 
-                    req.write(websearch_templates.tmpl_record_format_htmlbrief_body(
+                        req.write(websearch_templates.tmpl_record_format_htmlbrief_body(
+                            ln = ln,
+                            recid = recid,
+                            row_number = row_number,
+                            relevance = relevance,
+                            record = record,
+                            relevances_prologue = relevances_prologue,
+                            relevances_epilogue = relevances_epilogue,
+                            display_add_to_basket = display_add_to_basket
+                            ))
+
+                    req.write(websearch_templates.tmpl_record_format_htmlbrief_footer(
                         ln = ln,
-                        recid = recid,
-                        row_number = row_number,
-                        relevance = relevance,
-                        record = record,
-                        relevances_prologue = relevances_prologue,
-                        relevances_epilogue = relevances_epilogue,
-                        display_add_to_basket = display_add_to_basket
-                        ))
-
-                req.write(websearch_templates.tmpl_record_format_htmlbrief_footer(
-                    ln = ln,
-                    display_add_to_basket = display_add_to_basket))
-
-            elif format.startswith("hd"):
-                # HTML detailed format:
-                for irec in range(irec_max, irec_min, -1):
-                    if record_exists(recIDs[irec]) == -1:
-                        print_warning(req, _("The record has been deleted."))
-                        continue
-                    unordered_tabs = get_detailed_page_tabs(get_colID(guess_primary_collection_of_a_record(recIDs[irec])),
-                                                            recIDs[irec], ln=ln)
-                    ordered_tabs_id = [(tab_id, values['order']) for (tab_id, values) in unordered_tabs.iteritems()]
-                    ordered_tabs_id.sort(lambda x,y: cmp(x[1],y[1]))
-
-                    link_ln = ''
-
-                    if ln != CFG_SITE_LANG:
-                        link_ln = '?ln=%s' % ln
-
-                    recid = recIDs[irec]
-                    recid_to_display = recid  # Record ID used to build the URL.
-                    if CFG_WEBSEARCH_USE_ALEPH_SYSNOS:
-                        try:
-                            recid_to_display = get_fieldvalues(recid,
-                                    CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG)[0]
-                        except IndexError:
-                            # No external sysno is available, keep using
-                            # internal recid.
-                            pass
-
-                    citedbynum = 0 #num of citations, to be shown in the cit tab
-                    references = -1 #num of references
-                    if CFG_BIBRANK_SHOW_CITATION_LINKS:
-                        citedbynum = get_cited_by_count(recid)
-                    if not CFG_CERN_SITE:#FIXME:should be replaced by something like CFG_SHOW_REFERENCES
-                        reftag = ""
-                        reftags = get_field_tags("reference")
-                        if reftags:
-                            reftag = reftags[0]
-                        tmprec = get_record(recid)
-                        if reftag and len(reftag) > 4:
-                            references = len(record_get_field_instances(tmprec, reftag[0:3], reftag[3], reftag[4]))
-
-                    tabs = [(unordered_tabs[tab_id]['label'], \
-                             '%s/record/%s/%s%s' % (CFG_SITE_URL, recid_to_display, tab_id, link_ln), \
-                             tab_id == tab,
-                             unordered_tabs[tab_id]['enabled']) \
-                            for (tab_id, order) in ordered_tabs_id
-                            if unordered_tabs[tab_id]['visible'] == True]
-
-                    # load content
-                    if tab == 'usage':
-                        req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
-                                                     tabs,
-                                                     ln,
-                                                     citationnum=citedbynum,
-                                                     referencenum=references))
-                        r = calculate_reading_similarity_list(recIDs[irec], "downloads")
-                        downloadsimilarity = None
-                        downloadhistory = None
-                        #if r:
-                        #    downloadsimilarity = r
-                        if CFG_BIBRANK_SHOW_DOWNLOAD_GRAPHS:
-                            downloadhistory = create_download_history_graph_and_box(recIDs[irec], ln)
-
-                        r = calculate_reading_similarity_list(recIDs[irec], "pageviews")
-                        viewsimilarity = None
-                        if r: viewsimilarity = r
-                        content = websearch_templates.tmpl_detailed_record_statistics(recIDs[irec],
-                                                                                      ln,
-                                                                                      downloadsimilarity=downloadsimilarity,
-                                                                                      downloadhistory=downloadhistory,
-                                                                                      viewsimilarity=viewsimilarity)
-                        req.write(content)
-                        req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
-                                                                                      tabs,
-                                                                                      ln))
-                    elif tab == 'citations':
-                        recid = recIDs[irec]
-                        req.write(webstyle_templates.detailed_record_container_top(recid,
-                                                     tabs,
-                                                     ln,
-                                                     citationnum=citedbynum,
-                                                     referencenum=references))
-                        req.write(websearch_templates.tmpl_detailed_record_citations_prologue(recid, ln))
-
-                        # Citing
-                        citinglist = calculate_cited_by_list(recid)
-                        req.write(websearch_templates.tmpl_detailed_record_citations_citing_list(recid,
-                                                                                                 ln,
-                                                                                                 citinglist,
-                                                                                                 sf=sf,
-                                                                                                 so=so,
-                                                                                                 sp=sp,
-                                                                                                 rm=rm))
-                        # Self-cited
-                        selfcited = get_self_cited_by(recid)
-                        req.write(websearch_templates.tmpl_detailed_record_citations_self_cited(recid,
-                                  ln, selfcited=selfcited, citinglist=citinglist))
-                        # Co-cited
-                        s = calculate_co_cited_with_list(recid)
-                        cociting = None
-                        if s:
-                            cociting = s
-                        req.write(websearch_templates.tmpl_detailed_record_citations_co_citing(recid,
-                                                                                               ln,
-                                                                                               cociting=cociting))
-                        # Citation history, if needed
-                        citationhistory = None
-                        if citinglist:
-                            citationhistory = create_citation_history_graph_and_box(recid, ln)
-                        #debug
-                        if verbose > 3:
-                            print_warning(req, "Citation graph debug: " + \
-                                          str(len(citationhistory)))
-
-                        req.write(websearch_templates.tmpl_detailed_record_citations_citation_history(recid, ln, citationhistory))
-                        req.write(websearch_templates.tmpl_detailed_record_citations_epilogue(recid, ln))
-                        req.write(webstyle_templates.detailed_record_container_bottom(recid,
-                                                                                      tabs,
-                                                                                      ln))
-                    elif tab == 'references':
-                        req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
-                                                     tabs,
-                                                     ln,
-                                                     citationnum=citedbynum,
-                                                     referencenum=references))
-
-                        req.write(format_record(recIDs[irec], 'HDREF', ln=ln, user_info=user_info, verbose=verbose))
-                        req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
-                                                                                      tabs,
-                                                                                      ln))
-                    elif tab == 'keywords':
-                        from invenio.bibclassify_webinterface import \
-                            record_get_keywords, get_sorting_options, \
-                            generate_keywords, get_keywords_body
-                        from invenio.webinterface_handler import wash_urlargd
-                        form = req.form
-                        argd = wash_urlargd(form, {
-                            'generate': (str, 'no'),
-                            'sort': (str, 'occurrences'),
-                            'type': (str, 'tagcloud'),
-                            'numbering': (str, 'off'),
-                            })
-                        recid = recIDs[irec]
+                        display_add_to_basket = display_add_to_basket))
 
-                        req.write(webstyle_templates.detailed_record_container_top(recid,
-                            tabs, ln, citationnum=citedbynum, referencenum=references))
+                elif format.startswith("hd"):
+                    # HTML detailed format:
+                    for irec in range(irec_max, irec_min, -1):
+                        if record_exists(recIDs[irec]) == -1:
+                            print_warning(req, _("The record has been deleted."))
+                            continue
+                        unordered_tabs = get_detailed_page_tabs(get_colID(guess_primary_collection_of_a_record(recIDs[irec])),
+                                                                recIDs[irec], ln=ln)
+                        ordered_tabs_id = [(tab_id, values['order']) for (tab_id, values) in unordered_tabs.iteritems()]
+                        ordered_tabs_id.sort(lambda x,y: cmp(x[1],y[1]))
 
-                        if argd['generate'] == 'yes':
-                            # The user asked to generate the keywords.
-                            keywords = generate_keywords(req, recid)
+                        link_ln = ''
+
+                        if ln != CFG_SITE_LANG:
+                            link_ln = '?ln=%s' % ln
+
+                        recid = recIDs[irec]
+                        recid_to_display = recid  # Record ID used to build the URL.
+                        if CFG_WEBSEARCH_USE_ALEPH_SYSNOS:
+                            try:
+                                recid_to_display = get_fieldvalues(recid,
+                                        CFG_BIBUPLOAD_EXTERNAL_SYSNO_TAG)[0]
+                            except IndexError:
+                                # No external sysno is available, keep using
+                                # internal recid.
+                                pass
+
+                        citedbynum = 0 #num of citations, to be shown in the cit tab
+                        references = -1 #num of references
+                        if CFG_BIBRANK_SHOW_CITATION_LINKS:
+                            citedbynum = get_cited_by_count(recid)
+                        if not CFG_CERN_SITE:#FIXME:should be replaced by something like CFG_SHOW_REFERENCES
+                            reftag = ""
+                            reftags = get_field_tags("reference")
+                            if reftags:
+                                reftag = reftags[0]
+                            tmprec = get_record(recid)
+                            if reftag and len(reftag) > 4:
+                                references = len(record_get_field_instances(tmprec, reftag[0:3], reftag[3], reftag[4]))
+
+                        tabs = [(unordered_tabs[tab_id]['label'], \
+                                 '%s/record/%s/%s%s' % (CFG_SITE_URL, recid_to_display, tab_id, link_ln), \
+                                 tab_id == tab,
+                                 unordered_tabs[tab_id]['enabled']) \
+                                for (tab_id, order) in ordered_tabs_id
+                                if unordered_tabs[tab_id]['visible'] == True]
+
+                        # load content
+                        if tab == 'usage':
+                            req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
+                                                         tabs,
+                                                         ln,
+                                                         citationnum=citedbynum,
+                                                         referencenum=references))
+                            r = calculate_reading_similarity_list(recIDs[irec], "downloads")
+                            downloadsimilarity = None
+                            downloadhistory = None
+                            #if r:
+                            #    downloadsimilarity = r
+                            if CFG_BIBRANK_SHOW_DOWNLOAD_GRAPHS:
+                                downloadhistory = create_download_history_graph_and_box(recIDs[irec], ln)
+
+                            r = calculate_reading_similarity_list(recIDs[irec], "pageviews")
+                            viewsimilarity = None
+                            if r: viewsimilarity = r
+                            content = websearch_templates.tmpl_detailed_record_statistics(recIDs[irec],
+                                                                                          ln,
+                                                                                          downloadsimilarity=downloadsimilarity,
+                                                                                          downloadhistory=downloadhistory,
+                                                                                          viewsimilarity=viewsimilarity)
+                            req.write(content)
+                            req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
+                                                                                          tabs,
+                                                                                          ln))
+                        elif tab == 'citations':
+                            recid = recIDs[irec]
+                            req.write(webstyle_templates.detailed_record_container_top(recid,
+                                                         tabs,
+                                                         ln,
+                                                         citationnum=citedbynum,
+                                                         referencenum=references))
+                            req.write(websearch_templates.tmpl_detailed_record_citations_prologue(recid, ln))
+
+                            # Citing
+                            citinglist = calculate_cited_by_list(recid)
+                            req.write(websearch_templates.tmpl_detailed_record_citations_citing_list(recid,
+                                                                                                     ln,
+                                                                                                     citinglist,
+                                                                                                     sf=sf,
+                                                                                                     so=so,
+                                                                                                     sp=sp,
+                                                                                                     rm=rm))
+                            # Self-cited
+                            selfcited = get_self_cited_by(recid)
+                            req.write(websearch_templates.tmpl_detailed_record_citations_self_cited(recid,
+                                      ln, selfcited=selfcited, citinglist=citinglist))
+                            # Co-cited
+                            s = calculate_co_cited_with_list(recid)
+                            cociting = None
+                            if s:
+                                cociting = s
+                            req.write(websearch_templates.tmpl_detailed_record_citations_co_citing(recid,
+                                                                                                   ln,
+                                                                                                   cociting=cociting))
+                            # Citation history, if needed
+                            citationhistory = None
+                            if citinglist:
+                                citationhistory = create_citation_history_graph_and_box(recid, ln)
+                            #debug
+                            if verbose > 3:
+                                print_warning(req, "Citation graph debug: " + \
+                                              str(len(citationhistory)))
+
+                            req.write(websearch_templates.tmpl_detailed_record_citations_citation_history(recid, ln, citationhistory))
+                            req.write(websearch_templates.tmpl_detailed_record_citations_epilogue(recid, ln))
+                            req.write(webstyle_templates.detailed_record_container_bottom(recid,
+                                                                                          tabs,
+                                                                                          ln))
+                        elif tab == 'references':
+                            req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
+                                                         tabs,
+                                                         ln,
+                                                         citationnum=citedbynum,
+                                                         referencenum=references))
+
+                            req.write(format_record(recIDs[irec], 'HDREF', ln=ln, user_info=user_info, verbose=verbose))
+                            req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
+                                                                                          tabs,
+                                                                                          ln))
+                        elif tab == 'keywords':
+                            from invenio.bibclassify_webinterface import \
+                                record_get_keywords, get_sorting_options, \
+                                generate_keywords, get_keywords_body
+                            from invenio.webinterface_handler import wash_urlargd
+                            form = req.form
+                            argd = wash_urlargd(form, {
+                                'generate': (str, 'no'),
+                                'sort': (str, 'occurrences'),
+                                'type': (str, 'tagcloud'),
+                                'numbering': (str, 'off'),
+                                })
+                            recid = recIDs[irec]
+
+                            req.write(webstyle_templates.detailed_record_container_top(recid,
+                                tabs, ln, citationnum=citedbynum, referencenum=references))
+
+                            if argd['generate'] == 'yes':
+                                # The user asked to generate the keywords.
+                                keywords = generate_keywords(req, recid)
+                            else:
+                                # Get the keywords contained in the MARC.
+                                keywords = record_get_keywords(recid, argd)
+
+                            if keywords:
+                                req.write(get_sorting_options(argd, keywords))
+                            elif argd['sort'] == 'related' and not keywords:
+                                req.write('You may want to run BibIndex.')
+
+                            # Output the keywords or the generate button.
+                            get_keywords_body(keywords, req, recid, argd)
+
+                            req.write(webstyle_templates.detailed_record_container_bottom(recid,
+                                tabs, ln))
+                        elif tab == 'plots':
+                            req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
+                                                                                       tabs,
+                                                                                       ln))
+                            content = websearch_templates.tmpl_record_plots(
+                                                            recID=recIDs[irec],
+                                                            ln=ln)
+                            req.write(content)
+                            req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
+                                                                                          tabs,
+                                                                                          ln))
                         else:
-                            # Get the keywords contained in the MARC.
-                            keywords = record_get_keywords(recid, argd)
-
-                        if keywords:
-                            req.write(get_sorting_options(argd, keywords))
-                        elif argd['sort'] == 'related' and not keywords:
-                            req.write('You may want to run BibIndex.')
-
-                        # Output the keywords or the generate button.
-                        get_keywords_body(keywords, req, recid, argd)
-
-                        req.write(webstyle_templates.detailed_record_container_bottom(recid,
-                            tabs, ln))
-                    elif tab == 'plots':
-                        req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
-                                                                                   tabs,
-                                                                                   ln))
-                        content = websearch_templates.tmpl_record_plots(
-                                                        recID=recIDs[irec],
-                                                        ln=ln)
-                        req.write(content)
-                        req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
-                                                                                      tabs,
-                                                                                      ln))
-                    else:
-                        # Metadata tab
-                        req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
-                                                     tabs,
-                                                     ln,
-                                                     show_short_rec_p=False,
-                                                     citationnum=citedbynum, referencenum=references))
-
-                        creationdate = None
-                        modificationdate = None
-                        if record_exists(recIDs[irec]) == 1:
-                            creationdate = get_creation_date(recIDs[irec])
-                            modificationdate = get_modification_date(recIDs[irec])
-
-                        content = print_record(recIDs[irec], format, ot, ln,
+                            # Metadata tab
+                            req.write(webstyle_templates.detailed_record_container_top(recIDs[irec],
+                                                         tabs,
+                                                         ln,
+                                                         show_short_rec_p=False,
+                                                         citationnum=citedbynum, referencenum=references))
+
+                            creationdate = None
+                            modificationdate = None
+                            if record_exists(recIDs[irec]) == 1:
+                                creationdate = get_creation_date(recIDs[irec])
+                                modificationdate = get_modification_date(recIDs[irec])
+
+                            content = print_record(recIDs[irec], format, ot, ln,
+                                                   search_pattern=search_pattern,
+                                                   user_info=user_info, verbose=verbose,
+                                                   sf=sf, so=so, sp=sp, rm=rm)
+                            content = websearch_templates.tmpl_detailed_record_metadata(
+                                recID = recIDs[irec],
+                                ln = ln,
+                                format = format,
+                                creationdate = creationdate,
+                                modificationdate = modificationdate,
+                                content = content)
+                            req.write(content)
+
+                            req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
+                                                                                          tabs,
+                                                                                          ln,
+                                                                                          creationdate=creationdate,
+                                                                                          modificationdate=modificationdate,
+                                                                                          show_short_rec_p=False))
+
+                            if len(tabs) > 0:
+                                # Add the mini box at bottom of the page
+                                if CFG_WEBCOMMENT_ALLOW_REVIEWS:
+                                    from invenio.webcomment import get_mini_reviews
+                                    reviews = get_mini_reviews(recid = recIDs[irec], ln=ln)
+                                else:
+                                    reviews = ''
+                                actions = format_record(recIDs[irec], 'HDACT', ln=ln, user_info=user_info, verbose=verbose)
+                                files = format_record(recIDs[irec], 'HDFILE', ln=ln, user_info=user_info, verbose=verbose)
+                                req.write(webstyle_templates.detailed_record_mini_panel(recIDs[irec],
+                                                                                        ln,
+                                                                                        format,
+                                                                                        files=files,
+                                                                                        reviews=reviews,
+                                                                                        actions=actions))
+                else:
+                    # Other formats
+                    for irec in range(irec_max, irec_min, -1):
+                        req.write(print_record(recIDs[irec], format, ot, ln,
                                                search_pattern=search_pattern,
                                                user_info=user_info, verbose=verbose,
-                                               sf=sf, so=so, sp=sp, rm=rm)
-                        content = websearch_templates.tmpl_detailed_record_metadata(
-                            recID = recIDs[irec],
-                            ln = ln,
-                            format = format,
-                            creationdate = creationdate,
-                            modificationdate = modificationdate,
-                            content = content)
-                        req.write(content)
-
-                        req.write(webstyle_templates.detailed_record_container_bottom(recIDs[irec],
-                                                                                      tabs,
-                                                                                      ln,
-                                                                                      creationdate=creationdate,
-                                                                                      modificationdate=modificationdate,
-                                                                                      show_short_rec_p=False))
-
-                        if len(tabs) > 0:
-                            # Add the mini box at bottom of the page
-                            if CFG_WEBCOMMENT_ALLOW_REVIEWS:
-                                from invenio.webcomment import get_mini_reviews
-                                reviews = get_mini_reviews(recid = recIDs[irec], ln=ln)
-                            else:
-                                reviews = ''
-                            actions = format_record(recIDs[irec], 'HDACT', ln=ln, user_info=user_info, verbose=verbose)
-                            files = format_record(recIDs[irec], 'HDFILE', ln=ln, user_info=user_info, verbose=verbose)
-                            req.write(webstyle_templates.detailed_record_mini_panel(recIDs[irec],
-                                                                                    ln,
-                                                                                    format,
-                                                                                    files=files,
-                                                                                    reviews=reviews,
-                                                                                    actions=actions))
-            else:
-                # Other formats
-                for irec in range(irec_max, irec_min, -1):
-                    req.write(print_record(recIDs[irec], format, ot, ln,
-                                           search_pattern=search_pattern,
-                                           user_info=user_info, verbose=verbose,
-                                           sf=sf, so=so, sp=sp, rm=rm))
+                                               sf=sf, so=so, sp=sp, rm=rm))
+        finally:
+            prefetch_records([])
 
     else:
         print_warning(req, _("Use different search terms."))
@@ -3868,8 +4672,170 @@ def print_records_epilogue(req, format):
         epilogue = websearch_templates.tmpl_xml_default_epilogue()
     req.write(epilogue)
 
+# records announced by prefetch_records(), per thread:
+_record_prefetch = threading.local()
+
+def get_records_bibxxx_rows(recIDs):
+    """
+    Return the bibXXx rows of the records RECIDS, as a dictionary
+    {recID: [(tag, value, field_number), ...]} with the rows of each
+    record in the order of the xm output: controlfields first, then
+    datafields table by table, by field number and tag.  All the
+    records are read with one query per bibXXx table.
+    """
+    rows = {}
+    for recID in recIDs:
+        rows[int(recID)] = []
+    if not rows:
+        return rows
+    recIDs_placeholders = ','.join(['%s'] * len(rows))
+    # bib00x holds only the controlfields, then come bib01x to bib99x:
+    for digits in ['00'] + ['%02d' % number for number in range(1, 100)]:
+        query = "SELECT bb.id_bibrec,b.tag,b.value,bb.field_number FROM bib%sx AS b, bibrec_bib%sx AS bb "\
+                "WHERE bb.id_bibrec IN (%s) AND b.id=bb.id_bibxxx AND b.tag LIKE %%s "\
+                "ORDER BY bb.id_bibrec, bb.field_number, b.tag ASC" % (digits, digits, recIDs_placeholders)
+        for recID, field, value, field_number in run_sql(query, tuple(rows.keys()) + (digits + '%',)):
+            rows[recID].append((field, value, field_number))
+    return rows
+
+def print_bibxxx_rows_as_xm(rows, can_see_hidden=False):
+    """
+    Return the MARCXML controlfields and datafields of a record from
+    its bibXXx ROWS, as returned by get_records_bibxxx_rows().  Unless
+    CAN_SEE_HIDDEN is set, the CFG_BIBFORMAT_HIDDEN_TAGS are skipped.
+    """
+    out = ""
+    table_old = None
+    field_number_old = -999
+    field_old = ""
+    for field, value, field_number in rows:
+        if field.startswith('00'):
+            # controlfields
+            out += """        <controlfield tag="%s" >%s</controlfield>\n""" % \
+                   (encode_for_xml(field[0:3]), encode_for_xml(value))
+            continue
+        # datafields are grouped by bibXXx table:
+        if field[0:2] != table_old:
+            if field_number_old != -999:
+                out += """        </datafield>\n"""
+            table_old = field[0:2]
+            field_number_old = -999
+            field_old = ""
+        ind1, ind2 = field[3], field[4]
+        if ind1 == "_" or ind1 == "":
+            ind1 = " "
+        if ind2 == "_" or ind2 == "":
+            ind2 = " "
+        # print field tag, unless hidden
+        printme = True
+        if not can_see_hidden:
+            for htag in CFG_BIBFORMAT_HIDDEN_TAGS:
+                ltag = len(htag)
+                samelenfield = field[0:ltag]
+                if samelenfield == htag:
+                    printme = False
+
+        if printme:
+            if field_number != field_number_old or field[:-1] != field_old[:-1]:
+                if field_number_old != -999:
+                    out += """        </datafield>\n"""
+                out += """        <datafield tag="%s" ind1="%s" ind2="%s">\n""" % \
+                           (encode_for_xml(field[0:3]), encode_for_xml(ind1), encode_for_xml(ind2))
+                field_number_old = field_number
+                field_old = field
+            # print subfield value
+            value = encode_for_xml(value)
+            out += """            <subfield code="%s">%s</subfield>\n""" % \
+               (encode_for_xml(field[-1:]), value)
+
+    # all fields/subfields printed, so close the tag:
+    if field_number_old != -999:
+        out += """        </datafield>\n"""
+    return out
+
+def get_records(recIDs):
+    """
+    Return the record objects of the records RECIDS as a dictionary
+    {recID: record}, like get_record() would do for each of them, but
+    with a few queries for all of them: the serialized record
+    structures are read first, then the cached xm, then the bibXXx
+    values.  Records that do not exist or are deleted are not returned.
+    """
+    records = {}
+    recIDs = [int(recID) for recID in recIDs]
+    if not recIDs:
+        return records
+    recIDs_placeholders = ','.join(['%s'] * len(recIDs))
+    if CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE:
+        res = run_sql("SELECT id_bibrec, value FROM bibfmt WHERE format='recstruct' AND id_bibrec IN (%s)" % \
+                      recIDs_placeholders, tuple(recIDs))
+        for recID, value in res:
+            try:
+                records[recID] = deserialize_via_marshal(value)
+            except:
+                ### In case of corruption, let's rebuild it!
+                pass
+    missing_recIDs = [recID for recID in recIDs if not records.has_key(recID)]
+    if not missing_recIDs:
+        return records
+
+    # the other records are rebuilt like print_record(recID, 'xm') does:
+    recIDs_placeholders = ','.join(['%s'] * len(missing_recIDs))
+    existing_recIDs = HitSet(run_sql("SELECT id FROM bibrec WHERE id IN (%s)" % \
+                                     recIDs_placeholders, tuple(missing_recIDs)))
+    rows = get_records_bibxxx_rows(existing_recIDs)
+    can_see_hidden = (acc_authorize_action(None, 'runbibedit')[0] == 0)
+    for recID in existing_recIDs:
+        dbcollids = [value for field, value, field_number in rows[recID] \
+                     if field.startswith('980__')]
+        if ("DELETED" in dbcollids) or (CFG_CERN_SITE and "DUMMY" in dbcollids):
+            del rows[recID]
+    res = run_sql("SELECT id_bibrec, value FROM bibfmt WHERE format='xm' AND id_bibrec IN (%s)" % \
+                  recIDs_placeholders, tuple(missing_recIDs))
+    for recID, value in res:
+        if rows.has_key(recID):
+            records[recID] = create_record(zlib.decompress(value))[0]
+            del rows[recID]
+    for recID in rows:
+        records[recID] = create_record("""    <record>\n""" + \
+                                       """        <controlfield tag="001">%d</controlfield>\n""" % recID + \
+                                       print_bibxxx_rows_as_xm(rows[recID], can_see_hidden) + \
+                                       "    </record>\n")[0]
+    return records
+
+def prefetch_records(recIDs):
+    """
+    Announce that the records RECIDS are about to be formatted in this
+    order, for example because they are on the results page being
+    printed.  The get_record() call for one of them will then load it
+    together with the CFG_WEBSEARCH_PREFETCH_CHUNK_SIZE - 1 following
+    ones with get_records(), and hand them out one by one.  Call it
+    with an empty list once the records are formatted.
+    """
+    _record_prefetch.pending = list(recIDs)
+    _record_prefetch.positions = dict([(recID, idx) for idx, recID in enumerate(recIDs)])
+    _record_prefetch.records = {}
+
 def get_record(recid):
     """Directly the record object corresponding to the recid."""
+    positions = getattr(_record_prefetch, 'positions', None)
+    if positions:
+        try:
+            idx = positions.get(int(recid))
+        except ValueError:
+            idx = None
+        if idx is not None:
+            # load the next chunk of announced records:
+            chunk = _record_prefetch.pending[idx:idx + CFG_WEBSEARCH_PREFETCH_CHUNK_SIZE]
+            for recID in chunk:
+                positions.pop(recID, None)
+            _record_prefetch.records = get_records(chunk)
+    records = getattr(_record_prefetch, 'records', None)
+    if records:
+        try:
+            return records.pop(int(recid))
+        except (KeyError, ValueError):
+            pass
     if CFG_BIBUPLOAD_SERIALIZE_RECORD_STRUCTURE:
         value = run_sql("SELECT value FROM bibfmt WHERE id_bibrec=%s AND FORMAT='recstruct'",  (recid, ))
         if value:
@@ -3980,64 +4946,8 @@ def print_record(recID, format='hb', ot='', ln=CFG_SITE_LANG, decompress=zlib.de
                            (CFG_OAI_ID_FIELD[0:3], CFG_OAI_ID_FIELD[3:4], CFG_OAI_ID_FIELD[4:5], CFG_OAI_ID_FIELD[5:6], oai_ids[0])
                 out += "<datafield tag=\"980\" ind1=\"\" ind2=\"\"><subfield code=\"c\">DELETED</subfield></datafield>\n"
             else:
-                # controlfields
-                query = "SELECT b.tag,b.value,bb.field_number FROM bib00x AS b, bibrec_bib00x AS bb "\
-                        "WHERE bb.id_bibrec=%s AND b.id=bb.id_bibxxx AND b.tag LIKE '00%%' "\
-                        "ORDER BY bb.field_number, b.tag ASC"
-                res = run_sql(query, (recID, ))
-                for row in res:
-                    field, value = row[0], row[1]
-                    value = encode_for_xml(value)
-                    out += """        <controlfield tag="%s" >%s</controlfield>\n""" % \
-                           (encode_for_xml(field[0:3]), value)
-                # datafields
-                i = 1 # Do not process bib00x and bibrec_bib00x, as
-                      # they are controlfields. So start at bib01x and
-                      # bibrec_bib00x (and set i = 0 at the end of
-                      # first loop)
-                for digit1 in range(0, 10):
-                    for digit2 in range(i, 10):
-                        bx = "bib%d%dx" % (digit1, digit2)
-                        bibx = "bibrec_bib%d%dx" % (digit1, digit2)
-                        query = "SELECT b.tag,b.value,bb.field_number FROM %s AS b, %s AS bb "\
-                                "WHERE bb.id_bibrec=%%s AND b.id=bb.id_bibxxx AND b.tag LIKE %%s"\
-                                "ORDER BY bb.field_number, b.tag ASC" % (bx, bibx)
-                        res = run_sql(query, (recID, str(digit1)+str(digit2)+'%'))
-                        field_number_old = -999
-                        field_old = ""
-                        for row in res:
-                            field, value, field_number = row[0], row[1], row[2]
-                            ind1, ind2 = field[3], field[4]
-                            if ind1 == "_" or ind1 == "":
-                                ind1 = " "
-                            if ind2 == "_" or ind2 == "":
-                                ind2 = " "
-                            # print field tag, unless hidden
-                            printme = True
-                            if not can_see_hidden:
-                                for htag in CFG_BIBFORMAT_HIDDEN_TAGS:
-                                    ltag = len(htag)
-                                    samelenfield = field[0:ltag]
-                                    if samelenfield == htag:
-                                        printme = False
-
-                            if printme:
-                                if field_number != field_number_old or field[:-1] != field_old[:-1]:
-                                    if field_number_old != -999:
-                                        out += """        </datafield>\n"""
-                                    out += """        <datafield tag="%s" ind1="%s" ind2="%s">\n""" % \
-                                               (encode_for_xml(field[0:3]), encode_for_xml(ind1), encode_for_xml(ind2))
-                                    field_number_old = field_number
-                                    field_old = field
-                                # print subfield value
-                                value = encode_for_xml(value)
-                                out += """            <subfield code="%s">%s</subfield>\n""" % \
-                                   (encode_for_xml(field[-1:]), value)
-
-                        # all fields/subfields printed in this run, so close the tag:
-                        if field_number_old != -999:
-                            out += """        </datafield>\n"""
-                    i = 0 # Next loop should start looking at bib%0 and bibrec_bib00x
+                out += print_bibxxx_rows_as_xm(get_records_bibxxx_rows([recID])[int(recID)],
+                                               can_see_hidden)
             # we are at the end of printing the record:
             out += "    </record>\n"
 
@@ -4842,10 +5752,10 @@ def perform_request_search(req=None, cc=CFG_SITE_NAME, c=None, p="", f="", rg=CF
                 return page_end(req, of, ln)
         else:
             ## 3B - simple search
-            if search_results_cache.cache.has_key(query_representation_in_cache):
-                # query is not in the cache already, so reuse it:
+            results_in_any_collection = search_results_cache.get(query_representation_in_cache)
+            if results_in_any_collection is not None:
+                # query is in the cache already, so reuse it:
                 query_in_cache = True
-                results_in_any_collection = search_results_cache.cache[query_representation_in_cache]
                 if verbose and of.startswith("h"):
                     print_warning(req, "Search stage 0: query found in cache, reusing cached results.")
             else:
@@ -4872,10 +5782,8 @@ def perform_request_search(req=None, cc=CFG_SITE_NAME, c=None, p="", f="", rg=CF
             return page_end(req, of, ln)
 
         # store this search query results into search results cache if needed:
-        if CFG_WEBSEARCH_SEARCH_CACHE_SIZE and not query_in_cache:
-            if len(search_results_cache.cache) > CFG_WEBSEARCH_SEARCH_CACHE_SIZE:
-                search_results_cache.clear()
-            search_results_cache.cache[query_representation_in_cache] = results_in_any_collection
+        if CFG_WEBSEARCH_SEARCH_CACHE_BYTES and not query_in_cache:
+            search_results_cache.set(query_representation_in_cache, results_in_any_collection)
             if verbose and of.startswith("h"):
                 print_warning(req, "Search stage 3: storing query results in cache.")
 
@@ -5075,10 +5983,15 @@ def perform_request_search(req=None, cc=CFG_SITE_NAME, c=None, p="", f="", rg=CF
                         if sf: # do we have to sort?
                             results_final_recIDs = sort_records(req, results_final_recIDs, sf, so, sp, verbose, of)
                         elif rm: # do we have to rank?
+                            # only the records of the page to print need to be sorted:
+                            rank_limit = 0
+                            if rg != -9999:
+                                rank_limit = max(jrec, 1) + abs(rg) - 1
                             results_final_recIDs_ranked, results_final_relevances, results_final_relevances_prologue, results_final_relevances_epilogue, results_final_comments = \
                                                          rank_records(rm, 0, results_final[coll],
                                                                       string.split(p) + string.split(p1) +
-                                                                      string.split(p2) + string.split(p3), verbose)
+                                                                      string.split(p2) + string.split(p3), verbose,
+                                                                      rank_limit)
                             if of.startswith("h"):
                                 print_warning(req, results_final_comments)
                             if results_final_recIDs_ranked:
@@ -5224,15 +6137,28 @@ def perform_request_cache(req, action="show"):
     req.write(out)
     # show search results cache:
     out = "<h3>Search Cache</h3>"
-    out += "- search cache usage: %d queries cached (max. ~%d)" % \
-           (len(search_results_cache.cache), CFG_WEBSEARCH_SEARCH_CACHE_SIZE)
-    if len(search_results_cache.cache):
-        out += "<br />- search cache contents:"
-        out += "<blockquote>"
-        for query, hitset in search_results_cache.cache.items():
-            out += "<br />%s ... %s" % (query, hitset)
-        out += """<p><a href="%s/search/cache?action=clear">clear search results cache</a>""" % CFG_SITE_URL
-        out += "</blockquote>"
+    if not search_results_cache.store:
+        out += "- search cache disabled (CFG_WEBSEARCH_SEARCH_CACHE_BYTES = 0)"
+    else:
+        entries = search_results_cache.get_entries()
+        out += "- search cache directory: %s" % \
+               cgi.escape(search_results_cache.store.dirname)
+        out += "<br />- search cache usage: %d queries cached, %d bytes (max. ~%d)" % \
+               (len(entries), sum([size for dummy, size, dummy in entries]),
+                CFG_WEBSEARCH_SEARCH_CACHE_BYTES)
+        out += "<br />- search cache statistics of this process: %d hits, %d misses" % \
+               (search_results_cache.store.hits, search_results_cache.store.misses)
+        if entries:
+            out += "<br />- search cache contents (most recently used first):"
+            out += "<blockquote>"
+            for mtime, size, key in entries[:100]:
+                out += "<br />%s ... %d bytes, last used %s" % \
+                       (cgi.escape(key), size,
+                        time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(mtime)))
+            if len(entries) > 100:
+                out += "<br />..."
+            out += """<p><a href="%s/search/cache?action=clear">clear search results cache</a>""" % CFG_SITE_URL
+            out += "</blockquote>"
     req.write(out)
     # show field i18nname cache:
     out = "<h3>Field I18N names cache</h3>"
@@ -5315,6 +6241,10 @@ def get_most_popular_field_values(recids, tags, exclude_values=None, count_repet
     (But, if the same value occurs in another record, we count it, of
     course.)
 
+    The tags listed in CFG_WEBSEARCH_FACET_TAGS are counted from their
+    in-memory facet index; the other ones are read from the bibXXx
+    tables, with one query per tag.
+
     Example:
      >>> get_most_popular_field_values(range(11,20), '980__a')
      (('PREPRINT', 10), ('THESIS', 7), ...)
@@ -5323,61 +6253,82 @@ def get_most_popular_field_values(recids, tags, exclude_values=None, count_repet
      >>> get_most_popular_field_values(range(11,20), ('100__a', '700__a'), ('Ellis, J'))
      (('Ellis, N', 7), ...)
     """
-
-    def _get_most_popular_field_values_helper_sorter(val1, val2):
-        "Compare VAL1 and VAL2 according to, firstly, frequency, then secondly, alphabetically."
-        compared_via_frequencies = cmp(valuefreqdict[val2], valuefreqdict[val1])
-        if compared_via_frequencies == 0:
-            return cmp(val1.lower(), val2.lower())
-        else:
-            return compared_via_frequencies
-
-    valuefreqdict = {}
     ## sanity check:
     if not exclude_values:
         exclude_values = []
     if isinstance(tags, str):
         tags = (tags,)
-    ## find values to count:
-    vals_to_count = []
+    if isinstance(recids, (int, long)):
+        recids = [recids]
+    ## look up facet indexes and previously computed counts:
+    indexes = [get_facet_index(tag) for tag in tags]
+    counts_key = None
+    if None not in indexes and tags:
+        # results are cacheable, since the facet index timestamps
+        # tell us whether the values have changed since:
+        hitset = HitSet(recids)
+        counts_key = (tuple(tags), repr(exclude_values),
+                      count_repetitive_values,
+                      tuple([facet_cache.indexes[tag].timestamp for tag in tags]),
+                      md5(hitset.fastdump()).digest())
+        out = facet_cache.counts.get(counts_key)
+        if out is not None:
+            return out
+        # skip the records without values:
+        union = HitSet()
+        for index in indexes:
+            union |= index['recids']
+        recids = hitset & union
+    ## count values:
+    valuefreqdict = {}
     displaytmp = {}
     if count_repetitive_values:
-        # counting technique A: can look up many records at once: (very fast)
-        for tag in tags:
-            vals_to_count.extend(get_fieldvalues(recids, tag))
+        # counting technique A: count every occurrence of every value
+        for tag, index in zip(tags, indexes):
+            if index is None:
+                vals_to_count = get_fieldvalues(list(recids), tag)
+            else:
+                column = index['column']
+                values = index['values']
+                idfreqdict = {}
+                for recid in recids:
+                    for value_id in column.get(recid, ()):
+                        idfreqdict[value_id] = idfreqdict.get(value_id, 0) + 1
+                vals_to_count = []
+                for value_id, freq in idfreqdict.iteritems():
+                    val = values[value_id]
+                    if val not in exclude_values:
+                        valuefreqdict[val] = valuefreqdict.get(val, 0) + freq
+            for val in vals_to_count:
+                if val not in exclude_values:
+                    valuefreqdict[val] = valuefreqdict.get(val, 0) + 1
     else:
-        # counting technique B: must count record-by-record: (slow)
+        # counting technique B: count values once per record, even
+        # across various tags, case insensitively
+        columns = []
+        for tag, index in zip(tags, indexes):
+            if index is None:
+                columns.append((get_fieldvalues_per_record(recids, tag), None))
+            else:
+                columns.append((index['column'], index['values']))
         for recid in recids:
-            vals_in_rec = []
-            for tag in tags:
-                for val in get_fieldvalues(recid, tag, False):
-                    vals_in_rec.append(val)
-            # do not count repetitive values within this record
-            # (even across various tags, so need to unify again):
-            dtmp = {}
+            vals_in_rec = {}
+            for column, values in columns:
+                for val in column.get(recid, ()):
+                    if values is not None:
+                        val = values[val]
+                    vals_in_rec[val.lower()] = 1
+                    displaytmp[val.lower()] = val
             for val in vals_in_rec:
-                dtmp[val.lower()] = 1
-                displaytmp[val.lower()] = val
-            vals_in_rec = dtmp.keys()
-            vals_to_count.extend(vals_in_rec)
-    ## are we to exclude some of found values?
-    for val in vals_to_count:
-        if val not in exclude_values:
-            if valuefreqdict.has_key(val):
-                valuefreqdict[val] += 1
-            else:
-                valuefreqdict[val] = 1
-    ## sort by descending frequency of values:
-    out = ()
-    vals = valuefreqdict.keys()
-    vals.sort(_get_most_popular_field_values_helper_sorter)
-    for val in vals:
-        tmpdisplv = ''
-        if displaytmp.has_key(val):
-            tmpdisplv = displaytmp[val]
-        else:
-            tmpdisplv = val
-        out += (tmpdisplv, valuefreqdict[val]),
+                if val not in exclude_values:
+                    valuefreqdict[val] = valuefreqdict.get(val, 0) + 1
+    ## sort by descending frequency of values, then alphabetically:
+    vals = [(-freq, val.lower(), val) for val, freq in valuefreqdict.iteritems()]
+    vals.sort()
+    out = tuple([(displaytmp.get(val, val), -freq) for freq, dummy, val in vals])
+    if counts_key is not None:
+        facet_cache.counts.set(counts_key, out,
+                               sum([len(val) + 64 for val, dummy in out]))
     return out
 
 def profile(p="", f="", c=CFG_SITE_NAME):
@@ -27,6 +27,30 @@ __revision__ = \
 ## do we want experimental features? (0=no, 1=yes)
 CFG_EXPERIMENTAL_FEATURES = 0
 
+## array typecode of the record ranks precomputed by BibIndex for sort
+## fields, and the rank given to records not yet seen by BibIndex:
+CFG_WEBSEARCH_SORT_RANK_TYPECODE = 'I'
+CFG_WEBSEARCH_SORT_RANK_UNKNOWN = 2**32 - 1
+
+## maximum number of bibxxx values narrowed down by the trigram index
+## that regexp and substring searches verify one by one; beyond this,
+## the search is left to the database:
+CFG_WEBSEARCH_TRIGRAM_MAX_CANDIDATES = 50000
+
+## maximum number of records within which an expensive search unit
+## (e.g. a regexp) is searched when the preceding units of the query
+## already narrowed down the results; beyond this, the whole table is
+## searched:
+CFG_WEBSEARCH_RESTRICTED_SEARCH_MAX_RECORDS = 10000
+
+## maximum number of bytes of most popular field values cached per
+## process, keyed by the tags and by the set of records counted:
+CFG_WEBSEARCH_FACET_COUNTS_CACHE_SIZE = 1000000
+
+## number of records loaded at once when formatting records announced
+## by prefetch_records():
+CFG_WEBSEARCH_PREFETCH_CHUNK_SIZE = 100
+
 class InvenioWebSearchUnknownCollectionError(Exception):
     """Exception for bad collection."""
     def __init__(self, colname):
@@ -23,6 +23,7 @@ __revision__ = \
     "$Id$"
 
 import unittest
+from array import array
 
 from invenio import search_engine
 from invenio.testutils import make_test_suite, run_test_suite
@@ -41,6 +42,27 @@ class TestMiscUtilityFunctions(unittest.TestCase):
                          [[1, 'a', 9], [2, 'b', 8], [3, 'c', 7]])
 
 
+class TestSortRecordsByRanks(unittest.TestCase):
+    """Test sorting of records by precomputed sort ranks."""
+
+    def test_sort_records_by_ranks(self):
+        """search engine - sorting records by precomputed ranks"""
+        ranks = array('I', [0, 3, 1, 2, 1])
+        self.assertEqual(search_engine.sort_records_by_ranks([1, 2, 3, 4], ranks, 'd'),
+                         [2, 4, 3, 1])
+        self.assertEqual(search_engine.sort_records_by_ranks([1, 2, 3, 4], ranks, 'a'),
+                         [1, 3, 4, 2])
+
+    def test_sort_records_by_ranks_unknown_records(self):
+        """search engine - sorting records unknown to precomputed ranks"""
+        ranks = array('I', [0, 3, 1])
+        self.assertEqual(search_engine.sort_records_by_ranks([5, 1, 2], ranks, 'd'),
+                         [2, 1, 5])
+        self.assertEqual(search_engine.sort_records_by_ranks([5, 1, 2], ranks, 'a'),
+                         [1, 2, 5])
+        # the shared ranks array is left untouched:
+        self.assertEqual(list(ranks), [0, 3, 1])
+
 class TestWashQueryParameters(unittest.TestCase):
     """Test for washing of search query parameters."""
 
@@ -84,6 +106,69 @@ class TestStripAccents(unittest.TestCase):
         self.assertEqual("MEMEMEME",
                          search_engine.strip_accents('MÉMÊMËMÈ'))
 
+class TestTrigramSearchHelpers(unittest.TestCase):
+    """Test of the helpers of regexp and substring searches via trigrams."""
+
+    def test_get_regexp_literals(self):
+        """search engine - literals of regular expressions"""
+        self.assertEqual(search_engine.get_regexp_literals('^Ell?is.*J'),
+                         [u'El', u'is', u'J'])
+        self.assertEqual(search_engine.get_regexp_literals('foo(bar)?ba+z'),
+                         [u'foo', u'ba', u'z'])
+        self.assertEqual(search_engine.get_regexp_literals('e\\.g\\. [[:alpha:]]x'),
+                         [u'e.g. ', u'x'])
+
+    def test_get_regexp_literals_alternatives(self):
+        """search engine - literals of regular expressions with alternatives"""
+        self.assertEqual(search_engine.get_regexp_literals('ellis|bell'), [])
+        self.assertEqual(search_engine.get_regexp_literals('(j|john) ellis'),
+                         [u' ellis'])
+
+    def test_get_like_pattern_literals(self):
+        """search engine - literals of LIKE patterns"""
+        self.assertEqual(search_engine.get_like_pattern_literals('%ellis_j%'),
+                         ['ellis', 'j'])
+
+    def test_get_bibxxx_value_matcher(self):
+        """search engine - matching of bibxxx values"""
+        matcher = search_engine.get_bibxxx_value_matcher('%müller%', 'a')
+        self.failUnless(matcher('Hans MULLER'))
+        self.failIf(matcher('Hans Mueller'))
+        matcher = search_engine.get_bibxxx_value_matcher('^ell.s', 'r')
+        self.failUnless(matcher('Ellis, J'))
+        self.failIf(matcher('Bellis, J'))
+        matcher = search_engine.get_bibxxx_value_matcher('[[:<:]]ellis[[:>:]]', 'r')
+        self.failUnless(matcher('Ellis, J'))
+        self.failIf(matcher('Bellis, J'))
+        self.failIf(matcher('Ellison, J'))
+        matcher = search_engine.get_bibxxx_value_matcher('ellis[[:space:]]j', 'r')
+        self.failUnless(matcher('Ellis J'))
+        self.failIf(matcher('Ellis, J'))
+        matcher = search_engine.get_bibxxx_value_matcher('e\\.g\\. [[:alpha:]]x', 'r')
+        self.failUnless(matcher('see e.g. ax'))
+        self.failIf(matcher('see e.g. 1x'))
+        matcher = search_engine.get_bibxxx_value_matcher('[^[:digit:]]x', 'r')
+        self.failUnless(matcher('ax'))
+        self.failIf(matcher('1x'))
+        self.assertEqual(search_engine.get_bibxxx_value_matcher('[[.hyphen.]]x', 'r'), None)
+        self.assertEqual(search_engine.get_bibxxx_value_matcher('[[=e=]]x', 'r'), None)
+
+class TestSearchUnitsPlanning(unittest.TestCase):
+    """Test of the evaluation order of basic search units."""
+
+    def test_plan_conjunction(self):
+        """search engine - planning of AND and NOT search units"""
+        self.assertEqual(search_engine.plan_basic_search_units(
+            [['+', 'ellis*', 'author', 'w'],
+             ['-', 'muon', '', 'w'],
+             ['+', 'higgs', '', 'w']]), [2, 0, 1])
+
+    def test_plan_disjunction(self):
+        """search engine - no planning of OR search units"""
+        self.assertEqual(search_engine.plan_basic_search_units(
+            [['+', 'ellis', 'author', 'w'],
+             ['|', 'muon', '', 'w']]), None)
+
 class TestQueryParser(unittest.TestCase):
     """Test of search pattern (or query) parser."""
 
@@ -269,7 +354,10 @@ class TestQueryParser(unittest.TestCase):
                     [['+', 'Ellis, J', 'author', 'a']])
 
 TEST_SUITE = make_test_suite(TestWashQueryParameters,
+                             TestSortRecordsByRanks,
                              TestStripAccents,
+                             TestTrigramSearchHelpers,
+                             TestSearchUnitsPlanning,
                              TestQueryParser,
                              TestMiscUtilityFunctions)
 
@@ -45,7 +45,12 @@ from invenio.urlutils import same_urls_p
 from invenio.search_engine import perform_request_search, \
     guess_primary_collection_of_a_record, guess_collection_of_a_record, \
     collection_restricted_p, get_permitted_restricted_collections, \
-    get_fieldvalues, search_pattern
+    get_fieldvalues, get_fieldvalues_per_record, search_pattern, \
+    get_record, get_records, \
+    search_unit, set_search_unit_memoization, HitSet, \
+    search_unit_in_bibrec
+from invenio import search_engine
+from invenio.websearch_webcoll import Collection, get_indexes_last_updated_timestamp
 
 def parse_url(url):
     parts = urlparse.urlparse(url)
@@ -908,6 +913,57 @@ class WebSearchSearchEnginePythonAPITest(unittest.TestCase):
 """)
 
 
+    def test_search_engine_python_api_search_unit_memoization(self):
+        """websearch - search engine Python API with memoized search units"""
+        expected = list(search_unit('ellis', 'author'))
+        set_search_unit_memoization(True)
+        try:
+            hitset = search_unit('ellis', 'author')
+            ## modifying the returned hitset must not alter the memo:
+            hitset.intersection_update(search_unit('muon', ''))
+            self.assertEqual(expected, list(search_unit('ellis', 'author')))
+            self.assertEqual([8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 47],
+                             perform_request_search(p='ellis'))
+        finally:
+            set_search_unit_memoization(False)
+
+    def test_search_engine_python_api_search_unit_in_bibrec_memoization(self):
+        """websearch - search engine Python API with memoized date units"""
+        set_search_unit_memoization(True)
+        try:
+            hitset = search_unit_in_bibrec('1970-01-01', '2100-01-01', '')
+            self.assertEqual(list(hitset),
+                             list(search_unit_in_bibrec('1970-01-01', '2100-01-01', 'c')))
+            ## the default type and 'c' share their memo entry:
+            self.assertEqual(1, len(search_engine._SEARCH_UNIT_MEMO))
+        finally:
+            set_search_unit_memoization(False)
+
+    def test_search_engine_python_api_search_unit_restriction(self):
+        """websearch - search engine Python API with restricted search units"""
+        hitset = search_unit('ellis', 'author')
+        self.assertEqual(list(search_unit('.*', '245__a', 'r') & hitset),
+                         list(search_unit('.*', '245__a', 'r', restrict_to=hitset)))
+        ## planned query, regexp unit searched within the author hits:
+        self.assertEqual(list(search_unit('.*', '245__a', 'r') & hitset),
+                         perform_request_search(p='245__a:/.*/ and ellis'))
+
+    def test_search_engine_python_api_search_pattern_restriction(self):
+        """websearch - search engine Python API with restricted search patterns"""
+        restriction = HitSet(range(1, 50))
+        for pattern in ('ellis', 'ellis or muon', 'ellis -muon',
+                        '245__a:/.*/ and ellis', 'collection:ARTICLE -980__:"DELETED"'):
+            self.assertEqual(list(search_pattern(p=pattern) & restriction),
+                             list(search_pattern(p=pattern, restrict_to=restriction)))
+
+    def test_search_engine_python_api_search_pattern_restriction_ap(self):
+        """websearch - search engine Python API with restricted search patterns and ap"""
+        restriction = HitSet(range(1, 50))
+        for pattern in ('muon; decay', 'ellis and title:"muon; decay"',
+                        'ellis and 245__a:/muon;.*/', 'ellis and 100__a:"Ellis;*"'):
+            self.assertEqual(list(search_pattern(p=pattern, ap=1) & restriction),
+                             list(search_pattern(p=pattern, ap=1, restrict_to=restriction)))
+
 class WebSearchSearchEngineWebAPITest(unittest.TestCase):
     """Check typical search engine Web API calls on the demo data."""
 
@@ -1579,6 +1635,32 @@ class WebSearchGetFieldValuesTest(unittest.TestCase):
         self.assertEqual(get_fieldvalues([17, 18], '909C1u', repetitive_values=False),
                          ['CERN'])
 
+    def test_get_fieldvalues_per_record(self):
+        """websearch - get_fieldvalues_per_record() agrees with get_fieldvalues()"""
+        self.assertEqual(get_fieldvalues_per_record([], '700__a'), {})
+        self.assertEqual(get_fieldvalues_per_record([10, 13], '001___'),
+                         {10: ['10'], 13: ['13']})
+        expected = {}
+        for recid in (9, 13, 18):
+            if get_fieldvalues(recid, '700__a'):
+                expected[recid] = get_fieldvalues(recid, '700__a')
+        self.assertEqual(get_fieldvalues_per_record([9, 13, 18], '700__a'),
+                         expected)
+
+class WebSearchGetRecordsTest(unittest.TestCase):
+    """Testing get_records() bulk record loading."""
+
+    def test_get_records_same_as_get_record(self):
+        """websearch - get_records() agrees with get_record()"""
+        recids = [1, 10, 18]
+        records = get_records(recids)
+        for recid in recids:
+            self.assertEqual(records[recid], get_record(recid))
+
+    def test_get_records_empty(self):
+        """websearch - get_records() for no records"""
+        self.assertEqual(get_records([]), {})
+
 class WebSearchAddToBasketTest(unittest.TestCase):
     """Test of the add-to-basket presence depending on user rights."""
 
@@ -1756,6 +1838,37 @@ class WebSearchSPIRESSyntaxTest(unittest.TestCase):
                                                expected_text='[9, 12, 14, 47]'))
 
 
+class WebSearchWebCollQuickUpdateTest(unittest.TestCase):
+    """Check the incremental reclist calculation of webcoll."""
+
+    def test_calculate_reclist_modified_recids(self):
+        """websearch - webcoll incremental reclist equals full reclist"""
+        for name in ('Articles', 'Preprints', 'Multimedia & Arts', CFG_SITE_NAME):
+            reclist = list(Collection(name).calculate_reclist()[0])
+            for modified_recids in (HitSet(), HitSet(range(1, 50)),
+                                    HitSet(range(1, 200))):
+                coll = Collection(name)
+                self.assertEqual(list(coll.calculate_reclist(modified_recids)[0]),
+                                 reclist)
+                self.failIf(coll.reclist_changed_p)
+
+    def test_calculate_reclist_modified_recids_stale_reclist(self):
+        """websearch - webcoll incremental reclist repairs modified records"""
+        reclist = Collection('Articles').calculate_reclist()[0]
+        modified_recids = HitSet(range(1, 200))
+        coll = Collection('Articles')
+        coll.reclist = reclist - modified_recids
+        coll.reclist.add(300) # a record that does not exist any more
+        self.assertEqual(list(coll.calculate_reclist(modified_recids | HitSet([300]))[0]),
+                         list(reclist))
+        self.failUnless(coll.reclist_changed_p)
+
+    def test_indexes_last_updated_timestamp(self):
+        """websearch - webcoll index timestamp of the collection dbqueries"""
+        self.assertEqual(get_indexes_last_updated_timestamp([Collection(CFG_SITE_NAME)]),
+                         None)
+        self.failIf(get_indexes_last_updated_timestamp([Collection('Articles')]) is None)
+
 TEST_SUITE = make_test_suite(WebSearchWebPagesAvailabilityTest,
                              WebSearchTestSearch,
                              WebSearchTestBrowse,
@@ -1785,12 +1898,14 @@ TEST_SUITE = make_test_suite(WebSearchWebPagesAvailabilityTest,
                              WebSearchSummarizerTest,
                              WebSearchRecordCollectionGuessTest,
                              WebSearchGetFieldValuesTest,
+                             WebSearchGetRecordsTest,
                              WebSearchAddToBasketTest,
                              WebSearchAlertTeaserTest,
                              WebSearchSpanQueryTest,
                              WebSearchReferstoCitedbyTest,
                              WebSearchSPIRESSyntaxTest,
-                             WebSearchTestWildcardLimit)
+                             WebSearchTestWildcardLimit,
+                             WebSearchWebCollQuickUpdateTest)
 
 
 if __name__ == "__main__":
@@ -40,7 +40,8 @@ from invenio.config import \
      CFG_WEBSEARCH_ENABLED_SEARCH_INTERFACES, \
      CFG_WEBSEARCH_DEFAULT_SEARCH_INTERFACE
 from invenio.messages import gettext_set_language, language_list_long
-from invenio.search_engine import HitSet, search_pattern, get_creation_date, get_field_i18nname, collection_restricted_p, sort_records
+from invenio.search_engine import HitSet, search_pattern, get_creation_date, get_field_i18nname, collection_restricted_p, sort_records, \
+     create_basic_search_units, get_index_id_from_field
 from invenio.dbquery import run_sql, Error, get_table_update_time
 from invenio.bibrank_record_sorter import get_bibrank_methods
 from invenio.dateutils import convert_datestruct_to_dategui
@@ -152,6 +153,11 @@ class Collection:
         self.reclist_with_nonpublic_subcolls = HitSet()
         # used to store the temporary result of the calculation of nbrecs of an external collection
         self.nbrecs_tmp = None
+        # whether reclist or nbrecs changed during this run; unknown
+        # until calculate_reclist() is run, so assume they did:
+        self.reclist_changed_p = 1
+        # whether the reclist was ever calculated and stored in the DB:
+        self.reclist_stored_p = 0
         if not name:
             self.name = CFG_SITE_NAME # by default we are working on the home page
             self.id = 1
@@ -170,6 +176,7 @@ class Collection:
                     self.nbrecs = res[0][3]
                     try:
                         self.reclist = HitSet(res[0][4])
+                        self.reclist_stored_p = res[0][4] is not None
                     except:
                         self.reclist = HitSet()
                 else: # collection does not exist!
@@ -740,12 +747,16 @@ class Collection:
           formatoptions = self.create_formatoptions(ln)
         )
 
-    def calculate_reclist(self):
-        """Calculate, set and return the (reclist, reclist_with_nonpublic_subcolls) tuple for given collection."""
+    def calculate_reclist(self, modified_recids=None):
+        """Calculate, set and return the (reclist, reclist_with_nonpublic_subcolls) tuple for given collection.
+           If MODIFIED_RECIDS is given, then the stored reclist is only patched
+           for these records, i.e. the dbquery is evaluated within them only."""
         if self.calculate_reclist_run_already or str(self.dbquery).startswith("hostedcollection:"):
             # do we have to recalculate?
             return (self.reclist, self.reclist_with_nonpublic_subcolls)
         write_message("... calculating reclist of %s" % self.name, verbose=6)
+        old_nbrecs = self.nbrecs
+        old_reclist = self.reclist
         reclist = HitSet() # will hold results for public sons only; good for storing into DB
         reclist_with_nonpublic_subcolls = HitSet() # will hold results for both public and nonpublic sons; good for deducing total
                                                    # number of documents
@@ -753,7 +764,7 @@ class Collection:
             # A - collection does not have dbquery, so query recursively all its sons
             #     that are either non-restricted or that have the same restriction rules
             for coll in self.get_sons():
-                coll_reclist, coll_reclist_with_nonpublic_subcolls = coll.calculate_reclist()
+                coll_reclist, coll_reclist_with_nonpublic_subcolls = coll.calculate_reclist(modified_recids)
                 if ((coll.restricted_p() is None) or
                     (coll.restricted_p() == self.restricted_p())):
                     # add this reclist ``for real'' only if it is public
@@ -763,15 +774,26 @@ class Collection:
             # B - collection does have dbquery, so compute it:
             #     (note: explicitly remove DELETED records)
             if CFG_CERN_SITE:
-                reclist = search_pattern(None, self.dbquery + \
-                                         ' -980__:"DELETED" -980__:"DUMMY"')
+                dbquery = self.dbquery + ' -980__:"DELETED" -980__:"DUMMY"'
             else:
-                reclist = search_pattern(None, self.dbquery + ' -980__:"DELETED"')
+                dbquery = self.dbquery + ' -980__:"DELETED"'
+            if modified_recids is not None and self.reclist_stored_p:
+                # B1 - incremental update: re-evaluate only the modified records
+                reclist = HitSet(self.reclist)
+                if modified_recids:
+                    reclist.difference_update(modified_recids)
+                    reclist.union_update(search_pattern(None, dbquery,
+                                                        restrict_to=modified_recids))
+            else:
+                # B2 - full update
+                reclist = search_pattern(None, dbquery)
             reclist_with_nonpublic_subcolls = copy.deepcopy(reclist)
         # store the results:
         self.nbrecs = len(reclist_with_nonpublic_subcolls)
         self.reclist = reclist
         self.reclist_with_nonpublic_subcolls = reclist_with_nonpublic_subcolls
+        self.reclist_changed_p = self.nbrecs != old_nbrecs or \
+                                 self.reclist != old_reclist
         # last but not least, update the speed-up flag:
         self.calculate_reclist_run_already = 1
         # return the two sets:
@@ -825,6 +847,11 @@ class Collection:
         if self.update_reclist_run_already:
             # do we have to reupdate?
             return 0
+        if task_has_option("quick") and \
+               not self.reclist_changed_p and self.reclist_stored_p:
+            # nothing new to store
+            self.update_reclist_run_already = 1
+            return 0
         write_message("... updating reclist of %s (%s recs)" % (self.name, self.nbrecs), verbose=6)
         sys.stdout.flush()
         try:
@@ -838,6 +865,33 @@ class Collection:
         self.update_reclist_run_already = 1
         return 0
 
+    def webpage_cache_outdated_p(self, modified_recids=None,
+                                 rg=CFG_WEBSEARCH_INSTANT_BROWSE):
+        """Tell whether the webpage cache of the collection has to be
+           updated after its reclist was calculated, i.e. whether the
+           record counts shown on its page changed (its own or those of
+           its sons), or whether one of its latest RG additions is
+           among MODIFIED_RECIDS (all of them count if None).  This
+           holds for aggregate collections too, since their latest
+           additions come from their reclist as well."""
+        if self.reclist_changed_p:
+            return True
+        for son in self.get_sons('r') + self.get_sons('v'):
+            if son.reclist_changed_p:
+                return True
+        if not self.reclist or rg == 0:
+            return False
+        if modified_recids is None:
+            return True
+        modified_in_reclist = self.reclist & modified_recids
+        if not modified_in_reclist:
+            return False
+        if CFG_CERN_SITE:
+            # latest additions may be sorted specially, so be careful:
+            return True
+        latest_additions = intbitset(list(self.reclist)[-rg:])
+        return bool(modified_in_reclist & latest_additions)
+
 def get_datetime(var, format_string="%Y-%m-%d %H:%M:%S"):
     """Returns a date string according to the format string.
        It can handle normal date strings and shifts with respect
@@ -909,6 +963,60 @@ def get_cache_last_updated_timestamp():
     f.close()
     return timestamp
 
+def get_cache_last_fast_updated_timestamp():
+    """Return the timestamp up to which the record modifications are
+       accounted for in the collection reclists."""
+    try:
+        f = open(CFG_CACHE_LAST_FAST_UPDATED_TIMESTAMP_FILE, "r")
+    except:
+        return "1970-01-01 00:00:00"
+    timestamp = f.read()
+    f.close()
+    return timestamp
+
+def set_cache_last_fast_updated_timestamp(timestamp):
+    """Set the timestamp up to which the record modifications are
+       accounted for in the collection reclists to TIMESTAMP."""
+    try:
+        f = open(CFG_CACHE_LAST_FAST_UPDATED_TIMESTAMP_FILE, "w")
+    except:
+        return timestamp
+    f.write(timestamp)
+    f.close()
+    return timestamp
+
+def get_indexes_last_updated_timestamp(colls):
+    """Return the oldest last updated timestamp of the indexes searched
+       by the dbqueries of COLLS, since the records modified after it
+       may not be indexed yet, or None if none of them was ever updated.
+       Indexes not searched by any dbquery (e.g. fulltext) are left out,
+       so that they do not hold the timestamp back."""
+    index_ids = {}
+    for coll in colls:
+        if not coll.dbquery or str(coll.dbquery).startswith("hostedcollection:"):
+            continue
+        for dummy_op, dummy_p, f, dummy_m in create_basic_search_units(None, coll.dbquery, ''):
+            index_id = get_index_id_from_field(f)
+            if index_id:
+                index_ids[index_id] = 1
+    if not index_ids:
+        return None
+    res = run_sql("SELECT MIN(last_updated) FROM idxINDEX WHERE last_updated IS NOT NULL AND id IN (%s)" % \
+                  ",".join([str(idx_id) for idx_id in index_ids.keys()]))
+    if res and res[0][0]:
+        return str(res[0][0])
+    return None
+
+def get_modified_recids_since(timestamp, tolerance=CFG_CACHE_LAST_UPDATED_TIMESTAMP_TOLERANCE):
+    """Return hitset of the records modified since TIMESTAMP, minus
+       TOLERANCE seconds."""
+    timestamp = re.sub(r'\.[0-9]+$', '', timestamp)
+    since = time.strftime("%Y-%m-%d %H:%M:%S",
+                          time.localtime(time.mktime(time.strptime(timestamp, "%Y-%m-%d %H:%M:%S")) - \
+                                         tolerance))
+    return intbitset(run_sql("SELECT id FROM bibrec WHERE modification_date>=%s",
+                             (since,)))
+
 def set_cache_last_updated_timestamp(timestamp):
     """Set last updated cache timestamp to TIMESTAMP."""
     try:
@@ -934,15 +1042,21 @@ def main():
                     "  -r, --recursive\t Update cache for the given collection and all its\n"
                     "\t\t\t descendants (to be used in combination with -c). [no]\n"
                     "  -f, --force\t\t Force update even if cache is up to date. [no]\n"
+                    "  -q, --quick\t\t Update reclists only for the records modified since\n"
+                    "\t\t\t the last run, and skip the webpage cache update of\n"
+                    "\t\t\t the collections whose record counts and latest\n"
+                    "\t\t\t additions did not change. Run without it after\n"
+                    "\t\t\t changing collection definitions. [no]\n"
                     "  -p, --part\t\t Update only certain cache parts (1=reclist,"
                     " 2=webpage). [both]\n"
                     "  -l, --language\t Update pages in only certain language"
                     " (e.g. fr,it,...). [all]\n",
             version=__revision__,
-            specific_params=("c:rfp:l:", [
+            specific_params=("c:rfqp:l:", [
                     "collection=",
                     "recursive",
                     "force",
+                    "quick",
                     "part=",
                     "language="
                 ]),
@@ -967,6 +1081,8 @@ def task_submit_elaborate_specific_parameter(key, value, opts, args):
         task_set_option("recursive", 1)
     elif key in ("-f", "--force"):
         task_set_option("force", 1)
+    elif key in ("-q", "--quick"):
+        task_set_option("quick", 1)
     elif key in ("-p", "--part"):
         task_set_option("part", int(value))
     elif key in ("-l", "--language"):
@@ -1038,6 +1154,18 @@ def task_run_core():
             res = run_sql("SELECT name FROM collection ORDER BY id")
             for row in res:
                 colls.append(get_collection(row[0]))
+        # in quick mode, find out the records modified since the
+        # reclists were last calculated:
+        modified_recids = None
+        if task_has_option("quick") and task_get_option('part', 1) == 1 and \
+               not task_has_option("collection"):
+            last_fast_updated_timestamp = get_cache_last_fast_updated_timestamp()
+            if last_fast_updated_timestamp.startswith("1970"):
+                write_message("No previous reclist calculation known, doing full update.")
+            else:
+                modified_recids = get_modified_recids_since(last_fast_updated_timestamp)
+                write_message("Quick update: %d records modified since %s." % \
+                              (len(modified_recids), last_fast_updated_timestamp))
         # secondly, update collection reclist cache:
         if task_get_option('part', 1) == 1:
             i = 0
@@ -1047,7 +1175,7 @@ def task_run_core():
                 if str(coll.dbquery).startswith("hostedcollection:"):
                     coll.set_nbrecs_for_external_collection()
                 else:
-                    coll.calculate_reclist()
+                    coll.calculate_reclist(modified_recids)
                 task_sleep_now_if_required()
                 coll.update_reclist()
                 task_update_progress("Part 1/2: done %d/%d" % (i, len(colls)))
@@ -1057,8 +1185,12 @@ def task_run_core():
             i = 0
             for coll in colls:
                 i += 1
-                write_message("%s / webpage cache update" % coll.name)
-                coll.update_webpage_cache()
+                if task_has_option("quick") and \
+                       not coll.webpage_cache_outdated_p(modified_recids):
+                    write_message("%s / webpage cache is up to date" % coll.name, verbose=3)
+                else:
+                    write_message("%s / webpage cache update" % coll.name)
+                    coll.update_webpage_cache()
                 task_update_progress("Part 2/2: done %d/%d" % (i, len(colls)))
                 task_sleep_now_if_required(can_stop_too=True)
 
@@ -1068,6 +1200,17 @@ def task_run_core():
         if not task_has_option("collection"):
             set_cache_last_updated_timestamp(task_run_start_timestamp)
             write_message("Collection cache timestamp is set to %s." % get_cache_last_updated_timestamp(), verbose=3)
+            if task_get_option('part', 1) == 1:
+                # the records modified after the oldest update of the
+                # indexes the dbqueries use may not be found by the dbqueries yet, so have them
+                # re-evaluated by the next quick run:
+                last_fast_updated_timestamp = task_run_start_timestamp
+                indexes_last_updated_timestamp = get_indexes_last_updated_timestamp(colls)
+                if indexes_last_updated_timestamp:
+                    last_fast_updated_timestamp = min(last_fast_updated_timestamp,
+                                                      indexes_last_updated_timestamp)
+                set_cache_last_fast_updated_timestamp(last_fast_updated_timestamp)
+                write_message("Collection reclist timestamp is set to %s." % get_cache_last_fast_updated_timestamp(), verbose=3)
     else:
         ## cache up to date, we don't have to run
         write_message("Collection cache is up to date, no need to run.")
@@ -25,7 +25,6 @@ __revision__ = "$Id$"
 
 import sys
 import datetime
-import time
 import os
 try:
     from invenio.dbquery import run_sql
@@ -37,6 +36,8 @@ try:
     from invenio.access_control_mailcookie import mail_cookie_gc
     from invenio.bibdocfile import BibDoc
     from invenio.bibsched import gc_tasks
+    from invenio.session import get_session_storage, \
+         InvenioMySQLSessionStorage
 except ImportError, e:
     print "Error: %s" % (e, )
     sys.exit(1)
@@ -281,23 +282,28 @@ def guest_user_garbage_collector():
 
     # 1 - DELETE EXPIRED SESSIONS
     write_message("- deleting expired sessions")
-    timelimit = time.time()
-    write_message("  DELETE FROM session WHERE"
-        " session_expiry < %d \n" % (timelimit, ), verbose=9)
-    delcount['session'] += run_sql("DELETE FROM session WHERE"
-        " session_expiry < %s """ % (timelimit, ))
+    session_storage = get_session_storage()
+    write_message("  %s.cleanup()\n" % (session_storage.__class__.__name__, ),
+        verbose=9)
+    delcount['session'] += session_storage.cleanup()
 
 
     # 1b - DELETE GUEST USERS WITHOUT SESSION
     write_message("- deleting guest users without session")
 
     # get uids
-    write_message("""  SELECT u.id\n  FROM user AS u LEFT JOIN session AS s\n  ON u.id = s.uid\n  WHERE s.uid IS NULL AND u.email = ''""", verbose=9)
-
-    result = run_sql("""SELECT u.id
-    FROM user AS u LEFT JOIN session AS s
-    ON u.id = s.uid
-    WHERE s.uid IS NULL AND u.email = ''""")
+    if isinstance(session_storage, InvenioMySQLSessionStorage):
+        write_message("""  SELECT u.id\n  FROM user AS u LEFT JOIN session AS s\n  ON u.id = s.uid\n  WHERE s.uid IS NULL AND u.email = ''""", verbose=9)
+
+        result = run_sql("""SELECT u.id
+        FROM user AS u LEFT JOIN session AS s
+        ON u.id = s.uid
+        WHERE s.uid IS NULL AND u.email = ''""")
+    else:
+        write_message("""  SELECT id FROM user WHERE email = ''\n  (minus the uids having a stored session)""", verbose=9)
+        session_uids = session_storage.get_uids()
+        result = [row for row in run_sql("SELECT id FROM user WHERE email = ''")
+                  if row[0] not in session_uids]
     write_message(result, verbose=9)
 
     if result:
@@ -22,6 +22,9 @@ Session management adapted from mod_python Session class.
 
 Just use L{get_session} to obtain a session object (with a dictionary
 interface, which will let you store permanent information).
+
+Sessions are stored via a pluggable storage backend (see
+L{get_session_storage}), chosen with C{CFG_WEBSESSION_STORAGE}.
 """
 
 from invenio.webinterface_handler_wsgi_utils import add_cookie, Cookie, get_cookie
@@ -32,6 +35,8 @@ import random
 import re
 import sys
 import os
+import errno
+import tempfile
 if sys.hexversion < 0x2060000:
     from md5 import md5
 else:
@@ -39,10 +44,291 @@ else:
 
 from invenio.dbquery import run_sql, blob_to_string
 from invenio.config import CFG_WEBSESSION_EXPIRY_LIMIT_REMEMBER, \
-    CFG_WEBSESSION_EXPIRY_LIMIT_DEFAULT
+    CFG_WEBSESSION_EXPIRY_LIMIT_DEFAULT, CFG_CACHEDIR
+try:
+    from invenio.config import CFG_WEBSESSION_STORAGE, \
+        CFG_WEBSESSION_STORAGE_DIR
+except ImportError:
+    CFG_WEBSESSION_STORAGE = 'mysql'
+    CFG_WEBSESSION_STORAGE_DIR = ''
 from invenio.websession_config import CFG_WEBSESSION_COOKIE_NAME, \
     CFG_WEBSESSION_ONE_DAY, CFG_WEBSESSION_CLEANUP_CHANCE, \
-    CFG_WEBSESSION_ENABLE_LOCKING
+    CFG_WEBSESSION_ENABLE_LOCKING, CFG_WEBSESSION_ACCESS_REFRESH_INTERVAL
+
+class InvenioSessionStorage(object):
+    """
+    Interface of a session storage backend.
+
+    A storage maps session identifiers to serialized session objects,
+    together with their expiry time and the uid of their owner.
+    """
+
+    def load(self, sid):
+        """
+        @param sid: the session identifier.
+        @type sid: 32 hexadecimal string
+        @return: the serialized session object, or None if not found.
+        @rtype: string
+        """
+        raise NotImplementedError
+
+    def save(self, sid, session_object, session_expiry, uid):
+        """
+        Store (or replace) a serialized session object.
+
+        @param sid: the session identifier.
+        @type sid: 32 hexadecimal string
+        @param session_object: the serialized session.
+        @type session_object: string
+        @param session_expiry: UNIX timestamp after which the session can be
+            garbage collected.
+        @type session_expiry: double
+        @param uid: the user id owning the session.
+        @type uid: int
+        """
+        raise NotImplementedError
+
+    def delete(self, sid):
+        """
+        Remove a session.
+
+        @param sid: the session identifier.
+        @type sid: 32 hexadecimal string
+        """
+        raise NotImplementedError
+
+    def cleanup(self):
+        """
+        Remove the expired sessions.
+
+        @return: the number of removed sessions.
+        @rtype: int
+        """
+        raise NotImplementedError
+
+    def get_uid(self, sid):
+        """
+        @param sid: the session identifier.
+        @type sid: 32 hexadecimal string
+        @return: the uid owning the session, or None if not found.
+        @rtype: int
+        """
+        raise NotImplementedError
+
+    def get_uids(self, expiring_before=None):
+        """
+        @param expiring_before: if set, only consider the sessions
+            expiring before this UNIX timestamp.
+        @type expiring_before: double
+        @return: the uids owning a non expired session.
+        @rtype: set of int
+        """
+        raise NotImplementedError
+
+class InvenioMySQLSessionStorage(InvenioSessionStorage):
+    """
+    Session storage based on the MySQL C{session} table.
+    """
+
+    def load(self, sid):
+        res = run_sql("SELECT session_object FROM session "
+                        "WHERE session_key=%s", (sid, ))
+        if res:
+            return blob_to_string(res[0][0])
+        return None
+
+    def save(self, sid, session_object, session_expiry, uid):
+        run_sql("""
+            INSERT session(
+                session_key,
+                session_expiry,
+                session_object,
+                uid
+            ) VALUE(%s,
+                %s,
+                %s,
+                %s
+            ) ON DUPLICATE KEY UPDATE
+                session_expiry=%s,
+                session_object=%s,
+                uid=%s
+        """, (sid, session_expiry, session_object, uid,
+            session_expiry, session_object, uid))
+
+    def delete(self, sid):
+        run_sql("DELETE FROM session WHERE session_key=%s", (sid, ))
+
+    def cleanup(self):
+        return run_sql("""
+            DELETE FROM session
+            WHERE session_expiry<=UNIX_TIMESTAMP()
+        """)
+
+    def get_uid(self, sid):
+        res = run_sql("SELECT uid FROM session WHERE session_key=%s", (sid, ))
+        if res:
+            return res[0][0]
+        return None
+
+    def get_uids(self, expiring_before=None):
+        if expiring_before is None:
+            res = run_sql("SELECT DISTINCT uid FROM session "
+                "WHERE session_expiry>UNIX_TIMESTAMP()")
+        else:
+            res = run_sql("SELECT DISTINCT uid FROM session "
+                "WHERE session_expiry>UNIX_TIMESTAMP() AND session_expiry<%s",
+                (expiring_before, ))
+        return set([row[0] for row in res])
+
+class InvenioFileSessionStorage(InvenioSessionStorage):
+    """
+    Session storage keeping every session in its own file.
+
+    Files are spread in 256 subdirectories of C{directory}, according to
+    the first two characters of the session identifier.  Each file holds
+    the uid of the owner on its first line, followed by the serialized
+    session object; the modification time of the file is set to the
+    session expiry time.  Files are written to a temporary file that is
+    then renamed, so that concurrent readers never see partial sessions.
+
+    @param directory: the directory where to store the sessions.
+    @type directory: string
+    """
+
+    ## Seconds after which a temporary file is considered abandoned.
+    TMP_FILE_LIFETIME = 3600
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _get_path(self, sid):
+        """
+        @return: the path of the file storing the session C{sid}.
+        @rtype: string
+        """
+        return os.path.join(self.directory, sid[:2], sid)
+
+    def _iter_paths(self):
+        """
+        @return: an iterator over the paths of all the stored files.
+        @rtype: iterator of strings
+        """
+        for dirpath, dummy, filenames in os.walk(self.directory):
+            for filename in filenames:
+                yield os.path.join(dirpath, filename)
+
+    def _read(self, path):
+        """
+        @return: the uid and the serialized session stored in C{path}, or
+            None if the file does not exist or has expired.
+        @rtype: (int, string)
+        """
+        try:
+            session_file = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            if os.fstat(session_file.fileno()).st_mtime <= time.time():
+                return None
+            uid, session_object = session_file.read().split('\n', 1)
+        finally:
+            session_file.close()
+        return int(uid), session_object
+
+    def load(self, sid):
+        content = self._read(self._get_path(sid))
+        if content is None:
+            return None
+        return content[1]
+
+    def save(self, sid, session_object, session_expiry, uid):
+        path = self._get_path(sid)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError, err:
+                if err.errno != errno.EEXIST:
+                    raise
+        fd, tmp_path = tempfile.mkstemp(prefix='.' + sid, dir=dirname)
+        try:
+            session_file = os.fdopen(fd, 'wb')
+            try:
+                session_file.write('%s\n' % uid)
+                session_file.write(session_object)
+            finally:
+                session_file.close()
+            os.utime(tmp_path, (session_expiry, session_expiry))
+            os.rename(tmp_path, path)
+        except:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+    def delete(self, sid):
+        try:
+            os.remove(self._get_path(sid))
+        except OSError:
+            pass
+
+    def cleanup(self):
+        now = time.time()
+        count = 0
+        for path in self._iter_paths():
+            if os.path.basename(path).startswith('.'):
+                ## Temporary file of save(): it only gets the session
+                ## expiry time just before being renamed, so remove it
+                ## only once it has clearly been left behind.
+                expiry = now - self.TMP_FILE_LIFETIME
+            else:
+                expiry = now
+            try:
+                if os.stat(path).st_mtime <= expiry:
+                    os.remove(path)
+                    count += 1
+            except OSError:
+                ## Concurrently removed.
+                pass
+        return count
+
+    def get_uid(self, sid):
+        content = self._read(self._get_path(sid))
+        if content is None:
+            return None
+        return content[0]
+
+    def get_uids(self, expiring_before=None):
+        uids = set()
+        for path in self._iter_paths():
+            if not os.path.basename(path).startswith('.'):
+                if expiring_before is not None:
+                    try:
+                        if os.stat(path).st_mtime >= expiring_before:
+                            continue
+                    except OSError:
+                        continue
+                content = self._read(path)
+                if content is not None:
+                    uids.add(content[0])
+        return uids
+
+_SESSION_STORAGE = None
+def get_session_storage():
+    """
+    @return: the session storage configured with C{CFG_WEBSESSION_STORAGE}.
+    @rtype: L{InvenioSessionStorage}
+    """
+    global _SESSION_STORAGE
+    if _SESSION_STORAGE is None:
+        if CFG_WEBSESSION_STORAGE == 'file':
+            _SESSION_STORAGE = InvenioFileSessionStorage(
+                CFG_WEBSESSION_STORAGE_DIR or
+                os.path.join(CFG_CACHEDIR, 'sessions'))
+        else:
+            _SESSION_STORAGE = InvenioMySQLSessionStorage()
+    return _SESSION_STORAGE
 
 def get_session(req, sid=None):
     """
@@ -69,7 +355,8 @@ def get_session(req, sid=None):
 
 class InvenioSession(dict):
     """
-    This class implements a Session handling based on MySQL.
+    This class implements a Session handling based on a pluggable
+    L{InvenioSessionStorage} (MySQL by default).
 
     @param req: the mod_python request object.
     @type req: mod_python request object
@@ -83,6 +370,10 @@ class InvenioSession(dict):
         implementation.
     @note: This class implements IP verification to prevent basic cookie
         stealing.
+    @note: L{save} only writes to the storage when the session has been
+        modified since it was loaded (or when its last access time needs
+        refreshing), and never stores guest sessions that carry no
+        information.
     @raise ValueError: if C{sid} is provided and correspond to a broken
         session.
     """
@@ -99,6 +390,8 @@ class InvenioSession(dict):
         self._invalid = 0
         self._http_ip = None
         self._https_ip = None
+        self._stored_state = None
+        self._stored_accessed = 0
 
         dict.__init__(self)
 
@@ -168,16 +461,15 @@ class InvenioSession(dict):
 
     def load(self):
         """
-        Load the session from the database.
+        Load the session from the storage.
         @return: 1 in case of success, 0 otherwise.
         @rtype: integer
         """
         session_dict = None
         invalid = False
-        res = run_sql("SELECT session_object FROM session "
-                        "WHERE session_key=%s", (self._sid, ))
-        if res:
-            session_dict = cPickle.loads(blob_to_string(res[0][0]))
+        session_object = get_session_storage().load(self._sid)
+        if session_object is not None:
+            session_dict = cPickle.loads(session_object)
             remote_ip = self._req.remote_ip
             if self._req.is_https():
                 if session_dict['_https_ip'] is not None and \
@@ -207,48 +499,77 @@ class InvenioSession(dict):
         self._timeout  = session_dict["_timeout"]
         self._remember_me = session_dict["_remember_me"]
         self.update(session_dict["_data"])
+        ## Keep an independent copy of what is stored, in order to detect
+        ## modifications (also of mutable values) at save time.
+        self._set_stored_state(cPickle.loads(session_object))
         return 1
 
+    def _get_state(self):
+        """
+        @return: the session as it is written to the storage, except for
+            the last access time.
+        @rtype: dict
+        """
+        return {"_data" : self.copy(),
+                "_created" : self._created,
+                "_timeout" : self._timeout,
+                "_http_ip" : self._http_ip,
+                "_https_ip" : self._https_ip,
+                "_remember_me" : self._remember_me
+        }
+
+    def _set_stored_state(self, session_dict):
+        """
+        Remember C{session_dict} as the state currently in the storage.
+        """
+        self._stored_accessed = session_dict.pop("_accessed")
+        self._stored_state = session_dict
+
+    def _is_empty(self):
+        """
+        @return: True if the session holds no information worth storing,
+            i.e. it belongs to the generic guest user and does not contain
+            anything else.
+        @rtype: bool
+        """
+        if self._remember_me:
+            return False
+        for key, value in self.iteritems():
+            if key != 'uid' or value not in (0, -1):
+                return False
+        return True
+
     def save(self):
         """
-        Save the session to the database.
+        Save the session to the storage, if it has been modified.
         """
         if not self._invalid:
-            session_dict = {"_data" : self.copy(),
-                    "_created" : self._created,
-                    "_accessed": self._accessed,
-                    "_timeout" : self._timeout,
-                    "_http_ip" : self._http_ip,
-                    "_https_ip" : self._https_ip,
-                    "_remember_me" : self._remember_me
-            }
-            session_key = self._sid
+            if self._is_empty():
+                if self._stored_state is not None:
+                    ## Information has been removed from a stored session.
+                    get_session_storage().delete(self._sid)
+                    self._stored_state = None
+                return
+            session_dict = self._get_state()
+            if session_dict == self._stored_state and \
+                    self._accessed - self._stored_accessed < \
+                        CFG_WEBSESSION_ACCESS_REFRESH_INTERVAL:
+                return
+            session_dict["_accessed"] = self._accessed
             session_object = cPickle.dumps(session_dict, -1)
             session_expiry = time.time() + self._timeout + \
                 CFG_WEBSESSION_ONE_DAY
             uid = self.get('uid', -1)
-            run_sql("""
-                INSERT session(
-                    session_key,
-                    session_expiry,
-                    session_object,
-                    uid
-                ) VALUE(%s,
-                    %s,
-                    %s,
-                    %s
-                ) ON DUPLICATE KEY UPDATE
-                    session_expiry=%s,
-                    session_object=%s,
-                    uid=%s
-            """, (session_key, session_expiry, session_object, uid,
-                session_expiry, session_object, uid))
+            get_session_storage().save(self._sid, session_object,
+                session_expiry, uid)
+            self._set_stored_state(cPickle.loads(session_object))
 
     def delete(self):
         """
         Delete the session.
         """
-        run_sql("DELETE FROM session WHERE session_key=%s", (self._sid, ))
+        get_session_storage().delete(self._sid)
+        self._stored_state = None
         self.clear()
 
     def invalidate(self):
@@ -361,19 +682,16 @@ class InvenioSession(dict):
 
     def cleanup(self):
         """
-        Perform the database session cleanup.
+        Perform the session storage cleanup.
         """
         def session_cleanup():
             """
             Session cleanup procedure which to be executed at the end
             of the request handling.
             """
-            run_sql("""
-                DELETE FROM session
-                WHERE session_expiry<=UNIX_TIMESTAMP()
-            """)
+            get_session_storage().cleanup()
         self._req.register_cleanup(session_cleanup)
-        self._req.log_error("InvenioSession: registered database cleanup.")
+        self._req.log_error("InvenioSession: registered storage cleanup.")
 
     def __del__(self):
         self.unlock()
@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+##
+## This file is part of Invenio.
+## Copyright (C) 2011 CERN.
+##
+## Invenio is free software; you can redistribute it and/or
+## modify it under the terms of the GNU General Public License as
+## published by the Free Software Foundation; either version 2 of the
+## License, or (at your option) any later version.
+##
+## Invenio is distributed in the hope that it will be useful, but
+## WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+## General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with Invenio; if not, write to the Free Software Foundation, Inc.,
+## 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""Unit tests for the session handling library."""
+
+__revision__ = "$Id$"
+
+import unittest
+import tempfile
+import shutil
+import time
+import os
+
+from invenio import session
+from invenio.testutils import make_test_suite, run_test_suite
+
+class FileSessionStorageTest(unittest.TestCase):
+    """Test the file based session storage."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.storage = session.InvenioFileSessionStorage(self.directory)
+        self.sid = '0123456789abcdef0123456789abcdef'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_and_load(self):
+        """session - file storage save and load"""
+        self.assertEqual(self.storage.load(self.sid), None)
+        self.storage.save(self.sid, 'foo\nbar', time.time() + 60, 5)
+        self.assertEqual(self.storage.load(self.sid), 'foo\nbar')
+        self.assertEqual(self.storage.get_uids(), set([5]))
+        self.assertEqual(self.storage.get_uid(self.sid), 5)
+        self.storage.delete(self.sid)
+        self.assertEqual(self.storage.get_uid(self.sid), None)
+        self.assertEqual(self.storage.load(self.sid), None)
+
+    def test_cleanup(self):
+        """session - file storage cleanup of expired sessions"""
+        other_sid = 'f' * 32
+        self.storage.save(self.sid, 'foo', time.time() - 1, 5)
+        self.storage.save(other_sid, 'bar', time.time() + 60, 6)
+        self.assertEqual(self.storage.load(self.sid), None)
+        self.assertEqual(self.storage.get_uids(), set([6]))
+        self.assertEqual(self.storage.cleanup(), 1)
+        self.assertEqual(self.storage.load(other_sid), 'bar')
+        self.failIf(os.path.exists(os.path.join(self.directory, '01',
+            self.sid)))
+
+    def test_cleanup_keeps_temporary_files(self):
+        """session - file storage cleanup spares files being saved"""
+        os.makedirs(os.path.join(self.directory, '01'))
+        tmp_path = os.path.join(self.directory, '01', '.' + self.sid + 'tmp')
+        open(tmp_path, 'w').close()
+        os.utime(tmp_path, (time.time() - 1, time.time() - 1))
+        self.assertEqual(self.storage.cleanup(), 0)
+        self.failUnless(os.path.exists(tmp_path))
+        old = time.time() - self.storage.TMP_FILE_LIFETIME - 1
+        os.utime(tmp_path, (old, old))
+        self.assertEqual(self.storage.cleanup(), 1)
+        self.failIf(os.path.exists(tmp_path))
+
+    def test_get_uids_expiring_before(self):
+        """session - file storage uids of sessions expiring soon"""
+        self.storage.save(self.sid, 'foo', time.time() + 60, 5)
+        self.storage.save('f' * 32, 'bar', time.time() + 3600, 6)
+        self.assertEqual(self.storage.get_uids(time.time() + 600), set([5]))
+        self.assertEqual(self.storage.get_uids(), set([5, 6]))
+
+class DummyStorage(session.InvenioSessionStorage):
+    """Session storage in a dictionary, counting the writes."""
+
+    def __init__(self):
+        self.sessions = {}
+        self.writes = 0
+
+    def load(self, sid):
+        return self.sessions.get(sid)
+
+    def save(self, sid, session_object, session_expiry, uid):
+        self.sessions[sid] = session_object
+        self.writes += 1
+
+    def delete(self, sid):
+        self.sessions.pop(sid, None)
+
+class DummyRequest:
+    """Minimal request object for InvenioSession."""
+    remote_ip = '127.0.0.1'
+
+    def is_https(self):
+        return False
+
+    def register_cleanup(self, callback):
+        pass
+
+    def log_error(self, message):
+        pass
+
+class InvenioSessionSaveTest(unittest.TestCase):
+    """Test that sessions are only written when needed."""
+
+    def setUp(self):
+        self.storage = DummyStorage()
+        self.old_storage = session._SESSION_STORAGE
+        session._SESSION_STORAGE = self.storage
+        self.old_add_cookie = session.add_cookie
+        self.old_get_cookie = session.get_cookie
+        session.add_cookie = lambda req, cookie: None
+        session.get_cookie = lambda req, name: None
+
+    def tearDown(self):
+        session._SESSION_STORAGE = self.old_storage
+        session.add_cookie = self.old_add_cookie
+        session.get_cookie = self.old_get_cookie
+
+    def test_empty_guest_session_not_stored(self):
+        """session - empty guest sessions are not stored"""
+        guest_session = session.InvenioSession(DummyRequest())
+        guest_session['uid'] = 0
+        guest_session.save()
+        self.assertEqual(self.storage.writes, 0)
+
+    def test_unmodified_session_not_stored(self):
+        """session - unmodified sessions are not stored again"""
+        new_session = session.InvenioSession(DummyRequest())
+        new_session['uid'] = 5
+        new_session['user_info'] = {'uid': 5, 'group': []}
+        new_session.save()
+        self.assertEqual(self.storage.writes, 1)
+        ## The first save after loading also stores the IP bookkeeping.
+        session.InvenioSession(DummyRequest(), new_session.sid()).save()
+        writes = self.storage.writes
+        loaded_session = session.InvenioSession(DummyRequest(),
+            new_session.sid())
+        self.failIf(loaded_session.is_new())
+        loaded_session.save()
+        self.assertEqual(self.storage.writes, writes)
+        loaded_session['user_info']['group'].append('foo')
+        loaded_session.save()
+        self.assertEqual(self.storage.writes, writes + 1)
+
+TEST_SUITE = make_test_suite(FileSessionStorageTest, InvenioSessionSaveTest)
+
+if __name__ == "__main__":
+    run_test_suite(TEST_SUITE)
@@ -83,3 +83,9 @@ CFG_WEBSESSION_CLEANUP_CHANCE = 10000 #: cleanups have 1 in CLEANUP_CHANCE chanc
 ## could been handled at the same time. This is quite limited and, anyway
 ## there's already local locking available thanks to our MySQL backend.
 CFG_WEBSESSION_ENABLE_LOCKING = False
+
+## Unmodified sessions are not written back to the storage; however their
+## last access time is refreshed at most every
+## CFG_WEBSESSION_ACCESS_REFRESH_INTERVAL seconds so that sessions that
+## are being used do not expire.
+CFG_WEBSESSION_ACCESS_REFRESH_INTERVAL = 3600
@@ -81,6 +81,9 @@ from invenio.webstat_engine import get_keyevent_trend_collection_population, \
     update_error_log_analyzer, \
     get_apache_error_log_ranking
 
+# Imports handling key event rollups
+from invenio.webstat_engine import update_keyevent_rollup
+
 # Imports handling custom events
 from invenio.webstat_engine import get_customevent_table, \
     get_customevent_trend, \
@@ -143,6 +146,7 @@ KEYEVENT_REPOSITORY = {'collection population':
                                    'webstat_%(event_id)s_%(collection)s_%(timespan)s',
                             'ylabel': 'Number of records',
                             'multiple': None,
+                            'rollups': ['collection population'],
                             'output': 'Graph'},
                         'search frequency':
                           {'fullname': 'Search frequency',
@@ -153,6 +157,7 @@ KEYEVENT_REPOSITORY = {'collection population':
                                    'webstat_%(event_id)s_%(timespan)s',
                             'ylabel': 'Number of searches',
                             'multiple': None,
+                            'rollups': ['search frequency'],
                             'output': 'Graph'},
                         'search type distribution':
                           {'fullname': 'Search type distribution',
@@ -165,6 +170,7 @@ KEYEVENT_REPOSITORY = {'collection population':
                             'ylabel': 'Number of searches',
                             'multiple': ['Simple searches',
                                          'Advanced searches'],
+                            'rollups': ['simple searches', 'advanced searches'],
                             'output': 'Graph'},
                         'download frequency':
                           {'fullname': 'Download frequency',
@@ -175,6 +181,7 @@ KEYEVENT_REPOSITORY = {'collection population':
                             'cachefilename': 'webstat_%(event_id)s_%(collection)s_%(timespan)s',
                             'ylabel': 'Number of downloads',
                             'multiple': None,
+                            'rollups': ['download frequency'],
                             'output': 'Graph'},
                          'comments frequency':
                           {'fullname': 'Comments frequency',
@@ -185,6 +192,7 @@ KEYEVENT_REPOSITORY = {'collection population':
                             'cachefilename': 'webstat_%(event_id)s_%(collection)s_%(timespan)s',
                             'ylabel': 'Number of comments',
                             'multiple': None,
+                            'rollups': ['comments frequency'],
                             'output': 'Graph'},
                         'number of loans':
                           {'fullname': 'Number of loans',
@@ -195,6 +203,7 @@ KEYEVENT_REPOSITORY = {'collection population':
                                    'webstat_%(event_id)s_%(timespan)s',
                             'ylabel': 'Number of loans',
                             'multiple': None,
+                            'rollups': ['number of loans'],
                             'output': 'Graph'},
                         'web submissions':
                           {'fullname': 'Number of web submissions',
@@ -662,6 +671,11 @@ def cache_keyevent_trend(ids=[]):
             combos = [i + [y] for y in extra for i in combos]
         combos = [dict(extra) for extra in combos]
 
+        # Bring the pre-aggregated counters up to date first
+        for rollup in KEYEVENT_REPOSITORY[event_id].get('rollups', []):
+            for combo in combos:
+                update_keyevent_rollup(rollup, combo.get('collection', 'All'))
+
         for i in range(len(timespans)):
             # Get timespans parameters
             args['timespan'] = timespans[i][0]
@@ -32,6 +32,8 @@ from invenio.search_engine import perform_request_search, \
     get_most_popular_field_values
 from invenio.dbquery import run_sql, \
     wash_table_column_name
+from invenio.intbitset import intbitset
+from invenio.session import get_session_storage
 from invenio.websubmitadmin_dblayer import get_docid_docname_alldoctypes
 from invenio.bibcirculation_utils import book_title_from_MARC, \
     book_information_from_MARC
@@ -41,6 +43,78 @@ from invenio.bibcirculation_dblayer import get_id_bibrec, \
 WEBSTAT_SESSION_LENGTH = 48 * 60 * 60 # seconds
 WEBSTAT_GRAPH_TOKENS = '-=#+@$%&XOSKEHBC'
 
+# Key events for which hourly and daily counters are pre-aggregated in
+# staKEYEVENTROLLUP, as: rollup name -> (date column, FROM clause, extra
+# WHERE condition, record id column usable to restrict to a collection).
+# The SQL snippets are passed to run_sql() with parameters, hence '%%'.
+WEBSTAT_KEYEVENT_ROLLUPS = {
+    'collection population': ('creation_date', 'bibrec', '', 'id'),
+    'search frequency': ('date', 'query INNER JOIN user_query ON id=id_query',
+                         '', None),
+    'simple searches': ('date', 'query INNER JOIN user_query ON id=id_query',
+                        "urlargs LIKE '%%p=%%'", None),
+    'advanced searches': ('date',
+                          'query INNER JOIN user_query ON id=id_query',
+                          "urlargs LIKE '%%as=1%%'", None),
+    'download frequency': ('download_time', 'rnkDOWNLOADS', '', 'id_bibrec'),
+    'comments frequency': ('date_creation', 'cmtRECORDCOMMENT', '',
+                           'id_bibrec'),
+    'number of loans': ('loaned_on', 'crcLOAN', '', None),
+    }
+WEBSTAT_ROLLUP_IN_CHUNK_SIZE = 10000 # record ids per SQL IN clause
+WEBSTAT_ROLLUP_EPOCH = datetime.datetime(1970, 1, 1) # counters start here
+
+# KEY EVENT ROLLUP SECTION
+
+def update_keyevent_rollup(rollup, collection='All', rebuild=False):
+    """
+    Updates the hourly and daily counters of the given rollup (one of
+    WEBSTAT_KEYEVENT_ROLLUPS) up to the last complete hour.
+
+    The counters of the whole site ('All') are updated incrementally,
+    from the time of the previous update.  The counters restricted to a
+    collection are always rebuilt, since the records of a collection
+    change over time.
+
+    @param rollup: The rollup name
+    @type rollup: str
+
+    @param collection: A collection name, or 'All'
+    @type collection: str
+
+    @param rebuild: Whether to recompute all the counters
+    @type rebuild: bool
+    """
+    if WEBSTAT_KEYEVENT_ROLLUPS[rollup][3] is None:
+        collection = 'All'
+    until = datetime.datetime.now().replace(minute=0, second=0, microsecond=0)
+    since = None
+    if not rebuild and collection == 'All':
+        since = _get_keyevent_rollup_mark(rollup, collection)
+        if since is not None and since >= until:
+            return
+    if since is None:
+        run_sql("DELETE FROM staKEYEVENTROLLUP WHERE event=%s AND collection=%s",
+                (rollup, collection))
+        since = WEBSTAT_ROLLUP_EPOCH
+
+    # hourly counters, aggregated by the database
+    _store_keyevent_rollup_counts(rollup, collection, 'hour',
+        _get_keyevent_raw_counts(rollup, collection, since, until))
+
+    # daily counters, summed from the hourly ones (the first day may
+    # have been partially counted already)
+    first_day = datetime.datetime(since.year, since.month, since.day)
+    days = {}
+    for bucket, value in _get_keyevent_rollup_counts(rollup, collection,
+                                                     'hour', first_day, until):
+        day = datetime.datetime(bucket.year, bucket.month, bucket.day)
+        days[day] = days.get(day, 0) + value
+    _store_keyevent_rollup_counts(rollup, collection, 'day', days.items())
+
+    run_sql("REPLACE INTO staKEYEVENTROLLUPSTATUS (event, collection, last_updated) "
+            "VALUES (%s, %s, %s)", (rollup, collection, until))
+
 # KEY EVENT TREND SECTION
 
 def get_keyevent_trend_collection_population(args):
@@ -63,6 +137,11 @@ def get_keyevent_trend_collection_population(args):
     @param args['t_format']: Date and time formatting string
     @type args['t_format']: str
     """
+    trend = _get_trend_from_rollup('collection population', args,
+                                   cumulative=True)
+    if trend is not None:
+        return trend
+
     # collect action dates
     lower = _to_datetime(args['t_start'], args['t_format']).isoformat()
     upper = _to_datetime(args['t_end'], args['t_format']).isoformat()
@@ -110,6 +189,10 @@ def get_keyevent_trend_search_frequency(args):
     @param args['t_format']: Date and time formatting string
     @type args['t_format']: str
     """
+    trend = _get_trend_from_rollup('search frequency', args)
+    if trend is not None:
+        return trend
+
     # collect action dates
     lower = _to_datetime(args['t_start'], args['t_format']).isoformat()
     upper = _to_datetime(args['t_end'], args['t_format']).isoformat()
@@ -142,6 +225,10 @@ def get_keyevent_trend_comments_frequency(args):
     @param args['t_format']: Date and time formatting string
     @type args['t_format']: str
     """
+    trend = _get_trend_from_rollup('comments frequency', args)
+    if trend is not None:
+        return trend
+
     # collect action dates
     lower = _to_datetime(args['t_start'], args['t_format']).isoformat()
     upper = _to_datetime(args['t_end'], args['t_format']).isoformat()
@@ -182,6 +269,12 @@ def get_keyevent_trend_search_type_distribution(args):
     @param args['t_format']: Date and time formatting string
     @type args['t_format']: str
     """
+    s_trend = _get_trend_from_rollup('simple searches', args)
+    a_trend = _get_trend_from_rollup('advanced searches', args)
+    if s_trend is not None and a_trend is not None:
+        return [(s_trend[i][0], (s_trend[i][1], a_trend[i][1]))
+                for i in range(len(s_trend))]
+
     lower = _to_datetime(args['t_start'], args['t_format']).isoformat()
     upper = _to_datetime(args['t_end'], args['t_format']).isoformat()
 
@@ -228,6 +321,9 @@ def get_keyevent_trend_download_frequency(args):
     @param args['t_format']: Date and time formatting string
     @type args['t_format']: str
     """
+    trend = _get_trend_from_rollup('download frequency', args)
+    if trend is not None:
+        return trend
 
     lower = _to_datetime(args['t_start'], args['t_format']).isoformat()
     upper = _to_datetime(args['t_end'], args['t_format']).isoformat()
@@ -266,6 +362,10 @@ def get_keyevent_trend_number_of_loans(args):
     @param args['t_format']: Date and time formatting string
     @type args['t_format']: str
     """
+    trend = _get_trend_from_rollup('number of loans', args)
+    if trend is not None:
+        return trend
+
     # collect action dates
     lower = _to_datetime(args['t_start'], args['t_format']).isoformat()
     upper = _to_datetime(args['t_end'], args['t_format']).isoformat()
@@ -1286,23 +1386,14 @@ def get_keyevent_snapshot_sessions():
     @return: The current number of website visitors (guests, logged in)
     @type: (int, int)
     """
-    # SQL to retrieve sessions in the Guests
-    sql = "SELECT COUNT(session_expiry) " + \
-          "FROM session INNER JOIN user ON uid=id " + \
-          "WHERE email = '' AND " + \
-          "session_expiry-%d < unix_timestamp() AND " \
-          % WEBSTAT_SESSION_LENGTH + \
-          "unix_timestamp() < session_expiry"
-    guests = run_sql(sql)[0][0]
-
-    # SQL to retrieve sessions in the Logged in users
-    sql = "SELECT COUNT(session_expiry) " + \
-          "FROM session INNER JOIN user ON uid=id " + \
-          "WHERE email <> '' AND " + \
-          "session_expiry-%d < unix_timestamp() AND " \
-          % WEBSTAT_SESSION_LENGTH + \
-          "unix_timestamp() < session_expiry"
-    logged_ins = run_sql(sql)[0][0]
+    # Retrieve the owners of the recent sessions from the configured
+    # session storage, which is not necessarily the session table
+    uids = get_session_storage().get_uids(time.time() + WEBSTAT_SESSION_LENGTH)
+
+    # Logged in users are the ones with an email address, guests the others
+    registered = intbitset(run_sql("SELECT id FROM user WHERE email <> ''"))
+    logged_ins = len([uid for uid in uids if uid in registered])
+    guests = len(uids) - logged_ins
 
     # Assemble, according to return type
     return (guests, logged_ins)
@@ -2419,3 +2510,187 @@ def _get_tag_name(tag):
     if res:
         return res[0][0]
     return ''
+
+
+def _get_keyevent_rollup_mark(rollup, collection):
+    """
+    Returns the time until which the counters of the given rollup and
+    collection are up to date, or None if they were never computed.
+    """
+    res = run_sql("SELECT last_updated FROM staKEYEVENTROLLUPSTATUS "
+                  "WHERE event=%s AND collection=%s", (rollup, collection))
+    if res:
+        return res[0][0]
+    return None
+
+
+def _get_keyevent_rollup_counts(rollup, collection, granularity, lower, upper):
+    """
+    Returns the stored [(bucket start, count)] counters of the given
+    granularity ('hour' or 'day') whose bucket starts in [lower, upper).
+    """
+    if lower >= upper:
+        return []
+    return list(run_sql("SELECT bucket, value FROM staKEYEVENTROLLUP "
+                        "WHERE event=%s AND collection=%s AND granularity=%s "
+                        "AND bucket>=%s AND bucket<%s",
+                        (rollup, collection, granularity, lower, upper)))
+
+
+def _store_keyevent_rollup_counts(rollup, collection, granularity, counts):
+    """
+    Stores the given [(bucket start, count)] counters, replacing the
+    existing ones.
+    """
+    counts = list(counts)
+    for i in range(0, len(counts), 1000):
+        chunk = counts[i:i + 1000]
+        params = []
+        for bucket, value in chunk:
+            params.extend([rollup, collection, granularity, bucket, value])
+        run_sql("INSERT INTO staKEYEVENTROLLUP "
+                "(event, collection, granularity, bucket, value) VALUES " +
+                ", ".join(["(%s, %s, %s, %s, %s)"] * len(chunk)) +
+                " ON DUPLICATE KEY UPDATE value=VALUES(value)", tuple(params))
+
+
+def _get_keyevent_raw_counts(rollup, collection, lower, upper, recent=False):
+    """
+    Returns the [(hour, count)] number of actions of the given rollup
+    which happened in [lower, upper), computed from the raw data.
+
+    @param recent: If True, few actions are expected, so that they are
+                   restricted to the collection in Python rather than
+                   with SQL IN clauses.
+    @type recent: bool
+    """
+    date_column, from_clause, condition, recid_column = \
+        WEBSTAT_KEYEVENT_ROLLUPS[rollup]
+    where = date_column + ">=%s AND " + date_column + "<%s"
+    if condition:
+        where += " AND " + condition
+    hour = "DATE_FORMAT(" + date_column + ", '%%Y-%%m-%%d %%H:00:00')"
+
+    if collection == 'All':
+        return [(_to_datetime(bucket), count) for bucket, count in
+                run_sql("SELECT " + hour + ", COUNT(*) FROM " + from_clause +
+                        " WHERE " + where + " GROUP BY 1", (lower, upper))]
+
+    recids = get_collection_reclist(collection)
+    counts = {}
+    if recent:
+        for action_date, recid in run_sql("SELECT " + date_column + ", " +
+                                          recid_column + " FROM " +
+                                          from_clause + " WHERE " + where,
+                                          (lower, upper)):
+            if recid in recids:
+                bucket = action_date.replace(minute=0, second=0)
+                counts[bucket] = counts.get(bucket, 0) + 1
+    else:
+        recids = recids.tolist()
+        for i in range(0, len(recids), WEBSTAT_ROLLUP_IN_CHUNK_SIZE):
+            ids_str = ','.join([str(recid) for recid in
+                                recids[i:i + WEBSTAT_ROLLUP_IN_CHUNK_SIZE]])
+            for bucket, count in run_sql("SELECT " + hour + ", COUNT(*) FROM " +
+                                         from_clause + " WHERE " + where +
+                                         " AND " + recid_column + " IN (" +
+                                         ids_str + ") GROUP BY 1",
+                                         (lower, upper)):
+                bucket = _to_datetime(bucket)
+                counts[bucket] = counts.get(bucket, 0) + count
+    return counts.items()
+
+
+def _get_keyevent_counts(rollup, collection, lower, upper, mark, use_days):
+    """
+    Returns [(time, count)] counters covering the actions of the given
+    rollup in [lower, upper): the stored counters until MARK, the raw
+    data afterwards.  Daily counters are used only if USE_DAYS is True,
+    in which case LOWER must be at midnight.
+    """
+    counts = []
+    rolled_upper = min(upper, mark)
+    if lower < rolled_upper:
+        hours_from = lower
+        if use_days:
+            last_day = datetime.datetime(rolled_upper.year,
+                                         rolled_upper.month, rolled_upper.day)
+            if lower < last_day:
+                counts.extend(_get_keyevent_rollup_counts(rollup, collection,
+                                                          'day', lower,
+                                                          last_day))
+                hours_from = last_day
+        counts.extend(_get_keyevent_rollup_counts(rollup, collection, 'hour',
+                                                  hours_from, rolled_upper))
+    if upper > mark:
+        counts.extend(_get_keyevent_raw_counts(rollup, collection,
+                                               max(lower, mark), upper,
+                                               recent=True))
+    return counts
+
+
+def _get_trend_from_rollup(rollup, args, cumulative=False):
+    """
+    Same as _get_trend_from_actions(), for the actions counted by the
+    given rollup, but computed from the pre-aggregated counters.
+
+    @param rollup: The rollup name (see WEBSTAT_KEYEVENT_ROLLUPS)
+    @type rollup: str
+
+    @param args: The key event arguments (collection, t_start, t_end,
+                 granularity, t_format)
+    @type args: dict
+
+    @param cumulative: Whether to return the running total of actions
+    @type cumulative: bool
+
+    @return: A list of tuples zipping a time-domain and a value-domain,
+             or None if no counters are available for the given
+             arguments, in which case the raw data has to be used.
+    @type: [(str, int)]
+    """
+    collection = args.get('collection', 'All')
+    if WEBSTAT_KEYEVENT_ROLLUPS[rollup][3] is None:
+        collection = 'All'
+    granularity = args['granularity']
+    if granularity not in ('hour', 'day', 'month', 'year'):
+        return None
+    t_start = _to_datetime(args['t_start'], args['t_format'])
+    t_end = _to_datetime(args['t_end'], args['t_format'])
+    use_days = granularity != 'hour'
+    if t_start.minute or t_start.second or (use_days and t_start.hour):
+        return None
+    mark = _get_keyevent_rollup_mark(rollup, collection)
+    if mark is None:
+        return None
+
+    counts = _get_keyevent_counts(rollup, collection, t_start, t_end, mark,
+                                  use_days)
+    counts.sort()
+    value = 0
+    if cumulative:
+        for dummy, count in _get_keyevent_counts(rollup, collection,
+                                                 WEBSTAT_ROLLUP_EPOCH,
+                                                 t_start, mark, True):
+            value += count
+
+    dt_iter = _get_datetime_iter(args['t_start'], granularity,
+                                 args['t_format'])
+    stop_at = t_end - datetime.timedelta(seconds=1)
+    vector = []
+    index = 0
+    # pylint: disable=E1101
+    old = dt_iter.next()
+    # pylint: enable=E1101
+    for current in dt_iter:
+        if not cumulative:
+            value = 0
+        while index < len(counts) and counts[index][0] < current:
+            if counts[index][0] >= old:
+                value += counts[index][1]
+            index += 1
+        vector.append((old.strftime('%Y-%m-%d %H:%M:%S'), value))
+        old = current
+        if current > stop_at:
+            break
+    return vector
@@ -230,7 +230,7 @@ def task_run_core():
     if keyevents and len(keyevents) > 0:
         for i in range(len(keyevents)):
             write_message("Caching key event 1: %s" % keyevents[i])
-            webstat.cache_keyevent_trend(keyevents)
+            webstat.cache_keyevent_trend([keyevents[i]])
             task_update_progress("Part 1/2: done %d/%d" % (i + 1, len(keyevents)))
 
     # Cache custom events
@@ -48,6 +48,16 @@ from invenio.errorlib import register_exception, get_pretty_traceback
 ## turned on (it is done automatically by wsgi_handler_test).
 CFG_WSGI_SERVE_STATIC_FILES = False
 
+## Output written with req.write(..., flush=0) is kept in a list of chunks
+## and sent to the client as soon as at least CFG_WSGI_BUFFER_FLUSH_SIZE
+## bytes are pending, so that big responses are streamed with a bounded
+## memory usage.
+CFG_WSGI_BUFFER_FLUSH_SIZE = 65536
+
+## Block size used when streaming files that cannot be handed over to the
+## server wsgi.file_wrapper (e.g. byte ranges).
+CFG_WSGI_SENDFILE_BLOCK_SIZE = 65536
+
 class InputProcessed(object):
     """
     Auxiliary class used when reading input.
@@ -68,7 +78,9 @@ class SimulatedModPythonRequest(object):
         self.__environ = environ
         self.__start_response = start_response
         self.__response_sent_p = False
-        self.__buffer = ''
+        self.__buffer = []
+        self.__buffer_size = 0
+        self.__file_to_send = None
         self.__low_level_headers = []
         self.__headers = table(self.__low_level_headers)
         self.__headers.add = self.__headers.add_header
@@ -122,32 +134,66 @@ class SimulatedModPythonRequest(object):
         return self.__low_level_headers
 
     def get_buffer(self):
-        return self.__buffer
+        return ''.join(self.__buffer)
 
     def write(self, string, flush=1):
         if isinstance(string, unicode):
-            self.__buffer += string.encode('utf8')
-        else:
-            self.__buffer += string
-        if flush:
+            string = string.encode('utf8')
+        if string:
+            if self.__file_to_send is not None:
+                self.__send_pending_file()
+            self.__buffer.append(string)
+            self.__buffer_size += len(string)
+        if flush or self.__buffer_size >= CFG_WSGI_BUFFER_FLUSH_SIZE:
             self.flush()
 
+    def __send(self, data):
+        """
+        Send data to the client through the WSGI write callable.
+        """
+        self.__bytes_sent += len(data)
+        try:
+            if not self.__write_error:
+                self.__write(data)
+        except IOError, err:
+            if "failed to write data" in str(err) or "client connection closed" in str(err):
+                ## Let's just log this exception without alerting the admin:
+                register_exception(req=self)
+                self.__write_error = True ## This flag is there just
+                    ## to not report later other errors to the admin.
+            else:
+                raise
+
     def flush(self):
         self.send_http_header()
+        if self.__file_to_send is not None:
+            self.__send_pending_file()
         if self.__buffer:
-            self.__bytes_sent += len(self.__buffer)
-            try:
-                if not self.__write_error:
-                    self.__write(self.__buffer)
-            except IOError, err:
-                if "failed to write data" in str(err) or "client connection closed" in str(err):
-                    ## Let's just log this exception without alerting the admin:
-                    register_exception(req=self)
-                    self.__write_error = True ## This flag is there just
-                        ## to not report later other errors to the admin.
-                else:
-                    raise
-            self.__buffer = ''
+            data = ''.join(self.__buffer)
+            self.__buffer = []
+            self.__buffer_size = 0
+            self.__send(data)
+
+    def get_response_iterable(self):
+        """
+        Terminate the response handling, by returning whatever is still
+        pending (the buffered output or a file passed to L{sendfile}) as
+        an iterable to be returned to the WSGI server, instead of pushing
+        it through the write callable.
+        """
+        self.send_http_header()
+        if self.__file_to_send is not None:
+            if not self.__buffer:
+                file_wrapper, size = self.__file_to_send
+                self.__file_to_send = None
+                self.__bytes_sent += size
+                return file_wrapper
+            self.__send_pending_file()
+        ret = self.__buffer
+        self.__bytes_sent += self.__buffer_size
+        self.__buffer = []
+        self.__buffer_size = 0
+        return ret
 
     def set_content_type(self, content_type):
         self.__headers['content-type'] = content_type
@@ -202,12 +248,35 @@ class SimulatedModPythonRequest(object):
     def get_wsgi_status(self):
         return self.__status
 
+    def __send_pending_file(self):
+        """
+        Stream the file previously passed to L{sendfile}, whenever
+        something else has to be sent after it.
+        """
+        file_wrapper, dummy = self.__file_to_send
+        self.__file_to_send = None
+        try:
+            for chunk in file_wrapper:
+                self.__send(chunk)
+        finally:
+            file_wrapper.close()
+
     def sendfile(self, path, offset=0, the_len=-1):
         try:
-            self.send_http_header()
-            file_to_send = open(path)
+            self.flush()
+            file_to_send = open(path, 'rb')
+            if offset == 0 and the_len < 0 and \
+                    'wsgi.file_wrapper' in self.__environ:
+                ## Let the server send the file, possibly with its native
+                ## zero-copy facilities: the file wrapper is returned to the
+                ## server by get_response_iterable().
+                size = os.fstat(file_to_send.fileno()).st_size
+                self.__file_to_send = (self.__environ['wsgi.file_wrapper'](
+                    file_to_send, CFG_WSGI_SENDFILE_BLOCK_SIZE), size)
+                return self.__bytes_sent + size
             file_to_send.seek(offset)
-            file_wrapper = FileWrapper(file_to_send)
+            file_wrapper = FileWrapper(file_to_send,
+                CFG_WSGI_SENDFILE_BLOCK_SIZE)
             count = 0
             if the_len < 0:
                 for chunk in file_wrapper:
@@ -370,7 +439,7 @@ def application(environ, start_response):
                     ret = invenio_handler(req)
             else:
                 ret = invenio_handler(req)
-            req.flush()
+            return req.get_response_iterable()
         except SERVER_RETURN, status:
             status = int(str(status))
             if status not in (OK, DONE):
@@ -384,7 +453,7 @@ def application(environ, start_response):
                     start_response(req.get_wsgi_status(), req.get_low_level_headers(), sys.exc_info())
                 return generate_error_page(req, admin_to_be_alerted)
             else:
-                req.flush()
+                return req.get_response_iterable()
         except:
             register_exception(req=req, alert_admin=True)
             if not req.response_sent_p:
@@ -63,7 +63,7 @@ from invenio.websubmit_icon_creator import create_icon, InvenioWebSubmitIconCrea
 import invenio.template
 websubmit_templates = invenio.template.load('websubmit')
 from invenio.websearchadminlib import get_detailed_page_tabs
-from invenio.session import get_session
+from invenio.session import get_session, get_session_storage
 import invenio.template
 webstyle_templates = invenio.template.load('webstyle')
 websearch_templates = invenio.template.load('websearch')
@@ -611,9 +611,9 @@ class WebInterfaceSubmitPages(WebInterfaceDirectory):
                 return apache.HTTP_BAD_REQUEST
 
             # Retrieve user information. We cannot rely on the session here.
-            res = run_sql("SELECT uid FROM session WHERE session_key=%s", (argd['session_id'],))
-            if len(res):
-                uid = res[0][0]
+            session_uid = get_session_storage().get_uid(argd['session_id'])
+            if session_uid is not None:
+                uid = session_uid
                 user_info = collect_user_info(uid)
                 try:
                     act_fd = file(os.path.join(curdir, 'act'))